@@ -144,6 +144,7 @@ def use_gui():
 
 
 packages = ['PyMca5', 'PyMca5.PyMcaPlugins', 'PyMca5.tests',
+            'PyMca5.tests.benchmarks',
             'PyMca5.PyMca',
             'PyMca5.PyMcaCore',
             'PyMca5.PyMcaPhysics',
@@ -41,9 +41,16 @@
 import sys
 import glob
 import logging
+import collections
 
 logger = logging.getLogger(__name__)
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    logger.info("Cannot import ThreadPoolExecutor")
+    ThreadPoolExecutor = None
+
 
 PLUGINS_DIR = None
 try:
@@ -106,6 +113,14 @@ def __init__(self):
         # the sums.
         self._dynamicLimit = 5.0E6
         self._tryNumpy = True
+        # dynamically loaded stacks are read in blocks of about this size
+        # by this number of threads (None: number of cores)
+        self._dynamicBlockSize = 16 * 1024 ** 2
+        self._dynamicWorkers = None
+        # optional cumulative sum of the stack along the MCA axis
+        self._roiIndex = None
+        self._roiIndexEnabled = False
+        self._roiIndexFile = None
 
     def setPluginDirectoryList(self, dirlist):
         for directory in dirlist:
@@ -287,48 +302,19 @@ def stackUpdated(self, positioners=None):
                 logger.info("Unsupported index for max spectrum calculation")
         else:
             t0 = time.time()
-            shape = self._stack.data.shape
-            if self.mcaIndex in [2, -1]:
-                self._stackImageData = numpy.zeros((shape[0], shape[1]),
-                                                dtype=numpy.float64)
-                mcaData0 = numpy.zeros((shape[2],), numpy.float64)
-                if hasattr(numpy, "NINF"):
-                    mcaMax = mcaData0 + numpy.NINF
-                else:
-                    mcaMax = mcaData0 - numpy.inf
-                step = 1
-                for i in range(shape[0]):
-                    tmpData = self._stack.data[i:i+step,:,:]
-                    numpy.add(self._stackImageData[i:i+step,:],
-                              numpy.sum(tmpData, 2),
-                              self._stackImageData[i:i+step,:])
-                    tmpData.shape = step*shape[1], shape[2]
-                    tmpMax = numpy.nanmax(tmpData, axis=0)
-                    numpy.add(mcaData0, numpy.sum(tmpData, 0), mcaData0)
-                    mcaMax =numpy.max([mcaMax, tmpMax], axis=0)
-            elif self.mcaIndex == 0:
-                self._stackImageData = numpy.zeros((shape[1], shape[2]),
-                                                dtype=numpy.float64)
-                mcaData0 = numpy.zeros((shape[0],), numpy.float64)
-                if hasattr(numpy, "NINF"):
-                    mcaMax = mcaData0 + numpy.NINF
-                else:
-                    mcaMax = mcaData0 - numpy.inf
-                step = 1
-                for i in range(shape[0]):
-                    tmpData = self._stack.data[i:i+step,:,:]
-                    tmpData.shape = tmpData.shape[1:]
-                    numpy.add(self._stackImageData,
-                              tmpData,
-                              self._stackImageData)
-                    mcaData0[i] = tmpData.sum()
-                    mcaMax[i] = numpy.nanmax(tmpData)
-            else:
+            if self.mcaIndex not in [0, 1, 2, -1]:
                 raise ValueError("Unhandled case 1D index = %d" % self.mcaIndex)
+            self._stackImageData, mcaData0, mcaMax = \
+                        self._calculateDynamicStackSums(self._stack.data,
+                                                        self.mcaIndex)
             logger.debug("Print dynamic loading elapsed = %f", time.time() - t0)
 
         logger.debug("__stackImageData.shape = %s", self._stackImageData.shape)
 
+        self._roiIndex = None
+        if self._roiIndexEnabled:
+            self._buildROIIndex()
+
         if previousStackImageSize:
             if previousStackImageSize != self._stackImageData.size:
                 self._clearPositioners()
@@ -391,6 +377,79 @@ def stackUpdated(self, positioners=None):
         for key in self.pluginInstanceDict.keys():
             self.pluginInstanceDict[key].stackUpdated()
 
+    def _calculateDynamicStackSums(self, data, mcaIndex):
+        """
+        Sum image, sum spectrum and maximum spectrum of a 3D stack which is
+        not held in memory. The stack is read once in blocks along the
+        first dimension (aligned with the HDF5 chunks when available) and
+        the blocks are reduced by a pool of threads.
+
+        :returns tuple: image, spectrum, max spectrum
+        """
+        shape = data.shape
+        if mcaIndex < 0:
+            mcaIndex += 3
+        imageShape = tuple(n for i, n in enumerate(shape) if i != mcaIndex)
+        imageData = numpy.zeros(imageShape, dtype=numpy.float64)
+        mcaData = numpy.zeros((shape[mcaIndex],), numpy.float64)
+        mcaMax = numpy.full((shape[mcaIndex],), -numpy.inf)
+
+        # number of rows per block
+        itemsize = numpy.dtype(getattr(data, "dtype", numpy.float64)).itemsize
+        step = max(int(self._dynamicBlockSize //
+                       (shape[1] * shape[2] * itemsize)), 1)
+        chunks = getattr(data, "chunks", None)
+        if chunks:
+            step = max(step // chunks[0], 1) * chunks[0]
+        blocks = [(i, min(i + step, shape[0])) for i in range(0, shape[0], step)]
+
+        def reduce(i0, i1):
+            tmpData = data[i0:i1]
+            if mcaIndex == 0:
+                return (numpy.sum(tmpData, axis=0, dtype=numpy.float64),
+                        numpy.sum(tmpData, axis=(1, 2), dtype=numpy.float64),
+                        numpy.nanmax(tmpData, axis=(1, 2)))
+            else:
+                otherAxes = tuple(i for i in range(3) if i != mcaIndex)
+                return (numpy.sum(tmpData, axis=mcaIndex, dtype=numpy.float64),
+                        numpy.sum(tmpData, axis=otherAxes, dtype=numpy.float64),
+                        numpy.nanmax(tmpData, axis=otherAxes))
+
+        def collect(i0, i1, result):
+            # partial results are combined in block order so that the sums
+            # do not depend on the number of threads
+            image, spectrum, maxSpectrum = result
+            if mcaIndex == 0:
+                imageData[()] += image
+                mcaData[i0:i1] = spectrum
+                mcaMax[i0:i1] = maxSpectrum
+            else:
+                imageData[i0:i1] = image
+                mcaData[()] += spectrum
+                numpy.maximum(mcaMax, maxSpectrum, out=mcaMax)
+
+        nworkers = self._dynamicWorkers
+        if nworkers is None:
+            nworkers = os.cpu_count() or 1
+        nworkers = min(nworkers, len(blocks))
+        if nworkers < 2 or ThreadPoolExecutor is None:
+            for i0, i1 in blocks:
+                collect(i0, i1, reduce(i0, i1))
+        else:
+            logger.debug("Reduce %d blocks with %d threads",
+                         len(blocks), nworkers)
+            pending = collections.deque()
+            with ThreadPoolExecutor(max_workers=nworkers) as pool:
+                for i0, i1 in blocks:
+                    pending.append((i0, i1, pool.submit(reduce, i0, i1)))
+                    if len(pending) >= 2 * nworkers:
+                        i0, i1, future = pending.popleft()
+                        collect(i0, i1, future.result())
+                while pending:
+                    i0, i1, future = pending.popleft()
+                    collect(i0, i1, future.result())
+        return imageData, mcaData, mcaMax
+
     def getStackOriginalCurve(self):
         # TODO: Make sure copies are returned
         x = self._mcaData0.x[0]
@@ -521,6 +580,11 @@ def updateROIImages(self, ddict=None):
             imageNames[1] = "%s %s at Max." % (title, cursor)
             imageNames[2] = "%s %s at Min." % (title, cursor)
 
+        # images not calculated (ROI index)
+        imageNames = [name for name, image in zip(imageNames, imageList)
+                      if image is not None]
+        imageList = [image for image in imageList if image is not None]
+
         self.showROIImageList(imageList, image_names=imageNames)
 
     def showOriginalImage(self):
@@ -629,178 +693,22 @@ def calculateMcaDataObject(self, normalize=False, mask=None, mcamax=False):
             arrayMask = (actualSelectionMask > 0)
 
         logger.debug("Reached MCA calculation")
-        cleanMask = numpy.nonzero(arrayMask)
 
         logger.debug("self.fileIndex, self.mcaIndex = %d , %d",
                      self.fileIndex, self.mcaIndex)
         t0 = time.time()
-        if len(cleanMask[0]) and len(cleanMask[1]):
+        if arrayMask.any():
             logger.debug("USING MASK")
-            cleanMask = numpy.array(cleanMask).transpose()
-            if self.fileIndex == 2:
-                if self.mcaIndex == 0:
-                    if isinstance(self._stack.data, numpy.ndarray):
-                        logger.debug("In memory case 0")
-                        for r, c in cleanMask:
-                            tmpData = self._stack.data[:, r, c]
-                            mcaData += tmpData
-                            if mcamax:
-                                if mcaMax is None:
-                                    mcaMax = tmpData
-                                else:
-                                    mcaMax = numpy.max([mcaMax, tmpData], axis=0)
-                    else:
-                        logger.debug("Dynamic loading case 0")
-                        #no other choice than to read all images
-                        #for the time being, one by one
-                        rMin = cleanMask[0][0]
-                        rMax = cleanMask[-1][0]
-                        cMin = cleanMask[:, 1].min()
-                        cMax = cleanMask[:, 1].max()
-                        #rMin, cMin = cleanMask.min(axis=0)
-                        #rMax, cMax = cleanMask.max(axis=0)
-                        tmpMask = arrayMask[rMin:(rMax+1),cMin:(cMax+1)]
-                        tmpData = numpy.zeros((1, rMax-rMin+1,cMax-cMin+1))
-                        mcaMax = numpy.zeros((self._stack.data.shape[0],), dtype=numpy.float64)
-                        for i in range(self._stack.data.shape[0]):
-                            tmpData[0:1,:,:] = self._stack.data[i:i+1,rMin:(rMax+1),cMin:(cMax+1)]
-                            #multiplication is faster than selection
-                            mcaData[i] = (tmpData[0]*tmpMask).sum(dtype=numpy.float64)
-                            if mcamax:
-                                mcaMax[i] = numpy.max(tmpData[0][tmpMask])
-                elif self.mcaIndex == 1:
-                    if isinstance(self._stack.data, numpy.ndarray):
-                        for r, c in cleanMask:
-                            tmpData = self._stack.data[r,:,c]
-                            mcaData += tmpData
-                            if mcamax:
-                                if mcaMax is None:
-                                    mcaMax = tmpData
-                                else:
-                                    mcaMax = numpy.max([mcaMax, tmpData], axis=0)
-                    else:
-                        raise IndexError("Dynamic loading case 1")
-                else:
-                    raise IndexError("Wrong combination of indices. Case 0")
-            elif self.fileIndex == 1:
-                if self.mcaIndex == 0:
-                    if isinstance(self._stack.data, numpy.ndarray):
-                        logger.debug("In memory case 2")
-                        for r, c in cleanMask:
-                            tmpData = self._stack.data[:, r, c]
-                            mcaData += tmpData
-                            if mcamax:
-                                if mcaMax is None:
-                                    mcaMax = tmpData
-                                else:
-                                    mcaMax = numpy.max([mcaMax, tmpData], axis=0)
-                    else:
-                        logger.debug("Dynamic loading case 2")
-                        #no other choice than to read all images
-                        #for the time being, one by one
-                        if 1:
-                            rMin = cleanMask[0][0]
-                            rMax = cleanMask[-1][0]
-                            cMin = cleanMask[:, 1].min()
-                            cMax = cleanMask[:, 1].max()
-                            #rMin, cMin = cleanMask.min(axis=0)
-                            #rMax, cMax = cleanMask.max(axis=0)
-                            tmpMask = arrayMask[rMin:(rMax + 1), cMin:(cMax + 1)]
-                            tmpData = numpy.zeros((1, rMax - rMin + 1, cMax - cMin + 1))
-                            mcaMax = numpy.zeros((self._stack.data.shape[0],), dtype=numpy.float64)
-                            for i in range(self._stack.data.shape[0]):
-                                tmpData[0:1, :, :] = self._stack.data[i:i + 1, rMin:(rMax + 1), cMin:(cMax + 1)]
-                                # multiplication is faster than selection
-                                mcaData[i] = (tmpData[0] * tmpMask).sum(dtype=numpy.float64)
-                                # Multiplication does not work with negative data
-                                # because zero it's already a maximum
-                                if mcamax:
-                                    mcaMax[i] = numpy.max(tmpData[0][tmpMask])
-                        if 0:
-                            tmpData = numpy.zeros((1, self._stack.data.shape[1], self._stack.data.shape[2]))
-                            for i in range(self._stack.data.shape[0]):
-                                tmpData[0:1, :, :] = self._stack.data[i:i + 1,:,:]
-                                #multiplication is faster than selection
-                                #tmpData[arrayMask].sum() in my machine
-                                mcaData[i] = (tmpData[0] * arrayMask).sum(dtype=numpy.float64)
-                elif self.mcaIndex == 2:
-                    if isinstance(self._stack.data, numpy.ndarray):
-                        logger.debug("In memory case 3")
-                        for r, c in cleanMask:
-                            tmpData = self._stack.data[r, c, :]
-                            mcaData += tmpData
-                            if mcamax:
-                                if mcaMax is None:
-                                    mcaMax = tmpData
-                                else:
-                                    mcaMax = numpy.max([mcaMax, tmpData], axis=0) 
-                    else:
-                        logger.debug("Dynamic loading case 3")
-                        #try to minimize access to the file
-                        row_list = []
-                        row_dict = {}
-                        for r, c in cleanMask:
-                            if mcaMax is None:
-                                self._stack.data[r, c, :]
-                            if r not in row_list:
-                                row_list.append(r)
-                                row_dict[r] = []
-                            row_dict[r].append(c)
-                        for r in row_list:
-                            tmpMcaData = self._stack.data[r:r + 1, row_dict[r], :]
-                            tmpMcaData.shape = -1, mcaData.shape[0]
-                            mcaData += numpy.sum(tmpMcaData, axis=0, dtype=numpy.float64)
-                            if mcamax:
-                                mcaMax = numpy.max([mcaMax, numpy.max(tmpMcaData, axis=0)], axis=0)
-                else:
-                    raise IndexError("Wrong combination of indices. Case 1")
-            elif self.fileIndex == 0:
-                if self.mcaIndex == 1:
-                    if isinstance(self._stack.data, numpy.ndarray):
-                        logger.debug("In memory case 4")
-                        for r, c in cleanMask:
-                            tmpData = self._stack.data[r, :, c]
-                            mcaData += tmpData
-                            if mcamax:
-                                if mcaMax is None:
-                                    mcaMax = tmpData
-                                else:
-                                    mcaMax = numpy.max([mcaMax, tmpData], axis=0)
-                    else:
-                        raise IndexError("Dynamic loading case 4")
-                elif self.mcaIndex in [2, -1]:
-                    if isinstance(self._stack.data, numpy.ndarray):
-                        logger.debug("In memory case 5")
-                        for r, c in cleanMask:
-                            tmpData = self._stack.data[r, c, :]
-                            mcaData += tmpData
-                            if mcamax:
-                                if mcaMax is None:
-                                    mcaMax = tmpData
-                                else:
-                                    mcaMax = numpy.max([mcaMax, tmpData], axis=0) 
-                    else:
-                        logger.debug("Dynamic loading case 5")
-                        #try to minimize access to the file
-                        row_list = []
-                        row_dict = {}
-                        for r, c in cleanMask:
-                            if mcaMax is None:
-                                mcaMax = self._stack.data[r, c, :]
-                            if r not in row_list:
-                                row_list.append(r)
-                                row_dict[r] = []
-                            row_dict[r].append(c)
-                        for r in row_list:
-                            tmpMcaData = self._stack.data[r:r + 1, row_dict[r], :]
-                            tmpMcaData.shape = -1, mcaData.shape[0]
-                            mcaData += tmpMcaData.sum(axis=0, dtype=numpy.float64)
-                            if mcamax:
-                                mcaMax = numpy.max([mcaMax, numpy.max(tmpMcaData, axis=0)], axis=0)
-                else:
-                    raise IndexError("Wrong combination of indices. Case 2")
-            else:
+            if self.fileIndex not in [0, 1, 2]:
                 raise IndexError("File index undefined")
+            if (self.mcaIndex not in [0, 1, 2, -1]) or \
+               (self.mcaIndex % 3 == self.fileIndex):
+                raise IndexError("Wrong combination of indices %d, %d" %
+                                 (self.fileIndex, self.mcaIndex))
+            mcaData, mcaMax = self._calculateMaskedSums(self._stack.data,
+                                                        self.mcaIndex,
+                                                        arrayMask,
+                                                        mcamax=mcamax)
         else:
             logger.debug("NOT USING MASK !")
 
@@ -843,6 +751,152 @@ def calculateMcaDataObject(self, normalize=False, mask=None, mcamax=False):
 
         return dataObject
 
+    def _calculateMaskedSums(self, data, mcaIndex, arrayMask, mcamax=False):
+        """
+        Sum spectrum and maximum spectrum of the pixels selected by a mask.
+
+        The stack is processed in blocks of image rows restricted to the
+        columns of the selection. Blocks without selected pixels are not
+        read and the blocks are aligned with the HDF5 chunks when available.
+
+        :param data: 3D stack (ndarray or dynamically loaded)
+        :param int mcaIndex: MCA axis
+        :param arrayMask: boolean image
+        :param bool mcamax: calculate the maximum spectrum
+        :returns tuple: sum spectrum, max spectrum (None when not requested)
+        """
+        if mcaIndex < 0:
+            mcaIndex += 3
+        # data axes of the image rows and columns
+        rowAxis, colAxis = [i for i in range(3) if i != mcaIndex]
+        nChannels = data.shape[mcaIndex]
+        mcaData = numpy.zeros((nChannels,), dtype=numpy.float64)
+        mcaMax = None
+
+        selectedRows = numpy.nonzero(arrayMask.any(axis=1))[0]
+        selectedColumns = numpy.nonzero(arrayMask.any(axis=0))[0]
+        rMin, rMax = selectedRows[0], selectedRows[-1] + 1
+        cMin, cMax = selectedColumns[0], selectedColumns[-1] + 1
+
+        # number of image rows per block
+        itemsize = numpy.dtype(getattr(data, "dtype", numpy.float64)).itemsize
+        step = max(int(self._dynamicBlockSize //
+                       ((cMax - cMin) * nChannels * itemsize)), 1)
+        chunks = getattr(data, "chunks", None)
+        if chunks:
+            chunkRows = chunks[rowAxis]
+            step = max(step // chunkRows, 1) * chunkRows
+            rMin = (rMin // chunkRows) * chunkRows
+
+        idx = [slice(None)] * 3
+        idx[colAxis] = slice(cMin, cMax)
+        for r0 in range(rMin, rMax, step):
+            r1 = min(r0 + step, rMax)
+            blockMask = arrayMask[r0:r1, cMin:cMax]
+            if not blockMask.any():
+                continue
+            idx[rowAxis] = slice(r0, r1)
+            block = numpy.asarray(data[tuple(idx)])
+            # selected spectra: (nPixels, nChannels)
+            block = numpy.moveaxis(block, mcaIndex, -1)[blockMask]
+            mcaData += block.sum(axis=0, dtype=numpy.float64)
+            if mcamax:
+                blockMax = block.max(axis=0)
+                if mcaMax is None:
+                    mcaMax = blockMax
+                else:
+                    numpy.maximum(mcaMax, blockMax, out=mcaMax)
+        return mcaData, mcaMax
+
+    def setROIIndexEnabled(self, flag=True, filename=None):
+        """
+        Enable or disable the cumulative sum index along the MCA axis.
+
+        With the index the ROI, background, left, middle and right images
+        are obtained from two image lookups instead of reading the whole
+        channel range of the stack. The Maximum and Minimum images are not
+        calculated when the index is used. See `getROIIndexSize` for the
+        memory required.
+
+        :param bool flag: True to enable the index
+        :param str filename: store the index in a memory mapped .npy file
+                             instead of RAM
+        """
+        self._roiIndexEnabled = bool(flag)
+        self._roiIndexFile = filename
+        self._roiIndex = None
+        if self._roiIndexEnabled and self._stackImageData is not None:
+            self._buildROIIndex()
+
+    def isROIIndexEnabled(self):
+        return self._roiIndexEnabled
+
+    def getROIIndexSize(self):
+        """
+        Returns the number of bytes (RAM or file) needed by the ROI index
+        of the current stack
+        """
+        if self._stackImageData is None:
+            return 0
+        nChannels = self._stack.data.shape[self.mcaIndex]
+        return (nChannels + 1) * self._stackImageData.size * \
+               numpy.dtype(numpy.float64).itemsize
+
+    def _buildROIIndex(self):
+        """
+        Cumulative sum of the spectra with shape (nChannels + 1,) + image
+        shape so that index[i2] - index[i1] is the sum of channels [i1, i2)
+        """
+        t0 = time.time()
+        data = self._stack.data
+        nChannels = data.shape[self.mcaIndex]
+        shape = (nChannels + 1,) + self._stackImageData.shape
+        if self._roiIndexFile:
+            index = numpy.lib.format.open_memmap(self._roiIndexFile,
+                                                 mode="w+",
+                                                 dtype=numpy.float64,
+                                                 shape=shape)
+        else:
+            index = numpy.empty(shape, dtype=numpy.float64)
+        index[0] = 0
+        if self.mcaIndex == 0:
+            for i in range(nChannels):
+                numpy.add(index[i], data[i], index[i + 1])
+        else:
+            # iterate over the first image dimension
+            mcaAxis = self.mcaIndex - 1
+            if mcaAxis < 0:
+                mcaAxis += len(data.shape) - 1
+            for i in range(data.shape[0]):
+                tmpData = numpy.cumsum(data[i], axis=mcaAxis,
+                                       dtype=numpy.float64)
+                if mcaAxis:
+                    tmpData = tmpData.T
+                index[1:, i] = tmpData
+        if self._roiIndexFile:
+            index.flush()
+        self._roiIndex = index
+        logger.info("ROI index of %.1f MB built in %.2f s (%s)",
+                    index.nbytes / 1024. ** 2, time.time() - t0,
+                    self._roiIndexFile or "RAM")
+
+    def _calculateROIImagesFromIndex(self, i1, i2, imiddle):
+        index = self._roiIndex
+        first = index[i1]
+        last = index[i2]
+        roiImage = last - first
+        leftImage = index[i1 + 1] - first
+        middleImage = index[imiddle + 1] - index[imiddle]
+        rightImage = last - index[i2 - 1]
+        background = 0.5 * (i2 - i1) * (leftImage + rightImage)
+        return {'ROI': roiImage,
+                'Maximum': None,
+                'Minimum': None,
+                'Left': leftImage,
+                'Middle': middleImage,
+                'Right': rightImage,
+                'Background': background}
+
     def calculateROIImages(self, index1, index2, imiddle=None, energy=None):
         logger.debug("Calculating ROI images")
         i1 = min(index1, index2)
@@ -863,6 +917,14 @@ def calculateROIImages(self, index1, index2, imiddle=None, energy=None):
                       'Background': dummy}
             return imageDict
 
+        if self._roiIndex is not None:
+            t0 = time.time()
+            imageDict = self._calculateROIImagesFromIndex(i1, i2, imiddle)
+            self.__ROIImageCalculationIsUsingSuppliedEnergyAxis = False
+            logger.debug("ROI images from index elapsed = %f",
+                         time.time() - t0)
+            return imageDict
+
         isUsingSuppliedEnergyAxis = False
         if self.fileIndex == 0:
             if self.mcaIndex == 1:
@@ -69,14 +69,17 @@ def __init__(
             "Expectation Max.",
             "Cov. Multiple Arrays",
             "Corr. Multiple Arrays",
+            "Randomized SVD",
         ]
         self._multipleIndex = [3, 4]
+        self._randomizedIndex = [5]
         self.functions = [
             PCAModule.numpyCovariancePCA,
             PCAModule.numpyCorrelationPCA,
             PCAModule.expectationMaximizationPCA,
             PCAModule.multipleArrayCovariancePCA,
             PCAModule.multipleArrayCorrelationPCA,
+            PCAModule.randomizedPCA,
         ]
         self.methodOptions.mainLayout = qt.QGridLayout(self.methodOptions)
         self.methodOptions.mainLayout.setContentsMargins(0, 0, 0, 0)
@@ -139,6 +142,25 @@ def __init__(
         self.speedOptions.mainLayout.addWidget(self.binningLabel, 1, 0)
         self.speedOptions.mainLayout.addWidget(self.binningCombo, 1, 1)
         self.binningCombo.activated[int].connect(self._updatePlotFromBinningCombo)
+
+        # randomized SVD options
+        self.oversamplingLabel = qt.QLabel(self.speedOptions)
+        self.oversamplingLabel.setText("Oversampling:")
+        self.oversampling = qt.QSpinBox(self.speedOptions)
+        self.oversampling.setMinimum(0)
+        self.oversampling.setValue(10)
+        self.oversampling.setMaximum(100)
+        self.iterationsLabel = qt.QLabel(self.speedOptions)
+        self.iterationsLabel.setText("Power Iterations:")
+        self.iterations = qt.QSpinBox(self.speedOptions)
+        self.iterations.setMinimum(0)
+        self.iterations.setValue(2)
+        self.iterations.setMaximum(20)
+        self.speedOptions.mainLayout.addWidget(self.oversamplingLabel, 2, 0)
+        self.speedOptions.mainLayout.addWidget(self.oversampling, 2, 1)
+        self.speedOptions.mainLayout.addWidget(self.iterationsLabel, 3, 0)
+        self.speedOptions.mainLayout.addWidget(self.iterations, 3, 1)
+        self._updateRandomizedOptions(1)
         if regions:
             self.__regions = True
             self.__addRegionsWidget()
@@ -227,8 +249,15 @@ def _slot(self, index):
             else:
                 self.regionsWidget.setEnabled(False)
                 self.graph.setEnabled(False)
+        self._updateRandomizedOptions(index)
         return
 
+    def _updateRandomizedOptions(self, index):
+        enabled = index in self._randomizedIndex
+        for widget in [self.oversamplingLabel, self.oversampling,
+                       self.iterationsLabel, self.iterations]:
+            widget.setEnabled(enabled)
+
     def setSpectrum(self, x, y, legend=None, info=None):
         if self.graph is None:
             self.__addRegionsWidget()
@@ -294,6 +323,11 @@ def setParameters(self, ddict):
                 self.binningCombo.setEnabled(True)
             else:
                 self.binningCombo.setEnabled(False)
+            self._updateRandomizedOptions(ddict["method"])
+        if "oversampling" in ddict:
+            self.oversampling.setValue(ddict["oversampling"])
+        if "iterations" in ddict:
+            self.iterations.setValue(ddict["iterations"])
         if "regions" in ddict:
             self.regionsWidget.setRegions(regions)
         return
@@ -306,6 +340,9 @@ def getParameters(self):
         ddict["method"] = i
         ddict["methodlabel"] = self.methods[i]
         ddict["function"] = self.functions[i]
+        if i in self._randomizedIndex:
+            ddict["oversampling"] = self.oversampling.value()
+            ddict["iterations"] = self.iterations.value()
         mask = None
         if self.__regions:
             regions = self.regionsWidget.getRegions()
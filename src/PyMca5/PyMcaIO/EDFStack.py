@@ -32,6 +32,7 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 from PyMca5.PyMcaCore import DataObject
 from PyMca5.PyMcaIO import EdfFile
+from PyMca5.PyMcaIO import PrefetchLoader
 from PyMca5.PyMcaCore import EdfFileDataSource
 from PyMca5.PyMcaMisc import PhysicalMemory
 import numpy
@@ -57,16 +58,119 @@
 Y_AXIS=1
 Z_AXIS=2
 
+
+class VirtualStack(object):
+    """
+    Read-only 3D array-like view of a set of 2D images stored in different
+    files, the images being stacked along the given axis.
+
+    The images are memory mapped when accessed, so building the stack does
+    not read any data. Indexing supports integers, slices and the ellipsis
+    plus sequences of integers along the stacked axis. As for an HDF5
+    dataset, the result of an indexing operation is a numpy array in memory.
+    """
+    def __init__(self, frames, frameShape, frameDtype, axis=0, dtype=None):
+        """
+        :param frames: List of (filename, offset) tuples
+        :param frameShape: Shape of the 2D images
+        :param frameDtype: Data type of the images in the files
+        :param axis: Axis along which the images are stacked
+        :param dtype: Data type of the returned arrays (default frameDtype)
+        """
+        self._frames = list(frames)
+        self._frameShape = tuple(frameShape)
+        self._frameDtype = numpy.dtype(frameDtype)
+        self._axis = axis
+        if dtype is None:
+            dtype = frameDtype
+        self.dtype = numpy.dtype(dtype)
+        shape = list(self._frameShape)
+        shape.insert(axis, len(self._frames))
+        self.shape = tuple(shape)
+        self.ndim = len(shape)
+        self.size = int(numpy.prod(shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[()]
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+    def getFrame(self, index):
+        """
+        Return a read-only numpy.memmap of the given image
+        """
+        filename, offset = self._frames[index]
+        return numpy.memmap(filename, dtype=self._frameDtype, mode="r",
+                            offset=offset, shape=self._frameShape)
+
+    def _normalizeKey(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key:
+            i = key.index(Ellipsis)
+            key = key[:i] + \
+                  (slice(None),) * (self.ndim - len(key) + 1) + \
+                  key[i + 1:]
+        if len(key) > self.ndim:
+            raise IndexError("Too many indices for a %dD stack" % self.ndim)
+        return key + (slice(None),) * (self.ndim - len(key))
+
+    def __getitem__(self, key):
+        key = self._normalizeKey(key)
+        axis = self._axis
+        frameIndex = key[axis]
+        frameKey = key[:axis] + key[axis + 1:]
+        if isinstance(frameIndex, (int, numpy.integer)):
+            return numpy.array(self.getFrame(frameIndex)[frameKey],
+                               dtype=self.dtype)
+        indices = numpy.arange(len(self._frames))[frameIndex]
+        # shape of the selection within one image without reading it
+        dummy = numpy.lib.stride_tricks.as_strided(numpy.zeros(1),
+                                                   shape=self._frameShape,
+                                                   strides=(0, 0))
+        frameShape = dummy[frameKey].shape
+        # position of the stacked axis in the output
+        position = len([k for k in key[:axis] \
+                        if not isinstance(k, (int, numpy.integer))])
+        shape = frameShape[:position] + (len(indices),) + \
+                frameShape[position:]
+        data = numpy.empty(shape, dtype=self.dtype)
+        for i, index in enumerate(indices):
+            data[(slice(None),) * position + (i,)] = \
+                                        self.getFrame(index)[frameKey]
+        return data
+
+
 class EDFStack(DataObject.DataObject):
-    def __init__(self, filelist = None, imagestack=None, dtype=None):
+    def __init__(self, filelist = None, imagestack=None, dtype=None,
+                 virtual=None, nworkers=None):
+        """
+        :param filelist: List of EDF files or first file of an indexed stack
+        :param imagestack: True to stack the images along the first axis
+        :param dtype: Data type of the stack (default is the file one)
+        :param virtual: If True, uncompressed EDF files with the native
+                        byte order are not read but memory mapped through
+                        a VirtualStack. If None (default) this is only done
+                        when the stack does not fit in physical memory.
+        :param nworkers: Number of threads reading the files. If None
+                         (default) PrefetchLoader.DEFAULT_WORKERS are used.
+                         Use 1 to read the files sequentially.
+        """
         DataObject.DataObject.__init__(self)
         self.incrProgressBar=0
+        self.__nworkers = nworkers
+        self.__loader = None
         self.__keyList = []
         if imagestack is None:
             self.__imageStack = False
         else:
             self.__imageStack = imagestack
         self.__dtype = dtype
+        self.__virtual = virtual
         if filelist is not None:
             if type(filelist) != type([]):
                 filelist = [filelist]
@@ -83,6 +187,8 @@ def loadFileList(self, filelist, fileindex=0):
         self.sourceType = SOURCE_TYPE
         self.info = {}
         self.nbFiles=len(filelist)
+        self.__loader = PrefetchLoader.PrefetchLoader(self._readFirstImage,
+                                                nworkers=self.__nworkers)
         fileSampling = 1
         mcaSampling = 1
 
@@ -112,6 +218,18 @@ def loadFileList(self, filelist, fileindex=0):
         if self.__dtype is None:
             self.__dtype = arrRet.dtype
 
+        if (nImages == 1) and (len(arrRet.shape) == 2) and \
+           ("_sample_" not in filelist[0]):
+            virtual = self.__virtual
+            if virtual is None:
+                needed_ = self.nbFiles * arrRet.size * \
+                          numpy.dtype(self.__dtype).itemsize
+                physicalMemory = PhysicalMemory.getPhysicalMemoryOrNone()
+                virtual = (physicalMemory is not None) and \
+                          (physicalMemory < (1.05 * needed_))
+            if virtual and self._loadVirtualFileList(filelist, fileindex):
+                return
+
         self.onBegin(self.nbFiles)
         singleImageShape = arrRet.shape
         actualImageStack = False
@@ -178,10 +296,8 @@ def loadFileList(self, filelist, fileindex=0):
                                                      arrRet.shape[1]),
                                                      self.__dtype)
                             self.incrProgressBar=0
-                            for tempEdfFileName in filelist:
-                                tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
-                                pieceOfStack=tempEdf.GetData(0)
-                                self.data[self.incrProgressBar] = pieceOfStack
+                            for idx, pieceOfStack in self._readImages(filelist):
+                                self.data[idx] = pieceOfStack
                                 self.incrProgressBar += 1
                                 self.onProgress(self.incrProgressBar)
                             actualImageStack = True
@@ -191,10 +307,8 @@ def loadFileList(self, filelist, fileindex=0):
                                                      self.nbFiles),
                                                      self.__dtype)
                             self.incrProgressBar=0
-                            for tempEdfFileName in filelist:
-                                tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
-                                pieceOfStack=tempEdf.GetData(0)
-                                self.data[:,:, self.incrProgressBar] = pieceOfStack
+                            for idx, pieceOfStack in self._readImages(filelist):
+                                self.data[:,:, idx] = pieceOfStack
                                 self.incrProgressBar += 1
                                 self.onProgress(self.incrProgressBar)
                     except (MemoryError, ValueError):
@@ -430,10 +544,8 @@ def loadFileList(self, filelist, fileindex=0):
                     self.nbFiles = len(filelist)
                     self.incrProgressBar=0
                     if fileindex == 1:
-                        for tempEdfFileName in filelist:
-                            tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
-                            pieceOfStack=tempEdf.GetData(0)
-                            self.data[:,self.incrProgressBar,:] = pieceOfStack[:,:]
+                        for idx, pieceOfStack in self._readImages(filelist):
+                            self.data[:, idx, :] = pieceOfStack[:,:]
                             self.incrProgressBar += 1
                             self.onProgress(self.incrProgressBar * fileSampling)
                     else:
@@ -448,7 +560,6 @@ def loadFileList(self, filelist, fileindex=0):
                             i0StartFile = filelist[0].replace("_sample_", "_I0start_")
                             if os.path.exists(i0StartFile):
                                 ID24 = True
-                                id24idx = 0
                                 i0Start = EdfFile.EdfFile(i0StartFile, 'rb').GetData(0).astype(numpy.float64)
                                 i0Start -= bckData
                                 i0EndFile = filelist[0].replace("_sample_", "_I0end_")
@@ -464,24 +575,20 @@ def loadFileList(self, filelist, fileindex=0):
                                     motorName = positionersEdf.GetHeader(i).get("Title", "Motor_%02d" % i)
                                     motorValue = positionersEdf.GetData(i)
                                     self.info["positioners"][motorName] = motorValue
-                        for tempEdfFileName in filelist:
-                            tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
+                        for idx, pieceOfStack in self._readImages(filelist):
                             if ID24:
-                                pieceOfStack=-numpy.log((tempEdf.GetData(0) - bckData)/(i0Start[0,:] + id24idx * i0Slope))
+                                pieceOfStack=-numpy.log((pieceOfStack - bckData)/(i0Start[0,:] + idx * i0Slope))
                                 pieceOfStack[numpy.isfinite(pieceOfStack) == False] = 1
-                                id24idx += 1
-                            else:
-                                pieceOfStack=tempEdf.GetData(0)
                             try:
-                                self.data[self.incrProgressBar, :,:] = pieceOfStack[::mcaSampling,:]
+                                self.data[idx, :,:] = pieceOfStack[::mcaSampling,:]
                             except Exception:
                                 if pieceOfStack.shape[1] != arrRet.shape[1]:
-                                    _logger.warning(" ERROR on file %s", tempEdfFileName)
+                                    _logger.warning(" ERROR on file %s", filelist[idx])
                                     _logger.warning(" DIM 1 error Assuming missing data were at the end!!!")
                                 if pieceOfStack.shape[0] != arrRet.shape[0]:
-                                    _logger.warning(" ERROR on file %s", tempEdfFileName)
+                                    _logger.warning(" ERROR on file %s", filelist[idx])
                                     _logger.warning(" DIM 0 error Assuming missing data were at the end!!!")
-                                self.data[self.incrProgressBar,
+                                self.data[idx,
                                           :pieceOfStack.shape[0],
                                           :pieceOfStack.shape[1]] = pieceOfStack[:, :]
                             self.incrProgressBar += 1
@@ -542,6 +649,90 @@ def loadFileList(self, filelist, fileindex=0):
                 self.info["xScale"] = (originX, deltaX)
                 self.info["yScale"] = (originY, deltaY)
 
+    def _loadVirtualFileList(self, filelist, fileindex=0):
+        """
+        Build a VirtualStack over the files. It returns False, without
+        modifying the stack, if any file cannot be memory mapped or if the
+        images do not share the same shape and data type.
+        """
+        frames = []
+        frameShape = None
+        frameDtype = None
+        self.onBegin(self.nbFiles)
+        try:
+            for i, fname in enumerate(filelist):
+                edf = EdfFile.EdfFile(fname, 'rb')
+                if (edf.GetNumImages() != 1) or (not edf.IsMemMappable(0)):
+                    _logger.info("Cannot memory map %s", fname)
+                    return False
+                image = edf.Images[0]
+                if image.NumDim != 2:
+                    return False
+                shape = (image.Dim2, image.Dim1)
+                dtype = numpy.dtype(edf.GetDefaultNumpyType(image.DataType,
+                                                            index=0))
+                if frameShape is None:
+                    frameShape = shape
+                    frameDtype = dtype
+                elif (shape != frameShape) or (dtype != frameDtype):
+                    _logger.info("Inconsistent image in %s", fname)
+                    return False
+                frames.append((fname, image.DataPosition))
+                self.onProgress(i + 1)
+        finally:
+            self.onEnd()
+
+        if (fileindex == 2) or self.__imageStack:
+            self.__imageStack = True
+            axis = 0
+        elif fileindex == 1:
+            axis = 1
+        else:
+            axis = 0
+        self.data = VirtualStack(frames, frameShape, frameDtype,
+                                 axis=axis, dtype=self.__dtype)
+        self.incrProgressBar = len(frames)
+        self.__nFiles = len(frames)
+        self.__nImagesPerFile = 1
+        shape = self.data.shape
+        for i in range(len(shape)):
+            key = 'Dim_%d' % (i+1,)
+            self.info[key] = shape[i]
+        self.info["SourceType"] = SOURCE_TYPE
+        if self.__imageStack:
+            self.info["McaIndex"] = 0
+            self.info["FileIndex"] = 1
+        else:
+            self.info["FileIndex"] = fileindex
+        self.info["SourceName"] = self.sourceName
+        self.info["NumberOfFiles"] = self.__nFiles * 1
+        self.info["Size"] = self.__nFiles * self.__nImagesPerFile
+        return True
+
+    @staticmethod
+    def _readFirstImage(filename):
+        return EdfFile.EdfFile(filename, 'rb').GetData(0)
+
+    def _readImages(self, filelist):
+        """
+        Generator of (file index, first image of the file) tuples. The files
+        are read in parallel and the images come in completion order.
+        """
+        try:
+            for idx, data in self.__loader(filelist):
+                yield idx, data
+        except PrefetchLoader.LoadCancelled:
+            self.onEnd()
+            raise
+
+    def cancel(self):
+        """
+        Stop loading the stack. It can be called from the progress callbacks
+        or from another thread. The loading raises PrefetchLoader.LoadCancelled.
+        """
+        if self.__loader is not None:
+            self.__loader.cancel()
+
     def onBegin(self, n):
         pass
 
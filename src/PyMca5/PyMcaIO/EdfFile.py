@@ -39,7 +39,8 @@
     class EdfFile:
         __init__(self,FileName)
         GetNumImages(self)
-        def GetData(self,Index, DataType="",Pos=None,Size=None):
+        def GetData(self,Index, DataType="",Pos=None,Size=None,MemMap=False):
+        IsMemMappable(self,Index)
         GetPixel(self,Index,Position)
         GetHeader(self,Index)
         GetStaticHeader(self,Index)
@@ -587,7 +588,33 @@ def GetData(self, *var, **kw):
         finally:
             self.__makeSureFileIsClosed()
 
-    def _GetData(self, Index, DataType="", Pos=None, Size=None):
+    def IsMemMappable(self, Index):
+        """ Returns True if the data of the image can be accessed through a
+            read-only numpy.memmap, that is, if it is an uncompressed EDF
+            image stored with the native byte order.
+            Index:          The zero-based index of the image in the file
+        """
+        if Index < 0 or Index >= self.NumImages:
+            return False
+        if self.ADSC or self.MARCCD or self.TIFF or self.PILATUS_CBF or \
+           self.SPE:
+            return False
+        if not self.__ownedOpen:
+            # compressed file or file object supplied by the caller
+            return False
+        image = self.Images[Index]
+        if self.SysByteOrder.upper() != image.ByteOrder.upper():
+            return False
+        datatype = self.__GetDefaultNumpyType__(image.DataType, index=Index)
+        nbytes = numpy.dtype(datatype).itemsize * \
+                 int(numpy.prod(self.__GetImageShape(Index)))
+        try:
+            fileSize = os.path.getsize(self.FileName)
+        except OSError:
+            return False
+        return (image.DataPosition + nbytes) <= fileSize
+
+    def _GetData(self, Index, DataType="", Pos=None, Size=None, MemMap=False):
         """ Returns numpy array with image data
             Index:          The zero-based index of the image in the file
             DataType:       The edf type of the array to be returnd
@@ -614,12 +641,21 @@ def _GetData(self, Index, DataType="", Pos=None, Size=None):
                             (0,0) or (0,0,0)
             Size:           Tuple, size of the data to be returned as x) or (x,y) or
                             (x,y,z) if ommited, is the distance from Pos to the end.
+            MemMap:         If True and the image can be memory mapped (see
+                            IsMemMappable), a read-only numpy.memmap view of the
+                            data (or of the requested region) is returned instead
+                            of a copy. Otherwise the data are read as usual.
 
             If Pos and Size not mentioned, returns the whole data.
         """
         fastedf = self.fastedf
         if Index < 0 or Index >= self.NumImages:
             raise ValueError("EdfFile: Index out of limit")
+        if MemMap and self.IsMemMappable(Index):
+            Data = self.__GetMemMap(Index, Pos, Size)
+            if DataType != "":
+                Data = self.__SetDataType__(Data, DataType)
+            return Data
         if fastedf is None:fastedf = 0
         if Pos is None and Size is None:
             if self.ADSC or self.MARCCD or self.PILATUS_CBF or self.SPE:
@@ -636,29 +672,17 @@ def _GetData(self, Index, DataType="", Pos=None, Size=None):
                     _logger.debug("What is the meaning of this error?")
                     datasize = 8
                 if self.Images[Index].NumDim == 3:
-                    sizeToRead = self.Images[Index].Dim1 * \
-                                 self.Images[Index].Dim2 * \
-                                 self.Images[Index].Dim3 * datasize
-                    Data = numpy.array(numpy.frombuffer(self.File.read(sizeToRead),
-                                                        datatype))
-                    Data = numpy.reshape(Data, (self.Images[Index].Dim3, self.Images[Index].Dim2, self.Images[Index].Dim1))
+                    Data = self.__ReadArray((self.Images[Index].Dim3,
+                                             self.Images[Index].Dim2,
+                                             self.Images[Index].Dim1),
+                                            datatype)
                 elif self.Images[Index].NumDim == 2:
-                    sizeToRead = self.Images[Index].Dim1 * \
-                                 self.Images[Index].Dim2 * datasize
-                    Data = numpy.array(numpy.frombuffer(self.File.read(sizeToRead),
-                                                        datatype))
-                    #print "datatype = ",datatype
-                    #print "Data.type = ", Data.dtype.char
-                    #print "self.Images[Index].DataType ", self.Images[Index].DataType
-                    #print "Data.shape",Data.shape
-                    #print "datasize = ",datasize
-                    #print "sizeToRead ",sizeToRead
-                    #print "lenData = ", len(Data)
-                    Data = numpy.reshape(Data, (self.Images[Index].Dim2, self.Images[Index].Dim1))
+                    Data = self.__ReadArray((self.Images[Index].Dim2,
+                                             self.Images[Index].Dim1),
+                                            datatype)
                 elif self.Images[Index].NumDim == 1:
-                    sizeToRead = self.Images[Index].Dim1 * datasize
-                    Data = numpy.array(numpy.frombuffer(self.File.read(sizeToRead),
-                                                        datatype))
+                    Data = self.__ReadArray((self.Images[Index].Dim1,),
+                                            datatype, partial=True)
         elif self.ADSC or self.MARCCD or self.PILATUS_CBF or self.SPE:
             return self.__data[Pos[1]:(Pos[1] + Size[1]),
                                Pos[0]:(Pos[0] + Size[0])]
@@ -677,7 +701,7 @@ def _GetData(self, Index, DataType="", Pos=None, Size=None):
                 Size = list(Size)
                 if Size[0] == 0:Size[0] = sizex - Pos[0]
                 self.File.seek((Pos[0] * size_pixel) + self.Images[Index].DataPosition, 0)
-                Data = numpy.array(numpy.frombuffer(self.File.read(Size[0] * size_pixel), type_))
+                Data = self.__ReadArray((Size[0],), type_, partial=True)
             elif self.Images[Index].NumDim == 2:
                 if Pos == None: Pos = (0, 0)
                 if Size == None: Size = (0, 0)
@@ -716,7 +740,7 @@ def _GetData(self, Index, DataType="", Pos=None, Size=None):
                 Size = list(Size)
                 if Size[0] == 0:Size[0] = sizex - Pos[0]
                 self.File.seek((Pos[0] * size_pixel) + self.Images[Index].DataPosition, 0)
-                Data = numpy.array(numpy.frombuffer(self.File.read(Size[0] * size_pixel), type_))
+                Data = self.__ReadArray((Size[0],), type_, partial=True)
             elif self.Images[Index].NumDim == 2:
                 if Pos == None: Pos = (0, 0)
                 if Size == None: Size = (0, 0)
@@ -724,19 +748,9 @@ def _GetData(self, Index, DataType="", Pos=None, Size=None):
                 sizex, sizey = self.Images[Index].Dim1, self.Images[Index].Dim2
                 if Size[0] == 0:Size[0] = sizex - Pos[0]
                 if Size[1] == 0:Size[1] = sizey - Pos[1]
-                #print len(range(Pos[1],Pos[1]+Size[1])), "LECTURES OF ", Size[0], "POINTS"
-                #print "sizex = ", sizex, "sizey = ", sizey
                 Data = numpy.zeros((Size[1], Size[0]), type_)
-                dataindex = 0
-                for y in range(Pos[1], Pos[1] + Size[1]):
-                    self.File.seek((((y * sizex) + Pos[0]) * size_pixel) + self.Images[Index].DataPosition, 0)
-                    line = numpy.array(numpy.frombuffer(self.File.read(Size[0] * size_pixel), type_))
-                    Data[dataindex, :] = line[:]
-                    #Data=numpy.concatenate((Data,line))
-                    dataindex += 1
-                #print "DataSize = ",Data.shape
-                #print "Requested reshape = ",Size[1],'x',Size[0]
-                #Data = numpy.reshape(Data, (Size[1],Size[0]))
+                self.__ReadRegion(Data, self.Images[Index].DataPosition,
+                                  sizex, Pos[0], Pos[1])
             elif self.Images[Index].NumDim == 3:
                 if Pos == None: Pos = (0, 0, 0)
                 if Size == None: Size = (0, 0, 0)
@@ -745,12 +759,12 @@ def _GetData(self, Index, DataType="", Pos=None, Size=None):
                 if Size[0] == 0:Size[0] = sizex - Pos[0]
                 if Size[1] == 0:Size[1] = sizey - Pos[1]
                 if Size[2] == 0:Size[2] = sizez - Pos[2]
-                for z in range(Pos[2], Pos[2] + Size[2]):
-                    for y in range(Pos[1], Pos[1] + Size[1]):
-                        self.File.seek(((((z * sizey + y) * sizex) + Pos[0]) * size_pixel) + self.Images[Index].DataPosition, 0)
-                        line = numpy.array(numpy.frombuffer(self.File.read(Size[0] * size_pixel), type_))
-                        Data = numpy.concatenate((Data, line))
-                Data = numpy.reshape(Data, (Size[2], Size[1], Size[0]))
+                Data = numpy.zeros((Size[2], Size[1], Size[0]), type_)
+                for i, z in enumerate(range(Pos[2], Pos[2] + Size[2])):
+                    self.__ReadRegion(Data[i],
+                                      self.Images[Index].DataPosition + \
+                                      z * sizey * sizex * size_pixel,
+                                      sizex, Pos[0], Pos[1])
 
         if self.SysByteOrder.upper() != self.Images[Index].ByteOrder.upper():
             Data = Data.byteswap()
@@ -991,6 +1005,104 @@ def __makeSureFileIsClosed(self):
         return
 
 
+    def __GetImageShape(self, Index):
+        """ Internal method: returns the shape of the image data
+        """
+        image = self.Images[Index]
+        if image.NumDim == 3:
+            return (image.Dim3, image.Dim2, image.Dim1)
+        elif image.NumDim == 2:
+            return (image.Dim2, image.Dim1)
+        return (image.Dim1,)
+
+    def __GetMemMap(self, Index, Pos=None, Size=None):
+        """ Internal method: returns a read-only numpy.memmap of the image
+            data or of the requested region
+        """
+        image = self.Images[Index]
+        datatype = self.__GetDefaultNumpyType__(image.DataType, index=Index)
+        shape = self.__GetImageShape(Index)
+        Data = numpy.memmap(self.FileName, dtype=datatype, mode="r",
+                            offset=image.DataPosition, shape=shape)
+        if Pos is None and Size is None:
+            return Data
+        region = []
+        # Pos and Size are given as (x, y, z), that is, in reversed order
+        for i, dim in enumerate(reversed(shape)):
+            start = 0
+            length = 0
+            if Pos is not None:
+                start = Pos[i]
+            if Size is not None:
+                length = Size[i]
+            if length == 0:
+                length = dim - start
+            region.insert(0, slice(start, start + length))
+        return Data[tuple(region)]
+
+    def __ReadInto(self, Data):
+        """ Internal method: fills the contiguous array Data reading from the
+            current position of the file. Returns the number of bytes read.
+        """
+        buffer = Data.reshape(-1).view(numpy.uint8)
+        nbytes = buffer.size
+        if not hasattr(self.File, "readinto"):
+            chunk = self.File.read(nbytes)
+            buffer[:len(chunk)] = numpy.frombuffer(chunk, numpy.uint8)
+            return len(chunk)
+        view = memoryview(buffer)
+        nread = 0
+        while nread < nbytes:
+            n = self.File.readinto(view[nread:])
+            if not n:
+                break
+            nread += n
+        return nread
+
+    def __ReadArray(self, shape, datatype, partial=False):
+        """ Internal method: reads an array from the current position of the
+            file without intermediate copies. If partial is True, a truncated
+            1D array is returned when the file does not contain enough data.
+        """
+        Data = numpy.empty(shape, datatype)
+        nread = self.__ReadInto(Data)
+        if nread < Data.nbytes:
+            if partial:
+                return Data[:nread // Data.itemsize]
+            raise ValueError("EdfFile: Not enough data in file %s" % \
+                             self.FileName)
+        return Data
+
+    def __ReadRegion(self, Data, DataPosition, sizex, x, y):
+        """ Internal method: fills the 2D array Data with the region of a
+            2D image of sizex columns starting at DataPosition in the file.
+            x and y are the coordinates of the first pixel of the region.
+        """
+        nrows, ncolumns = Data.shape
+        if (nrows == 0) or (ncolumns == 0):
+            return
+        size_pixel = Data.itemsize
+        self.File.seek(DataPosition + ((y * sizex) + x) * size_pixel, 0)
+        if ncolumns == sizex:
+            nread = self.__ReadInto(Data)
+        elif 4 * ncolumns >= sizex:
+            # read all the rows at once and keep the requested columns
+            block = numpy.empty((nrows, sizex), Data.dtype)
+            nread = self.__ReadInto(
+                        block.reshape(-1)[:(nrows - 1) * sizex + ncolumns])
+            Data[:] = block[:, :ncolumns]
+            nread = nread - (nrows - 1) * (sizex - ncolumns) * size_pixel
+        else:
+            # narrow region, one read per row
+            nread = 0
+            for row in range(nrows):
+                self.File.seek(DataPosition + \
+                               (((y + row) * sizex) + x) * size_pixel, 0)
+                nread += self.__ReadInto(Data[row])
+        if nread < Data.nbytes:
+            raise ValueError("EdfFile: Not enough data in file %s" % \
+                             self.FileName)
+
     def __GetDefaultNumpyType__(self, EdfType, index=None):
         """ Internal method: returns NumPy type according to Edf type
         """
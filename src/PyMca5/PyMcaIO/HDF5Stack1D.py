@@ -40,19 +40,25 @@
 from PyMca5.PyMcaMisc import PhysicalMemory
 from PyMca5.PyMcaCore import NexusDataSource
 from PyMca5.PyMcaCore import NexusTools
+from PyMca5.PyMcaIO import PrefetchLoader
 
 SOURCE_TYPE = "HDF5Stack1D"
 
 class HDF5Stack1D(DataObject.DataObject):
     def __init__(self, filelist, selection,
                        scanlist=None,
-                       dtype=None):
+                       dtype=None,
+                       nworkers=None):
         DataObject.DataObject.__init__(self)
 
         #the data type of the generated stack
         self.__dtype0 = dtype
         self.__dtype  = dtype
 
+        # number of threads reading ahead the datasets
+        self.__nworkers = nworkers
+        self.__loader = None
+
         if filelist is not None:
             if selection is not None:
                 self.loadFileList(filelist, selection, scanlist)
@@ -82,6 +88,9 @@ def loadFileList(self, filelist, selection, scanlist=None):
             if type(scanlist) not in (type([]), type(())):
                 scanlist = [scanlist]
 
+        self.__loader = PrefetchLoader.PrefetchLoader(self._readSpectra,
+                                                nworkers=self.__nworkers)
+
         # all the files in the same source
         hdfStack = NexusDataSource.NexusDataSource(filelist)
 
@@ -466,234 +475,252 @@ def loadFileList(self, filelist, selection, scanlist=None):
             else:
                 self.onBegin(dim0)
             self.incrProgressBar=0
-            for hdf in hdfStack._sourceObjectList:
-                entryNames = list(hdf["/"].keys())
-                goodEntryNames = []
-                for entry in entryNames:
-                    tmpPath = "/" + entry
-                    try:
-                        if hasattr(hdf[tmpPath], "keys"):
-                            goodEntryNames.append(entry)
-                    except KeyError:
-                        _logger.info("Broken link with key? <%s>" % tmpPath)
 
-                for scan in scanlist:
-                    IN_MEMORY = None
-                    nStart = n
-                    for ySelection in ySelectionList:
-                        n = nStart
-                        if JUST_KEYS:
-                            entryName = goodEntryNames[int(scan.split(".")[-1])-1]
-                            path = entryName + ySelection
-                            if mSelection is not None:
-                                mpath = entryName + mSelection
-                                mdtype = hdf[mpath].dtype
-                                if mdtype not in [numpy.float64, numpy.float32]:
-                                    mdtype = numpy.float64
-                                mDataset = numpy.asarray(hdf[mpath], dtype=mdtype)
-                            if xSelectionList is not None:
-                                xDatasetList = []
-                                for xSelection in xSelectionList:
-                                    xpath = entryName + xSelection
-                                    xDataset = hdf[xpath][()]
-                                    xDatasetList.append(xDataset)
-                        else:
-                            path = scan + ySelection
-                            if mSelection is not None:
-                                mpath = scan + mSelection
-                                mdtype = hdf[mpath].dtype
-                                if mdtype not in [numpy.float64, numpy.float32]:
-                                    mdtype = numpy.float64
-                                mDataset = numpy.asarray(hdf[mpath], dtype=mdtype)
-                            if xSelectionList is not None:
-                                xDatasetList = []
-                                for xSelection in xSelectionList:
-                                    xpath = scan + xSelection
-                                    xDataset = hdf[xpath][()]
-                                    xDatasetList.append(xDataset)
-                        try:
-                            yDataset = hdf[path]
-                            tmpShape = yDataset.shape
-                            totalBytes = numpy.ones((1,), yDataset.dtype).itemsize
-                            for nItems in tmpShape:
-                                totalBytes *= nItems
-                            # should one be conservative or just try?
-                            if (totalBytes/(1024.*1024.)) > (0.4 * physicalMemory):
-                                _logger.info("Force dynamic loading of spectra")
-                                #read from disk
-                                IN_MEMORY = False
+            # read the spectra of the next scans while filling the stack
+            # without keeping too many of them in memory
+            prefetchBytes = 0.4 * physicalMemory * 1024 * 1024 / \
+                            self.__loader.readahead
+            def spectraPaths():
+                for hdf in hdfStack._sourceObjectList:
+                    goodEntryNames = self._getGoodEntryNames(hdf)
+                    for scan in scanlist:
+                        for ySelection in ySelectionList:
+                            if JUST_KEYS:
+                                entryName = goodEntryNames[\
+                                                int(scan.split(".")[-1])-1]
+                                path = entryName + ySelection
                             else:
-                                #read the data into memory
-                                _logger.info("Attempt to load whole map into memory")
-                                yDataset = hdf[path][()]
+                                path = scan + ySelection
+                            yield hdf, path, prefetchBytes
+            prefetched = self._prefetch(spectraPaths())
+            try:
+                for hdf in hdfStack._sourceObjectList:
+                    goodEntryNames = self._getGoodEntryNames(hdf)
+
+                    for scan in scanlist:
+                        IN_MEMORY = None
+                        nStart = n
+                        for ySelection in ySelectionList:
+                            n = nStart
+                            if JUST_KEYS:
+                                entryName = goodEntryNames[int(scan.split(".")[-1])-1]
+                                path = entryName + ySelection
+                                if mSelection is not None:
+                                    mpath = entryName + mSelection
+                                    mdtype = hdf[mpath].dtype
+                                    if mdtype not in [numpy.float64, numpy.float32]:
+                                        mdtype = numpy.float64
+                                    mDataset = numpy.asarray(hdf[mpath], dtype=mdtype)
+                                if xSelectionList is not None:
+                                    xDatasetList = []
+                                    for xSelection in xSelectionList:
+                                        xpath = entryName + xSelection
+                                        xDataset = hdf[xpath][()]
+                                        xDatasetList.append(xDataset)
+                            else:
+                                path = scan + ySelection
+                                if mSelection is not None:
+                                    mpath = scan + mSelection
+                                    mdtype = hdf[mpath].dtype
+                                    if mdtype not in [numpy.float64, numpy.float32]:
+                                        mdtype = numpy.float64
+                                    mDataset = numpy.asarray(hdf[mpath], dtype=mdtype)
+                                if xSelectionList is not None:
+                                    xDatasetList = []
+                                    for xSelection in xSelectionList:
+                                        xpath = scan + xSelection
+                                        xDataset = hdf[xpath][()]
+                                        xDatasetList.append(xDataset)
+                            yDataset = next(prefetched)[1]
+                            if yDataset is not None:
                                 IN_MEMORY = True
-                        except (MemoryError, ValueError):
-                            _logger.info("Dynamic loading of spectra")
-                            yDataset = hdf[path]
-                            IN_MEMORY = False
-                        nMcaInYDataset = 1
-                        for dim in yDataset.shape:
-                            nMcaInYDataset *= dim
-                        nMcaInYDataset = int(nMcaInYDataset/mcaDim)
-                        timeData = None
-                        if _time is not None:
-                            if "live_time" in mcaObjectPaths:
-                                # it is assumed that all have the same structure!!!
-                                timePath = NexusTools.getMcaObjectPaths(hdf, path)["live_time"]
-                            elif "elapsed_time" in mcaObjectPaths:
-                                timePath = NexusTools.getMcaObjectPaths(hdf,
-                                                                        path)["elapsed_time"]
-                            if timePath in hdf:
-                                timeData = hdf[timePath][()]
-                            elif "::" in timePath:
-                                externalFile, externalPath = timePath.split("::")
-                                with h5py.File(externalFile, "r") as timeHdf:
-                                    timeData = timeHdf[externalPath][()]
-                        if mcaIndex != 0:
-                            if IN_MEMORY:
-                                yDataset.shape = -1, mcaDim
-                            if mSelection is not None:
-                                case = -1
-                                nMonitorData = 1
-                                for v in mDataset.shape:
-                                    nMonitorData *= v
-                                if nMonitorData == nMcaInYDataset:
-                                    mDataset.shape = nMcaInYDataset
-                                    case = 0
-                                elif nMonitorData == (nMcaInYDataset * mcaDim):
-                                    case = 1
-                                    mDataset.shape = nMcaInYDataset, mcaDim
-                                if case == -1:
-                                    raise ValueError(\
-                                        "I do not know how to handle this monitor data")
-                            if timeData is not None:
-                                case = -1
-                                nTimeData = 1
-                                for v in timeData.shape:
-                                    nTimeData *= v
-                                if nTimeData == nMcaInYDataset:
-                                    timeData.shape = nMcaInYDataset
-                                    case = 0
-                                    _time[nStart: nStart + nMcaInYDataset] += timeData
-                                if case == -1:
-                                    _logger.warning("I do not know how to handle this time data")
-                                    _logger.warning("Ignoring time information")
-                                    _time= None
-                            if (len(yDataset.shape) == 3) and\
-                               (dim1 == yDataset.shape[1]):
-                                mca = 0
-                                deltaI = int(yDataset.shape[1]/dim1)
-                                for ii in range(yDataset.shape[0]):
-                                    i = int(n/dim1)
-                                    yData = yDataset[ii:(ii+1)]
-                                    yData.shape = -1, mcaDim
-                                    if mSelection is not None:
-                                        if case == 0:
-                                            mData = numpy.outer(mDataset[mca:(mca+dim1)],
-                                                                numpy.ones((mcaDim)))
-                                            self.data[i, :, :] += yData / mData
-                                        elif case == 1:
-                                            mData = mDataset[mca:(mca+dim1), :]
-                                            mData.shape = -1, mcaDim
-                                            self.data[i, :, :]  += yData / mData
-                                    else:
-                                        self.data[i:(i+deltaI), :] += yData
-                                    n += yDataset.shape[1]
-                                    mca += dim1
                             else:
-                                for mca in range(nMcaInYDataset):
-                                    i = int(n/dim1)
-                                    j = n % dim1
-                                    if len(yDataset.shape) == 3:
-                                        ii = int(mca/yDataset.shape[1])
-                                        jj = mca % yDataset.shape[1]
-                                        yData = yDataset[ii, jj]
-                                    elif len(yDataset.shape) == 2:
-                                        yData = yDataset[mca,:]
-                                    elif len(yDataset.shape) == 1:
-                                        yData = yDataset
-                                    if mSelection is not None:
-                                        if case == 0:
-                                            self.data[i, j, :] += yData / mDataset[mca]
-                                        elif case == 1:
-                                            self.data[i, j, :] += yData / mDataset[mca, :]
-                                    else:
-                                        self.data[i, j, :] += yData
-                                    n += 1
-                        else:
-                            if mSelection is not None:
-                                case = -1
-                                nMonitorData = 1
-                                for v in mDataset.shape:
-                                    nMonitorData *= v
-                                if nMonitorData == yDataset.shape[0]:
-                                    case = 3
-                                    mDataset.shape = yDataset.shape[0]
-                                elif nMonitorData == nMcaInYDataset:
-                                    mDataset.shape = nMcaInYDataset
-                                    case = 0
-                                #elif nMonitorData == (yDataset.shape[1] * yDataset.shape[2]):
-                                #    case = 1
-                                #    mDataset.shape = yDataset.shape[1], yDataset.shape[2]
-                                if case == -1:
-                                    raise ValueError(\
-                                        "I do not know how to handle this monitor data")
-                            if IN_MEMORY:
-                                yDataset.shape = mcaDim, -1
-                            if len(yDataset.shape) != 3:
-                                for mca in range(nMcaInYDataset):
-                                    i = int(n/dim1)
-                                    j = n % dim1
-                                    if len(yDataset.shape) == 3:
-                                        ii = int(mca/yDataset.shape[2])
-                                        jj = mca % yDataset.shape[2]
-                                        yData = yDataset[:, ii, jj]
-                                    elif len(yDataset.shape) == 2:
-                                        yData = yDataset[:, mca]
-                                    elif len(yDataset.shape) == 1:
-                                        yData = yDataset[:]
-                                    if mSelection is not None:
-                                        if case == 0:
-                                            self.data[i, j, :] += yData / mDataset[mca]
-                                        elif case == 1:
-                                            self.data[i, j, :] += yData / mDataset[:, mca]
-                                        elif case == 3:
-                                            self.data[i, j, :] += yData / mDataset
+                                try:
+                                    yDataset = hdf[path]
+                                    tmpShape = yDataset.shape
+                                    totalBytes = numpy.ones((1,), yDataset.dtype).itemsize
+                                    for nItems in tmpShape:
+                                        totalBytes *= nItems
+                                    # should one be conservative or just try?
+                                    if (totalBytes/(1024.*1024.)) > (0.4 * physicalMemory):
+                                        _logger.info("Force dynamic loading of spectra")
+                                        #read from disk
+                                        IN_MEMORY = False
                                     else:
-                                        self.data[i, j, :] += yData
-                                    n += 1
-                            else:
-                                #stack of images to be read as MCA
-                                for nImage in range(yDataset.shape[0]):
-                                    tmp = yDataset[nImage:(nImage+1)]
-                                    if len(tmp.shape) == 3:
+                                        #read the data into memory
+                                        _logger.info("Attempt to load whole map into memory")
+                                        yDataset = hdf[path][()]
+                                        IN_MEMORY = True
+                                except (MemoryError, ValueError):
+                                    _logger.info("Dynamic loading of spectra")
+                                    yDataset = hdf[path]
+                                    IN_MEMORY = False
+                            nMcaInYDataset = 1
+                            for dim in yDataset.shape:
+                                nMcaInYDataset *= dim
+                            nMcaInYDataset = int(nMcaInYDataset/mcaDim)
+                            timeData = None
+                            if _time is not None:
+                                if "live_time" in mcaObjectPaths:
+                                    # it is assumed that all have the same structure!!!
+                                    timePath = NexusTools.getMcaObjectPaths(hdf, path)["live_time"]
+                                elif "elapsed_time" in mcaObjectPaths:
+                                    timePath = NexusTools.getMcaObjectPaths(hdf,
+                                                                            path)["elapsed_time"]
+                                if timePath in hdf:
+                                    timeData = hdf[timePath][()]
+                                elif "::" in timePath:
+                                    externalFile, externalPath = timePath.split("::")
+                                    with h5py.File(externalFile, "r") as timeHdf:
+                                        timeData = timeHdf[externalPath][()]
+                            if mcaIndex != 0:
+                                if IN_MEMORY:
+                                    yDataset.shape = -1, mcaDim
+                                if mSelection is not None:
+                                    case = -1
+                                    nMonitorData = 1
+                                    for v in mDataset.shape:
+                                        nMonitorData *= v
+                                    if nMonitorData == nMcaInYDataset:
+                                        mDataset.shape = nMcaInYDataset
+                                        case = 0
+                                    elif nMonitorData == (nMcaInYDataset * mcaDim):
+                                        case = 1
+                                        mDataset.shape = nMcaInYDataset, mcaDim
+                                    if case == -1:
+                                        raise ValueError(\
+                                            "I do not know how to handle this monitor data")
+                                if timeData is not None:
+                                    case = -1
+                                    nTimeData = 1
+                                    for v in timeData.shape:
+                                        nTimeData *= v
+                                    if nTimeData == nMcaInYDataset:
+                                        timeData.shape = nMcaInYDataset
+                                        case = 0
+                                        _time[nStart: nStart + nMcaInYDataset] += timeData
+                                    if case == -1:
+                                        _logger.warning("I do not know how to handle this time data")
+                                        _logger.warning("Ignoring time information")
+                                        _time= None
+                                if (len(yDataset.shape) == 3) and\
+                                   (dim1 == yDataset.shape[1]):
+                                    mca = 0
+                                    deltaI = int(yDataset.shape[1]/dim1)
+                                    for ii in range(yDataset.shape[0]):
+                                        i = int(n/dim1)
+                                        yData = yDataset[ii:(ii+1)]
+                                        yData.shape = -1, mcaDim
+                                        if mSelection is not None:
+                                            if case == 0:
+                                                mData = numpy.outer(mDataset[mca:(mca+dim1)],
+                                                                    numpy.ones((mcaDim)))
+                                                self.data[i, :, :] += yData / mData
+                                            elif case == 1:
+                                                mData = mDataset[mca:(mca+dim1), :]
+                                                mData.shape = -1, mcaDim
+                                                self.data[i, :, :]  += yData / mData
+                                        else:
+                                            self.data[i:(i+deltaI), :] += yData
+                                        n += yDataset.shape[1]
+                                        mca += dim1
+                                else:
+                                    for mca in range(nMcaInYDataset):
                                         i = int(n/dim1)
                                         j = n % dim1
-                                        if 0:
-                                            #this loop is extremely SLOW!!!(and useless)
-                                            for ii in range(tmp.shape[1]):
-                                                for jj in range(tmp.shape[2]):
-                                                    self.data[i+ii, j+jj, nImage] += tmp[0, ii, jj]
+                                        if len(yDataset.shape) == 3:
+                                            ii = int(mca/yDataset.shape[1])
+                                            jj = mca % yDataset.shape[1]
+                                            yData = yDataset[ii, jj]
+                                        elif len(yDataset.shape) == 2:
+                                            yData = yDataset[mca,:]
+                                        elif len(yDataset.shape) == 1:
+                                            yData = yDataset
+                                        if mSelection is not None:
+                                            if case == 0:
+                                                self.data[i, j, :] += yData / mDataset[mca]
+                                            elif case == 1:
+                                                self.data[i, j, :] += yData / mDataset[mca, :]
                                         else:
-                                            self.data[i:i+tmp.shape[1],
-                                                      j:j+tmp.shape[2], nImage] += tmp[0]
+                                            self.data[i, j, :] += yData
+                                        n += 1
+                            else:
                                 if mSelection is not None:
-                                    for mca in range(yDataset.shape[0]):
+                                    case = -1
+                                    nMonitorData = 1
+                                    for v in mDataset.shape:
+                                        nMonitorData *= v
+                                    if nMonitorData == yDataset.shape[0]:
+                                        case = 3
+                                        mDataset.shape = yDataset.shape[0]
+                                    elif nMonitorData == nMcaInYDataset:
+                                        mDataset.shape = nMcaInYDataset
+                                        case = 0
+                                    #elif nMonitorData == (yDataset.shape[1] * yDataset.shape[2]):
+                                    #    case = 1
+                                    #    mDataset.shape = yDataset.shape[1], yDataset.shape[2]
+                                    if case == -1:
+                                        raise ValueError(\
+                                            "I do not know how to handle this monitor data")
+                                if IN_MEMORY:
+                                    yDataset.shape = mcaDim, -1
+                                if len(yDataset.shape) != 3:
+                                    for mca in range(nMcaInYDataset):
                                         i = int(n/dim1)
                                         j = n % dim1
-                                        yData = self.data[i, j, :]
-                                        if case == 0:
-                                            self.data[i, j, :] += yData / mDataset[mca]
-                                        elif case == 1:
-                                            self.data[i, j, :]  += yData / mDataset[:, mca]
+                                        if len(yDataset.shape) == 3:
+                                            ii = int(mca/yDataset.shape[2])
+                                            jj = mca % yDataset.shape[2]
+                                            yData = yDataset[:, ii, jj]
+                                        elif len(yDataset.shape) == 2:
+                                            yData = yDataset[:, mca]
+                                        elif len(yDataset.shape) == 1:
+                                            yData = yDataset[:]
+                                        if mSelection is not None:
+                                            if case == 0:
+                                                self.data[i, j, :] += yData / mDataset[mca]
+                                            elif case == 1:
+                                                self.data[i, j, :] += yData / mDataset[:, mca]
+                                            elif case == 3:
+                                                self.data[i, j, :] += yData / mDataset
+                                        else:
+                                            self.data[i, j, :] += yData
                                         n += 1
                                 else:
-                                    n += tmp.shape[1] * tmp.shape[2]
-                        yDataset = None
-                        if dim0 == 1:
-                            self.onProgress(j)
-                if dim0 != 1:
-                    self.onProgress(i)
+                                    #stack of images to be read as MCA
+                                    for nImage in range(yDataset.shape[0]):
+                                        tmp = yDataset[nImage:(nImage+1)]
+                                        if len(tmp.shape) == 3:
+                                            i = int(n/dim1)
+                                            j = n % dim1
+                                            if 0:
+                                                #this loop is extremely SLOW!!!(and useless)
+                                                for ii in range(tmp.shape[1]):
+                                                    for jj in range(tmp.shape[2]):
+                                                        self.data[i+ii, j+jj, nImage] += tmp[0, ii, jj]
+                                            else:
+                                                self.data[i:i+tmp.shape[1],
+                                                          j:j+tmp.shape[2], nImage] += tmp[0]
+                                    if mSelection is not None:
+                                        for mca in range(yDataset.shape[0]):
+                                            i = int(n/dim1)
+                                            j = n % dim1
+                                            yData = self.data[i, j, :]
+                                            if case == 0:
+                                                self.data[i, j, :] += yData / mDataset[mca]
+                                            elif case == 1:
+                                                self.data[i, j, :]  += yData / mDataset[:, mca]
+                                            n += 1
+                                    else:
+                                        n += tmp.shape[1] * tmp.shape[2]
+                            yDataset = None
+                            if dim0 == 1:
+                                self.onProgress(j)
+                    if dim0 != 1:
+                        self.onProgress(i)
+            finally:
+                # stop the reading threads even on errors or cancellation
+                prefetched.close()
             self.onEnd()
         elif not DONE:
             # data into memory but as images
@@ -1028,6 +1055,53 @@ def getDimensions(self, nFiles, nScans, shape, index=None):
 
         return dim0, dim1, shape[index]
 
+    def _getGoodEntryNames(self, hdf):
+        goodEntryNames = []
+        for entry in hdf["/"].keys():
+            tmpPath = "/" + entry
+            try:
+                if hasattr(hdf[tmpPath], "keys"):
+                    goodEntryNames.append(entry)
+            except KeyError:
+                _logger.info("Broken link with key? <%s>" % tmpPath)
+        return goodEntryNames
+
+    @staticmethod
+    def _readSpectra(item):
+        """
+        Read into memory the dataset given by (hdf, path, maxBytes). It
+        returns None if the dataset is larger than maxBytes or cannot be
+        read, leaving the decision to the caller.
+        """
+        hdf, path, maxBytes = item
+        try:
+            dataset = hdf[path]
+            if (dataset.size * dataset.dtype.itemsize) > maxBytes:
+                return None
+            return dataset[()]
+        except (MemoryError, ValueError):
+            return None
+
+    def _prefetch(self, items):
+        """
+        Generator of (index, data) tuples of the given items read ahead
+        in their original order.
+        """
+        try:
+            for index, data in self.__loader(items, ordered=True):
+                yield index, data
+        except PrefetchLoader.LoadCancelled:
+            self.onEnd()
+            raise
+
+    def cancel(self):
+        """
+        Stop loading the stack. It can be called from the progress callbacks
+        or from another thread. The loading raises PrefetchLoader.LoadCancelled.
+        """
+        if self.__loader is not None:
+            self.__loader.cancel()
+
     def onBegin(self, n):
         pass
 
@@ -0,0 +1,146 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2026 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__doc__ = """
+Thread pool based prefetching of the items of a stack.
+
+Stacks are usually built from many files that are read one after the
+other. The time spent opening and reading each file is mostly spent
+waiting for the file system, so several files can be read at the same
+time. A PrefetchLoader reads the items with a pool of threads, keeping
+at most a given number of them pending, and yields them as they become
+available so that the caller can fill a preallocated buffer.
+
+Example::
+
+    loader = PrefetchLoader(lambda name: EdfFile(name, "rb").GetData(0))
+    for index, image in loader(filelist):
+        data[index] = image
+"""
+import os
+import threading
+import logging
+try:
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+except ImportError:
+    ThreadPoolExecutor = None
+
+_logger = logging.getLogger(__name__)
+
+# Reading files is I/O bound: use more threads than processors
+DEFAULT_WORKERS = min(16, (os.cpu_count() or 1) + 4)
+
+# Maximum number of items read ahead for each worker
+READ_AHEAD_PER_WORKER = 4
+
+
+class LoadCancelled(IOError):
+    """Raised when the loading has been cancelled"""
+    pass
+
+
+class PrefetchLoader(object):
+    def __init__(self, reader, nworkers=None, readahead=None):
+        """
+        :param reader: Callable receiving an item and returning its data
+        :param nworkers: Number of I/O threads. Defaults to DEFAULT_WORKERS.
+            A value of 1 reads the items sequentially in the calling thread.
+        :param readahead: Maximum number of items read but not yet consumed.
+            Defaults to READ_AHEAD_PER_WORKER times the number of workers.
+        """
+        self.reader = reader
+        if nworkers is None:
+            nworkers = DEFAULT_WORKERS
+        self.nworkers = max(int(nworkers), 1)
+        if readahead is None:
+            readahead = READ_AHEAD_PER_WORKER * self.nworkers
+        self.readahead = max(int(readahead), self.nworkers)
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """
+        Request the loading to stop. Items not yet read are not read and
+        the iteration raises LoadCancelled. It can be called from any thread.
+        """
+        self._cancelled.set()
+
+    def isCancelled(self):
+        return self._cancelled.is_set()
+
+    def _checkCancelled(self):
+        if self._cancelled.is_set():
+            raise LoadCancelled("Loading cancelled")
+
+    def __call__(self, items, ordered=False):
+        """
+        Generator of (index, data) tuples, index being the position of the
+        item in the given sequence.
+
+        :param items: Iterable of the items to be passed to the reader
+        :param ordered: If True, the items are yielded in their original
+            order. Otherwise they are yielded as soon as they are read.
+        """
+        if (self.nworkers < 2) or (ThreadPoolExecutor is None):
+            for index, item in enumerate(items):
+                self._checkCancelled()
+                yield index, self.reader(item)
+            return
+        iterator = enumerate(items)
+        # pending futures in submission order
+        pending = {}
+        pool = ThreadPoolExecutor(max_workers=self.nworkers)
+        try:
+            exhausted = False
+            while True:
+                while (not exhausted) and (len(pending) < self.readahead):
+                    self._checkCancelled()
+                    try:
+                        index, item = next(iterator)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending[pool.submit(self.reader, item)] = index
+                if not pending:
+                    break
+                future = next(iter(pending))
+                if not ordered:
+                    done = wait(pending, return_when=FIRST_COMPLETED)[0]
+                    for future in pending:
+                        if future in done:
+                            break
+                self._checkCancelled()
+                index = pending.pop(future)
+                yield index, future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
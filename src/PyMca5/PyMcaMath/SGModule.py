@@ -65,10 +65,6 @@ def calc_coeff(num_points, pol_degree, diff_order=0):
             if pol_degree == __LAST_POL_DEGREE:
                 if diff_order == __LAST_DIFF_ORDER:
                     return __LAST_COEFF
-    else:
-        __LAST_NUM_POINTS = num_points
-        __LAST_POL_DEGREE = pol_degree
-        __LAST_DIFF_ORDER = diff_order
 
 
     # setup interpolation matrix
@@ -94,6 +90,9 @@ def calc_coeff(num_points, pol_degree, diff_order=0):
     if (ODD_SIGN < 0) and (diff_order %2):
         coeff *= ODD_SIGN
 
+    __LAST_NUM_POINTS = num_points
+    __LAST_POL_DEGREE = pol_degree
+    __LAST_DIFF_ORDER = diff_order
     __LAST_COEFF = coeff
     return coeff
 
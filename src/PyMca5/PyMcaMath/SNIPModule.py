@@ -35,6 +35,7 @@
 
 snip1d = SpecfitFuns.snip1d
 snip2d = SpecfitFuns.snip2d
+stripbackground = SpecfitFuns.stripbackground
 
 
 def getSpectrumBackground(spectrum, width, roi_min=None, roi_max=None, smoothing=1):
@@ -48,44 +49,21 @@ def getSpectrumBackground(spectrum, width, roi_min=None, roi_max=None, smoothing
 
 getSnip1DBackground = getSpectrumBackground
 
-def subtractSnip1DBackgroundFromStack(stack, width, roi_min=None, roi_max=None,  smoothing=1):
-    mcaIndex = -1
-    if hasattr(stack, "info") and hasattr(stack, "data"):
-        data = stack.data
-        mcaIndex = stack.info.get('McaIndex', -1)
-    else:
-        data = stack
-    if not isinstance(data, numpy.ndarray):
-        raise TypeError("This Plugin only supports numpy arrays")
-
-    if roi_min is None:
-        roi_min = 0
-    if roi_max is None:
-        roi_max = data.shape[mcaIndex]
-
-    oldShape = data.shape
-    if mcaIndex in [-1, len(data.shape)-1]:
-        data.shape = -1, oldShape[-1]
-        if roi_min > 0:
-            data[:, 0:roi_min] = 0
-        if roi_max < oldShape[-1]:
-            data[:, roi_max:] = 0
-        for i in range(data.shape[0]):
-            data[i,roi_min:roi_max] -= snip1d(data[i,roi_min:roi_max],
-                                              width, smoothing)
-        data.shape = oldShape
+def _snip1DStackBlocks(data, width, roi_min, roi_max, smoothing, replace):
+    # data: 2D view with the channels along the first dimension. The
+    # background of a block of spectra is obtained in a single call.
+    nSpectra = data.shape[1]
+    blockSize = max(1, (8 * 1024 * 1024) // (8 * max(roi_max - roi_min, 1)))
+    for i in range(0, nSpectra, blockSize):
+        block = data[roi_min:roi_max, i:i + blockSize]
+        background = stripbackground(block, width, smoothing)
+        if replace:
+            block[()] = background
+        else:
+            block -= background
 
-    elif mcaIndex == 0:
-        data.shape = oldShape[0], -1
-        for i in range(data.shape[-1]):
-            data[roi_min:roi_max, i] -= snip1d(data[roi_min:roi_max, i],
-                                               width, smoothing)
-        data.shape = oldShape
-    else:
-        raise ValueError("Invalid 1D index %d" % mcaIndex)
-    return
 
-def replaceStackWithSnip1DBackground(stack, width, roi_min=None, roi_max=None,  smoothing=1):
+def _snip1DStack(stack, width, roi_min, roi_max, smoothing, replace):
     mcaIndex = -1
     if hasattr(stack, "info") and hasattr(stack, "data"):
         data = stack.data
@@ -107,21 +85,23 @@ def replaceStackWithSnip1DBackground(stack, width, roi_min=None, roi_max=None,
             data[:, 0:roi_min] = 0
         if roi_max < oldShape[-1]:
             data[:, roi_max:] = 0
-        for i in range(data.shape[0]):
-            data[i,roi_min:roi_max] = snip1d(data[i,roi_min:roi_max],
-                                              width, smoothing)
+        _snip1DStackBlocks(data.T, width, roi_min, roi_max, smoothing, replace)
         data.shape = oldShape
 
     elif mcaIndex == 0:
         data.shape = oldShape[0], -1
-        for i in range(data.shape[-1]):
-            data[roi_min:roi_max, i] = snip1d(data[roi_min:roi_max, i],
-                                               width, smoothing)
+        _snip1DStackBlocks(data, width, roi_min, roi_max, smoothing, replace)
         data.shape = oldShape
     else:
         raise ValueError("Invalid 1D index %d" % mcaIndex)
     return
 
+def subtractSnip1DBackgroundFromStack(stack, width, roi_min=None, roi_max=None,  smoothing=1):
+    return _snip1DStack(stack, width, roi_min, roi_max, smoothing, False)
+
+def replaceStackWithSnip1DBackground(stack, width, roi_min=None, roi_max=None,  smoothing=1):
+    return _snip1DStack(stack, width, roi_min, roi_max, smoothing, True)
+
 
 def getImageBackground(image, width, roi_min=None, roi_max=None, smoothing=1):
     if roi_min is None:
@@ -0,0 +1,343 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2025 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+"""
+Buffered HDF5 output of the results of many fits.
+
+The results are accumulated in a preallocated structured array with the
+fields parameters, sigmas, estimation, chisq, niter and status and they are
+written in blocks to the datasets of a single NXprocess group::
+
+    entry (NXentry)
+        fit_process (NXprocess)
+            program, version, date, parameter_names
+            configuration (NXnote)
+            results (NXdata)
+                chisq, niter, status
+                <parameter>, <parameter>_errors, <parameter>_estimation
+
+All the result datasets have the shape of the fitted stack (one value per
+spectrum). The parameter names do not need to be known in advance, the
+datasets of a parameter are created the first time it is found. Without
+process name the results group and the process information are written
+directly in the NXentry.
+"""
+import datetime
+import logging
+import numpy
+import h5py
+
+import PyMca5
+from PyMca5.PyMcaIO import ConfigDict
+
+_logger = logging.getLogger(__name__)
+
+text_dtype = h5py.special_dtype(vlen=str)
+
+# values of the status dataset
+STATUS_NOT_FITTED = -1
+STATUS_OK = 0
+STATUS_FAILED = 1
+
+
+def to_h5py_utf8(str_list):
+    return numpy.array(str_list, dtype=text_dtype)
+
+
+class FitResultBuffer(object):
+    """
+    Store the results of the fits of the spectra of a stack.
+
+    :param filename: Output HDF5 file name or opened h5py group
+    :param shape: Shape of the stack without the spectrum dimension
+    :param entry: Name of the NXentry
+    :param process: Name of the NXprocess or None
+    :param results: Name of the NXdata group with the results
+    :param title: Optional title of the NXentry
+    :param dtype: Type of the chisq and parameter datasets
+    :param blockSize: Number of results kept in memory between writes
+    :param configuration: Fit configuration (dictionary or text)
+    :param overwrite: Replace the entry if already present
+    """
+    def __init__(self, filename, shape, entry="entry", process="fit_process",
+                 results="results", title=None, dtype=numpy.float64,
+                 blockSize=1024, configuration=None, overwrite=False):
+        if isinstance(shape, int):
+            shape = (shape,)
+        self.filename = filename
+        self.shape = tuple(int(n) for n in shape)
+        self.size = int(numpy.prod(self.shape))
+        self.entryName = entry
+        self.processName = process
+        self.resultsName = results
+        self.title = title
+        self.dtype = dtype
+        self.blockSize = max(1, int(blockSize))
+        self.configuration = configuration
+        self.overwrite = overwrite
+        self._file = None
+        self._ownsFile = False
+        self._closed = False
+        self._results = None
+        self._names = []
+        self._columns = {}
+        self._lastNames = None
+        self._lastColumns = None
+        self._buffer = None
+        self._nBuffered = 0
+        self._nStored = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._nStored
+
+    @property
+    def parameterNames(self):
+        return list(self._names)
+
+    def add(self, index, chisq, names=None, values=None, sigmas=None,
+            estimation=None, niter=0, status=STATUS_OK):
+        """
+        Store the results of one or more fits.
+
+        :param index: Flat index of the spectrum in the stack or 1D array
+            of indices
+        :param chisq: Reduced chi square (one value per index)
+        :param names: Names of the parameters
+        :param values: Fitted values of shape (n_indices, n_parameters)
+        :param sigmas: Uncertainties of the fitted values
+        :param estimation: Initial values of the parameters
+        :param niter: Number of iterations (one value per index)
+        :param status: STATUS_OK, STATUS_FAILED or a user defined code
+        """
+        index = numpy.atleast_1d(numpy.asarray(index, dtype=numpy.intp))
+        n = index.size
+        if n == 0:
+            return
+        if (index.min() < 0) or (index.max() >= self.size):
+            raise IndexError("Result index out of range")
+        columns = self._getColumns(names)
+        for start in range(0, n, self.blockSize):
+            stop = min(n, start + self.blockSize)
+            if self._nBuffered + stop - start > self.blockSize:
+                self.flush()
+            records = self._buffer[self._nBuffered:
+                                   self._nBuffered + stop - start]
+            records['index'] = index[start:stop]
+            records['chisq'] = numpy.broadcast_to(chisq, (n,))[start:stop]
+            records['niter'] = numpy.broadcast_to(niter, (n,))[start:stop]
+            records['status'] = numpy.broadcast_to(status, (n,))[start:stop]
+            for field, data in (('parameters', values),
+                                ('sigmas', sigmas),
+                                ('estimation', estimation)):
+                records[field] = numpy.nan
+                if (data is not None) and columns.size:
+                    data = numpy.asarray(data, dtype=numpy.float64)
+                    data = data.reshape(-1, columns.size)
+                    data = numpy.broadcast_to(data, (n, columns.size))
+                    records[field][:, columns] = data[start:stop]
+            self._nBuffered += stop - start
+            self._nStored += stop - start
+
+    def _getColumns(self, names):
+        if not names:
+            names = ()
+        else:
+            names = tuple("%s" % name for name in names)
+        if names == self._lastNames:
+            return self._lastColumns
+        newNames = [name for name in names if name not in self._columns]
+        if newNames or (self._buffer is None):
+            # the buffered results are written with the previous layout
+            self.flush()
+            for name in newNames:
+                self._columns[name] = len(self._names)
+                self._names.append(name)
+            nParameters = len(self._names)
+            dtype = [('index', numpy.intp),
+                     ('parameters', numpy.float64, (nParameters,)),
+                     ('sigmas', numpy.float64, (nParameters,)),
+                     ('estimation', numpy.float64, (nParameters,)),
+                     ('chisq', numpy.float64),
+                     ('niter', numpy.int32),
+                     ('status', numpy.int32)]
+            self._buffer = numpy.zeros((self.blockSize,), dtype=dtype)
+        self._lastNames = names
+        self._lastColumns = numpy.array([self._columns[name]
+                                         for name in names],
+                                        dtype=numpy.intp)
+        return self._lastColumns
+
+    def flush(self):
+        """
+        Write the buffered results to the output file.
+        """
+        if not self._nBuffered:
+            return
+        results = self._getResultsGroup()
+        records = self._buffer[:self._nBuffered]
+        records = records[numpy.argsort(records['index'], kind='stable')]
+        datasets = [(results['chisq'], records['chisq']),
+                    (results['niter'], records['niter']),
+                    (results['status'], records['status'])]
+        for i, name in enumerate(self._names):
+            datasets.append((results[name], records['parameters'][:, i]))
+            datasets.append((results[name + "_errors"],
+                             records['sigmas'][:, i]))
+            datasets.append((results[name + "_estimation"],
+                             records['estimation'][:, i]))
+        for start, stop in self._getRuns(records['index']):
+            position = numpy.unravel_index(records['index'][start], self.shape)
+            selection = tuple(int(i) for i in position[:-1]) + \
+                        (slice(int(position[-1]),
+                               int(position[-1]) + stop - start),)
+            for dataset, data in datasets:
+                dataset[selection] = data[start:stop]
+        self._nBuffered = 0
+        self._file.flush()
+
+    def _getRuns(self, index):
+        """
+        Ranges of sorted indices written with a single slice, that is
+        consecutive and within the same row.
+        """
+        breaks = (numpy.diff(index) != 1) | \
+                 ((index[1:] % self.shape[-1]) == 0)
+        limits = [0] + list(numpy.nonzero(breaks)[0] + 1) + [index.size]
+        return zip(limits[:-1], limits[1:])
+
+    def _open(self):
+        if self._closed:
+            raise IOError("Output already closed")
+        if self._file is not None:
+            return self._results
+        if isinstance(self.filename, h5py.Group):
+            self._file = self.filename.file
+            root = self.filename
+            self._ownsFile = False
+        else:
+            self._file = h5py.File(self.filename, mode="a")
+            root = self._file
+            self._ownsFile = True
+            if "NX_class" not in root.attrs:
+                root.attrs["NX_class"] = to_h5py_utf8("NXroot")
+        if self.entryName in root:
+            if not self.overwrite:
+                if self._ownsFile:
+                    self._file.close()
+                self._file = None
+                raise IOError("Entry %s already exists" % self.entryName)
+            del root[self.entryName]
+        now = datetime.datetime.now().isoformat()
+        entry = root.create_group(self.entryName)
+        entry.attrs["NX_class"] = to_h5py_utf8("NXentry")
+        entry.create_dataset("start_time", data=to_h5py_utf8(now))
+        if self.title is not None:
+            entry.create_dataset("title", data=to_h5py_utf8(self.title))
+        if self.processName:
+            entry.attrs["default"] = to_h5py_utf8(self.processName + "/" +
+                                                  self.resultsName)
+            process = entry.create_group(self.processName)
+            process.attrs["NX_class"] = to_h5py_utf8("NXprocess")
+            process.create_dataset("program", data=to_h5py_utf8("pymca"))
+            process.create_dataset("version",
+                                   data=to_h5py_utf8(PyMca5.version()))
+            process.create_dataset("date", data=to_h5py_utf8(now))
+        else:
+            entry.attrs["default"] = to_h5py_utf8(self.resultsName)
+            process = entry
+        if self.configuration is not None:
+            configuration = self.configuration
+            if not isinstance(configuration, str):
+                configuration = ConfigDict.ConfigDict(configuration).tostring()
+            note = process.create_group("configuration")
+            note.attrs["NX_class"] = to_h5py_utf8("NXnote")
+            note.create_dataset("type", data=to_h5py_utf8("text/plain"))
+            note.create_dataset("data", data=to_h5py_utf8(configuration))
+            note.create_dataset("file_name",
+                                data=to_h5py_utf8("SimpleFit.ini"))
+            note.create_dataset("description",
+                                data=to_h5py_utf8("Fit configuration"))
+        results = process.create_group(self.resultsName)
+        results.attrs["NX_class"] = to_h5py_utf8("NXdata")
+        results.attrs["signal"] = to_h5py_utf8("chisq")
+        if len(self.shape) == 1:
+            results.attrs["axes"] = to_h5py_utf8(["index"])
+            results.create_dataset("index", data=numpy.arange(self.size))
+        results.create_dataset("chisq", shape=self.shape,
+                               dtype=self.dtype, fillvalue=numpy.nan)
+        results.create_dataset("niter", shape=self.shape,
+                               dtype=numpy.int32)
+        results.create_dataset("status", shape=self.shape,
+                               dtype=numpy.int32,
+                               fillvalue=STATUS_NOT_FITTED)
+        self._results = results
+        return results
+
+    def _getResultsGroup(self):
+        results = self._open()
+        for name in self._names:
+            if name in results:
+                continue
+            for suffix in ("", "_errors", "_estimation"):
+                results.create_dataset(name + suffix, shape=self.shape,
+                                       dtype=self.dtype,
+                                       fillvalue=numpy.nan)
+        return results
+
+    def close(self):
+        """
+        Write the pending results and close the output file.
+        """
+        if self._closed:
+            return
+        self.flush()
+        # the output is created even if there are no results
+        results = self._getResultsGroup()
+        process = results.parent
+        process.create_dataset("parameter_names",
+                               data=to_h5py_utf8(self._names))
+        entry = process if not self.processName else process.parent
+        entry.create_dataset("end_time", data=to_h5py_utf8(
+                             datetime.datetime.now().isoformat()))
+        if self._ownsFile:
+            self._file.close()
+        else:
+            self._file.flush()
+        self._file = None
+        self._results = None
+        self._closed = True
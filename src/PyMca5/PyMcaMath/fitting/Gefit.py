@@ -47,7 +47,8 @@
 
 def LeastSquaresFit(model, parameters0, data=None, maxiter = 100,constrains=None,
                         weightflag = 0,model_deriv=None,deltachi=None,fulloutput=0,
-                        xdata=None,ydata=None,sigmadata=None,linear=None):
+                        xdata=None,ydata=None,sigmadata=None,linear=None,
+                        model_jacobian=None):
     """
     Typical use:
 
@@ -96,6 +97,11 @@ def LeastSquaresFit(model, parameters0, data=None, maxiter = 100,constrains=None
                       of the fitting parameters, index is the fitting parameter index of which the the derivative has
                       to be provided in the supplied array of x points.
 
+        model_jacobian - function providing at once the derivatives of the fitting function respect to
+                      several fitted parameters. It will be called as model_jacobian(parameters, indices, x)
+                      and it has to return an array of shape (len(indices), len(x)). When given, it is used
+                      instead of model_deriv.
+
         linear - Flag to indicate a linear fit instead of a non-linear. Default is non-linear fit (=false)
 
         maxiter - Maximum number of iterations (default is 100)
@@ -129,7 +135,8 @@ def LeastSquaresFit(model, parameters0, data=None, maxiter = 100,constrains=None
                                         fulloutput=fulloutput,
                                         xdata=xdata,
                                         ydata=ydata,
-                                        sigmadata=sigmadata)
+                                        sigmadata=sigmadata,
+                                        model_jacobian=model_jacobian)
     elif len(constrains) == 0:
         try:
             model(parameters,x)
@@ -146,7 +153,8 @@ def LeastSquaresFit(model, parameters0, data=None, maxiter = 100,constrains=None
                                     fulloutput=fulloutput,
                                     xdata=xdata,
                                     ydata=ydata,
-                                    sigmadata=sigmadata)
+                                    sigmadata=sigmadata,
+                                    model_jacobian=model_jacobian)
         except TypeError:
             print("You should reconsider how to write your function")
             raise TypeError("You should reconsider how to write your function")
@@ -158,13 +166,15 @@ def LeastSquaresFit(model, parameters0, data=None, maxiter = 100,constrains=None
                                 fulloutput=fulloutput,
                                 xdata=xdata,
                                 ydata=ydata,
-                                sigmadata=sigmadata)
+                                sigmadata=sigmadata,
+                                model_jacobian=model_jacobian)
 
 def LinearLeastSquaresFit(model0,parameters0,data0,maxiter,
                                 constrains0,weightflag,model_deriv=None,deltachi=0.01,fulloutput=0,
                                     xdata=None,
                                     ydata=None,
-                                    sigmadata=None):
+                                    sigmadata=None,
+                                    model_jacobian=None):
     #get the codes:
     # 0 = Free       1 = Positive     2 = Quoted
     # 3 = Fixed      4 = Factor       5 = Delta
@@ -255,7 +265,7 @@ def LinearLeastSquaresFit(model0,parameters0,data0,maxiter,
         n_free, free_index, noigno, fitparam, derivfactor  =ChisqAlphaBeta(
                                                  model,newpar,
                                                  x,y,weight,constrains,model_deriv=model_deriv,
-                                                 linear=1)
+                                                 linear=1,model_jacobian=model_jacobian)
         nr, nc = alpha0.shape
         fittedpar = numpy.dot(beta, inv(alpha0))
         #check respect of constraints (only positive is handled -force parameter to 0 and fix it-)
@@ -270,7 +280,7 @@ def LinearLeastSquaresFit(model0,parameters0,data0,maxiter,
         if error:continue
         for i in range(n_free):
             newpar[free_index[i]] = fittedpar[0,i]
-        newpar=numpy.array(getparameters(newpar,constrains))
+        newpar=getparametersarray(newpar,constrains)
         iiter=-1
     yfit = model(newpar,x)
     chisq = (weight * pow(y-yfit , 2)).sum()
@@ -286,7 +296,8 @@ def RestreinedLeastSquaresFit(model0,parameters0,data0,maxiter,
                 constrains0,weightflag,model_deriv=None,deltachi=0.01,fulloutput=0,
                                     xdata=None,
                                     ydata=None,
-                                    sigmadata=None):
+                                    sigmadata=None,
+                                    model_jacobian=None):
     #get the codes:
     # 0 = Free       1 = Positive     2 = Quoted
     # 3 = Fixed      4 = Factor       5 = Delta
@@ -373,6 +384,7 @@ def RestreinedLeastSquaresFit(model0,parameters0,data0,maxiter,
                 selfweight = 1.0 / (abs(selfy) + numpy.equal(abs(selfy),0))
     n_param = len(parameters)
     index = numpy.arange(0,nr0,2)
+    transform = getconstrainsarrays(constrains)
     while (iiter > 0):
         niter = niter + 1
         if (niter < 2) and (n_param*3 < nr0):
@@ -387,7 +399,8 @@ def RestreinedLeastSquaresFit(model0,parameters0,data0,maxiter,
         chisq0, alpha0, beta,\
         n_free, free_index, noigno, fitparam, derivfactor  =ChisqAlphaBeta(
                                                  model,fittedpar,
-                                                 x,y,weight,constrains,model_deriv=model_deriv)
+                                                 x,y,weight,constrains,model_deriv=model_deriv,
+                                                 model_jacobian=model_jacobian)
         nr, nc = alpha0.shape
         flag = 0
         lastdeltachi = chisq0
@@ -436,7 +449,7 @@ def RestreinedLeastSquaresFit(model0,parameters0,data0,maxiter,
                         print("Parameter limits are",pmin,' and ',pmax)
                         print("A = ",A,"B = ",B)
                 newpar [free_index[i]] = pwork [0] [i]
-            newpar=numpy.array(getparameters(newpar,constrains))
+            newpar=getparametersarray(newpar,constrains,transform)
             workpar = numpy.take(newpar,noigno)
             #yfit = model(workpar.tolist(), x)
             yfit = model(workpar,x)
@@ -463,7 +476,8 @@ def RestreinedLeastSquaresFit(model0,parameters0,data0,maxiter,
     else:
         return fittedpar.tolist(), chisq/(len(yfit)-len(sigma0)), sigmapar.tolist(),niter,lastdeltachi
 
-def ChisqAlphaBeta(model0, parameters, x,y,weight, constrains,model_deriv=None,linear=None):
+def ChisqAlphaBeta(model0, parameters, x,y,weight, constrains,model_deriv=None,linear=None,
+                   model_jacobian=None):
     if linear is None:linear=0
     model = model0
     #nr0, nc = data.shape
@@ -511,76 +525,48 @@ def ChisqAlphaBeta(model0, parameters, x,y,weight, constrains,model_deriv=None,l
                 print("Limits are %f and %f" % (pmin, pmax))
                 print("Parameter will be kept at its starting value")
     fitparam = numpy.array(fitparam, numpy.float64)
-    alpha = numpy.zeros((n_free, n_free),numpy.float64)
-    beta = numpy.zeros((1,n_free),numpy.float64)
     delta = (fitparam + numpy.equal(fitparam,0.0)) * 0.00001
     nr  = x.shape[0]
+    transform = getconstrainsarrays(constrains)
     ##############
     # Prior to each call to the function one has to re-calculate the
     # parameters
-    pwork = parameters.copy()
-    for i in range(n_free):
-        pwork [free_index[i]] = fitparam [i]
-    newpar = getparameters(pwork.tolist(),constrains)
-    newpar = numpy.take(newpar,noigno)
+    pwork = numpy.array(parameters, dtype=numpy.float64)
+    pwork[free_index] = fitparam
     if n_free == 0:
         raise ValueError("No free parameters to fit")
-    for i in range(n_free):
-        if model_deriv is None:
-            #pwork = parameters.copy()
-            pwork [free_index[i]] = fitparam [i] + delta [i]
-            newpar = getparameters(pwork.tolist(),constrains)
-            newpar=numpy.take(newpar,noigno)
-            f1 = model(newpar, x)
-            pwork [free_index[i]] = fitparam [i] - delta [i]
-            newpar = getparameters(pwork.tolist(),constrains)
-            newpar=numpy.take(newpar,noigno)
-            f2 = model(newpar, x)
-            help0 = (f1-f2) / (2.0 * delta [i])
-            help0 = help0 * derivfactor[i]
-            pwork [free_index[i]] = fitparam [i]
-            #removed I resize outside the loop:
-            #help0 = numpy.resize(help0,(1,nr))
-        else:
-            help0=model_deriv(pwork,free_index[i],x)
-            help0 = help0 * derivfactor[i]
-
-        if i == 0 :
-            deriv = help0
-        else:
-            deriv = numpy.concatenate((deriv,help0), 0)
-    #line added to resize outside the loop
-    deriv=numpy.resize(deriv,(n_free,nr))
-    if linear:
-        pseudobetahelp = weight * y
+    if model_jacobian is not None:
+        deriv = numpy.array(model_jacobian(pwork, free_index, x),
+                            dtype=numpy.float64, copy=True).reshape(n_free, nr)
+        deriv *= numpy.array(derivfactor).reshape(-1, 1)
     else:
-        newpar = getparameters(pwork.tolist(),constrains)
-        newpar = numpy.take(newpar,noigno)
-        yfit = model(newpar, x)
-        deltay = y - yfit
-        help0 = weight * deltay
-    for i in range(n_free):
-        derivi = numpy.resize(deriv [i,:], (1,nr))
-        if linear:
-            if i==0:
-                beta = numpy.resize(numpy.sum((pseudobetahelp * derivi),1),(1,1))
-            else:
-                beta = numpy.concatenate((beta, numpy.resize(numpy.sum((pseudobetahelp * derivi),1),(1,1))), 1)
-        else:
-            help1 = numpy.resize(numpy.sum((help0 * derivi),1),(1,1))
-            if i == 0:
-                beta = help1
+        deriv = numpy.zeros((n_free, nr), numpy.float64)
+        for i in range(n_free):
+            if model_deriv is None:
+                pwork [free_index[i]] = fitparam [i] + delta [i]
+                newpar = getparametersarray(pwork,constrains,transform)
+                f1 = model(newpar[noigno], x)
+                pwork [free_index[i]] = fitparam [i] - delta [i]
+                newpar = getparametersarray(pwork,constrains,transform)
+                f2 = model(newpar[noigno], x)
+                help0 = (f1-f2) / (2.0 * delta [i])
+                pwork [free_index[i]] = fitparam [i]
             else:
-                beta = numpy.concatenate((beta, help1), 1)
-        help1 = numpy.inner(deriv,weight*derivi)
-        if i == 0:
-            alpha = help1
-        else:
-            alpha = numpy.concatenate((alpha, help1),1)
+                help0=model_deriv(pwork,free_index[i],x)
+            deriv[i] = numpy.reshape(help0, (nr,)) * derivfactor[i]
+    # alpha and beta from the whole Jacobian at once
+    weightedDeriv = deriv * numpy.reshape(weight, (1, nr))
+    alpha = numpy.dot(weightedDeriv, deriv.T)
     if linear:
+        beta = numpy.dot(weightedDeriv, numpy.reshape(y, (nr,))).reshape(1, n_free)
         #not used
         chisq = 0.0
     else:
+        newpar = getparametersarray(pwork,constrains,transform)
+        yfit = model(newpar[noigno], x)
+        deltay = y - yfit
+        help0 = weight * deltay
+        beta = numpy.dot(deriv, numpy.reshape(help0, (nr,))).reshape(1, n_free)
         chisq = (help0 * deltay).sum()
     return chisq, alpha, beta, \
            n_free, free_index, noigno, fitparam, derivfactor
@@ -621,6 +607,51 @@ def getparameters(parameters,constrains):
             newparam[i] = constrains[2][i]-newparam[int(constrains[1][i])]
     return newparam
 
+def getconstrainsarrays(constrains):
+    """
+    Index arrays describing the constraints, to be used by getparametersarray.
+    It returns None when the constraints have to be applied sequentially
+    (a parameter related to another related parameter).
+    """
+    codes = numpy.array(constrains[0], dtype=numpy.int32)
+    positive = numpy.nonzero(codes == CPOSITIVE)[0]
+    ignored = numpy.nonzero(codes == CIGNORED)[0]
+    related = []
+    for code in [CFACTOR, CDELTA, CSUM]:
+        index = numpy.nonzero(codes == code)[0]
+        reference = numpy.array([int(constrains[1][i]) for i in index],
+                                dtype=numpy.intp)
+        value = numpy.array([constrains[2][i] for i in index],
+                            dtype=numpy.float64)
+        if index.size and numpy.isin(codes[reference],
+                                     [CFACTOR, CDELTA, CSUM, CIGNORED]).any():
+            return None
+        related.append((index, reference, value))
+    return positive, ignored, related
+
+def getparametersarray(parameters,constrains,transform=None):
+    """
+    Vectorized version of getparameters returning an array.
+
+    transform - optional output of getconstrainsarrays(constrains)
+    """
+    if transform is None:
+        transform = getconstrainsarrays(constrains)
+    if transform is None:
+        return numpy.array(getparameters(parameters,constrains),
+                           dtype=numpy.float64)
+    positive, ignored, related = transform
+    newparam = numpy.array(parameters, dtype=numpy.float64)
+    newparam[positive] = numpy.abs(newparam[positive])
+    (factor, factorRef, factorValue), \
+    (delta, deltaRef, deltaValue), \
+    (csum, csumRef, csumValue) = related
+    newparam[factor] = factorValue * newparam[factorRef]
+    newparam[delta] = deltaValue + newparam[deltaRef]
+    newparam[csum] = csumValue - newparam[csumRef]
+    newparam[ignored] = 0
+    return newparam
+
 def getsigmaparameters(parameters,sigma0,constrains):
     # 0 = Free       1 = Positive     2 = Quoted
     # 3 = Fixed      4 = Factor       5 = Delta
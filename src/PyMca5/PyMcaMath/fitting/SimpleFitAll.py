@@ -34,6 +34,8 @@
 import logging
 
 from PyMca5.PyMcaIO import ConfigDict
+from PyMca5.PyMcaMath.fitting import FitResultBuffer
+from PyMca5.PyMcaMath.fitting.Gefit import CIGNORED
 import PyMca5
 
 
@@ -93,6 +95,11 @@ def __init__(self, fit):
         self.__estimationPolicy = "always"
         self._currentFitStartTime = ""
         self._currentFitEndTime = ""
+        # write a complete NXentry per curve besides the summary
+        self.curveEntries = True
+        self._entryNameFormat = "fit_%d"
+        self._h5f = None
+        self._output = None
 
     def setProgressCallback(self, method):
         """
@@ -152,16 +159,9 @@ def processAll(self):
         assert self.curves_y is not None, "You must first call setData()!"
         data = self.curves_y
 
-        # create output file
-        with h5py.File(self.getOutputFileName(), mode="w-") as h5f:
-            h5f.attrs["NX_class"] = "NXroot"
-
         # get the total number of fits to be performed
         self._nSpectra = len(data)
 
-        # a watcher to verify if a table can be generated
-        self._referenceParameters = None
-
         # optimization
         self.__estimationPolicy = "always"
         backgroundPolicy = self.fit._fitConfiguration['fit']['background_estimation_policy']
@@ -177,16 +177,37 @@ def processAll(self):
         self._parameters = None
         self._progress = 0
         self._status = "Fitting"
-        for i in range(self._nSpectra):
-            self._progress = (i * 100.) / self._nSpectra
+        # the output file is kept open while fitting
+        with h5py.File(self.getOutputFileName(), mode="w-") as h5f:
+            h5f.attrs["NX_class"] = "NXroot"
+            self._h5f = h5f
+            # same layout as the summary built from the curve entries
+            title = "Summary of %s to %s" % (self._entryNameFormat % 0,
+                        self._entryNameFormat % (self._nSpectra - 1))
+            self._output = FitResultBuffer.FitResultBuffer(h5f,
+                                    self._nSpectra,
+                                    entry="fit_summary",
+                                    process=None,
+                                    results="result",
+                                    title=title,
+                                    dtype=numpy.float32,
+                                    configuration=self.fit.getConfiguration())
             try:
-                self.processSpectrum(i)
-            except Exception:
-                _logger.error(
-                        "Error %s processing index = %d", sys.exc_info()[1], i)
-                if _logger.getEffectiveLevel() == logging.DEBUG:
-                    raise
-        self.onProcessSpectraFinished()
+                for i in range(self._nSpectra):
+                    self._progress = (i * 100.) / self._nSpectra
+                    try:
+                        self.processSpectrum(i)
+                    except Exception:
+                        _logger.error(
+                            "Error %s processing index = %d", sys.exc_info()[1], i)
+                        if _logger.getEffectiveLevel() == logging.DEBUG:
+                            raise
+                        self._output.add(i, numpy.nan,
+                                         status=FitResultBuffer.STATUS_FAILED)
+                self.onProcessSpectraFinished()
+            finally:
+                self._h5f = None
+                self._output = None
         self._status = "Ready"
         if self.progressCallback is not None:
             self.progressCallback(self._nSpectra, self._nSpectra)
@@ -264,21 +285,24 @@ def fitOneSpectrumFinished(self):
         fitOutput = self.fit.getResult(configuration=False)
         result = fitOutput['result']
         idx = self._currentFitIndex
-        parNames = [x["name"] for x in self.fit.paramlist]
-        if idx == 0:
-            self._referenceParameters = parNames
-        if self._referenceParameters is not None:
-            if self._referenceParameters == parNames:
-                _logger.info("Fit of spectrum %d has same parameters" % idx)
-            else:
-                _logger.info("Fit of spectrum %d has different parameters" % idx)
-                self._referenceParameters = None
 
         if result is None:
             _logger.warning("result not valid for index %d", idx)
+            self._output.add(idx, numpy.nan,
+                             status=FitResultBuffer.STATUS_FAILED)
             return
 
-        self._appendOneResultToHdf5(resultDict=fitOutput["result"])
+        free = [i for i, param in enumerate(self.fit.paramlist)
+                if param['code'] not in ['IGNORE', 'IGNORED', CIGNORED]]
+        self._output.add(idx, result['chisq'],
+                         names=[self.fit.paramlist[i]['name'] for i in free],
+                         values=[result['fittedvalues'][i] for i in free],
+                         sigmas=[result['sigma_values'][i] for i in free],
+                         estimation=[self.fit.paramlist[i]['estimation']
+                                     for i in free],
+                         niter=result['niter'])
+        if self.curveEntries:
+            self._appendOneResultToHdf5(resultDict=fitOutput["result"])
 
     def _appendOneResultToHdf5(self, resultDict):
         # Get all the  necessary data (TODO: pass it to method as attrs)
@@ -293,154 +317,96 @@ def _appendOneResultToHdf5(self, resultDict):
         fitted_data = self.fit.evaluateDefinedFunction(x)
         configIni = ConfigDict.ConfigDict(self.fit.getConfiguration()).tostring()
         fit_paramlist = self.fit.paramlist
-        filename = self.getOutputFileName()
 
-        # Write the data to file (append)
-        self._entryNameFormat = "fit_%d"
-        with h5py.File(filename, mode="r+") as h5f:
-            entry = h5f.create_group(self._entryNameFormat % idx)
-            entry.attrs["NX_class"] = to_h5py_utf8("NXentry")
-            entry.attrs["default"] = to_h5py_utf8("fit_process/results/plot")
-            entry.create_dataset("start_time",
-                                 data=to_h5py_utf8(start_time))
-            entry.create_dataset("end_time", data=to_h5py_utf8(end_time))
-            entry.create_dataset("title",
-                                 data=to_h5py_utf8("Fit of '%s'" % legend))
-
-            process = entry.create_group("fit_process")
-            process.attrs["NX_class"] = to_h5py_utf8("NXprocess")
-            process.create_dataset("program", data=to_h5py_utf8("pymca"))
-            process.create_dataset("version", data=to_h5py_utf8(PyMca5.version()))
-            process.create_dataset("date", data=to_h5py_utf8(end_time))
-
-            configuration = process.create_group("configuration")
-            configuration.attrs["NX_class"] = to_h5py_utf8("NXnote")
-            configuration.create_dataset("type", data=to_h5py_utf8("text/plain"))
-            configuration.create_dataset("data", data=to_h5py_utf8(configIni))
-            configuration.create_dataset("file_name", data=to_h5py_utf8("SimpleFit.ini"))
-            configuration.create_dataset("description",
-                                         data=to_h5py_utf8("Fit configuration"))
-
-            results = process.create_group("results")
-            results.attrs["NX_class"] = to_h5py_utf8("NXcollection")
-
-            estimation = results.create_group("estimation")
-            estimation.attrs["NX_class"] = to_h5py_utf8("NXcollection")
-
-            for p in fit_paramlist:
-                pgroup = estimation.create_group(p["name"])
-                # constraint code can be an int, convert to str
-                if numpy.issubdtype(numpy.array(p['code']).dtype,
-                                    numpy.integer):
-                    pgroup.create_dataset('code', data=to_h5py_utf8(CONS[p['code']]))
-                else:
-                    pgroup.create_dataset('code', data=to_h5py_utf8(p['code']))
-                pgroup.create_dataset('cons1', data=p['cons1'])
-                pgroup.create_dataset('cons2', data=p['cons2'])
-                pgroup.create_dataset('estimation', data=p['estimation'])
-
-            for key, value in resultDict.items():
-                if not numpy.issubdtype(type(key), numpy.character):
-                    _logger.debug("skipping key %s (not a text string)", key)
-                    continue
-                if key == "fittedvalues":
-                    output_key = "parameter_values"
-                elif key == "parameters":
-                    output_key = "parameter_names"
-                elif key == "sigma_values":
-                    output_key = "parameter_sigmas"
-                else:
-                    output_key = key
-
-                value_dtype = numpy.array(value).dtype
-                if numpy.issubdtype(value_dtype, numpy.number) or\
-                        numpy.issubdtype(value_dtype, numpy.bool_):
-                    # straightforward conversion to HDF5
-                    results.create_dataset(output_key,
-                                           data=value)
-                elif numpy.issubdtype(value_dtype, numpy.character):
-                    # ensure utf-8 output
-                    results.create_dataset(output_key,
-                                           data=to_h5py_utf8(value))
-
-            plot = results.create_group("plot")
-            plot.attrs["NX_class"] = to_h5py_utf8("NXdata")
-            plot.attrs["signal"] = to_h5py_utf8("raw_data")
-            plot.attrs["auxiliary_signals"] = to_h5py_utf8(["fitted_data"])
-            plot.attrs["axes"] = to_h5py_utf8(["x"])
-            plot.attrs["title"] = to_h5py_utf8("Fit of '%s'" % legend)
-            signal = plot.create_dataset("raw_data", data=y)
-            if ylabel is not None:
-                signal.attrs["long_name"] = to_h5py_utf8(ylabel)
-            axis = plot.create_dataset("x", data=x)
-            if xlabel is not None:
-                axis.attrs["long_name"] = to_h5py_utf8(xlabel)
-            if sigma is not None:
-                plot.create_dataset("errors", data=sigma)
-            plot.create_dataset("fitted_data", data=fitted_data)
+        # Write the data to the opened output file
+        h5f = self._h5f
+        entry = h5f.create_group(self._entryNameFormat % idx)
+        entry.attrs["NX_class"] = to_h5py_utf8("NXentry")
+        entry.attrs["default"] = to_h5py_utf8("fit_process/results/plot")
+        entry.create_dataset("start_time",
+                             data=to_h5py_utf8(start_time))
+        entry.create_dataset("end_time", data=to_h5py_utf8(end_time))
+        entry.create_dataset("title",
+                             data=to_h5py_utf8("Fit of '%s'" % legend))
+
+        process = entry.create_group("fit_process")
+        process.attrs["NX_class"] = to_h5py_utf8("NXprocess")
+        process.create_dataset("program", data=to_h5py_utf8("pymca"))
+        process.create_dataset("version", data=to_h5py_utf8(PyMca5.version()))
+        process.create_dataset("date", data=to_h5py_utf8(end_time))
+
+        configuration = process.create_group("configuration")
+        configuration.attrs["NX_class"] = to_h5py_utf8("NXnote")
+        configuration.create_dataset("type", data=to_h5py_utf8("text/plain"))
+        configuration.create_dataset("data", data=to_h5py_utf8(configIni))
+        configuration.create_dataset("file_name", data=to_h5py_utf8("SimpleFit.ini"))
+        configuration.create_dataset("description",
+                                     data=to_h5py_utf8("Fit configuration"))
+
+        results = process.create_group("results")
+        results.attrs["NX_class"] = to_h5py_utf8("NXcollection")
+
+        estimation = results.create_group("estimation")
+        estimation.attrs["NX_class"] = to_h5py_utf8("NXcollection")
+
+        for p in fit_paramlist:
+            pgroup = estimation.create_group(p["name"])
+            # constraint code can be an int, convert to str
+            if numpy.issubdtype(numpy.array(p['code']).dtype,
+                                numpy.integer):
+                pgroup.create_dataset('code', data=to_h5py_utf8(CONS[p['code']]))
+            else:
+                pgroup.create_dataset('code', data=to_h5py_utf8(p['code']))
+            pgroup.create_dataset('cons1', data=p['cons1'])
+            pgroup.create_dataset('cons2', data=p['cons2'])
+            pgroup.create_dataset('estimation', data=p['estimation'])
+
+        for key, value in resultDict.items():
+            if not numpy.issubdtype(type(key), numpy.character):
+                _logger.debug("skipping key %s (not a text string)", key)
+                continue
+            if key == "fittedvalues":
+                output_key = "parameter_values"
+            elif key == "parameters":
+                output_key = "parameter_names"
+            elif key == "sigma_values":
+                output_key = "parameter_sigmas"
+            else:
+                output_key = key
+
+            value_dtype = numpy.array(value).dtype
+            if numpy.issubdtype(value_dtype, numpy.number) or\
+                    numpy.issubdtype(value_dtype, numpy.bool_):
+                # straightforward conversion to HDF5
+                results.create_dataset(output_key,
+                                       data=value)
+            elif numpy.issubdtype(value_dtype, numpy.character):
+                # ensure utf-8 output
+                results.create_dataset(output_key,
+                                       data=to_h5py_utf8(value))
+
+        plot = results.create_group("plot")
+        plot.attrs["NX_class"] = to_h5py_utf8("NXdata")
+        plot.attrs["signal"] = to_h5py_utf8("raw_data")
+        plot.attrs["auxiliary_signals"] = to_h5py_utf8(["fitted_data"])
+        plot.attrs["axes"] = to_h5py_utf8(["x"])
+        plot.attrs["title"] = to_h5py_utf8("Fit of '%s'" % legend)
+        signal = plot.create_dataset("raw_data", data=y)
+        if ylabel is not None:
+            signal.attrs["long_name"] = to_h5py_utf8(ylabel)
+        axis = plot.create_dataset("x", data=x)
+        if xlabel is not None:
+            axis.attrs["long_name"] = to_h5py_utf8(xlabel)
+        if sigma is not None:
+            plot.create_dataset("errors", data=sigma)
+        plot.create_dataset("fitted_data", data=fitted_data)
 
     def getOutputFileName(self):
         return os.path.join(self.outputDir,
                             self.outputFileName)
 
-    def _isSummaryEntryAcceptable(self):
-        if self._referenceParameters is not None:
-            if self._nSpectra > 1:
-                return True
-
-    def _createSummaryEntry(self):
-        filename = self.getOutputFileName()
-        with h5py.File(filename, mode="r+") as h5f:
-            for idx in range(self._nSpectra):
-                inputEntryName = os.path.join("/", self._entryNameFormat % idx)
-                inputEntry = h5f[inputEntryName]
-                start_time = inputEntry["start_time"]
-                end_time = inputEntry["end_time"]
-                chisq = inputEntry["fit_process/results/chisq"]
-                parameterValues = inputEntry["fit_process/results/parameter_values"]
-                parameterErrors = inputEntry["fit_process/results/parameter_sigmas"]
-                parameterNames = inputEntry["fit_process/results/parameter_names"]
-                if idx == 0:
-                    entry = h5f.create_group("fit_summary")
-                    entry.attrs["NX_class"] = u"NXentry"
-                    entry.attrs["default"] = u"result"
-                    entry["start_time"] = to_h5py_utf8(datetime.datetime.now().isoformat())
-                    result = entry.create_group("result")
-                    result.attrs["NX_class"] = u"NXdata"
-                    result.attrs["axes"] = to_h5py_utf8(["index"])
-                    result.attrs["signal"] = to_h5py_utf8("chisq")
-                    result["index"] = numpy.arange(self._nSpectra)
-                    result.create_dataset("chisq",
-                                          shape=(self._nSpectra,),
-                                          dtype=numpy.float32)
-                    for parameter0 in parameterNames:
-                        parameter = to_utf8(parameter0)
-                        result.create_dataset(parameter,
-                                              shape=(self._nSpectra,),
-                                              dtype=numpy.float32)
-                        result.create_dataset(parameter + "_errors",
-                                              shape=(self._nSpectra,),
-                                              dtype=numpy.float32)
-                        result.create_dataset(parameter + "_estimation",
-                                              shape=(self._nSpectra,),
-                                              dtype=numpy.float32)
-                result["chisq"][idx] = chisq
-                for par in range(len(parameterNames)):
-                    parameter = to_utf8(parameterNames[par])
-                    estimationName = "fit_process/results/estimation/%s/estimation" % \
-                                     parameter
-                    estimation = inputEntry[estimationName]
-                    result[parameter][idx] = parameterValues[par]
-                    result[parameter + "_errors"][idx] = parameterErrors[par]
-                    result[parameter + "_estimation"][idx] = estimation
-            
-            entry["end_time"] = to_h5py_utf8(datetime.datetime.now().isoformat())
-            first = self._entryNameFormat % 0
-            last = self._entryNameFormat % (self._nSpectra - 1)
-            entry["title"] = "Summary of %s to %s" % (first, last)
-            
     def onProcessSpectraFinished(self):
         _logger.debug("All curves processed")
         self._status = "Curves Fitting finished"
-        if self._isSummaryEntryAcceptable():
-            self._createSummaryEntry()
+        if self._output is not None:
+            self._output.close()
@@ -39,6 +39,7 @@
 import types
 import logging
 from . import Gefit
+from . import StackGefit
 from . import SpecfitFuns
 from PyMca5 import getDefaultUserFitFunctionsDirectory
 
@@ -55,6 +56,10 @@ def __init__(self):
         self._x0 = None
         self._y0 = None
 
+        #strip background and the data and configuration it comes from
+        self._z = None
+        self._stripInput = None
+
         #get default configuration
         self.getDefaultConfiguration()
 
@@ -144,18 +149,7 @@ def setConfiguration(self, ddict, try_import=False):
                          xmax=self._fitConfiguration['fit']['xmax'])
             return
 
-        for key in ['strip_flag', 'stripanchorsflag', 'stripalgorithm',
-                    'stripwidth', 'stripiterations', 'stripconstant']:
-            if oldConfig['fit'][key] != self._fitConfiguration['fit'][key]:
-                _logger.debug("RECALCULATING STRIP")
-                self._getStripBackground()
-                break
-            if key == 'stripanchorsflag':
-                if len(oldConfig['fit']['stripanchorslist']) !=\
-                   len(self._fitConfiguration['fit']['stripanchorslist']):
-                    _logger.debug("ANCHORS CHANGE, RECALCULATING STRIP")
-                    self._getStripBackground()
-                    break
+        self._updateStripBackground()
 
     def getConfiguration(self):
         ddict = {}
@@ -206,7 +200,7 @@ def setData(self, x, y, sigma=None, xmin=None, xmax=None, **kw):
             self._sigma = self._sigma0[idx]
         _logger.debug("TODO: Make sure we have something to fit")
         #get strip/SNIP background
-        self._z = self._getStripBackground()
+        self._updateStripBackground()
 
     def importFunctions(self, modname):
         #modname can be a module or a file
@@ -242,6 +236,14 @@ def importFunctions(self, modname):
             derivative=newfun.DERIVATIVE
         except Exception:
             derivative=None
+        try:
+            jacobian=newfun.JACOBIAN
+        except Exception:
+            jacobian=None
+        try:
+            stackFunction=newfun.STACK_FUNCTION
+        except Exception:
+            stackFunction=None
         try:
             configure=newfun.CONFIGURE
         except Exception:
@@ -260,6 +262,8 @@ def importFunctions(self, modname):
             ddict['default_parameters'] = None
             ddict['estimate']   = None
             ddict['derivative'] = None
+            ddict['jacobian']   = None
+            ddict['stack_function'] = None
             ddict['configure']  = None
             ddict['widget']     = None
             ddict['file']       = newfun.__file__
@@ -268,6 +272,10 @@ def importFunctions(self, modname):
                 ddict['estimate'] = estimate[i]
             if derivative is not None:
                 ddict['derivative'] = derivative[i]
+            if jacobian is not None:
+                ddict['jacobian'] = jacobian[i]
+            if stackFunction is not None:
+                ddict['stack_function'] = stackFunction[i]
             if configure is not None:
                 ddict['configure'] = configure[i]
                 if ddict['configure'] is not None:
@@ -297,6 +305,8 @@ def _importSilxFunctions(self, mod):
             ddict['default_parameters'] = None
             ddict['estimate']   = self._wrapSilxEstimate(theory.estimate)
             ddict['derivative'] = self._wrapSilxDerivate(theory.derivative)
+            ddict['jacobian']   = None
+            ddict['stack_function'] = None
             ddict['configure']  = theory.configure
             ddict['widget']     = None
             ddict['file']       = mod.__file__
@@ -390,6 +400,33 @@ def _getLimits(self, x, xmin, xmax):
             xmax = x[-1]
         return xmin, xmax
 
+    def _getStripKey(self):
+        ddict = self._fitConfiguration['fit']
+        key = [ddict.get(name) for name in ['stripanchorsflag',
+                                            'stripalgorithm',
+                                            'stripwidth',
+                                            'stripiterations',
+                                            'stripconstant',
+                                            'snipwidth',
+                                            'stripfilterwidth']]
+        key.append(tuple(ddict.get('stripanchorslist') or []))
+        return tuple(key)
+
+    def _updateStripBackground(self):
+        """
+        Calculate the strip/SNIP background of the current data unless
+        neither the data nor the strip configuration changed since the
+        last calculation.
+        """
+        key = self._getStripKey()
+        if (self._stripInput is None) or \
+           (self._stripInput[0] is not self._y) or \
+           (self._stripInput[1] != key):
+            _logger.debug("CALCULATING STRIP BACKGROUND")
+            self._z = self._getStripBackground()
+            self._stripInput = self._y, key
+        return self._z
+
     def _getStripBackground(self, x=None, y=None):
         #this makes the assumption x are equally spaced
         #and I should build a spline if that is not the case
@@ -657,7 +694,7 @@ def estimateBackground(self):
         return parameters, constraints
 
     def estimateFunction(self):
-        self._z = self._getStripBackground()
+        self._updateStripBackground()
         fname = self.getFitFunction()
         if fname is None:
             return [],[[],[],[]]
@@ -692,32 +729,20 @@ def startFit(self):
             self._setStatus("No data to be fitted")
             return
         self._setStatus("Fit started")
-        param_list = self.final_theory
-        length      = len(param_list)
-        param_val   = []
-        param_constrains   = [[],[],[]]
+        fitInput = self.getFitInput()
+        param_val = fitInput['parameters']
+        param_constrains = fitInput['constrains']
         flagconstrained=0
-        for param in self.paramlist:
-            #print param['name'],param['group'],param['estimation']
-            param_val.append(param['estimation'])
-            if (param['code'] != 'FREE') & (param['code'] != 0) & \
-               (param['code'] != 0.0) :
+        for code in param_constrains[0]:
+            if (code != 'FREE') & (code != 0) & (code != 0.0):
                 flagconstrained=1
-            param_constrains [0].append(param['code'])
-            param_constrains [1].append(param['cons1'])
-            param_constrains [2].append(param['cons2'])
 
         #weight handling
-        if self._fitConfiguration['fit']['weight'] in ["NO Weight", 0]:
-            weightflag = 0
-        else:
-            weightflag = 1
+        weightflag = self._getWeightFlag()
         _logger.debug("STILL TO HANDLE DERIVATIVES")
         model_deriv = self.modelFunctionDerivative
-        if self._fitConfiguration['fit']['strip_flag']:
-            y = self._y - self._z
-        else:
-            y = self._y
+        model_jacobian = self.modelFunctionJacobian
+        y = fitInput['y']
         self._fitResult = None
         if not flagconstrained:
             param_constrains = []
@@ -729,6 +754,7 @@ def startFit(self):
                     constrains=param_constrains,
                     weightflag=weightflag,
                     model_deriv=model_deriv,
+                    model_jacobian=model_jacobian,
                     fulloutput=True)
         except Exception:
             if _logger.getEffectiveLevel() == logging.DEBUG:
@@ -764,6 +790,128 @@ def startFit(self):
         self._setStatus("Fit finished")
         return result
 
+    def getFitInput(self):
+        """
+        Returns a dictionary with the x, y and sigma values to be fitted,
+        the starting values of the parameters and their constraints as
+        used by startFit, the parameter names and the number of background
+        parameters.
+        """
+        ddict = {}
+        ddict['x'] = self._x
+        if self._fitConfiguration['fit']['strip_flag']:
+            ddict['y'] = self._y - self._z
+        else:
+            ddict['y'] = self._y
+        ddict['sigma'] = self._sigma
+        ddict['parameters'] = []
+        ddict['constrains'] = [[],[],[]]
+        ddict['names'] = []
+        for param in self.paramlist:
+            ddict['parameters'].append(param['estimation'])
+            ddict['constrains'][0].append(param['code'])
+            ddict['constrains'][1].append(param['cons1'])
+            ddict['constrains'][2].append(param['cons2'])
+            ddict['names'].append(param['name'])
+        ddict['n_background_parameters'] = self.__nBackgroundParameters
+        return ddict
+
+    def _getWeightFlag(self):
+        if self._fitConfiguration['fit']['weight'] in ["NO Weight", 0]:
+            return 0
+        else:
+            return 1
+
+    def _getStackFunctions(self):
+        # function dictionaries of the background and of the fit function
+        # (None if not used)
+        fit = self._fitConfiguration['fit']
+        functions = self._fitConfiguration['functions']
+        result = []
+        for flag, name in [('background_flag', 'background_function'),
+                           ('function_flag', 'fit_function')]:
+            if fit[flag] and (fit[name] not in [None, "None", "NONE"]):
+                result.append(functions[fit[name]])
+            else:
+                result.append(None)
+        return result
+
+    def isStackFitAvailable(self):
+        """
+        True if the background and the fit function can be evaluated for
+        many spectra at once and therefore startStackFit can be used.
+        """
+        for ddict in self._getStackFunctions():
+            if ddict is None:
+                continue
+            if ddict.get('stack_function', None) is None:
+                return False
+        return True
+
+    def startStackFit(self, x, y, parameters, constrains, sigma=None,
+                      nbackground=0):
+        """
+        Fit at once the spectra given as the rows of y sharing the abscissa x.
+
+        parameters - array of shape (n_spectra, n_parameters) with the starting
+                     values of the parameters
+        constrains - constraints as in Gefit. The codes are shared by all the
+                     spectra and the values can be given per spectrum as arrays
+                     of shape (n_spectra, n_parameters)
+        nbackground - number of background parameters
+
+        The output is the one of StackGefit.LeastSquaresFit with one row of
+        values per spectrum.
+        """
+        background, function = self._getStackFunctions()
+        if not self.isStackFitAvailable():
+            raise TypeError("Fit functions cannot be evaluated for many spectra")
+        def model(pars, t):
+            return self.stackModelFunction(pars, t, nbackground)
+        jacobian = None
+        if all([ddict['jacobian'] is not None
+                for ddict in (background, function) if ddict is not None]):
+            def jacobian(pars, t):
+                return self.stackModelFunctionJacobian(pars, t, nbackground)
+        return StackGefit.LeastSquaresFit(model, parameters,
+                                          xdata=x,
+                                          ydata=y,
+                                          sigmadata=sigma,
+                                          constrains=constrains,
+                                          weightflag=self._getWeightFlag(),
+                                          model_jacobian=jacobian,
+                                          fulloutput=True)
+
+    def stackModelFunction(self, pars, t, nbackground=None):
+        """
+        Model function evaluated for the parameters of many spectra given
+        as the rows of pars.
+        """
+        if nbackground is None:
+            nbackground = self.__nBackgroundParameters
+        background, function = self._getStackFunctions()
+        result = numpy.zeros((pars.shape[0], numpy.size(t)), numpy.float64)
+        if nbackground:
+            result += background['stack_function'](pars[:, :nbackground], t)
+        if pars.shape[1] > nbackground:
+            result += function['stack_function'](pars[:, nbackground:], t)
+        return result
+
+    def stackModelFunctionJacobian(self, pars, t, nbackground=None):
+        """
+        Derivatives of stackModelFunction respect to all the parameters
+        as an array of shape (n_spectra, n_parameters, len(t))
+        """
+        if nbackground is None:
+            nbackground = self.__nBackgroundParameters
+        background, function = self._getStackFunctions()
+        result = numpy.zeros(pars.shape + (numpy.size(t),), numpy.float64)
+        if nbackground:
+            result[:, :nbackground] = background['jacobian'](pars[:, :nbackground], t)
+        if pars.shape[1] > nbackground:
+            result[:, nbackground:] = function['jacobian'](pars[:, nbackground:], t)
+        return result
+
     def modelFunction(self, pars, t):
         result = 0.0 * t
 
@@ -797,6 +945,34 @@ def numericDerivative(self, f, parameters, index, x):
     def modelFunctionDerivative(self, pars, index, x):
         return self.numericDerivative(self.modelFunction, pars, index, x)
 
+    def modelFunctionJacobian(self, pars, indices, x):
+        """
+        Derivatives of the model function respect to the parameters given by
+        the indices as an array of shape (len(indices), len(x)). Analytical
+        derivatives of the background and of the fit function are used when
+        available, numerical derivatives otherwise.
+        """
+        indices = numpy.asarray(indices, dtype=numpy.intp)
+        result = numpy.zeros((indices.size, numpy.size(x)), numpy.float64)
+        nb = self.__nBackgroundParameters
+        functions = self._fitConfiguration['functions']
+        parts = []
+        if nb:
+            parts.append((functions[self.getBackgroundFunction()], 0, nb))
+        if len(self.paramlist) > nb:
+            parts.append((functions[self.getFitFunction()], nb, len(pars)))
+        numeric = numpy.ones(indices.shape, dtype=bool)
+        for ddict, start, stop in parts:
+            jacobian = ddict.get('jacobian', None)
+            rows = numpy.nonzero((indices >= start) & (indices < stop))[0]
+            if (jacobian is None) or (not rows.size):
+                continue
+            result[rows] = jacobian(pars[start:stop], x)[indices[rows] - start]
+            numeric[rows] = False
+        for row in numpy.nonzero(numeric)[0]:
+            result[row] = self.modelFunctionDerivative(pars, indices[row], x)
+        return result
+
     def getResult(self, configuration=False):
         #print " get results to be implemented"
         ddict = {}
@@ -108,6 +108,9 @@
 CSUM        = 6
 CIGNORED    = 7
 
+# conversion factor from FWHM to the standard deviation of a gaussian
+TOSIGMA = 1.0 / (2.0 * numpy.sqrt(2.0 * numpy.log(2.0)))
+
 
 class SpecfitFunctions(object):
     def __init__(self,config=None):
@@ -115,6 +118,23 @@ def __init__(self,config=None):
             self.config=SPECFITFUNCTIONS_DEFAULTS
         else:
             self.config=config
+        # last spectrum given to estimateStrip and its strip background
+        self._lastStrip = None
+
+    def estimateStrip(self, yy):
+        """
+        Strip background used by the estimations. The background and the
+        peak estimations of a spectrum share the calculation.
+        """
+        yy = numpy.asarray(yy)
+        lastStrip = self._lastStrip
+        if lastStrip is not None:
+            lastY, lastZ = lastStrip
+            if (lastY.shape == yy.shape) and numpy.array_equal(lastY, yy):
+                return lastZ.copy()
+        zz = SpecfitFuns.subac(yy, 1.000, 10000)
+        self._lastStrip = numpy.array(yy, copy=True), zz.copy()
+        return zz
 
     def gauss(self,pars,x):
        """
@@ -265,6 +285,211 @@ def bkg_none(self,pars,x):
         """
         return numpy.zeros(x.shape,numpy.float64)
 
+    def stack_gauss(self, pars, x):
+        """
+        Gaussians evaluated with numpy. The parameters can have leading
+        dimensions (one set of parameters per spectrum) and the output
+        has then the shape pars.shape[:-1] + (len(x),)
+        """
+        (height, position, fwhm), x = self._peakParameters(pars, x, 3)
+        u, g = self._gaussianTerms(position, fwhm, x, 20)
+        return (height * g).sum(axis=-2)
+
+    def stack_agauss(self, pars, x):
+        """
+        Area gaussians evaluated with numpy (see stack_gauss)
+        """
+        (area, position, fwhm), x = self._peakParameters(pars, x, 3)
+        u, g = self._gaussianTerms(position, fwhm, x, 35)
+        return (area * g / (fwhm * TOSIGMA * numpy.sqrt(2.0 * numpy.pi))).sum(axis=-2)
+
+    def stack_lorentz(self, pars, x):
+        """
+        Lorentzians evaluated with numpy (see stack_gauss)
+        """
+        (height, position, fwhm), x = self._peakParameters(pars, x, 3)
+        v, d = self._lorentzianTerms(position, fwhm, x)
+        return (height / d).sum(axis=-2)
+
+    def stack_alorentz(self, pars, x):
+        """
+        Area lorentzians evaluated with numpy (see stack_gauss)
+        """
+        (area, position, fwhm), x = self._peakParameters(pars, x, 3)
+        v, d = self._lorentzianTerms(position, fwhm, x)
+        return (area / (0.5 * numpy.pi * fwhm * d)).sum(axis=-2)
+
+    def stack_pvoigt(self, pars, x):
+        """
+        Pseudo-Voigt functions evaluated with numpy (see stack_gauss)
+        """
+        (height, position, fwhm, eta), x = self._peakParameters(pars, x, 4)
+        u, g = self._gaussianTerms(position, fwhm, x, 35)
+        v, d = self._lorentzianTerms(position, fwhm, x)
+        return (height * (eta / d + (1.0 - eta) * g)).sum(axis=-2)
+
+    def stack_apvoigt(self, pars, x):
+        """
+        Area pseudo-Voigt functions evaluated with numpy (see stack_gauss)
+        """
+        (area, position, fwhm, eta), x = self._peakParameters(pars, x, 4)
+        u, g = self._gaussianTerms(position, fwhm, x, 35)
+        v, d = self._lorentzianTerms(position, fwhm, x)
+        lorentzian = 1.0 / (0.5 * numpy.pi * fwhm * d)
+        gaussian = g / (fwhm * TOSIGMA * numpy.sqrt(2.0 * numpy.pi))
+        return (area * (eta * lorentzian + (1.0 - eta) * gaussian)).sum(axis=-2)
+
+    def stack_bkg_constant(self, pars, x):
+        """
+        Constant background evaluated with numpy (see stack_gauss)
+        """
+        pars = numpy.asarray(pars, dtype=numpy.float64)
+        x = numpy.asarray(x, dtype=numpy.float64).reshape(-1)
+        return pars[..., 0:1] * numpy.ones_like(x)
+
+    def stack_bkg_linear(self, pars, x):
+        """
+        Linear background evaluated with numpy (see stack_gauss)
+        """
+        pars = numpy.asarray(pars, dtype=numpy.float64)
+        x = numpy.asarray(x, dtype=numpy.float64).reshape(-1)
+        return pars[..., 0:1] + pars[..., 1:2] * x
+
+    def jacobian_gauss(self, pars, x):
+        """
+        Derivatives of gauss respect to all its parameters as an array
+        of shape (len(pars), len(x)). Leading dimensions of the parameters
+        are kept (see stack_gauss).
+        """
+        (height, position, fwhm), x = self._peakParameters(pars, x, 3)
+        u, g = self._gaussianTerms(position, fwhm, x, 20)
+        return self._peakJacobian([g,
+                                   height * g * u / (fwhm * TOSIGMA),
+                                   height * g * u * u / fwhm])
+
+    def jacobian_agauss(self, pars, x):
+        """
+        Derivatives of agauss respect to all its parameters as an array
+        of shape (len(pars), len(x)). Leading dimensions of the parameters
+        are kept (see stack_gauss).
+        """
+        (area, position, fwhm), x = self._peakParameters(pars, x, 3)
+        u, g = self._gaussianTerms(position, fwhm, x, 35)
+        sigma = fwhm * TOSIGMA
+        g /= sigma * numpy.sqrt(2.0 * numpy.pi)
+        return self._peakJacobian([g,
+                                   area * g * u / sigma,
+                                   area * g * (u * u - 1.0) / fwhm])
+
+    def jacobian_lorentz(self, pars, x):
+        """
+        Derivatives of lorentz respect to all its parameters as an array
+        of shape (len(pars), len(x)). Leading dimensions of the parameters
+        are kept (see stack_gauss).
+        """
+        (height, position, fwhm), x = self._peakParameters(pars, x, 3)
+        v, d = self._lorentzianTerms(position, fwhm, x)
+        f = height / (d * d)
+        return self._peakJacobian([1.0 / d,
+                                   4.0 * f * v / fwhm,
+                                   2.0 * f * v * v / fwhm])
+
+    def jacobian_alorentz(self, pars, x):
+        """
+        Derivatives of alorentz respect to all its parameters as an array
+        of shape (len(pars), len(x)). Leading dimensions of the parameters
+        are kept (see stack_gauss).
+        """
+        (area, position, fwhm), x = self._peakParameters(pars, x, 3)
+        v, d = self._lorentzianTerms(position, fwhm, x)
+        l = 1.0 / (0.5 * numpy.pi * fwhm * d)
+        f = area * l
+        return self._peakJacobian([l,
+                                   4.0 * f * v / (fwhm * d),
+                                   f * (2.0 * v * v / d - 1.0) / fwhm])
+
+    def jacobian_pvoigt(self, pars, x):
+        """
+        Derivatives of pvoigt respect to all its parameters as an array
+        of shape (len(pars), len(x)). Leading dimensions of the parameters
+        are kept (see stack_gauss).
+        """
+        (height, position, fwhm, eta), x = self._peakParameters(pars, x, 4)
+        u, g = self._gaussianTerms(position, fwhm, x, 35)
+        v, d = self._lorentzianTerms(position, fwhm, x)
+        l = 1.0 / d
+        fl = eta * height * l * l
+        fg = (1.0 - eta) * height * g
+        return self._peakJacobian([eta * l + (1.0 - eta) * g,
+                                   4.0 * fl * v / fwhm + \
+                                   fg * u / (fwhm * TOSIGMA),
+                                   (2.0 * fl * v * v + fg * u * u) / fwhm,
+                                   height * (l - g)])
+
+    def jacobian_apvoigt(self, pars, x):
+        """
+        Derivatives of apvoigt respect to all its parameters as an array
+        of shape (len(pars), len(x)). Leading dimensions of the parameters
+        are kept (see stack_gauss).
+        """
+        (area, position, fwhm, eta), x = self._peakParameters(pars, x, 4)
+        u, g = self._gaussianTerms(position, fwhm, x, 35)
+        v, d = self._lorentzianTerms(position, fwhm, x)
+        sigma = fwhm * TOSIGMA
+        l = 1.0 / (0.5 * numpy.pi * fwhm * d)
+        g /= sigma * numpy.sqrt(2.0 * numpy.pi)
+        fl = eta * area * l
+        fg = (1.0 - eta) * area * g
+        return self._peakJacobian([eta * l + (1.0 - eta) * g,
+                                   4.0 * fl * v / (fwhm * d) + fg * u / sigma,
+                                   (fl * (2.0 * v * v / d - 1.0) + \
+                                    fg * (u * u - 1.0)) / fwhm,
+                                   area * (l - g)])
+
+    def jacobian_bkg_constant(self, pars, x):
+        """
+        Derivative of the constant background
+        """
+        shape = numpy.shape(pars)[:-1] + (1, numpy.size(x))
+        return numpy.ones(shape, numpy.float64)
+
+    def jacobian_bkg_linear(self, pars, x):
+        """
+        Derivatives of the linear background
+        """
+        shape = numpy.shape(pars)[:-1] + (2, numpy.size(x))
+        result = numpy.ones(shape, numpy.float64)
+        result[..., 1, :] = numpy.ravel(x)
+        return result
+
+    @staticmethod
+    def _peakParameters(pars, x, npars):
+        # list with the npars parameters of each peak as arrays of shape
+        # (..., npeaks, 1) and x as a 1D array
+        pars = numpy.asarray(pars, dtype=numpy.float64)
+        pars = pars.reshape(pars.shape[:-1] + (-1, npars, 1))
+        x = numpy.asarray(x, dtype=numpy.float64).reshape(-1)
+        return [pars[..., i, :] for i in range(npars)], x
+
+    @staticmethod
+    def _gaussianTerms(position, fwhm, x, cutoff):
+        # normalized distance and exponential term as computed by SpecfitFuns
+        u = (x - position) / (fwhm * TOSIGMA)
+        g = numpy.where(u <= cutoff, numpy.exp(-0.5 * u * u), 0.0)
+        return u, g
+
+    @staticmethod
+    def _lorentzianTerms(position, fwhm, x):
+        v = (x - position) / (0.5 * fwhm)
+        return v, 1.0 + v * v
+
+    @staticmethod
+    def _peakJacobian(derivatives):
+        # derivatives respect to each peak parameter, shape (..., npeaks, nx),
+        # as a single (..., npeaks * npars, nx) array
+        result = numpy.stack(numpy.broadcast_arrays(*derivatives), axis=-2)
+        return result.reshape(result.shape[:-3] + (-1, result.shape[-1]))
+
     def fun(self,param, t):
         gterm = param[2] * numpy.exp(-0.5 * ((t - param[3]) * (t - param[3]))/param[4])
         #gterm = gterm + param[3] * numpy.exp(-0.5 * ((t - param[4]) * (t - param[4]))/param[5])
@@ -387,7 +612,7 @@ def estimate_constant(self, xx, yy, zzz, xscaling=1.0, yscaling=None):
 
     def estimate_linear(self, xx, yy, zzz, xscaling=1.0, yscaling=None):
         # compute strip bg and use it to estimate the linear bg parameters
-        zz = SpecfitFuns.subac(yy, 1.000, 10000)
+        zz = self.estimateStrip(yy)
         n = float(len(zz))
         Sy = numpy.sum(zz)
         Sx = float(numpy.sum(xx))
@@ -415,7 +640,7 @@ def estimate_gauss(self,xx,yy,zzz,xscaling=1.0,yscaling=None):
        if yscaling == 0:
             yscaling=1.0
        fittedpar=[]
-       zz=SpecfitFuns.subac(yy,1.000,10000)
+       zz=self.estimateStrip(yy)
 
        npoints = len(zz)
        if self.config['AutoFwhm']:
@@ -1078,7 +1303,7 @@ def estimate_periodic_gauss(self,xx,yy,zzz,xscaling=1.0,yscaling=None):
         if yscaling == 0:
             yscaling=1.0
         fittedpar=[]
-        zz=SpecfitFuns.subac(yy,1.000,10000)
+        zz=self.estimateStrip(yy)
 
         npoints = len(zz)
         if self.config['AutoFwhm']:
@@ -1280,6 +1505,46 @@ def configure(self, *vars, **kw):
            fitfuns.configure,
            fitfuns.configure]
 
+# analytical derivatives respect to all the parameters at once
+# (None if the derivatives have to be obtained numerically)
+JACOBIAN=[fitfuns.jacobian_gauss,
+          fitfuns.jacobian_lorentz,
+          fitfuns.jacobian_agauss,
+          fitfuns.jacobian_alorentz,
+          fitfuns.jacobian_pvoigt,
+          fitfuns.jacobian_apvoigt,
+          None,
+          None,
+          None,
+          None,
+          None,
+          None,
+          None,
+          None,
+          None,
+          fitfuns.jacobian_bkg_constant,
+          fitfuns.jacobian_bkg_linear]
+
+# numpy versions of the functions accepting one set of parameters per
+# spectrum to fit many spectra at once (None if not available)
+STACK_FUNCTION=[fitfuns.stack_gauss,
+                fitfuns.stack_lorentz,
+                fitfuns.stack_agauss,
+                fitfuns.stack_alorentz,
+                fitfuns.stack_pvoigt,
+                fitfuns.stack_apvoigt,
+                None,
+                None,
+                None,
+                None,
+                None,
+                None,
+                None,
+                None,
+                None,
+                fitfuns.stack_bkg_constant,
+                fitfuns.stack_bkg_linear]
+
 def test(a):
     from PyMca5.PyMcaGui import PyMcaQt as qt
     from PyMca5.PyMcaMath.fitting import Specfit
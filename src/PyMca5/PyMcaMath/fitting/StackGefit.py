@@ -0,0 +1,446 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2025 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+"""
+Levenberg-Marquardt fit of many independent spectra sharing the abscissa
+and the fit model.
+
+The iterations of all the spectra are performed in lock-step on arrays of
+shape (n_spectra, n_parameters) and each spectrum leaves the calculation as
+soon as its fit is finished. The algorithm and the handling of the
+constraints follow the ones of Gefit.
+"""
+import logging
+import numpy
+from .Gefit import CFREE, CPOSITIVE, CQUOTED, CFIXED, \
+                   CFACTOR, CDELTA, CSUM, CIGNORED
+
+_logger = logging.getLogger(__name__)
+
+CODES = {"FREE": CFREE,
+         "POSITIVE": CPOSITIVE,
+         "QUOTED": CQUOTED,
+         "FIXED": CFIXED,
+         "FACTOR": CFACTOR,
+         "DELTA": CDELTA,
+         "SUM": CSUM,
+         "IGNORED": CIGNORED,
+         "IGNORE": CIGNORED}
+
+
+def LeastSquaresFit(model, parameters0, xdata, ydata, sigmadata=None,
+                    constrains=None, weightflag=0, model_jacobian=None,
+                    maxiter=100, deltachi=None, fulloutput=0):
+    """
+    Typical use:
+
+    LeastSquaresFit(model_function, parameters, xdata=xvalues, ydata=yvalues)
+
+        model_function - it has the form model_function(parameters, x) where
+                         parameters is an array of shape (n_spectra, n_parameters)
+                         and x the array of values in which the function is to be
+                         evaluated. It has to return an array of shape
+                         (n_spectra, len(x)).
+
+        parameters - array of shape (n_spectra, n_parameters) with the initial
+                     values to be refined
+
+        xdata - 1D array with the x axis data points common to all the spectra
+
+        ydata - array of shape (n_spectra, len(xdata)) with the spectra
+
+    Additional keywords:
+
+        sigmadata - array with the uncertainties associated to ydata
+
+        weightflag - 0 Means no weighted fit 1 means weighted fit
+
+        constrains - if provided, it is a sequence of three elements with the
+                     same meaning as in Gefit.LeastSquaresFit. The constraint
+                     codes are shared by all the spectra. The second and the
+                     third elements can be arrays of shape (n_spectra, n_parameters)
+                     to give different limits, factors, ... to each spectrum.
+                     The index of the parameter to which a parameter is related
+                     has to be the same for all the spectra.
+
+        model_jacobian - function providing the derivatives of the fitting function
+                     respect to all its parameters. It is called as
+                     model_jacobian(parameters, x) and it has to return an array of
+                     shape (n_spectra, n_parameters, len(x)). Derivatives are
+                     calculated numerically when not given.
+
+        maxiter - Maximum number of iterations (default is 100)
+
+        deltachi - Minimum relative decrease of chi square (default is 0.01)
+
+    Ignored parameters are removed from the parameters given to the model
+    function and to its jacobian.
+
+    Output:
+
+        fitted_parameters, reduced_chi_square, uncertainties
+
+        and, if fulloutput is set, the number of iterations and the last
+        relative decrease of chi square of each spectrum.
+
+    The outputs of the spectra whose fit failed are set to NaN.
+    """
+    if deltachi is None:
+        deltachi = 0.01
+    x = numpy.asarray(xdata, dtype=numpy.float64).reshape(-1)
+    y = numpy.asarray(ydata, dtype=numpy.float64)
+    if y.ndim != 2:
+        raise ValueError("Spectra have to be given as a 2D array")
+    nSpectra, nChannels = y.shape
+    if nChannels != x.size:
+        raise ValueError("Spectra and x data have different lengths")
+    parameters = numpy.array(parameters0, dtype=numpy.float64, copy=True)
+    if parameters.ndim != 2 or parameters.shape[0] != nSpectra:
+        raise ValueError("Expected one row of parameters per spectrum")
+    nParameters = parameters.shape[1]
+
+    # weights
+    if weightflag == 1:
+        if sigmadata is not None:
+            dummy = numpy.abs(numpy.broadcast_to(sigmadata, y.shape))
+        else:
+            dummy = numpy.abs(y)
+        weight = 1.0 / (dummy + numpy.equal(dummy, 0))
+        if sigmadata is not None:
+            weight *= weight
+    else:
+        weight = numpy.ones(y.shape, numpy.float64)
+
+    cons = _Constraints(constrains, nSpectra, nParameters)
+    if not cons.free.size:
+        raise ValueError("No free parameters to fit")
+    valid = cons.validQuoted(parameters)
+
+    # as in Gefit, the first iteration only uses one point out of two
+    firstWeight = weight
+    if nParameters * 3 < nChannels:
+        firstWeight = weight.copy()
+        firstWeight[:, 1::2] = 0.0
+
+    def getweight(idx):
+        return numpy.where((niter[idx] < 2)[:, None], firstWeight[idx],
+                           weight[idx])
+
+    def chisqAlphaBeta(idx, fitted):
+        w = getweight(idx)
+        factor = cons.derivativeFactor(idx, fitted, valid[idx])
+        yfit = model(fitted[:, cons.noigno], x)
+        if model_jacobian is None:
+            deriv = numericJacobian(idx, fitted)
+        else:
+            deriv = cons.freeJacobian(idx, model_jacobian(fitted[:, cons.noigno], x))
+        deriv *= factor[:, :, None]
+        deltay = y[idx] - yfit
+        help0 = w * deltay
+        alpha = numpy.matmul(deriv * w[:, None, :],
+                             deriv.transpose(0, 2, 1))
+        beta = numpy.matmul(deriv, help0[:, :, None])[:, :, 0]
+        # keep the parameters not to be refined at their values
+        fixed = ~valid[idx]
+        if fixed.any():
+            i, j = numpy.nonzero(fixed)
+            alpha[i, j, :] = 0.0
+            alpha[i, :, j] = 0.0
+            alpha[i, j, j] = 1.0
+            beta[i, j] = 0.0
+        return (help0 * deltay).sum(axis=1), alpha, beta
+
+    def numericJacobian(idx, fitted):
+        fitparam = fitted[:, cons.free]
+        delta = (fitparam + numpy.equal(fitparam, 0.0)) * 0.00001
+        deriv = numpy.zeros((idx.size, cons.free.size, nChannels), numpy.float64)
+        for i in range(cons.free.size):
+            pwork = fitparam.copy()
+            pwork[:, i] = fitparam[:, i] + delta[:, i]
+            f1 = model(cons.getparameters(idx, parameters[idx], pwork)[:, cons.noigno], x)
+            pwork[:, i] = fitparam[:, i] - delta[:, i]
+            f2 = model(cons.getparameters(idx, parameters[idx], pwork)[:, cons.noigno], x)
+            deriv[:, i] = (f1 - f2) / (2.0 * delta[:, i:i + 1])
+        return deriv
+
+    nFree = cons.free.size
+    fittedpar = cons.getparameters(numpy.arange(nSpectra), parameters,
+                                   parameters[:, cons.free])
+    flambda = numpy.zeros(nSpectra, numpy.float64) + 0.001
+    iiter = numpy.zeros(nSpectra, numpy.int64) + maxiter
+    niter = numpy.zeros(nSpectra, numpy.int64)
+    lastdeltachi = numpy.zeros(nSpectra, numpy.float64)
+    chisq0 = numpy.zeros(nSpectra, numpy.float64)
+    alpha0 = numpy.zeros((nSpectra, nFree, nFree), numpy.float64)
+    beta = numpy.zeros((nSpectra, nFree), numpy.float64)
+    active = numpy.ones(nSpectra, dtype=bool)
+    update = numpy.ones(nSpectra, dtype=bool)
+    failed = numpy.zeros(nSpectra, dtype=bool)
+    diagonal = numpy.arange(nFree)
+    while True:
+        # new curvature matrix for the spectra that made a step
+        idx = numpy.nonzero(active & update)[0]
+        if idx.size:
+            niter[idx] += 1
+            chisq0[idx], alpha0[idx], beta[idx] = chisqAlphaBeta(idx,
+                                                                 fittedpar[idx])
+            lastdeltachi[idx] = chisq0[idx]
+            update[idx] = False
+        idx = numpy.nonzero(active)[0]
+        if not idx.size:
+            break
+        alpha = alpha0[idx]
+        alpha[:, diagonal, diagonal] *= 1.0 + flambda[idx][:, None]
+        deltapar, ok = _solve(alpha, beta[idx])
+        failed[idx[~ok]] = True
+        active[idx[~ok]] = False
+        idx = idx[ok]
+        if not idx.size:
+            continue
+        newfree = cons.step(idx, fittedpar[idx][:, cons.free], deltapar[ok],
+                            valid[idx])
+        newpar = cons.getparameters(idx, parameters[idx], newfree)
+        yfit = model(newpar[:, cons.noigno], x)
+        chisq = (getweight(idx) * pow(y[idx] - yfit, 2)).sum(axis=1)
+        better = chisq <= chisq0[idx]
+        # rejected steps
+        i = idx[~better]
+        flambda[i] *= 10.0
+        active[i[flambda[i] > 1000]] = False
+        # accepted steps
+        i = idx[better]
+        fittedpar[i] = newpar[better]
+        lastdeltachi[i] = (chisq0[i] - chisq[better]) / \
+                          (chisq0[i] + (chisq0[i] == 0))
+        chisq0[i] = chisq[better]
+        flambda[i] /= 10.0
+        iiter[i] -= 1
+        active[i[(lastdeltachi[i] < deltachi) | (iiter[i] < 1)]] = False
+        update[i] = True
+
+    inverse, ok = _solve(alpha0, None)
+    failed |= ~ok
+    sigma0 = numpy.sqrt(numpy.abs(inverse[:, diagonal, diagonal]))
+    sigmapar = cons.getsigmaparameters(fittedpar, sigma0, valid)
+    nPoints = numpy.zeros(nSpectra, numpy.int64) + nChannels
+    if firstWeight is not weight:
+        nPoints[niter < 2] = (nChannels + 1) // 2
+    chisq = chisq0 / (nPoints - valid.sum(axis=1))
+    if failed.any():
+        _logger.debug("Fit failed for %d spectra", failed.sum())
+        fittedpar[failed] = numpy.nan
+        sigmapar[failed] = numpy.nan
+        chisq[failed] = numpy.nan
+    if fulloutput:
+        return fittedpar, chisq, sigmapar, niter, lastdeltachi
+    else:
+        return fittedpar, chisq, sigmapar
+
+
+def _solve(alpha, beta):
+    """
+    Solve the systems alpha * delta = beta of all the spectra, or invert alpha
+    if beta is None. It returns the solutions and a mask of the spectra for
+    which the matrix is not singular.
+    """
+    ok = numpy.ones(alpha.shape[0], dtype=bool)
+    try:
+        if beta is None:
+            return numpy.linalg.inv(alpha), ok
+        return numpy.linalg.solve(alpha, beta[:, :, None])[:, :, 0], ok
+    except numpy.linalg.LinAlgError:
+        pass
+    # some singular matrix, go spectrum by spectrum
+    if beta is None:
+        result = numpy.zeros(alpha.shape, numpy.float64)
+    else:
+        result = numpy.zeros(beta.shape, numpy.float64)
+    for i in range(alpha.shape[0]):
+        try:
+            if beta is None:
+                result[i] = numpy.linalg.inv(alpha[i])
+            else:
+                result[i] = numpy.linalg.solve(alpha[i], beta[i])
+        except numpy.linalg.LinAlgError:
+            ok[i] = False
+    return result, ok
+
+
+class _Constraints(object):
+    """
+    Constraints of the parameters as arrays. The codes are common to all the
+    spectra and the values can be different for each spectrum.
+    """
+    def __init__(self, constrains, nSpectra, nParameters):
+        shape = (nSpectra, nParameters)
+        if not constrains:
+            constrains = [[CFREE] * nParameters, 0.0, 0.0]
+        codes = []
+        for code in constrains[0]:
+            if isinstance(code, str):
+                if code not in CODES:
+                    raise ValueError("Unknown constraint %s" % code)
+                code = CODES[code]
+            codes.append(int(code))
+        if len(codes) != nParameters:
+            raise ValueError("Expected one constraint per parameter")
+        self.codes = numpy.array(codes, dtype=numpy.int32)
+        self.cons1 = numpy.array(numpy.broadcast_to(\
+                        numpy.asarray(constrains[1], dtype=numpy.float64), shape))
+        self.cons2 = numpy.array(numpy.broadcast_to(\
+                        numpy.asarray(constrains[2], dtype=numpy.float64), shape))
+        self.free = numpy.nonzero(numpy.isin(self.codes,
+                                  [CFREE, CPOSITIVE, CQUOTED]))[0]
+        self.noigno = numpy.nonzero(self.codes != CIGNORED)[0]
+        self.quoted = numpy.nonzero(self.codes[self.free] == CQUOTED)[0]
+        self.positive = numpy.nonzero(self.codes == CPOSITIVE)[0]
+        # related parameters in the order getparameters applies them
+        self.related = []
+        for i in range(nParameters):
+            if self.codes[i] in [CFACTOR, CDELTA, CSUM]:
+                reference = self.cons1[:, i]
+                if numpy.any(reference != reference[0]):
+                    raise ValueError("Parameter %d related to different " \
+                                     "parameters in different spectra" % i)
+                self.related.append((i, self.codes[i], int(reference[0])))
+            elif self.codes[i] == CIGNORED:
+                self.related.append((i, CIGNORED, None))
+        pmax = numpy.maximum(self.cons1, self.cons2)
+        pmin = numpy.minimum(self.cons1, self.cons2)
+        self.A = 0.5 * (pmax + pmin)
+        self.B = 0.5 * (pmax - pmin)
+
+        # derivatives of the parameters seen by the model respect to the
+        # free parameters, only needed if some parameters are related
+        self._derivatives = None
+        if len([x for x in self.related if x[1] != CIGNORED]):
+            freeIndex = numpy.arange(self.free.size)
+            derivatives = numpy.zeros((nSpectra, nParameters, self.free.size),
+                                      numpy.float64)
+            derivatives[:, self.free, freeIndex] = 1.0
+            for i, code, reference in self.related:
+                if code == CFACTOR:
+                    derivatives[:, i] = self.cons2[:, i:i + 1] * \
+                                        derivatives[:, reference]
+                elif code == CDELTA:
+                    derivatives[:, i] = derivatives[:, reference]
+                elif code == CSUM:
+                    derivatives[:, i] = - derivatives[:, reference]
+            self._derivatives = derivatives[:, self.noigno]
+        else:
+            self._freeModelIndex = numpy.searchsorted(self.noigno, self.free)
+
+    def getparameters(self, idx, parameters, freeValues):
+        """
+        Parameters of the spectra idx after replacing the free parameters
+        by freeValues and applying the constraints
+        """
+        newparam = parameters.copy()
+        newparam[:, self.free] = freeValues
+        newparam[:, self.positive] = numpy.abs(newparam[:, self.positive])
+        cons2 = self.cons2[idx]
+        for i, code, reference in self.related:
+            if code == CFACTOR:
+                newparam[:, i] = cons2[:, i] * newparam[:, reference]
+            elif code == CDELTA:
+                newparam[:, i] = cons2[:, i] + newparam[:, reference]
+            elif code == CSUM:
+                newparam[:, i] = cons2[:, i] - newparam[:, reference]
+            else:
+                newparam[:, i] = 0
+        return newparam
+
+    def validQuoted(self, parameters):
+        """
+        Mask of the free parameters that are refined. As in Gefit, quoted
+        parameters outside their limits are kept at their starting value.
+        """
+        valid = numpy.ones((parameters.shape[0], self.free.size), dtype=bool)
+        if self.quoted.size:
+            index = self.free[self.quoted]
+            p = parameters[:, index]
+            B = self.B[:, index]
+            valid[:, self.quoted] = (B > 0) & (numpy.abs(p - self.A[:, index]) <= B)
+        return valid
+
+    def derivativeFactor(self, idx, parameters, valid):
+        factor = numpy.ones(valid.shape, numpy.float64)
+        if self.quoted.size:
+            index = self.free[self.quoted]
+            A = self.A[idx][:, index]
+            B = self.B[idx][:, index]
+            B = numpy.where(B > 0, B, 1.0)
+            u = numpy.clip((parameters[:, index] - A) / B, -1.0, 1.0)
+            factor[:, self.quoted] = B * numpy.cos(numpy.arcsin(u))
+        factor[~valid] = 0.0
+        return factor
+
+    def freeJacobian(self, idx, jacobian):
+        """
+        Derivatives respect to the free parameters from the derivatives
+        respect to the parameters given to the model
+        """
+        jacobian = numpy.asarray(jacobian, dtype=numpy.float64)
+        if self._derivatives is None:
+            return jacobian[:, self._freeModelIndex]
+        return numpy.matmul(self._derivatives[idx].transpose(0, 2, 1), jacobian)
+
+    def step(self, idx, fitparam, deltapar, valid):
+        newfree = fitparam + deltapar
+        if self.quoted.size:
+            index = self.free[self.quoted]
+            A = self.A[idx][:, index]
+            B = self.B[idx][:, index]
+            B = numpy.where(B > 0, B, 1.0)
+            u = numpy.clip((fitparam[:, self.quoted] - A) / B, -1.0, 1.0)
+            newfree[:, self.quoted] = A + B * numpy.sin(numpy.arcsin(u) + \
+                                                    deltapar[:, self.quoted])
+        return numpy.where(valid, newfree, fitparam)
+
+    def getsigmaparameters(self, parameters, sigma0, valid):
+        sigmapar = numpy.zeros(parameters.shape, numpy.float64)
+        fixed = numpy.nonzero(self.codes == CFIXED)[0]
+        sigmapar[:, fixed] = parameters[:, fixed]
+        sigma = sigma0.copy()
+        if self.quoted.size:
+            factor = self.derivativeFactor(numpy.arange(parameters.shape[0]),
+                                           parameters, valid)
+            sigma[:, self.quoted] = numpy.abs(factor[:, self.quoted] * \
+                                              sigma[:, self.quoted])
+        sigma = numpy.where(valid, sigma, parameters[:, self.free])
+        sigmapar[:, self.free] = sigma
+        for i, code, reference in self.related:
+            if code == CFACTOR:
+                sigmapar[:, i] = self.cons2[:, i] * sigmapar[:, reference]
+            elif code in [CDELTA, CSUM]:
+                sigmapar[:, i] = sigmapar[:, reference]
+        return sigmapar
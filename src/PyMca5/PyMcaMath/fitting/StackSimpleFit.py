@@ -36,6 +36,8 @@
 import logging
 from PyMca5.PyMcaIO import ConfigDict
 from . import SimpleFitModule
+from . import FitResultBuffer
+from .Gefit import CFACTOR, CDELTA, CSUM, CIGNORED
 from PyMca5.PyMcaIO import ArraySave
 from PyMca5 import PyMcaDirs
 
@@ -58,6 +60,11 @@ def __init__(self, fit=None):
         # optimization variables
         self.mask = None
         self.__ALWAYS_ESTIMATE = True
+        # number of spectra fitted at once when the fit functions allow it
+        # (0 or None to fit the spectra one by one)
+        self.blockSize = 256
+        # results of variable length output
+        self._output = None
 
     def setProgressCallback(self, method):
         """
@@ -172,21 +179,33 @@ def processStack(self, mask=None):
         self._column = -1
         self._progress = 0
         self._status = "Fitting"
-        for i in range(nPixels):
-            self._progress = (i * 100.)/ nPixels
-            if (self._column+1) == self._nColumns:
-                self._column = 0
-                self._row   += 1
-            else:
-                self._column += 1
-            try:
-                if self.mask[self._row, self._column]:
-                    self.processStackData(i)
-            except Exception:
-                _logger.warning("Error %s processing index = %d, row = %d column = %d",
-                                sys.exc_info()[1], i, self._row, self._column)
-                if _logger.getEffectiveLevel() == logging.DEBUG:
-                    raise
+        if not self.fixedLenghtOutput:
+            self._output = FitResultBuffer.FitResultBuffer(
+                                    self.getOutputFileNames()['h5'],
+                                    (self._nRows, self._nColumns),
+                                    configuration=self.fit.getConfiguration(),
+                                    overwrite=True)
+        if self._isStackFitPossible():
+            self.processStackBlocks(nPixels)
+        else:
+            for i in range(nPixels):
+                self._progress = (i * 100.)/ nPixels
+                if (self._column+1) == self._nColumns:
+                    self._column = 0
+                    self._row   += 1
+                else:
+                    self._column += 1
+                try:
+                    if self.mask[self._row, self._column]:
+                        self.processStackData(i)
+                except Exception:
+                    _logger.warning("Error %s processing index = %d, row = %d column = %d",
+                                    sys.exc_info()[1], i, self._row, self._column)
+                    if _logger.getEffectiveLevel() == logging.DEBUG:
+                        raise
+                    if self._output is not None:
+                        self._output.add(i, numpy.nan,
+                                         status=FitResultBuffer.STATUS_FAILED)
         self.onProcessStackFinished()
         self._status = "Ready"
         if self.progressCallback is not None:
@@ -206,6 +225,152 @@ def processStackData(self, i):
         values, chisq, sigma, niter, lastdeltachi = self.fit.startFit()
         self.fitFinished()
 
+    def _isStackFitPossible(self):
+        if (not self.blockSize) or (self.blockSize < 2):
+            return False
+        if not self.fit.isStackFitAvailable():
+            return False
+        # all the spectra have to share the same x values
+        if self.stack_x is not None:
+            if self.stack_x.shape == self.stack_y.shape:
+                return False
+        return True
+
+    def processStackBlocks(self, nPixels):
+        """
+        Fit the selected pixels in blocks of blockSize spectra. The spectra
+        are prepared and estimated one by one and the spectra of a block
+        sharing the same parameters and constraint codes are fitted at once.
+
+        Under the default "Estimate always" policy every pixel is still set
+        up, stripped and estimated on its own, which dominates the time, so
+        the blocks give no real gain over processStack. The setup is only
+        skipped with "Estimate once" and without strip background.
+        """
+        pixels = numpy.nonzero(numpy.ravel(self.mask))[0]
+        # without estimation nor strip background, the spectra only need
+        # to be sorted and limited as the estimated reference spectrum
+        reuse = (not self.__ALWAYS_ESTIMATE) and \
+                (not self.fit._fitConfiguration['fit']['strip_flag'])
+        reference = None
+        for start in range(0, pixels.size, self.blockSize):
+            groups = {}
+            for i in pixels[start:start + self.blockSize]:
+                i = int(i)
+                self._progress = (i * 100.)/ nPixels
+                self._row, self._column = divmod(i, self._nColumns)
+                try:
+                    self.aboutToGetStackData(i)
+                    x, y, sigma, xmin, xmax = self.getFitInputValues(i)
+                    if reuse and (reference is not None):
+                        fitInput, index = reference
+                        fitInput = fitInput.copy()
+                        fitInput['y'] = numpy.ravel(y)[index]
+                        if sigma is not None:
+                            fitInput['sigma'] = numpy.ravel(sigma)[index]
+                    else:
+                        self.fit.setData(x, y, sigma=sigma, xmin=xmin, xmax=xmax)
+                        if (reference is None) or self.__ALWAYS_ESTIMATE:
+                            _logger.debug("Estimation")
+                            self.fit.estimate()
+                        fitInput = self.fit.getFitInput()
+                        if reference is None:
+                            index = numpy.argsort(numpy.ravel(x))
+                            x0 = numpy.ravel(x)[index]
+                            index = index[(x0 >= fitInput['x'][0]) & \
+                                          (x0 <= fitInput['x'][-1])]
+                            reference = fitInput, index
+                    self.estimateFinished()
+                except Exception:
+                    _logger.warning("Error %s processing index = %d, row = %d column = %d",
+                                    sys.exc_info()[1], i, self._row, self._column)
+                    if _logger.getEffectiveLevel() == logging.DEBUG:
+                        raise
+                    continue
+                # spectra fitted together share x, parameters and
+                # the parameters to which other parameters are related
+                x = fitInput['x']
+                codes, cons1, cons2 = fitInput['constrains']
+                related = [cons1[j] for j in range(len(codes))
+                           if codes[j] in ['FACTOR', 'DELTA', 'SUM',
+                                           CFACTOR, CDELTA, CSUM]]
+                key = (x.size, x[0], x[-1],
+                       tuple(fitInput['names']),
+                       tuple(["%s" % code for code in codes]),
+                       tuple(related),
+                       fitInput['sigma'] is None)
+                if key not in groups:
+                    groups[key] = []
+                groups[key].append((self._row, self._column, fitInput))
+            for key in groups:
+                self.processStackBlock(groups[key])
+
+    def processStackBlock(self, block):
+        """
+        Fit at once a list of (row, column, fit input) sharing the abscissa,
+        the parameters and the constraint codes.
+        """
+        rows = numpy.array([item[0] for item in block], dtype=numpy.intp)
+        columns = numpy.array([item[1] for item in block], dtype=numpy.intp)
+        first = block[0][2]
+        y = numpy.array([item[2]['y'] for item in block], dtype=numpy.float64)
+        if first['sigma'] is None:
+            sigma = None
+        else:
+            sigma = numpy.array([item[2]['sigma'] for item in block],
+                                dtype=numpy.float64)
+        parameters = numpy.array([item[2]['parameters'] for item in block],
+                                 dtype=numpy.float64)
+        codes = first['constrains'][0]
+        cons1 = numpy.array([item[2]['constrains'][1] for item in block],
+                            dtype=numpy.float64)
+        cons2 = numpy.array([item[2]['constrains'][2] for item in block],
+                            dtype=numpy.float64)
+        try:
+            values, chisq, sigmas, niter, lastdeltachi = \
+                self.fit.startStackFit(first['x'], y, parameters,
+                                       [codes, cons1, cons2],
+                                       sigma=sigma,
+                                       nbackground=first['n_background_parameters'])
+        except Exception:
+            _logger.warning("Error %s processing %d spectra starting at row = %d column = %d",
+                            sys.exc_info()[1], len(block), rows[0], columns[0])
+            if _logger.getEffectiveLevel() == logging.DEBUG:
+                raise
+            if self._output is not None:
+                self._output.add(rows * self._nColumns + columns, numpy.nan,
+                                 status=FitResultBuffer.STATUS_FAILED)
+            return
+        ok = numpy.isfinite(chisq)
+        for i in numpy.nonzero(~ok)[0]:
+            _logger.warning("result not valid for row %d, column %d",
+                            rows[i], columns[i])
+        names = [(i, name) for i, name in enumerate(first['names'])
+                 if codes[i] not in ['IGNORE', 'IGNORED', CIGNORED]]
+        if not self.fixedLenghtOutput:
+            free = [i for i, name in names]
+            if self._parameters is None:
+                self._parameters = [name for i, name in names]
+            self._output.add(rows * self._nColumns + columns, chisq,
+                             names=[name for i, name in names],
+                             values=values[:, free],
+                             sigmas=sigmas[:, free],
+                             estimation=parameters[:, free],
+                             niter=niter,
+                             status=numpy.where(ok,
+                                        FitResultBuffer.STATUS_OK,
+                                        FitResultBuffer.STATUS_FAILED))
+            return
+        rows = rows[ok]
+        columns = columns[ok]
+        if self._parameters is None:
+            self._initializeImages([name for i, name in names])
+        for i, name in names:
+            if name in self._images:
+                self._images[name][rows, columns] = values[ok, i]
+                self._sigmas[name][rows, columns] = sigmas[ok, i]
+        self._images['chisq'][rows, columns] = chisq[ok]
+
     def getFitInputValues(self, index):
         """
         Returns the fit parameters x, y, sigma, xmin, xmax
@@ -304,11 +469,6 @@ def aboutToGetStackData(self, idx):
         if self.progressCallback is not None:
             self.progressCallback(idx, self._nRows * self._nColumns)
 
-        if idx == 0:
-            specfile = os.path.join(self.outputDir,
-                                    self.outputFile+".spec")
-            if os.path.exists(self.outputFile):
-                os.remove(self.outputFile)
 
     def fitFinished(self):
         _logger.debug("fit finished")
@@ -320,31 +480,14 @@ def fitFinished(self):
         column = self._column
         if result is None:
             _logger.warning("result not valid for row %d, column %d", row, column)
+            if self._output is not None:
+                self._output.add(row * self._nColumns + column, numpy.nan,
+                                 status=FitResultBuffer.STATUS_FAILED)
             return
 
         if self.fixedLenghtOutput and (self._parameters is None):
             #If it is the first fit, initialize results array
-            imgdir = os.path.join(self.outputDir, "IMAGES")
-            if not os.path.exists(imgdir):
-                os.mkdir(imgdir)
-            if not os.path.isdir(imgdir):
-                msg= "%s does not seem to be a valid directory" % imgdir
-                raise IOError(msg)
-            self.imgDir = imgdir
-            self._parameters  = []
-            self._images      = {}
-            self._sigmas      = {}
-            for parameter in result['parameters']:
-                self._parameters.append(parameter)
-                self._images[parameter] = numpy.zeros((self._nRows,
-                                                       self._nColumns),
-                                                       numpy.float32)
-                self._sigmas[parameter] = numpy.zeros((self._nRows,
-                                                       self._nColumns),
-                                                       numpy.float32)
-            self._images['chisq'] = numpy.zeros((self._nRows,
-                                                       self._nColumns),
-                                                       numpy.float32)
+            self._initializeImages(result['parameters'])
 
         if self.fixedLenghtOutput:
             i = 0
@@ -356,44 +499,51 @@ def fitFinished(self):
                 i += 1
             self._images['chisq'][row, column] = result['chisq']
         else:
-            #specfile output always available
-            specfile = self.getOutputFileNames()['specfile']
-            self._appendOneResultToSpecfile(specfile, result=fitOutput)
-
-    def _appendOneResultToSpecfile(self, filename, result=None):
-        if result is None:
-            result = self.fit.getResult(configuration=False)
-
-        scanNumber = self._currentFitIndex
-
-        #open file in append mode
-        fitResult = result['result']
-        fittedValues = fitResult['fittedvalues']
-        fittedParameters = fitResult['parameters']
-        chisq = fitResult['chisq']
-        text = "\n#S %d %s\n" % (scanNumber, "PyMca Stack Simple Fit")
-        text += "#N %d\n" % (len(fittedParameters)+2)
-        text += "#L N  Chisq"
-        for parName in fittedParameters:
-            text += '  %s' % parName
-        text += "\n"
-        text += "1 %f" % chisq
-        for parValue in fittedValues:
-            text += "% .7E" % parValue
-        text += "\n"
-        sf = open(filename, 'ab')
-        sf.write(text)
-        sf.close()
+            free = [i for i, param in enumerate(self.fit.paramlist)
+                    if param['code'] not in ['IGNORE', 'IGNORED', CIGNORED]]
+            names = [self.fit.paramlist[i]['name'] for i in free]
+            if self._parameters is None:
+                self._parameters = names
+            self._output.add(row * self._nColumns + column,
+                             result['chisq'],
+                             names=names,
+                             values=[result['fittedvalues'][i] for i in free],
+                             sigmas=[result['sigma_values'][i] for i in free],
+                             estimation=[self.fit.paramlist[i]['estimation']
+                                         for i in free],
+                             niter=result['niter'])
+
+    def _initializeImages(self, parameters):
+        imgdir = os.path.join(self.outputDir, "IMAGES")
+        if not os.path.exists(imgdir):
+            os.mkdir(imgdir)
+        if not os.path.isdir(imgdir):
+            msg= "%s does not seem to be a valid directory" % imgdir
+            raise IOError(msg)
+        self.imgDir = imgdir
+        self._parameters  = []
+        self._images      = {}
+        self._sigmas      = {}
+        for parameter in parameters:
+            self._parameters.append(parameter)
+            self._images[parameter] = numpy.zeros((self._nRows,
+                                                   self._nColumns),
+                                                   numpy.float32)
+            self._sigmas[parameter] = numpy.zeros((self._nRows,
+                                                   self._nColumns),
+                                                   numpy.float32)
+        self._images['chisq'] = numpy.zeros((self._nRows,
+                                             self._nColumns),
+                                             numpy.float32)
 
     def getOutputFileNames(self):
-        specfile = os.path.join(self.outputDir,
-                                self.outputFile+".spec")
+        h5 = os.path.join(self.outputDir, self.outputFile + ".h5")
         imgDir = os.path.join(self.outputDir, "IMAGES")
         filename = os.path.join(imgDir, self.outputFile)
         csv = filename + ".csv"
         edf = filename + ".edf"
         ddict = {}
-        ddict['specfile'] = specfile
+        ddict['h5'] = h5
         ddict['csv'] = csv
         ddict['edf'] = edf
         return ddict
@@ -401,6 +551,10 @@ def getOutputFileNames(self):
     def onProcessStackFinished(self):
         _logger.debug("Stack proccessed")
         self._status = "Stack Fitting finished"
+        if self._output is not None:
+            self._status = "Writing output files"
+            self._output.close()
+            self._output = None
         if self.fixedLenghtOutput:
             self._status = "Writing output files"
             nParameters = len(self._parameters)
@@ -32,6 +32,7 @@
 */
 #include <./numpy/arrayobject.h>
 #include <math.h>
+#include <limits.h>
 
 #ifndef NPY_ARRAY_ENSURECOPY
 #define NPY_ARRAY_ENSURECOPY NPY_ENSURECOPY
@@ -62,6 +63,8 @@ static struct module_state _state;
 #endif
 #define MAX_SAVITSKY_GOLAY_WIDTH 101
 #define MIN_SAVITSKY_GOLAY_WIDTH 3
+/* number of spectra copied at once from a block by stripbackground */
+#define STRIP_TILE 8
 
 /* SNIP related functions */
 void lls(double *data, int size);
@@ -4048,38 +4051,20 @@ SpecfitFuns_pileup(PyObject *self, PyObject *args)
 }
 
 
-static PyObject *
-SpecfitFuns_SavitskyGolay(PyObject *self, PyObject *args)
+static void
+savitsky_golay(double *output, int n, int npoints, double *data)
 {
-    PyObject *input;
-    PyArrayObject *ret;
-    int n, npoints;
-    double dpoints = 5.;
+    /* Smooth output in place. data is a work buffer of n doubles */
     double coeff[MAX_SAVITSKY_GOLAY_WIDTH];
     int i, j, m;
     double  dhelp, den;
-    double  *data;
-    double  *output;
 
-    if (!PyArg_ParseTuple(args, "O|d", &input, &dpoints))
-        return NULL;
-
-    ret = (PyArrayObject *)
-             PyArray_FROMANY(input, NPY_DOUBLE, 1, 1, NPY_ARRAY_ENSURECOPY);
-
-    if (ret == NULL){
-        printf("Cannot create 1D array from input\n");
-        return NULL;
-    }
-    npoints = (int )  dpoints;
     if (!(npoints % 2)) npoints +=1;
 
-    n = (int) PyArray_DIMS(ret)[0];
-
     if((npoints < MIN_SAVITSKY_GOLAY_WIDTH) ||  (n < npoints))
     {
         /* do not smooth data */
-        return PyArray_Return(ret);
+        return;
     }
 
     /* calculate the coefficients */
@@ -4090,9 +4075,6 @@ SpecfitFuns_SavitskyGolay(PyObject *self, PyObject *args)
         coeff[m-i] = coeff[m+i];
     }
 
-    /* do the job */
-    output = (double *) PyArray_DATA(ret);
-
     /* simple smoothing at the beginning */
     for (j=0; j<=(int)(npoints/3); j++)
     {
@@ -4106,7 +4088,6 @@ SpecfitFuns_SavitskyGolay(PyObject *self, PyObject *args)
     }
 
     /*one does not need the whole spectrum buffer, but code is clearer */
-    data = (double *) malloc(n * sizeof(double));
     memcpy(data, output, n * sizeof(double));
 
     /* the actual SG smoothing in the middle */
@@ -4119,11 +4100,176 @@ SpecfitFuns_SavitskyGolay(PyObject *self, PyObject *args)
             *(output+i) = dhelp / den;
         }
     }
+}
+
+static PyObject *
+SpecfitFuns_SavitskyGolay(PyObject *self, PyObject *args)
+{
+    PyObject *input;
+    PyArrayObject *ret;
+    int n, npoints;
+    double dpoints = 5.;
+    double  *data;
+
+    if (!PyArg_ParseTuple(args, "O|d", &input, &dpoints))
+        return NULL;
+
+    ret = (PyArrayObject *)
+             PyArray_FROMANY(input, NPY_DOUBLE, 1, 1, NPY_ARRAY_ENSURECOPY);
+
+    if (ret == NULL){
+        printf("Cannot create 1D array from input\n");
+        return NULL;
+    }
+    npoints = (int )  dpoints;
+    n = (int) PyArray_DIMS(ret)[0];
+
+    data = (double *) malloc(n * sizeof(double));
+    if (data == NULL){
+        Py_DECREF(ret);
+        return PyErr_NoMemory();
+    }
+    savitsky_golay((double *) PyArray_DATA(ret), n, npoints, data);
     free(data);
     return PyArray_Return(ret);
 
 }
 
+static PyObject *
+SpecfitFuns_stripbackground(PyObject *self, PyObject *args)
+{
+    /* Background of a block of spectra (channels along the first axis):
+       optional smoothing, optional Savitsky-Golay filter and SNIP applied
+       to the segments delimited by the anchors. The GIL is released while
+       processing the spectra. The spectra are copied by tiles of STRIP_TILE
+       columns so that each channel row is read and written at once. */
+    PyObject *input;
+    PyObject *anchorsInput = Py_None;
+    PyArrayObject *ret;
+    PyArrayObject *anchorsArray = NULL;
+    double width0 = 50.;
+    double sgwidth0 = 0.;
+    int smooth_iterations = 0;
+    int width, sgwidth;
+    npy_intp n_channels, n_spectra;
+    npy_intp j, j0, k, t, n_tile;
+    int i, n_anchors, lastAnchor, anchor, size;
+    int *anchors = NULL;
+    double *pdata, *row;
+    double *tile;
+    double *spectrum;
+    double *work;
+
+    if (!PyArg_ParseTuple(args, "Od|idO", &input, &width0, &smooth_iterations,
+                          &sgwidth0, &anchorsInput))
+        return NULL;
+
+    ret = (PyArrayObject *)
+             PyArray_FROMANY(input, NPY_DOUBLE, 1, 2, NPY_ARRAY_ENSURECOPY);
+    if (ret == NULL){
+        printf("Cannot create 1D or 2D array from input\n");
+        return NULL;
+    }
+
+    n_channels = PyArray_DIMS(ret)[0];
+    if (PyArray_NDIM(ret) == 1)
+    {
+        n_spectra = 1;
+    }
+    else
+    {
+        n_spectra = PyArray_DIMS(ret)[1];
+    }
+    if (n_channels > INT_MAX)
+    {
+        Py_DECREF(ret);
+        PyErr_SetString(PyExc_ValueError, "Too many channels per spectrum");
+        return NULL;
+    }
+    size = (int) n_channels;
+
+    n_anchors = 0;
+    if (anchorsInput != Py_None)
+    {
+        anchorsArray = (PyArrayObject *)
+                PyArray_ContiguousFromObject(anchorsInput, NPY_INT, 0, 1);
+        if (anchorsArray == NULL)
+        {
+            Py_DECREF(ret);
+            return NULL;
+        }
+        n_anchors = (int) PyArray_SIZE(anchorsArray);
+        anchors = (int *) PyArray_DATA(anchorsArray);
+    }
+
+    tile = (double *) malloc((STRIP_TILE + 1) * n_channels * sizeof(double));
+    if (tile == NULL)
+    {
+        Py_DECREF(ret);
+        Py_XDECREF(anchorsArray);
+        return PyErr_NoMemory();
+    }
+    work = tile + STRIP_TILE * n_channels;
+
+    width = (int) width0;
+    sgwidth = (int) sgwidth0;
+    pdata = (double *) PyArray_DATA(ret);
+
+    Py_BEGIN_ALLOW_THREADS
+    for (j0 = 0; j0 < n_spectra; j0 += STRIP_TILE)
+    {
+        n_tile = MIN(STRIP_TILE, n_spectra - j0);
+        /* tile[t * n_channels + k] = pdata[k * n_spectra + j0 + t] */
+        for (k = 0; k < n_channels; k++)
+        {
+            row = pdata + k * n_spectra + j0;
+            for (t = 0; t < n_tile; t++)
+            {
+                tile[t * n_channels + k] = row[t];
+            }
+        }
+        for (j = 0; j < n_tile; j++)
+        {
+            spectrum = tile + j * n_channels;
+            for (i = 0; i < smooth_iterations; i++)
+            {
+                smooth1d(spectrum, size);
+            }
+            if (sgwidth > 0)
+            {
+                savitsky_golay(spectrum, size, sgwidth, work);
+            }
+            lastAnchor = 0;
+            for (i = 0; i < n_anchors; i++)
+            {
+                anchor = anchors[i];
+                if ((anchor > lastAnchor) && (anchor < size))
+                {
+                    snip1d(spectrum + lastAnchor, anchor - lastAnchor, width);
+                    lastAnchor = anchor;
+                }
+            }
+            if (lastAnchor < size)
+            {
+                snip1d(spectrum + lastAnchor, size - lastAnchor, width);
+            }
+        }
+        for (k = 0; k < n_channels; k++)
+        {
+            row = pdata + k * n_spectra + j0;
+            for (t = 0; t < n_tile; t++)
+            {
+                row[t] = tile[t * n_channels + k];
+            }
+        }
+    }
+    Py_END_ALLOW_THREADS
+
+    free(tile);
+    Py_XDECREF(anchorsArray);
+    return PyArray_Return(ret);
+}
+
 /* List of functions defined in the module */
 
 static PyMethodDef SpecfitFuns_methods[] = {
@@ -4152,6 +4298,7 @@ static PyMethodDef SpecfitFuns_methods[] = {
     {"voxelize",    SpecfitFuns_voxelize,   METH_VARARGS},
     {"pileup",      SpecfitFuns_pileup,   METH_VARARGS},
     {"SavitskyGolay",   SpecfitFuns_SavitskyGolay,   METH_VARARGS},
+    {"stripbackground", SpecfitFuns_stripbackground, METH_VARARGS},
     {"splitgauss",  SpecfitFuns_splitgauss,   METH_VARARGS},
     {"splitlorentz",SpecfitFuns_splitlorentz, METH_VARARGS},
     {"splitpvoigt", SpecfitFuns_splitpvoigt, METH_VARARGS},
@@ -32,6 +32,7 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import numpy
 import sys
+import logging
 __doc__ = """
 
 lstsq
@@ -47,6 +48,12 @@
 
 """
 
+_logger = logging.getLogger(__name__)
+
+# memory used by the weighted normal equations solved at once
+# when each column of b has its own weights (bytes)
+BATCH_MEMORY = 64 * 1024 * 1024
+
 # fit to a straight line
 
 def linregress(x, y, sigmay=None, full_output=False):
@@ -166,6 +173,8 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
         of `b`.
     sigma_b : uncertainties on the b values or None. If sigma_b has shape (M,) or (M, 1) and
               b has dimension (M, K), the uncertainty will be the same for all spectra.
+              Without weighting they are only propagated to the uncertainties of
+              the parameters.
 
     weight: 0 - No data weighting.
                 Uncertainty of 1 for each data point.
@@ -180,7 +189,12 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
                     prevent recalculation on repeated fits.
 
     uncertainties: If False, no uncertainties will be calculated unless the covariance
-                matrix is requested.
+                matrix is requested. A sequence of parameter indices restricts the
+                calculation to those parameters (the others are set to NaN, an empty
+                sequence gives NaN for all of them). Only the weighted fits with
+                individual weights and the propagation of individual uncertainties
+                become faster, in the other cases the uncertainties are the same for
+                all the columns of b and they are obtained at once.
 
     covariances: If True, an array of covariance matrix/matrices will be returned.
 
@@ -231,6 +245,12 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
     """
     a = numpy.asarray(a, dtype=numpy.float64)
     b = numpy.asarray(b, dtype=numpy.float64)
+    if numpy.ndim(uncertainties):
+        # uncertainties of the requested parameters only
+        uncertaintyIndex = numpy.asarray(uncertainties, dtype=numpy.intp)
+        uncertainties = True
+    else:
+        uncertaintyIndex = None
     a_shape = a.shape
     b_shape = b.shape
     original = b_shape
@@ -265,10 +285,18 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
             w = numpy.sqrt(numpy.abs(b))
             w = w + numpy.equal(w, 0)
     else:
-        # we have an unweighted fit with no uncertainties
-        # assume all the uncertainties equal to 1
-        fastest = True
-        w = numpy.ones(b.shape, numpy.float64)
+        # we have an unweighted fit
+        if sigma_b is not None:
+            # experimental uncertainties only to be propagated
+            w = numpy.abs(numpy.asarray(sigma_b, dtype=numpy.float64))
+            if w.size == b_shape[0]:
+                w.shape = b.shape[0]
+            else:
+                w.shape = b_shape
+        else:
+            # no uncertainties: assume all the uncertainties equal to 1
+            fastest = True
+            w = numpy.ones((b.shape[0], 1), numpy.float64)
     if len(w.shape) == 1:
         w.shape = -1, 1
     if covariances:
@@ -309,27 +337,13 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
                 sigmapar.shape = n, b_shape[1]
                 if covariances:
                     covarianceMatrix[:] = _covariance
-            elif covariances:
-                # loop in order not to use potentially big matrices
-                # but calculates the covariance matrices
-                # It only makes sense if the covariance matrix is requested
-                sigmapar = numpy.zeros((n, b_shape[1]), numpy.float64)
-                for k in range(b_shape[1]):
-                    pseudoData = numpy.eye(b_shape[0]) * w[:, k]
-                    tmpTerm = numpy.dot(dummy, numpy.dot(U.T, pseudoData))
-                    _covariance[:, :] = numpy.dot(tmpTerm, tmpTerm.T)
-                    sigmapar[:, k] = numpy.sqrt(numpy.diag(_covariance))
-                    covarianceMatrix[k] = _covariance
             else:
-                # loop in order not to use potentially big matrices
-                # but not calculating the covariance matrix
-                d = numpy.zeros(b.shape, numpy.float64)
-                sigmapar = numpy.zeros((n, b_shape[1]))
-                for k in range(b_shape[0]):
-                    d[k] = w[k]
-                    sigmapar += (numpy.dot(dummy, numpy.dot(U.T, d))) ** 2
-                    d[k] = 0.0
-                sigmapar[:, :] = numpy.sqrt(sigmapar)
+                # propagate the uncertainties of the data (closed form
+                # in blocks of columns, no per channel loop)
+                sigmapar = numpy.zeros((n, b_shape[1]), numpy.float64)
+                _propagateUncertainties(numpy.dot(dummy, U.T), w, sigmapar,
+                                covarianceMatrix if covariances else None,
+                                index=None if covariances else uncertaintyIndex)
     elif fastest:
         # same weight for all spectra
         # it could be made by the calling routine, because it is equivalent to supplying a
@@ -379,61 +393,30 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
                 s.shape = -1
                 dummy = numpy.dot(V.T, numpy.eye(n)*(1./s))
                 parameters[:, i:i+1] = numpy.dot(dummy, numpy.dot(U.T, tmpData))
-                if uncertainties or covariances:
+                if covariances:
                     # get the uncertainties
                     _covariance = numpy.dot(dummy, dummy.T)
                     sigmapar[:, i] = numpy.sqrt(numpy.diag(_covariance))
-                    if covariances:
-                        covarianceMatrix[i] = _covariance
-        elif 1:
-            # Pure matrix inversion (faster than SVD)
-            # I do not seem to gain anything by re-using the storage
-            #alpha = numpy.empty((n, n), numpy.float64)
-            #beta = numpy.empty((n, 1), numpy.float64)
-            for i in range(b_shape[1]):
-                tmpWeight = w[:, i:i+1]
-                A = a / tmpWeight
-                tmpData =  b[:, i:i+1] / tmpWeight
-                #numpy.dot(A.T, A, alpha)
-                #numpy.dot(A.T, tmpData, beta)
-                alpha = numpy.dot(A.T, A)
-                beta = numpy.dot(A.T, tmpData)
-                try:
-                    _covariance = numpy.linalg.inv(alpha)
-                except Exception:
-                    print("Exception")
-                    print("Exception", sys.exc_info()[1])
-                    continue
-                parameters[:, i:i+1] = numpy.dot(_covariance, beta)
-                if uncertainties:
-                    sigmapar[:, i] = numpy.sqrt(numpy.diag(_covariance))
-                if covariances:
-                    covarianceMatrix[i] = covariance
+                    covarianceMatrix[i] = _covariance
+                elif uncertainties:
+                    # only the diagonal of the covariance matrix
+                    if uncertaintyIndex is None:
+                        sigmapar[:, i] = numpy.sqrt((dummy * dummy).sum(axis=1))
+                    else:
+                        tmp = dummy[uncertaintyIndex]
+                        sigmapar[uncertaintyIndex, i] = \
+                                        numpy.sqrt((tmp * tmp).sum(axis=1))
         else:
-            # Matrix inversion with buffers does not improve
-            bufferProduct = numpy.empty((n, n + 1), numpy.float64)
-            bufferAB = numpy.empty((b_shape[0], n+1), numpy.float64)
-            alpha = numpy.empty((n, n), numpy.float64)
-            for i in range(b_shape[1]):
-                tmpWeight = w[:, i:i+1]
-                A = a / tmpWeight
-                tmpData =  b[:, i:i+1] / tmpWeight
-                bufferAB [:, :n] = A
-                bufferAB [:, n:n+1] = tmpData
-                numpy.dot(A.T, bufferAB, bufferProduct)
-                alpha[:, :]  = bufferProduct[:n, :n]
-                beta = bufferProduct[:,n]
-                try:
-                    _covariance = numpy.linalg.inv(alpha)
-                except Exception:
-                    print("Exception")
-                    print("Exception", sys.exc_inf())
-                    continue
-                parameters[:, i] = numpy.dot(_covariance, beta)
-                if uncertainties:
-                    sigmapar[:, i] = numpy.sqrt(numpy.diag(_covariance))
-                if covariances:
-                    covarianceMatrix[i] = covariance
+            # Pure matrix inversion (faster than SVD) of the
+            # normal equations of a block of columns at once
+            _batchedWeightedLstsq(a, b, w, parameters,
+                                  sigmapar if uncertainties or covariances else None,
+                                  covarianceMatrix if covariances else None,
+                                  index=None if covariances else uncertaintyIndex)
+    if uncertainties and uncertaintyIndex is not None:
+        notRequested = numpy.ones(n, dtype=bool)
+        notRequested[uncertaintyIndex] = False
+        sigmapar[notRequested] = numpy.nan
     if len(original) == 1:
         parameters.shape = -1
     if covariances:
@@ -461,6 +444,170 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
         return result
 
 
+def _propagateUncertainties(d, w, sigmapar, covarianceMatrix=None, index=None):
+    """
+    Uncertainties of the parameters x = d b when the data b has
+    uncorrelated uncertainties w:
+
+    sigmapar[i, k]**2 = sum_j d[i, j]**2 w[j, k]**2
+
+    :param d: matrix (N, M) mapping the data on the parameters
+    :param w: uncertainties of b (M, K) or (M, 1)
+    :param sigmapar: output buffer (N, K)
+    :param covarianceMatrix: output buffer (K, N, N) or None
+    :param index: parameters to be calculated (all by default)
+    """
+    if index is not None:
+        d = d[index]
+    n, m = d.shape
+    nColumns = sigmapar.shape[1]
+    if w.shape[1] == 1 and covarianceMatrix is None:
+        # same uncertainties for all columns
+        variance = numpy.dot(d * d, w * w)
+        if index is None:
+            sigmapar[:] = numpy.sqrt(variance)
+        else:
+            sigmapar[index] = numpy.sqrt(variance)
+        return
+    d2 = d * d
+    if covarianceMatrix is None:
+        blockSize = BATCH_MEMORY // (8 * (m + n))
+    else:
+        blockSize = BATCH_MEMORY // (8 * (m + 2 * n * n))
+    blockSize = max(1, min(nColumns, blockSize))
+    for start in range(0, nColumns, blockSize):
+        block = slice(start, min(start + blockSize, nColumns))
+        if w.shape[1] == 1:
+            variances = w * w
+        else:
+            variances = w[:, block] * w[:, block]
+        if covarianceMatrix is None:
+            if index is None:
+                sigmapar[:, block] = numpy.sqrt(numpy.dot(d2, variances))
+            else:
+                sigmapar[index, block] = numpy.sqrt(numpy.dot(d2, variances))
+        else:
+            _covariance = numpy.einsum('ij,jk,lj->kil', d, variances, d)
+            covarianceMatrix[block] = _covariance
+            sigmapar[:, block] = numpy.sqrt(numpy.diagonal(_covariance,
+                                                           axis1=1,
+                                                           axis2=2)).T
+
+
+def _batchedWeightedLstsq(a, b, w, parameters, sigmapar=None,
+                          covarianceMatrix=None, index=None):
+    """
+    Solve the weighted normal equations of each column of b
+
+    :param a: model matrix (M, N)
+    :param b: data (M, K)
+    :param w: uncertainties of b (M, K)
+    :param parameters: output buffer (N, K)
+    :param sigmapar: output buffer (N, K) or None
+    :param covarianceMatrix: output buffer (K, N, N) or None
+    :param index: parameters whose uncertainties are calculated (all by default)
+    """
+    m, n = a.shape
+    nColumns = b.shape[1]
+    if covarianceMatrix is not None:
+        index = None
+    elif sigmapar is None:
+        index = numpy.zeros((0,), dtype=numpy.intp)
+    # products of the model matrix columns (upper triangle only) are kept
+    # when they take at most half of the memory budget. Otherwise they are
+    # calculated again for each block of columns, by groups of pairs.
+    iu = numpy.triu_indices(n)
+    nPairs = iu[0].size
+    pairBlock = max(1, min(nPairs, BATCH_MEMORY // (2 * 8 * m)))
+    if pairBlock == nPairs:
+        products = a[:, iu[0]] * a[:, iu[1]]
+    else:
+        products = None
+    blockSize = (BATCH_MEMORY - 8 * m * pairBlock) // (8 * (3 * n * n + 2 * m))
+    blockSize = max(1, min(nColumns, blockSize))
+    for start in range(0, nColumns, blockSize):
+        block = slice(start, min(start + blockSize, nColumns))
+        weights = 1.0 / (w[:, block] * w[:, block])
+        alpha = numpy.empty((weights.shape[1], n, n), numpy.float64)
+        if products is None:
+            upper = numpy.empty((weights.shape[1], nPairs), numpy.float64)
+            for p0 in range(0, nPairs, pairBlock):
+                pairs = slice(p0, min(p0 + pairBlock, nPairs))
+                upper[:, pairs] = numpy.dot(weights.T,
+                                            a[:, iu[0][pairs]] *
+                                            a[:, iu[1][pairs]])
+        else:
+            upper = numpy.dot(weights.T, products)
+        alpha[:, iu[0], iu[1]] = upper
+        alpha[:, iu[1], iu[0]] = upper
+        beta = numpy.dot(a.T, b[:, block] * weights)
+        columns = numpy.arange(nColumns)[block]
+        try:
+            x, variances, _covariance = _solveNormalEquations(alpha, beta,
+                                    index=index,
+                                    covariance=covarianceMatrix is not None)
+        except numpy.linalg.LinAlgError:
+            # singular matrices: solve the columns one by one
+            solved = numpy.zeros(alpha.shape[0], dtype=bool)
+            solutions = []
+            for i in range(alpha.shape[0]):
+                try:
+                    solutions.append(_solveNormalEquations(alpha[i:i + 1],
+                                    beta[:, i:i + 1],
+                                    index=index,
+                                    covariance=covarianceMatrix is not None))
+                    solved[i] = True
+                except numpy.linalg.LinAlgError:
+                    pass
+            _logger.warning("%d singular systems out of %d in columns %d to %d",
+                            solved.size - solved.sum(), solved.size,
+                            block.start, block.stop - 1)
+            if not solved.any():
+                continue
+            columns = columns[solved]
+            x = numpy.concatenate([item[0] for item in solutions], axis=1)
+            variances = numpy.concatenate([item[1] for item in solutions],
+                                          axis=1)
+            if covarianceMatrix is not None:
+                _covariance = numpy.concatenate([item[2] for item in solutions])
+        parameters[:, columns] = x
+        if sigmapar is not None:
+            if index is None:
+                sigmapar[:, columns] = numpy.sqrt(variances)
+            else:
+                sigmapar[numpy.ix_(index, columns)] = numpy.sqrt(variances)
+        if covarianceMatrix is not None:
+            covarianceMatrix[columns] = _covariance
+
+
+def _solveNormalEquations(alpha, beta, index=None, covariance=False):
+    """
+    Solve the normal equations alpha x = beta of a block of columns.
+
+    :param alpha: curvature matrices (K, N, N)
+    :param beta: (N, K)
+    :param index: parameters whose variances are calculated (all if None)
+    :param covariance: return the inverse of alpha
+    :returns: x (N, K), the variances (N or len(index), K) and the
+              inverse of alpha or None
+    """
+    if covariance or index is None:
+        inverse = numpy.linalg.inv(alpha)
+        x = numpy.einsum('kij,jk->ik', inverse, beta)
+        variances = numpy.diagonal(inverse, axis1=1, axis2=2).T
+        if index is not None:
+            variances = variances[index]
+        return x, variances, inverse if covariance else None
+    # only the requested diagonal elements of the inverse
+    nColumns, n, n = alpha.shape
+    rhs = numpy.zeros((nColumns, n, 1 + index.size), numpy.float64)
+    rhs[:, :, 0] = beta.T
+    unit = numpy.arange(index.size)
+    rhs[:, index, 1 + unit] = 1.0
+    solution = numpy.linalg.solve(alpha, rhs)
+    return solution[:, :, 0].T, solution[:, index, 1 + unit].T, None
+
+
 def getModelMatrixFromFunction(model_function, dummy_parameters, xdata, derivative=None):
     nPoints = xdata.size
     nParameters = len(dummy_parameters)
@@ -546,6 +546,70 @@ def numpyPCA(stack, ncomponents=10, binning=None, legacy=True,
                              spectral_mask=spectral_mask,
                              force=force)
 
+def chunkedCovariancePCA(stack, ncomponents=10, binning=None, legacy=True, **kw):
+    return chunkedPCA(stack, ncomponents=ncomponents, binning=binning,
+                      legacy=legacy, center=True, scale=False, **kw)
+
+def chunkedCorrelationPCA(stack, ncomponents=10, binning=None, legacy=True, **kw):
+    return chunkedPCA(stack, ncomponents=ncomponents, binning=binning,
+                      legacy=legacy, center=True, scale=True, **kw)
+
+def chunkedPCA(stack, ncomponents=10, binning=None, legacy=True,
+               center=True, scale=False, mask=None, spectral_mask=None,
+               output=None, **kw):
+    """
+    Out-of-core covariance method. The data (numpy array or HDF5 dataset)
+    are read in chunks of spectra twice, once to accumulate the covariance
+    matrix and once to calculate the scores, that are written to the h5py
+    group output if given.
+    """
+    _logger.debug("PCAModule.chunkedPCA called")
+    if hasattr(stack, "info"):
+        index = stack.info.get('McaIndex', -1)
+    else:
+        index = kw.get("index", -1)
+    return PCATools.chunkedPCA(stack,
+                               index=index,
+                               ncomponents=ncomponents,
+                               binning=binning,
+                               legacy=legacy,
+                               center=center,
+                               scale=scale,
+                               mask=mask,
+                               spectral_mask=spectral_mask,
+                               output=output,
+                               nMca=kw.get("nMca", None))
+
+def randomizedPCA(stack, ncomponents=10, binning=None, legacy=True,
+                  center=True, scale=False, mask=None, spectral_mask=None,
+                  oversampling=10, iterations=2, seed=None, output=None,
+                  **kw):
+    """
+    Approximate covariance method using a randomized SVD. The data (numpy
+    array or HDF5 dataset) are read in chunks of spectra iterations + 3
+    times and the covariance matrix is never calculated. The number of
+    random vectors in excess of ncomponents is given by oversampling.
+    """
+    _logger.debug("PCAModule.randomizedPCA called")
+    if hasattr(stack, "info"):
+        index = stack.info.get('McaIndex', -1)
+    else:
+        index = kw.get("index", -1)
+    return PCATools.randomizedPCA(stack,
+                                  index=index,
+                                  ncomponents=ncomponents,
+                                  binning=binning,
+                                  legacy=legacy,
+                                  center=center,
+                                  scale=scale,
+                                  mask=mask,
+                                  spectral_mask=spectral_mask,
+                                  oversampling=oversampling,
+                                  iterations=iterations,
+                                  seed=seed,
+                                  output=output,
+                                  nMca=kw.get("nMca", None))
+
 def mdpPCASVDFloat32(stack, ncomponents=10, binning=None,
                      mask=None, spectral_mask=None, legacy=True, **kw):
     return mdpPCA(stack, ncomponents, binning=binning, dtype='float32',
@@ -35,6 +35,7 @@
 import time
 import numpy
 import numpy.linalg
+from PyMca5.PyMcaCore import McaStackView
 try:
     # make a explicit import to warn about missing optimized libraries
     import numpy.core._dotblas as dotblas
@@ -45,6 +46,9 @@
 
 _logger = logging.getLogger(__name__)
 
+# size in MB of the chunks of spectra read by the out-of-core methods
+CHUNK_MB = 50
+
 
 def getCovarianceMatrix(stack,
                         index=None,
@@ -533,6 +537,80 @@ def getCovarianceMatrix(stack,
     return covMatrix, sumSpectrum / usedPixels, usedPixels
 
 
+def getEigenSystem(cov, ncomponents, scale=False, average=None):
+    """
+    Calculate the eigenvalues and eigenvectors of a covariance matrix.
+
+    :param cov: Covariance matrix. It is modified in place if scale is True.
+    :param ncomponents: Number of eigenvectors to return
+    :param scale: Normalize the covariance matrix to unit standard deviation
+    :param average: Average spectrum. If given and with a positive sum,
+        the eigenvectors are given a positive sum.
+    :returns: The eigenvalues and eigenvectors sorted in decreasing order
+        of eigenvalue and the total variance.
+    """
+    # the total variance is the sum of the elements of the diagonal
+    totalVariance = numpy.array(numpy.diag(cov), copy=True)
+    _logger.info("Total Variance = %s", totalVariance.sum())
+
+    normalizeToUnitStandardDeviation = scale
+    #option to normalize to unit standard deviation
+    if normalizeToUnitStandardDeviation:
+        for i in range(cov.shape[0]):
+            if totalVariance[i] > 0:
+                cov[i, :] /= numpy.sqrt(totalVariance[i])
+                cov[:, i] /= numpy.sqrt(totalVariance[i])
+
+    t0 = time.time()
+    totalVariance = numpy.diag(cov).sum()
+    evalues, evectors = numpy.linalg.eigh(cov)
+    # The total variance should also be the sum of all the eigenvalues
+    calculatedTotalVariance = evalues.sum()
+    if abs(totalVariance - calculatedTotalVariance) > \
+           (0.0001 * calculatedTotalVariance):
+        _logger.info("WARNING: Discrepancy on total variance")
+        _logger.info("Variance from covariance matrix = %s",
+                     totalVariance)
+        _logger.info("Variance from sum of eigenvalues = %s",
+                     calculatedTotalVariance)
+    _logger.debug("Eig elapsed = %s", time.time() - t0)
+
+    dtype = numpy.float32
+    eigenvectors = numpy.zeros((ncomponents, cov.shape[0]), dtype)
+    eigenvalues = numpy.zeros((ncomponents,), dtype)
+    # sort eigenvalues
+    if 1:
+        a = [(evalues[i], i) for i in range(len(evalues))]
+        a.sort()
+        a.reverse()
+        totalExplainedVariance = 0.0
+        for i0 in range(ncomponents):
+            i = a[i0][1]
+            eigenvalues[i0] = evalues[i]
+            partialExplainedVariance = 100. * evalues[i] / \
+                                       calculatedTotalVariance
+            _logger.info("PC%02d  Explained variance %.5f %% ",
+                         i0 + 1, partialExplainedVariance)
+            totalExplainedVariance += partialExplainedVariance
+            eigenvectors[i0, :] = evectors[:, i]
+            #print("NORMA = ", numpy.dot(evectors[:, i].T, evectors[:, i]))
+        _logger.info("Total explained variance = %.2f %% ",
+                     totalExplainedVariance)
+    else:
+        idx = numpy.argsort(evalues)
+        eigenvalues[:]  = evalues[idx]
+        eigenvectors[:, :] = evectors[:, idx].T
+
+    # figure out if eigenvectors are to be multiplied by -1
+    if (average is not None) and (average.sum() > 0):
+        for i0 in range(ncomponents):
+            if eigenvectors[i0].sum() < 0.0:
+                _logger.info("PC%02d multiplied by -1" % i0)
+                eigenvectors[i0] *= -1
+
+    return eigenvalues, eigenvectors, calculatedTotalVariance
+
+
 def numpyPCA(stack, index=-1, ncomponents=10, binning=None,
                 center=True, scale=True, mask=None, spectral_mask=None, legacy=True, force=True):
     _logger.debug("PCATools.numpyPCA")
@@ -600,68 +678,13 @@ def numpyPCA(stack, index=-1, ncomponents=10, binning=None,
                                                              spatial_mask=mask,
                                                              weights=spectral_mask)
 
-    # the total variance is the sum of the elements of the diagonal
-    totalVariance = numpy.array(numpy.diag(cov), copy=True)
-    standardDeviation = numpy.sqrt(totalVariance)
+    standardDeviation = numpy.sqrt(numpy.diag(cov))
     standardDeviation = standardDeviation + (standardDeviation == 0)
-    _logger.info("Total Variance = %s", totalVariance.sum())
-
-    normalizeToUnitStandardDeviation = scale
-    #option to normalize to unit standard deviation
-    if normalizeToUnitStandardDeviation:
-        for i in range(cov.shape[0]):
-            if totalVariance[i] > 0:
-                cov[i, :] /= numpy.sqrt(totalVariance[i])
-                cov[:, i] /= numpy.sqrt(totalVariance[i])
-
-    t0 = time.time()
-    totalVariance = numpy.diag(cov).sum()
-    evalues, evectors = numpy.linalg.eigh(cov)
-    # The total variance should also be the sum of all the eigenvalues
-    calculatedTotalVariance = evalues.sum()
-    if abs(totalVariance - calculatedTotalVariance) > \
-           (0.0001 * calculatedTotalVariance):
-        _logger.info("WARNING: Discrepancy on total variance")
-        _logger.info("Variance from covariance matrix = %s",
-                     totalVariance)
-        _logger.info("Variance from sum of eigenvalues = %s",
-                     calculatedTotalVariance)
-    _logger.debug("Eig elapsed = %s", time.time() - t0)
+    eigenvalues, eigenvectors, calculatedTotalVariance = \
+                getEigenSystem(cov, ncomponents, scale=scale,
+                               average=avgSpectrum)
     cov = None
-
-    dtype = numpy.float32
-    images = numpy.zeros((ncomponents, nPixels), dtype)
-    eigenvectors = numpy.zeros((ncomponents, N), dtype)
-    eigenvalues = numpy.zeros((ncomponents,), dtype)
-    # sort eigenvalues
-    if 1:
-        a = [(evalues[i], i) for i in range(len(evalues))]
-        a.sort()
-        a.reverse()
-        totalExplainedVariance = 0.0
-        for i0 in range(ncomponents):
-            i = a[i0][1]
-            eigenvalues[i0] = evalues[i]
-            partialExplainedVariance = 100. * evalues[i] / \
-                                       calculatedTotalVariance
-            _logger.info("PC%02d  Explained variance %.5f %% ",
-                         i0 + 1, partialExplainedVariance)
-            totalExplainedVariance += partialExplainedVariance
-            eigenvectors[i0, :] = evectors[:, i]
-            #print("NORMA = ", numpy.dot(evectors[:, i].T, evectors[:, i]))
-        _logger.info("Total explained variance = %.2f %% ",
-                     totalExplainedVariance)
-    else:
-        idx = numpy.argsort(evalues)
-        eigenvalues[:]  = evalues[idx]
-        eigenvectors[:, :] = evectors[:, idx].T
-
-    # figure out if eigenvectors are to be multiplied by -1
-    if avgSpectrum.sum() > 0:
-        for i0 in range(ncomponents):
-            if eigenvectors[i0].sum() < 0.0:
-                _logger.info("PC%02d multiplied by -1" % i0)
-                eigenvectors[i0] *= -1
+    images = numpy.zeros((ncomponents, nPixels), numpy.float32)
 
     # calculate the projections
     # Subtracting the average and normalizing to standard deviation gives worse results.
@@ -723,6 +746,382 @@ def numpyPCA(stack, index=-1, ncomponents=10, binning=None,
                 "covariance":cov}
 
 
+def _getChunkedView(stack, index=None, binning=None, nMca=None):
+    """
+    Returns the data, a view iterating the data by chunks of (sampled)
+    spectra and the shape of the spatial dimensions.
+    """
+    if hasattr(stack, "info") and hasattr(stack, "data"):
+        #we are dealing with a PyMca data object
+        data = stack.data
+        if index is None:
+            index = stack.info.get("McaIndex", -1)
+    else:
+        data = stack
+    if index is None:
+        index = -1
+    shape = data.shape
+    if index not in [0, -1, len(shape) - 1]:
+        raise IndexError("1D index must be one of 0, -1 or %d" % len(shape))
+    if index < 0:
+        index = len(shape) + index
+    if binning is None:
+        binning = 1
+    # our binning (better said sampling) is spectral, in order not to
+    # affect the spatial resolution
+    nChannels = int(shape[index] / binning)
+    if nMca is None:
+        nMca = CHUNK_MB, 'MB'
+    view = McaStackView.FullView(data, mcaAxis=index,
+                                 mcaSlice=slice(0, nChannels * binning,
+                                                binning),
+                                 nMca=nMca, dtype=numpy.float64)
+    spatialShape = tuple(shape[i] for i in range(len(shape)) if i != index)
+    return data, view, spatialShape
+
+
+def _getChunkedScores(view, spatialShape, eigenvalues, eigenvectors,
+                      average, output=None):
+    """
+    Project the chunks of spectra of the view on the eigenvectors. The
+    scores are returned as an array or, if an h5py group is given as
+    output, written to its "scores" dataset together with the eigenvalues,
+    the eigenvectors and the average spectrum.
+    """
+    ncomponents = eigenvectors.shape[0]
+    scoresShape = (ncomponents,) + spatialShape
+    if output is None:
+        images = numpy.zeros(scoresShape, numpy.float32)
+    else:
+        for name, value in [("eigenvalues", eigenvalues),
+                            ("eigenvectors", eigenvectors),
+                            ("average", average)]:
+            if name in output:
+                del output[name]
+            output[name] = value
+        if "scores" in output:
+            del output["scores"]
+        images = output.create_dataset("scores", shape=scoresShape,
+                                       dtype=numpy.float32)
+    vectors = eigenvectors.astype(numpy.float64).T
+    for (idx, shape), chunk in view.items(keyType='select'):
+        scores = dotblas.dot(chunk, vectors).T
+        images[(slice(None),) + idx] = \
+                        scores.reshape((ncomponents,) + shape)
+    return images
+
+
+def _getCleanWeights(weights, nChannels, binning):
+    if binning is None:
+        binning = 1
+    if weights is None:
+        return numpy.ones((nChannels,), numpy.float64)
+    elif weights.size == nChannels:
+        # binning was taken into account
+        return numpy.array(weights, dtype=numpy.float64).reshape(-1)
+    else:
+        return numpy.array(weights[::binning][:nChannels],
+                           dtype=numpy.float64)
+
+
+def getChunkedCovarianceMatrix(stack,
+                               index=None,
+                               binning=None,
+                               center=True,
+                               weights=None,
+                               spatial_mask=None,
+                               nMca=None):
+    """
+    Calculate the covariance matrix of input data (stack) in a single pass
+    reading the data in chunks of spectra. Only the covariance matrix and
+    one chunk of spectra are kept in memory, therefore the input can be an
+    HDF5 dataset larger than the available memory.
+
+    The mean and the covariance of each chunk are merged into the running
+    ones in order to avoid the loss of precision of the accumulation of
+    the non centered products.
+
+    :param stack: Array of data (numpy ndarray or h5py dataset)
+    :param index: Array dimension containing the observables (0 or -1)
+    :param binning: Spectral sampling as in getCovarianceMatrix
+    :param center: Indicate if the mean is to be subtracted from the observables.
+    :param weights: Weight to be applied to each observable
+    :param spatial_mask: Array of size n where n is the number of pixels.
+        Only the pixels with a non-zero value are used.
+    :param nMca: Number of spectra read at once or tuple with the
+        maximal memory of the chunk (e.g. (100, 'MB'))
+    :returns: The covMatrix, the average spectrum and the number of used pixels.
+    """
+    data, view, spatialShape = _getChunkedView(stack, index=index,
+                                               binning=binning, nMca=nMca)
+    nChannels = view.nChan
+    cleanWeights = _getCleanWeights(weights, nChannels, binning)
+    if spatial_mask is not None:
+        spatial_mask = numpy.asarray(spatial_mask).reshape(spatialShape) > 0
+
+    covMatrix = numpy.zeros((nChannels, nChannels), numpy.float64)
+    average = numpy.zeros((nChannels,), numpy.float64)
+    usedPixels = 0
+    for (idx, shape), chunk in view.items(keyType='select'):
+        if spatial_mask is not None:
+            chunk = chunk[spatial_mask[idx].reshape(-1)]
+        nChunk = chunk.shape[0]
+        if not nChunk:
+            continue
+        chunk = chunk * cleanWeights
+        chunkAverage = chunk.mean(axis=0)
+        delta = chunkAverage - average
+        nTotal = usedPixels + nChunk
+        if center:
+            chunk -= chunkAverage
+            covMatrix += numpy.outer(delta, delta) * \
+                         (usedPixels * float(nChunk) / nTotal)
+        covMatrix += dotblas.dot(chunk.T, chunk)
+        average += delta * (float(nChunk) / nTotal)
+        usedPixels = nTotal
+    chunk = None
+    if usedPixels < 2:
+        raise ValueError("At least two spectra are needed")
+    covMatrix /= usedPixels - 1
+    return covMatrix, average, usedPixels
+
+
+def chunkedPCA(stack, index=-1, ncomponents=10, binning=None,
+               center=True, scale=True, mask=None, spectral_mask=None,
+               legacy=True, output=None, nMca=None, **kw):
+    """
+    Out-of-core covariance PCA of data read in chunks of spectra.
+
+    The covariance matrix is accumulated in a first pass over the data
+    (see getChunkedCovarianceMatrix) and the scores are calculated in a
+    second pass. The memory used is bounded by the size of the covariance
+    matrix, of the chunks and of the scores. The scores can be written
+    directly to HDF5 giving an h5py group as output, the returned scores
+    are then the created h5py dataset.
+
+    The results are the ones of numpyPCA.
+    """
+    _logger.debug("PCATools.chunkedPCA")
+    data, view, spatialShape = _getChunkedView(stack, index=index,
+                                               binning=binning, nMca=nMca)
+    N = view.nChan
+    if ncomponents > N:
+        msg = "Requested %d components for a maximum of %d" % (ncomponents, N)
+        raise ValueError(msg)
+    cov, avgSpectrum, calculatedPixels = \
+                getChunkedCovarianceMatrix(stack,
+                                           index=index,
+                                           binning=binning,
+                                           center=center,
+                                           weights=spectral_mask,
+                                           spatial_mask=mask,
+                                           nMca=nMca)
+    eigenvalues, eigenvectors, calculatedTotalVariance = \
+                getEigenSystem(cov, ncomponents, scale=scale,
+                               average=avgSpectrum)
+    cov = None
+
+    # calculate the projections as numpyPCA does
+    images = _getChunkedScores(view, spatialShape, eigenvalues, eigenvectors,
+                               avgSpectrum, output=output)
+    if legacy:
+        return images, eigenvalues, eigenvectors
+    else:
+        return {"scores": images,
+                "eigenvalues": eigenvalues,
+                "eigenvectors": eigenvectors,
+                "average": avgSpectrum,
+                "pixels": calculatedPixels,
+                "variance": calculatedTotalVariance}
+
+
+def _getChunkedProduct(view, vectors, weights=None, spatial_mask=None,
+                       center=True, average=None):
+    """
+    Accumulate data.T * (data * vectors) over the chunks of the view using
+    the weighted spectra of the selected pixels, centered if requested.
+
+    The chunks are not modified: the weights are applied to the vectors
+    and to the reduced products, the centering is a rank one correction
+    applied to data * vectors before the second product. If the average
+    spectrum is not given, it is calculated merging the means and the
+    products of the chunks as getChunkedCovarianceMatrix does and the
+    diagonal of data.T * data is calculated too, otherwise the returned
+    diagonal is None. Returns the product, the average spectrum, the
+    diagonal and the number of used pixels.
+    """
+    nChannels = vectors.shape[0]
+    if weights is not None:
+        weights = weights.reshape(-1, 1)
+        vectors = vectors * weights
+    product = numpy.zeros(vectors.shape, numpy.float64)
+    merge = average is None
+    if merge:
+        # average and diagonal of the unweighted data
+        average = numpy.zeros((nChannels,), numpy.float64)
+        diagonal = numpy.zeros((nChannels,), numpy.float64)
+    else:
+        diagonal = None
+        if weights is not None:
+            # unweighted average, the zero weight channels do not count
+            average = numpy.divide(average, weights[:, 0],
+                                   out=numpy.zeros(average.shape),
+                                   where=weights[:, 0] != 0)
+    usedPixels = 0
+    for (idx, shape), chunk in view.items(keyType='select'):
+        if spatial_mask is not None:
+            chunk = chunk[spatial_mask[idx].reshape(-1)]
+        nChunk = chunk.shape[0]
+        if not nChunk:
+            continue
+        nTotal = usedPixels + nChunk
+        if merge:
+            chunkAverage = chunk.mean(axis=0)
+            delta = chunkAverage - average
+            if center:
+                centered = chunkAverage
+                factor = usedPixels * float(nChunk) / nTotal
+                product += numpy.outer(delta, numpy.dot(delta, vectors)) * \
+                           factor
+                diagonal += delta * delta * factor
+                diagonal += ((chunk - chunkAverage) ** 2).sum(axis=0)
+            else:
+                centered = None
+                diagonal += (chunk * chunk).sum(axis=0)
+            average += delta * (float(nChunk) / nTotal)
+        elif center:
+            centered = average
+        else:
+            centered = None
+        # (chunk - centered).T * ((chunk - centered) * vectors)
+        reduced = dotblas.dot(chunk, vectors)
+        if centered is not None:
+            reduced -= numpy.dot(centered, vectors)
+            product -= numpy.outer(centered, reduced.sum(axis=0))
+        # faster than dot(chunk.T, reduced) for few vectors
+        product += dotblas.dot(reduced.T, chunk).T
+        usedPixels = nTotal
+    if weights is not None:
+        product *= weights
+        if merge:
+            average *= weights[:, 0]
+            diagonal *= weights[:, 0] ** 2
+    return product, average, diagonal, usedPixels
+
+
+def randomizedPCA(stack, index=-1, ncomponents=10, binning=None,
+                  center=True, scale=True, mask=None, spectral_mask=None,
+                  legacy=True, oversampling=10, iterations=2, seed=None,
+                  output=None, nMca=None, **kw):
+    """
+    Approximate PCA using a randomized range finder (randomized SVD).
+
+    The covariance matrix is never calculated. Each pass over the data,
+    read in chunks of spectra, multiplies it by a block of
+    ncomponents + oversampling vectors. The first pass uses random vectors
+    and also gives the average spectrum, each power iteration adds one
+    pass and improves the separation of components with close eigenvalues,
+    one more pass gives the reduced matrix whose eigen decomposition gives
+    the components and a final pass gives the scores. The input can be a
+    numpy array or an HDF5 dataset.
+
+    :param oversampling: Number of random vectors in excess of ncomponents
+    :param iterations: Number of power iterations
+    :param seed: Seed of the random vectors
+    :param output: Optional h5py group where the scores are written
+
+    The other parameters and the output are the ones of numpyPCA.
+    """
+    _logger.debug("PCATools.randomizedPCA")
+    data, view, spatialShape = _getChunkedView(stack, index=index,
+                                               binning=binning, nMca=nMca)
+    N = view.nChan
+    if ncomponents > N:
+        msg = "Requested %d components for a maximum of %d" % (ncomponents, N)
+        raise ValueError(msg)
+    if spectral_mask is None:
+        weights = None
+    else:
+        weights = _getCleanWeights(spectral_mask, N, binning)
+    if mask is not None:
+        mask = numpy.asarray(mask).reshape(spatialShape) > 0
+    nVectors = min(ncomponents + max(int(oversampling), 0), N)
+    randomState = numpy.random.RandomState(seed)
+    vectors = randomState.standard_normal((N, nVectors))
+
+    # first pass: sketch of the data and first and second moments
+    t0 = time.time()
+    product, avgSpectrum, diagonal, usedPixels = \
+                _getChunkedProduct(view, vectors, weights, spatial_mask=mask,
+                                   center=center)
+    if usedPixels < 2:
+        raise ValueError("At least two spectra are needed")
+    product /= usedPixels - 1
+    variance = diagonal / (usedPixels - 1)
+    if scale:
+        # the random vectors are scaled too and therefore still random
+        standardDeviation = numpy.sqrt(variance)
+        standardDeviation[standardDeviation == 0] = 1.0
+        standardDeviation.shape = -1, 1
+        product /= standardDeviation
+        totalVariance = (variance / (standardDeviation[:, 0] ** 2)).sum()
+    else:
+        standardDeviation = None
+        totalVariance = variance.sum()
+    _logger.info("Total Variance = %s", totalVariance)
+
+    def covarianceProduct(vectors):
+        if standardDeviation is not None:
+            vectors = vectors / standardDeviation
+        product = _getChunkedProduct(view, vectors, weights,
+                                     spatial_mask=mask, center=center,
+                                     average=avgSpectrum)[0]
+        product /= usedPixels - 1
+        if standardDeviation is not None:
+            product /= standardDeviation
+        return product
+
+    for i in range(max(int(iterations), 0)):
+        basis = numpy.linalg.qr(product)[0]
+        product = covarianceProduct(basis)
+    basis = numpy.linalg.qr(product)[0]
+    reduced = numpy.dot(basis.T, covarianceProduct(basis))
+    reduced = 0.5 * (reduced + reduced.T)
+    evalues, evectors = numpy.linalg.eigh(reduced)
+    order = numpy.argsort(evalues)[::-1][:ncomponents]
+    eigenvalues = evalues[order].astype(numpy.float32)
+    eigenvectors = numpy.dot(basis, evectors[:, order]).T.astype(numpy.float32)
+    _logger.debug("Randomized PCA elapsed = %s", time.time() - t0)
+    totalExplainedVariance = 0.0
+    for i0 in range(ncomponents):
+        partialExplainedVariance = 100. * eigenvalues[i0] / totalVariance
+        _logger.info("PC%02d  Explained variance %.5f %% ",
+                     i0 + 1, partialExplainedVariance)
+        totalExplainedVariance += partialExplainedVariance
+    _logger.info("Total explained variance = %.2f %% ",
+                 totalExplainedVariance)
+
+    # figure out if eigenvectors are to be multiplied by -1
+    if avgSpectrum.sum() > 0:
+        for i0 in range(ncomponents):
+            if eigenvectors[i0].sum() < 0.0:
+                _logger.info("PC%02d multiplied by -1" % i0)
+                eigenvectors[i0] *= -1
+
+    # calculate the projections as numpyPCA does
+    images = _getChunkedScores(view, spatialShape, eigenvalues, eigenvectors,
+                               avgSpectrum, output=output)
+    if legacy:
+        return images, eigenvalues, eigenvectors
+    else:
+        return {"scores": images,
+                "eigenvalues": eigenvalues,
+                "eigenvectors": eigenvectors,
+                "average": avgSpectrum,
+                "pixels": usedPixels,
+                "variance": totalVariance}
+
+
 def test():
     x = numpy.array([[0.0,  2.0,  3.0],
                      [3.0,  0.0, -1.0],
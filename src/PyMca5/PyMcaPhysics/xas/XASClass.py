@@ -395,53 +395,22 @@ def polspl_test():
     return
 
 
-def postEdge(set2,kmin=None,kmax=None,polDegree=[3,3,3],knots=None, full=False):
-    r"""
-        postEdge(set2,kmin=None,kmax=None,polDegree=[3,3,3],knots=None)
-
-     PURPOSE:
-    	This procedure calculates the post edge fit of a xafs spectrum
-
-     INPUTS:
-    	set2: input set of data
-
-     KEYWORD PARAMETERS:
-        kmin the bottom limit for the fit (defaults kmin=0)
-        kmax the upper limit for the fit (defaults max)
-
-     OUTPUTS:
-    	a set with the fit
-
-     MODIFICATION HISTORY:
-     	Written by:	Manuel Sanchez del Rio. ESRF
-    	February, 1993
-        1996-08-13 MSR (srio@esrf.fr) changes wmenu->wmenu2 and
-                   xtext->widget_message
-    	1998-10-01 srio@esrf.fr adapts for delia.
-    	2000-02-12 MSR (srio@esrf.fr) adds Dialog_Parent keyword
-    	2014-12-04 srio@esrf.eu Translated to python
-
+def _getPostEdgeIntervals(kmin, kmax, polDegree, knots=None):
     """
-    #Note that in/out arrays are numpy way: numpy.array((npoints,2))
+    Limits and number of coefficients of the polynomials of the post-edge
+    spline as expected by polspl (arrays start at index 1).
 
+    :return: xrange1, xl, xh, nc, nr
+    """
     xl = numpy.zeros(10)
     xh = numpy.zeros(10)
-    c = numpy.zeros(36)
     nc = numpy.zeros(10, numpy.int32)
     if len(polDegree) > 10:
         _logger.warning("Error: Maximum number of intervals is 10")
         _logger.warning("       Number of intervals forced to 10")
         polDegree = polDegree[0:9]
 
-    x1 = 0.0 # set2[:,0].min()
-    x2 = set2[:,0].max()
-
-    if kmin != None:
-        x1 = kmin
-    if kmax != None:
-        x2 = kmax
-
-    xrange1 = [x1,x2]
+    xrange1 = [kmin, kmax]
     _logger.debug("++++++++++++++++++%s", xrange1)
     if knots not in [None, []]:
         if len(knots) == len(polDegree):
@@ -479,6 +448,46 @@ def postEdge(set2,kmin=None,kmax=None,polDegree=[3,3,3],knots=None, full=False):
         for i in range(1,nr):
             xl[i+1] = knots[i]
             xh[i]   = xl[i+1]
+    return xrange1, xl, xh, nc, nr
+
+def postEdge(set2,kmin=None,kmax=None,polDegree=[3,3,3],knots=None, full=False):
+    r"""
+        postEdge(set2,kmin=None,kmax=None,polDegree=[3,3,3],knots=None)
+
+     PURPOSE:
+    	This procedure calculates the post edge fit of a xafs spectrum
+
+     INPUTS:
+    	set2: input set of data
+
+     KEYWORD PARAMETERS:
+        kmin the bottom limit for the fit (defaults kmin=0)
+        kmax the upper limit for the fit (defaults max)
+
+     OUTPUTS:
+    	a set with the fit
+
+     MODIFICATION HISTORY:
+     	Written by:	Manuel Sanchez del Rio. ESRF
+    	February, 1993
+        1996-08-13 MSR (srio@esrf.fr) changes wmenu->wmenu2 and
+                   xtext->widget_message
+    	1998-10-01 srio@esrf.fr adapts for delia.
+    	2000-02-12 MSR (srio@esrf.fr) adds Dialog_Parent keyword
+    	2014-12-04 srio@esrf.eu Translated to python
+
+    """
+    #Note that in/out arrays are numpy way: numpy.array((npoints,2))
+
+    x1 = 0.0 # set2[:,0].min()
+    x2 = set2[:,0].max()
+
+    if kmin != None:
+        x1 = kmin
+    if kmax != None:
+        x2 = kmax
+
+    xrange1, xl, xh, nc, nr = _getPostEdgeIntervals(x1, x2, polDegree, knots)
 
     #
     # select only points in selected interval
@@ -540,6 +549,141 @@ def postEdge0(k, mu, kmin=None, kmax=None, degrees=(3, 3, 3), knots=None, full=F
     set0[:, 1] = mu
     return postEdge(set0, kmin, kmax, degrees, knots=knots, full=full)
 
+def postEdgeStack(k, mu, kmin, kmax, degrees=(3, 3, 3), knots=None):
+    r"""
+    Vectorized version of postEdge0 for a set of spectra.
+
+    The polynomial spline of each spectrum is obtained solving the same
+    linear system as polspl, but the systems of all the spectra are built
+    and solved at once.
+
+    :param k: 2D array (nSpectra, nPoints) with the k values of each spectrum
+    :param mu: 2D array (nSpectra, nPoints) with the signal to be fitted
+    :param kmin: Lower limit of the fit
+    :param kmax: Upper limit of the fit of each spectrum
+    :param degrees: Degree of the polynomial of each interval
+    :param knots: Knots as accepted by postEdge
+    :return: fit (nSpectra, nPoints), xNodes and yNodes (nSpectra, nKnots)
+    """
+    k = numpy.asarray(k, dtype=numpy.float64)
+    mu = numpy.asarray(mu, dtype=numpy.float64)
+    nSpectra = k.shape[0]
+    kmax = numpy.broadcast_to(numpy.asarray(kmax, dtype=numpy.float64),
+                              (nSpectra,))
+    xl = numpy.zeros((nSpectra, 11))
+    xh = numpy.zeros((nSpectra, 11))
+    for s in range(nSpectra):
+        xrange1, xl[s, :10], xh[s, :10], nc, nr = \
+                    _getPostEdgeIntervals(kmin, kmax[s], degrees, knots)
+    # polspl swaps reversed limits
+    swap = xl[:, 1:nr + 1] >= xh[:, 1:nr + 1]
+    tmp = numpy.where(swap, xl[:, 1:nr + 1], xh[:, 1:nr + 1])
+    xl[:, 1:nr + 1] = numpy.where(swap, xh[:, 1:nr + 1], xl[:, 1:nr + 1])
+    xh[:, 1:nr + 1] = tmp
+
+    # indices of the coefficients of each interval (starting at 1)
+    nbs = numpy.zeros(12, dtype=int)
+    nbs[1] = 1
+    n = 0
+    for i in range(1, nr + 1):
+        n = n + int(nc[i])
+        nbs[i + 1] = n + 1
+    n = n + 2 * (nr - 1)
+    n1 = n + 1
+
+    # least squares part of the system, built from the sums of the powers
+    # of k over the points of each interval
+    a = numpy.zeros((nSpectra, n + 1, n + 2))
+    for ibl in range(1, nr + 1):
+        ns = nbs[ibl]
+        ne = nbs[ibl + 1] - 1
+        m = ne - ns + 1
+        inside = (k >= xl[:, ibl:ibl + 1]) & (k <= xh[:, ibl:ibl + 1])
+        # only consider the columns with points inside the interval
+        columns = numpy.nonzero(inside.any(axis=0))[0]
+        if columns.size:
+            columns = slice(columns[0], columns[-1] + 1)
+        else:
+            columns = slice(0, 0)
+        kPower = numpy.where(inside[:, columns], 1.0, 0.0)
+        kInterval = k[:, columns]
+        muInterval = mu[:, columns]
+        sums = numpy.zeros((nSpectra, 2 * m - 1))
+        for q in range(2 * m - 1):
+            if q:
+                kPower *= kInterval
+            sums[:, q] = kPower.sum(axis=1)
+            if q < m:
+                a[:, ns + q, n1] = (kPower * muInterval).sum(axis=1)
+        for i in range(m):
+            a[:, ns + i, ns:ne + 1] = sums[:, i:i + m]
+
+    # continuity of the function and its derivative at the knots
+    ncol = nbs[nr + 1] - 1
+    for ik in range(1, nr):
+        xk = numpy.where(xl[:, ik] > xl[:, ik + 1],
+                         .5 * (xl[:, ik] + xh[:, ik + 1]),
+                         .5 * (xh[:, ik] + xl[:, ik + 1]))
+        ncol = ncol + 1
+        ns = nbs[ik]
+        ne = nbs[ik + 1] - 1
+        a[:, ns, ncol] = -1.
+        ns = ns + 1
+        for i in range(ns, ne + 1):
+            a[:, i, ncol] = a[:, i - 1, ncol] * xk
+        ncol = ncol + 1
+        a[:, ns, ncol] = -1.
+        ns = ns + 1
+        for i in range(ns, ne + 1):
+            a[:, i, ncol] = (ns - i - 2) * numpy.power(xk, (i - ns + 1))
+        ncol = ncol - 1
+        ns = nbs[ik + 1]
+        ne = nbs[ik + 2] - 1
+        a[:, ns, ncol] = 1.0
+        ns = ns + 1
+        for i in range(ns, ne + 1):
+            a[:, i, ncol] = a[:, i - 1, ncol] * xk
+        ncol = ncol + 1
+        a[:, ns, ncol] = 1.0
+        ns = ns + 1
+        for i in range(ns, ne + 1):
+            a[:, i, ncol] = (i - ns + 2) * numpy.power(xk, (i - ns + 1))
+
+    # polspl only fills the upper triangle of the symmetric matrix
+    matrix = numpy.triu(a[:, 1:n + 1, 1:n + 1])
+    matrix = matrix + numpy.swapaxes(numpy.triu(matrix, 1), 1, 2)
+    vector = a[:, 1:n + 1, n1:n1 + 1]
+    try:
+        c = numpy.linalg.solve(matrix, vector)[:, :, 0]
+    except numpy.linalg.LinAlgError:
+        c = numpy.empty((nSpectra, n))
+        for s in range(nSpectra):
+            try:
+                c[s] = numpy.linalg.solve(matrix[s], vector[s])[:, 0]
+            except numpy.linalg.LinAlgError:
+                _logger.warning("Singular post-edge system")
+                c[s] = numpy.nan
+
+    def evaluate(j, x):
+        cstart = nbs[j] - 1
+        yval = numpy.zeros(x.shape)
+        for i in range(int(nc[j])):
+            yval += c[:, cstart + i:cstart + i + 1] * numpy.power(x, i)
+        return yval
+
+    # polspl_evaluate extrapolates the first and last polynomials
+    interval = numpy.ones(k.shape, dtype=int)
+    for j in range(1, nr):
+        interval += k > xh[:, j:j + 1]
+    fit = numpy.zeros(k.shape)
+    for j in range(1, nr + 1):
+        fit = numpy.where(interval == j, evaluate(j, k), fit)
+    xNodes = xh[:, 1:nr].astype(numpy.float32)
+    yNodes = numpy.zeros((nSpectra, nr - 1), dtype=numpy.float32)
+    for j in range(1, nr):
+        yNodes[:, j - 1] = evaluate(j, xh[:, j:j + 1])[:, 0]
+    return fit, xNodes, yNodes
+
 def getFTWindowWeights(tk, window="Gaussian", windpar=0.2, wrange=None):
 
     r"""
@@ -591,10 +735,11 @@ def getFTWindowWeights(tk, window="Gaussian", windpar=0.2, wrange=None):
         window = names[window]
     _logger.debug("Using window %s", window)
 
-    if wrange == None:
+    if wrange is None:
         xmax = tk.max()
         xmin = tk.min()
     else:
+        # the limits can be arrays to be broadcasted against tk
         xmin = wrange[0]
         xmax = wrange[1]
 
@@ -603,63 +748,56 @@ def getFTWindowWeights(tk, window="Gaussian", windpar=0.2, wrange=None):
     apo1 = xmin + windpar
     apo2 = xmax - windpar
 
-    npoint = len(tk)
-    wind = numpy.ones(npoint, dtype=numpy.float64)
-
-    if window in ["Gaussian", "Gauss"]:
-        wind = numpy.power((tk - xp)/xm, 2)
-        wind = numpy.exp(-wind * 9.2)
-
-    elif window == "Hanning":
-        for i in range(npoint):
-            if tk[i] <= apo1:
-                wind[i] = 0.5*(1.0-numpy.cos(numpy.pi*(tk[i]-xmin)/windpar))
-            if tk[i] >= apo2:
-                wind[i] = 0.5*(1.0+numpy.cos(numpy.pi*(tk[i]-apo2)/windpar))
-    elif window == "Box":
-        for i in range(npoint):
-            if tk[i] <= apo1:
-                wind[i] = 0.0
-            if tk[i] >= apo2:
-                wind[i] = 0.0
-    elif window in ["Parzen", "Triangle", "Triangular"]:
-        for i in range(npoint):
-            if tk[i] <= apo1:
-                wind[i] = (tk[i]-xmin)/windpar
-            if tk[i] >= apo2:
-                wind[i] = 1 - (tk[i]-apo2)/windpar
-    elif window == "Welch":
-        for i in range(npoint):
-            if tk[i] <= apo1:
-                wind[i] = 1.0 - numpy.power( ( (tk[i]-apo1) / windpar), 2)
-            if tk[i] >= apo2:
-                wind[i] =  1.0 - numpy.power( (tk[i]-apo2) / windpar, 2 )
-    elif window == "Hamming":
-        for i in range(npoint):
-            if tk[i] <= apo1:
-                wind[i] = 1.08 - (.54+0.46*numpy.cos(numpy.pi*(tk[i]-xmin)/windpar))
-            if tk[i] >= apo2:
-                wind[i] =   1.08 - (.54-0.46*numpy.cos(numpy.pi*(tk[i]-apo2)/windpar))
-    elif window == "Tukey":
-        for i in range(npoint):
-            if tk[i] <= apo1:
-                wind[i] = 1.0 - numpy.power(numpy.cos(0.5*numpy.pi*(tk[i]-xmin)/windpar),2)
-            if tk[i] >= apo2:
-                wind[i] = numpy.power(numpy.cos(-0.5*numpy.pi*(tk[i]-apo2)/windpar),2)
-    elif window == "Papul":
-        for i in range(npoint):
-            if tk[i] <= apo1:
-                a=(1./numpy.pi)*numpy.sin(numpy.pi*(tk[i]-xmin)/windpar) + \
-                  (1.-(tk[i]-xmin)/windpar)*numpy.cos(numpy.pi*(tk[i]-xmin)/windpar)
-                wind[i] = 1.0 - a
-            if tk[i] >= apo2:
-                a=(1./numpy.pi)*numpy.sin(numpy.pi*(tk[i]-apo2)/windpar) + \
-                  (1.-(tk[i]-apo2)/windpar)*numpy.cos(numpy.pi*(tk[i]-apo2)/windpar)
-                wind[i] = a
-    elif _XAS and window in ["Kaiser", "Kasel"]:
-        wind= (_xas.j0(windpar * numpy.sqrt(1. - 4.0 * pow((tk-xp)/xm, 2))) - 1.0)/ (_xas.j0(windpar) - 1.0)
-    else:
-        raise ValueError("Window <%s> not implemented" % window)
+    wind = numpy.ones(tk.shape, dtype=numpy.float64)
+    low = tk <= apo1
+    high = tk >= apo2
+    pi = numpy.pi
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        if window in ["Gaussian", "Gauss"]:
+            wind = numpy.power((tk - xp)/xm, 2)
+            wind = numpy.exp(-wind * 9.2)
+        elif window == "Hanning":
+            wind = numpy.where(low,
+                        0.5*(1.0-numpy.cos(pi*(tk-xmin)/windpar)), wind)
+            wind = numpy.where(high,
+                        0.5*(1.0+numpy.cos(pi*(tk-apo2)/windpar)), wind)
+        elif window == "Box":
+            wind[low] = 0.0
+            wind[high] = 0.0
+        elif window in ["Parzen", "Triangle", "Triangular"]:
+            wind = numpy.where(low, (tk-xmin)/windpar, wind)
+            wind = numpy.where(high, 1 - (tk-apo2)/windpar, wind)
+        elif window == "Welch":
+            wind = numpy.where(low,
+                        1.0 - numpy.power(((tk-apo1) / windpar), 2), wind)
+            wind = numpy.where(high,
+                        1.0 - numpy.power((tk-apo2) / windpar, 2), wind)
+        elif window == "Hamming":
+            wind = numpy.where(low,
+                        1.08 - (.54+0.46*numpy.cos(pi*(tk-xmin)/windpar)),
+                        wind)
+            wind = numpy.where(high,
+                        1.08 - (.54-0.46*numpy.cos(pi*(tk-apo2)/windpar)),
+                        wind)
+        elif window == "Tukey":
+            wind = numpy.where(low,
+                        1.0 - numpy.power(numpy.cos(0.5*pi*(tk-xmin)/windpar), 2),
+                        wind)
+            wind = numpy.where(high,
+                        numpy.power(numpy.cos(-0.5*pi*(tk-apo2)/windpar), 2),
+                        wind)
+        elif window == "Papul":
+            a = (1./pi)*numpy.sin(pi*(tk-xmin)/windpar) + \
+                (1.-(tk-xmin)/windpar)*numpy.cos(pi*(tk-xmin)/windpar)
+            wind = numpy.where(low, 1.0 - a, wind)
+            a = (1./pi)*numpy.sin(pi*(tk-apo2)/windpar) + \
+                (1.-(tk-apo2)/windpar)*numpy.cos(pi*(tk-apo2)/windpar)
+            wind = numpy.where(high, a, wind)
+        elif _XAS and window in ["Kaiser", "Kasel"]:
+            wind= (_xas.j0(windpar * numpy.sqrt(1. - 4.0 * pow((tk-xp)/xm, 2))) - 1.0)/ (_xas.j0(windpar) - 1.0)
+        else:
+            raise ValueError("Window <%s> not implemented" % window)
     return wind
 
 def getFT(k, exafs, npoints=2048, rrange=(0.0, 7.0),
@@ -735,6 +873,83 @@ def getFT(k, exafs, npoints=2048, rrange=(0.0, 7.0),
     ddict["FTImaginary"] = f13
     return ddict
 
+def getFTStack(k, exafs, krange, npoints=2048, rrange=(0.0, 7.0),
+               kstep=0.02, kweight=0, window="gaussian", apodization=0.2):
+    """
+    Vectorized version of getFT for a set of spectra.
+
+    :param k: 2D array (nSpectra, nPoints) with increasing k values
+    :param exafs: 2D array (nSpectra, nPoints) with the EXAFS signals
+    :param krange: Limits of the transformed region. Each limit can be a
+                   single value or one value per spectrum.
+    :return: Dictionary with the keys of getFT. The results depending on
+             the spectrum have nSpectra as first dimension.
+    """
+    k = numpy.asarray(k, dtype=numpy.float64)
+    nSpectra, nPoints = k.shape
+    kLow = numpy.broadcast_to(numpy.asarray(krange[0], dtype=numpy.float64),
+                              (nSpectra,))[:, None]
+    kHigh = numpy.broadcast_to(numpy.asarray(krange[1], dtype=numpy.float64),
+                               (nSpectra,))[:, None]
+    valid = (k >= kLow) & (k <= kHigh)
+    wweights = getFTWindowWeights(k,
+                                  window=window,
+                                  windpar=apodization,
+                                  wrange=(kLow, kHigh))
+    wweights[~valid] = 0.0
+    signal = wweights * exafs * pow(k, kweight)
+
+    # linear interpolation on the regular k grid with zero outside the
+    # transformed region, as numpy.interp does in getFT
+    interpolatedDataX = numpy.linspace(0.0, npoints-1, npoints) * kstep
+    interpolatedDataY = numpy.zeros((nSpectra, npoints), dtype=numpy.float64)
+    first = numpy.argmax(valid, axis=1)
+    last = nPoints - 1 - numpy.argmax(valid[:, ::-1], axis=1)
+    rows = numpy.arange(nSpectra)
+    kFirst = k[rows, first][:, None]
+    kLast = k[rows, last][:, None]
+    # only the grid points below the largest k can be different from zero
+    nGrid = numpy.searchsorted(interpolatedDataX, kLast.max(), side="right")
+    gridX = interpolatedDataX[:nGrid]
+    j = numpy.empty((nSpectra, nGrid), dtype=int)
+    for s in range(nSpectra):
+        j[s] = numpy.searchsorted(k[s], gridX, side="right") - 1
+    j = numpy.clip(j, first[:, None], numpy.maximum(first, last - 1)[:, None])
+    j1 = numpy.minimum(j + 1, nPoints - 1)
+    kj = numpy.take_along_axis(k, j, axis=1)
+    kj1 = numpy.take_along_axis(k, j1, axis=1)
+    yj = numpy.take_along_axis(signal, j, axis=1)
+    yj1 = numpy.take_along_axis(signal, j1, axis=1)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        slope = numpy.where(kj1 > kj, (yj1 - yj) / (kj1 - kj), 0.0)
+    gridY = slope * (gridX - kj) + yj
+    inside = (gridX >= kFirst) & (gridX <= kLast) & valid.any(axis=1)[:, None]
+    gridY[~inside] = 0.0
+    interpolatedDataY[:, :nGrid] = gridY
+
+    ff = numpy.fft.ifft(interpolatedDataY, axis=-1)
+    rstep = numpy.pi / npoints / kstep
+    rr = numpy.linspace(0.0, npoints-1, npoints) * rstep
+
+    coef = npoints * kstep / numpy.sqrt(numpy.pi) * numpy.sqrt(2.)
+    goodi = (rr  >= rrange[0]) & (rr  <= rrange[1])
+    f12 = coef * numpy.real(ff[:, goodi])
+    f13 = coef * numpy.imag(ff[:, goodi]) * (-1.)
+    f10 = rr[goodi]
+    f11 = numpy.sqrt(f12 * f12 + f13 * f13)
+
+    ddict = {}
+    ddict["InterpolatedK"] = interpolatedDataX
+    ddict["InterpolatedSignal"] = interpolatedDataY
+    ddict["KWeight"] = kweight
+    ddict["K"] = k
+    ddict["WindowWeight"] = wweights
+    ddict["FTRadius"] = f10
+    ddict["FTIntensity"] = f11
+    ddict["FTReal"] = f12
+    ddict["FTImaginary"] = f13
+    return ddict
+
 def getBackFT(fourier,npoint=4096,krange=[2.0,12.0],rstep=None,rmin=None,rmax=None):
     r"""
         fastbftr(fourier,npoint=4096,krange=[2.0,12.0],rstep=None,rmin=None,rmax=None)
@@ -845,6 +1060,21 @@ def getBackFT(fourier,npoint=4096,krange=[2.0,12.0],rstep=None,rmin=None,rmax=No
     return backftr
 
 
+def _getIncreasingIndices(energy):
+    """
+    Indices sorting the energies and keeping them strictly increasing, and
+    a flag telling if the sorted energies are equidistant.
+    """
+    idx = energy.argsort(kind='mergesort')
+    sortedEnergy = numpy.take(energy, idx)
+    delta = sortedEnergy[1:] - sortedEnergy[:-1]
+    equidistant = delta.min() == delta.max()
+    if delta.min() <= 1.0e-10:
+        # force data to be strictly increasing
+        # although we do not consider last point
+        idx = numpy.take(idx, numpy.nonzero(delta > 0)[0])
+    return idx, equidistant
+
 class XASClass(object):
     def __init__(self, backend=None):
         # This lists are to be updated as larch or any other backend
@@ -1037,29 +1267,11 @@ def setSpectrum(self, energy, mu, units=None, sanitize=True):
         mu0.shape = -1
         self._equidistant = False
 
-        # TODO: This should become a function to be called on its own
-        # make sure data are sorted
-        idx = energy.argsort(kind='mergesort')
+        # make sure data are sorted and strictly increasing
+        idx, equidistant = _getIncreasingIndices(energy0)
         energy = numpy.take(energy0, idx)
         mu = numpy.take(mu0, idx)
 
-        # make sure data are strictly increasing
-        delta = energy[1:] - energy[:-1]
-        dmin = delta.min()
-        dmax = delta.max()
-        if delta.min() <= 1.0e-10:
-            # force data to be strictly increasing
-            # although we do not consider last point
-            idx = numpy.nonzero(delta>0)[0]
-            energy = numpy.take(energy, idx)
-            mu = numpy.take(mu, idx)
-            delta = None
-
-        if dmin == dmax:
-            equidistant = True
-        else:
-            equidistant = False
-
         if units is None:
             if (energy[-1] - energy[0]) < 10:
                 units = "keV"
@@ -1137,6 +1349,223 @@ def processSpectrum(self):
         return ddict
 
 
+    def processSpectra(self, energy, mu, units=None):
+        """
+        Process at once a set of spectra sharing the same energies.
+
+        It gives the same results as calling setSpectrum and processSpectrum
+        on each spectrum, but the edge detection, the normalization, the
+        EXAFS extraction and the Fourier transform are performed on all
+        the spectra with array operations.
+
+        :param energy: 1D array with the energies common to all the spectra
+        :param mu: 2D array of shape (nSpectra, energy.size)
+        :param units: "eV", "keV" or None to deduce them from the energies
+        :return: Dictionary with the keys of processSpectrum. The results
+                 depending on the spectrum have nSpectra as first dimension.
+        """
+        energy0 = numpy.array(energy, dtype=numpy.float64, copy=True)
+        energy0.shape = -1
+        mu0 = numpy.asarray(mu, dtype=numpy.float64)
+        mu0 = mu0.reshape(-1, energy0.size)
+        idx, equidistant = _getIncreasingIndices(energy0)
+        energy = numpy.take(energy0, idx)
+        mu = numpy.take(mu0, idx, axis=1)
+        if units is None:
+            if (energy[-1] - energy[0]) < 10:
+                units = "keV"
+            else:
+                units = "eV"
+        if units.lower() not in ["kev", "ev"]:
+            raise ValueError("Unhandled units %s" % units)
+        elif units.lower() == "kev":
+            energy *= 1000.
+
+        configuration = self._configuration["DefaultBackend"]
+        e0 = self._calculateE0Stack(energy, mu, equidistant,
+                                    configuration["Normalization"])
+        ddict = self._normalizeStack(energy, mu, e0,
+                                     configuration["Normalization"])
+        ddict["Energy"] = energy
+        ddict["Mu"] = mu
+        cleanMu = mu - ddict["NormalizedBackground"]
+        kValues = e2k(energy[None, :] - e0[:, None])
+
+        # post-edge
+        config = configuration["EXAFS"]
+        kMin = config["KMin"]
+        kMax = kValues.max(axis=1)
+        kWeight = config["KWeight"]
+        if kMin is None:
+            kMin = 2
+        if config["KMax"] is not None:
+            kMax = numpy.minimum(kMax, config["KMax"])
+        number = config["Knots"].get("Number", 0)
+        if number == 0:
+            knots = None
+            if not hasattr(config["Knots"]["Orders"], "__len__"):
+                config["Knots"]["Orders"] = [config["Knots"]["Orders"]]
+        else:
+            knots = config["Knots"]["Values"]
+            if not hasattr(knots, "__len__"):
+                knots = [knots]
+        fit, xNodes, yNodes = postEdgeStack(kValues, cleanMu, kMin, kMax,
+                                            config["Knots"]["Orders"],
+                                            knots=knots)
+        ddict["PostEdgeK"] = kValues
+        ddict["PostEdgeB"] = fit
+        ddict["KnotsX"] = xNodes
+        ddict["KnotsY"] = yNodes
+        ddict["KMin"] = kMin
+        ddict["KMax"] = kMax
+        ddict["KWeight"] = kWeight
+
+        # normalization
+        exafs = (cleanMu - fit) / fit
+        ddict["EXAFSEnergy"] = k2e(kValues)
+        ddict["EXAFSKValues"] = kValues
+        ddict["EXAFSSignal"] = cleanMu
+        if kWeight:
+            exafs *= pow(kValues, kWeight)
+        ddict["EXAFSNormalized"] = exafs
+
+        # FT
+        config = configuration["FT"]
+        kRange = config["WindowRange"]
+        if config["WindowRange"] in [None, "None"]:
+            kRange = [kMin, kMax]
+        else:
+            kRange = [numpy.maximum(kRange[0], kMin),
+                      numpy.minimum(kRange[1], kMax)]
+        ddict["FT"] = getFTStack(kValues, exafs, kRange,
+                                 npoints=config["Points"],
+                                 window=config.get("Window", "Gaussian"),
+                                 apodization=config.get("WindowApodization",
+                                                        0.02),
+                                 rrange=config["Range"],
+                                 kstep=config["KStep"])
+        return ddict
+
+    def _calculateE0Stack(self, energy, mu, equidistant, config):
+        method = config["E0Method"]
+        methodLower = method.lower()
+        nSpectra = mu.shape[0]
+        if methodLower.endswith("manual"):
+            e0 = config["E0Value"]
+            if e0 is None:
+                raise ValueError("Edge energy not set")
+            return numpy.zeros((nSpectra,), numpy.float64) + e0
+        if methodLower.endswith("no smooth"):
+            npoints = None
+        elif methodLower.endswith("3pt sg"):
+            npoints = 3
+        elif methodLower.endswith("5pt sg"):
+            npoints = 5
+        elif methodLower.endswith("7pt sg"):
+            npoints = 7
+        elif methodLower.endswith("9pt sg"):
+            npoints = 9
+        else:
+            raise ValueError("Method <%s> not implemented" % method)
+        if equidistant:
+            # data do not need to be interpolated
+            eWork = energy
+        else:
+            # numpy.interp of all the spectra on the working grid
+            nWorkingPoints = 10 * energy.size
+            eWork = numpy.linspace(energy[1], energy[-2], nWorkingPoints)
+            j = numpy.searchsorted(energy, eWork, side="right") - 1
+            j = numpy.clip(j, 0, energy.size - 2)
+            t = (eWork - energy[j]) / (energy[j + 1] - energy[j])
+        # work on blocks of spectra small enough to stay in cache
+        blockSize = max(1, 65536 // eWork.size)
+        e0 = numpy.zeros((nSpectra,), numpy.float64)
+        for i0 in range(0, nSpectra, blockSize):
+            block = mu[i0:i0 + blockSize]
+            if equidistant:
+                muWork = block
+            else:
+                muWork = block[:, j + 1] - block[:, j]
+                muWork *= t
+                muWork += block[:, j]
+            if npoints is None:
+                idx = numpy.gradient(muWork, axis=1).argmax(axis=1)
+                e0[i0:i0 + blockSize] = eWork[idx]
+            else:
+                e0[i0:i0 + blockSize] = \
+                    XASNormalization.getE0SavitzkyGolayStack(eWork, muWork,
+                                                            points=npoints)
+        return e0
+
+    def _normalizeStack(self, energy, mu, e0, config):
+        nSpectra = mu.shape[0]
+        eMin = energy.min()
+        eMax = energy.max()
+        data = {}
+        atEdge = {}
+        plotLimits = {}
+        for key in ["PreEdge", "PostEdge"]:
+            regions = config [key] ["Regions"]
+            edgeMethod = config[key]["Method"]
+            if edgeMethod.lower() != "polynomial":
+                raise ValueError("Only normalization with polynomials implemented")
+            method = config[key]["Polynomial"]
+            fullModel = self._getNormalizationModelMatrix(key, method, energy)
+            edgeModel = self._getNormalizationModelMatrix(key, method, e0)
+            # spectra fitted on the same points share the model matrix
+            groups = {}
+            plotLimits[key] = numpy.zeros((nSpectra,), numpy.float64)
+            for s in range(nSpectra):
+                workingRegions, plotLimits[key][s] = \
+                    self._getWorkingRegions(key, regions, e0[s], eMin, eMax)
+                selection = tuple((numpy.searchsorted(energy, vMin, "left"),
+                                   numpy.searchsorted(energy, vMax, "right"))
+                                  for vMin, vMax in workingRegions)
+                groups.setdefault(selection, []).append(s)
+            data[key] = numpy.zeros(mu.shape, numpy.float64)
+            atEdge[key] = numpy.zeros((nSpectra,), numpy.float64)
+            for selection, spectra in groups.items():
+                idx = numpy.concatenate([numpy.arange(i0, i1) for i0, i1 \
+                                         in selection]).astype(int)
+                y = mu[spectra][:, idx]
+                if idx.size == 1:
+                    if method.lower() != 'constant':
+                        _logger.warning('Only one data point in region, '
+                                        'assuming constant function.')
+                    data[key][spectra] = y
+                    atEdge[key][spectra] = y[:, 0]
+                    continue
+                modelMatrix = fullModel[idx]
+                parameters = linalg.lstsq(modelMatrix, y.T,
+                                          uncertainties=False,
+                                          weight=False)[0]
+                data[key][spectra] = numpy.dot(fullModel, parameters).T
+                atEdge[key][spectra] = (edgeModel[spectra] * \
+                                        parameters.T).sum(axis=1)
+        jump = atEdge["PostEdge"] - atEdge["PreEdge"]
+        jumpMethod = config.get("JumpNormalizationMethod", "Flattened")
+        normalizedSpectrum = (mu - data["PreEdge"]) / jump[:, None]
+        if jumpMethod in [0, "Constant", "constant"]:
+            jumpMethod = "Constant"
+        else:
+            if jumpMethod not in [1, "Flattened", "flattened",
+                                  "Flatten", "flatten"]:
+                _logger.warning("WARNING: Undefined jump normalization method. Assume Flattened")
+            jumpMethod = "Flattened"
+            i = numpy.argmin(energy[None, :] < e0[:, None], axis=1)
+            flattened = numpy.arange(energy.size)[None, :] >= i[:, None]
+            factor = jump[:, None] / (data["PostEdge"] - data["PreEdge"])
+            normalizedSpectrum[flattened] *= factor[flattened]
+        return {"Jump": jump,
+                "JumpNormalizationMethod": jumpMethod,
+                "Edge": e0,
+                "NormalizedEnergy": energy,
+                "NormalizedMu": normalizedSpectrum,
+                "NormalizedBackground": data["PreEdge"],
+                "NormalizedSignal": data["PostEdge"],
+                "NormalizedPlotMin": plotLimits["PreEdge"],
+                "NormalizedPlotMax": plotLimits["PostEdge"]}
+
     def fourierTransform(self, k, mu, kMin=None, kMax=None, backend=None):
         if backend not in [None, "Default", "DefaultBackend"]:
             raise ValueError("Only default backend implemented")
@@ -1291,6 +1720,79 @@ def _getRegionsData(self, x0, y0, regions):
         yOut = numpy.take(y, idx)
         return xOut, yOut
 
+    def _getWorkingRegions(self, key, regions, e0, eMin, eMax):
+        """
+        Energy regions used to fit the pre-edge or the post-edge of a
+        spectrum with the given edge energy.
+
+        :return: The list of [vMin, vMax] regions and the plot limit
+        """
+        if regions is None:
+            if key == "PreEdge":
+                regions = [-1000., -40.]
+            else:
+                regions = [20., 1000.]
+        workingRegions = []
+        if key == "PreEdge":
+            plotMin = eMax
+            for i in range(0, len(regions), 2):
+                vMin = e0 + regions[2 * i]
+                vMax = e0 + regions[2 * i + 1]
+                if vMin < eMin:
+                    vMin = eMin
+                if vMax < eMin:
+                    vMax = 0.5 * (eMin + e0)
+                if vMin < plotMin:
+                    plotMin = vMin
+                workingRegions.append([vMin, vMax])
+            return workingRegions, plotMin
+        else:
+            plotMax = eMin
+            for i in range(0, len(regions), 2):
+                vMin = e0 + regions[2 * i]
+                vMax = e0 + regions[2 * i + 1]
+                if vMin > eMax:
+                    vMin = 0.5 * (e0 + eMax)
+                if vMax < eMin:
+                    vMax = eMax
+                if vMax > plotMax:
+                    plotMax = vMax
+                workingRegions.append([vMin, vMax])
+            return workingRegions, plotMax
+
+    def _getNormalizationModelMatrix(self, key, method, x):
+        methodLower = method.lower()
+        if methodLower == "constant":
+            modelMatrix = numpy.ones((x.size, 1), numpy.float64)
+            #parameters[key] = y.mean()
+        elif methodLower == "linear":
+            modelMatrix = numpy.empty((x.size, 2), numpy.float64)
+            modelMatrix[:, 0] = 1.0
+            modelMatrix[:, 1] = x
+        elif methodLower == "parabolic":
+            modelMatrix = numpy.empty((x.size, 3), numpy.float64)
+            modelMatrix[:, 0] = 1.0
+            modelMatrix[:, 1] = x
+            modelMatrix[:, 2] = pow(x, 2)
+        elif methodLower == "cubic":
+            modelMatrix = numpy.empty((x.size, 4), numpy.float64)
+            modelMatrix[:, 0] = 1.0
+            modelMatrix[:, 1] = x
+            modelMatrix[:, 2] = pow(x, 2)
+            modelMatrix[:, 3] = pow(x, 3)
+        elif methodLower == "victoreen":
+            modelMatrix = numpy.empty((x.size, 2), numpy.float64)
+            modelMatrix[:,0] = pow(x, -3)
+            modelMatrix[:,1] = pow(x, -4)
+        elif methodLower == "modif. victoreen":
+            modelMatrix = numpy.empty((x.size, 2), numpy.float64)
+            modelMatrix[:,0] = pow(x, -3)
+            modelMatrix[:,1] = 1.0
+        else:
+            raise ValueError("Unhandled %s polynomial <%s> " % \
+                             (key, method))
+        return modelMatrix
+
     def normalize(self, energy=None, mu=None, backend=None):
         if energy is None:
             energy = self._energy
@@ -1325,66 +1827,14 @@ def normalize(self, energy=None, mu=None, backend=None):
                 raise ValueError("Only normalization with polynomials implemented")
             method = config[key]["Polynomial"]
             methodLower = method.lower()
-            if regions is None:
-                if key == "PreEdge":
-                    regions = [-1000., -40.]
-                else:
-                    regions = [20., 1000.]
-            workingRegions = []
+            workingRegions, plotLimit = self._getWorkingRegions(key,
+                                                regions, e0, eMin, eMax)
             if key == "PreEdge":
-                plotMin = eMax
-                for i in range(0, len(regions), 2):
-                    vMin = e0 + regions[2 * i]
-                    vMax = e0 + regions[2 * i + 1]
-                    if vMin < eMin:
-                        vMin = eMin
-                    if vMax < eMin:
-                        vMax = 0.5 * (eMin + e0)
-                    if vMin < plotMin:
-                        plotMin = vMin
-                    workingRegions.append([vMin, vMax])
+                plotMin = plotLimit
             else:
-                plotMax = eMin
-                for i in range(0, len(regions), 2):
-                    vMin = e0 + regions[2 * i]
-                    vMax = e0 + regions[2 * i + 1]
-                    if vMin > eMax:
-                        vMin = 0.5 * (e0 + eMax)
-                    if vMax < eMin:
-                        vMax = eMax
-                    if vMax > plotMax:
-                        plotMax = vMax
-                    workingRegions.append([vMin, vMax])
+                plotMax = plotLimit
             x, y = self._getRegionsData(energy, mu, workingRegions)
-            if methodLower == "constant":
-                modelMatrix = numpy.ones((x.size, 1), numpy.float64)
-                #parameters[key] = y.mean()
-            elif methodLower == "linear":
-                modelMatrix = numpy.empty((x.size, 2), numpy.float64)
-                modelMatrix[:, 0] = 1.0
-                modelMatrix[:, 1] = x
-            elif methodLower == "parabolic":
-                modelMatrix = numpy.empty((x.size, 3), numpy.float64)
-                modelMatrix[:, 0] = 1.0
-                modelMatrix[:, 1] = x
-                modelMatrix[:, 2] = pow(x, 2)
-            elif methodLower == "cubic":
-                modelMatrix = numpy.empty((x.size, 4), numpy.float64)
-                modelMatrix[:, 0] = 1.0
-                modelMatrix[:, 1] = x
-                modelMatrix[:, 2] = pow(x, 2)
-                modelMatrix[:, 3] = pow(x, 3)
-            elif methodLower == "victoreen":
-                modelMatrix = numpy.empty((x.size, 2), numpy.float64)
-                modelMatrix[:,0] = pow(x, -3)
-                modelMatrix[:,1] = pow(x, -4)
-            elif methodLower == "modif. victoreen":
-                modelMatrix = numpy.empty((x.size, 2), numpy.float64)
-                modelMatrix[:,0] = pow(x, -3)
-                modelMatrix[:,1] = 1.0
-            else:
-                raise ValueError("Unhandled %s polynomial <%s> " % \
-                                 (key, config[key]["Polynomial"]))
+            modelMatrix = self._getNormalizationModelMatrix(key, method, x)
             # if only one point has been picked from region
             if len(y) == 1:
                 if methodLower != 'constant':
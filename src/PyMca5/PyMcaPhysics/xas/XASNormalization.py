@@ -139,6 +139,42 @@ def getE0SavitzkyGolay(energy, mu, points=5, full=False):
         return edge
 
 
+def getE0SavitzkyGolayStack(energy, mu, points=5):
+    """
+    Vectorized version of getE0SavitzkyGolay for a set of spectra sharing
+    the same energies.
+
+    :param energy: 1D array with the energies
+    :param mu: 2D array of shape (nSpectra, energy.size)
+    :return: 1D array with the edge energy of each spectrum
+    """
+    mu = numpy.asarray(mu, dtype=numpy.float64)
+    xPrime = numpy.asarray(energy, dtype=numpy.float64).reshape(-1)
+    # Savitzky-Golay derivative of all the spectra, as done by
+    # SGModule.getSavitzkyGolay on each of them
+    coeff = SGModule.calc_coeff(points, 2, 1)
+    N = numpy.size(coeff - 1) // 2
+    nValid = mu.shape[-1] - coeff.size + 1
+    yPrime = numpy.zeros(mu.shape, dtype=numpy.float64)
+    view = yPrime[:, N:N + nValid]
+    tmp = numpy.empty(view.shape, dtype=numpy.float64)
+    for i in range(coeff.size):
+        c = coeff[coeff.size - 1 - i]
+        if c != 0:
+            numpy.multiply(mu[:, i:i + nValid], c, out=tmp)
+            view += tmp
+
+    # center of mass around the maximum of the derivative
+    iMax = numpy.argmax(yPrime, axis=1)
+    idx = iMax[:, None] + numpy.arange(-points, points + 1)
+    valid = (idx >= 0) & (idx < xPrime.size)
+    idx = numpy.clip(idx, 0, xPrime.size - 1)
+    selection = numpy.take_along_axis(yPrime, idx, axis=1)
+    selection[~valid] = 0.0
+    return (selection * xPrime[idx]).sum(axis=1, dtype=numpy.float64) / \
+           selection.sum(axis=1, dtype=numpy.float64)
+
+
 def estimateXANESEdge(spectrum, energy=None, npoints=5, full=False,
                       sanitize=True):
     if sanitize:
@@ -34,6 +34,7 @@
 Module to process a stack of absorption spectra.
 """
 import os
+import collections
 import numpy
 import h5py
 import posixpath
@@ -45,6 +46,75 @@
 
 _logger = logging.getLogger(__name__)
 
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    _logger.info("Cannot import ProcessPoolExecutor")
+    ProcessPoolExecutor = None
+
+# target size in bytes of the chunks of the per pixel output datasets
+CHUNK_BYTES = 1024 * 1024
+
+
+def _getPixelChunks(shape, itemsize=4):
+    """
+    Chunk shape of a (nRows, nColumns, nPoints) dataset written row by row
+    and read pixel by pixel: whole spectra of consecutive pixels of a row.
+    """
+    nPoints = shape[-1]
+    nPixels = max(1, CHUNK_BYTES // max(1, nPoints * itemsize))
+    return (1, min(shape[1], nPixels), nPoints)
+
+
+def _processRow(analyzer, x, spectra, selection, normalizedIdx, exafsIdx,
+                outputs, jStep):
+    """
+    Process the spectra of one row of a stack by blocks of jStep spectra.
+
+    :param selection: indices of the spectra to process (None for all)
+    :param outputs: edge, jump, mu, normalized mu, EXAFS signal, FT intensity
+                    and FT imaginary part arrays of the row to be filled
+    """
+    edge, jump, mu, normalized, exafs, ftIntensity, ftImaginary = outputs
+    if selection is None:
+        selection = numpy.arange(spectra.shape[0])
+    for jStart in range(0, selection.size, jStep):
+        selected = selection[jStart:jStart + jStep]
+        ddict = analyzer.processSpectra(x, spectra[selected])
+        edge[selected] = ddict["Edge"]
+        jump[selected] = ddict["Jump"]
+        mu[selected] = ddict["Mu"]
+        normalized[selected] = ddict["NormalizedMu"][:, normalizedIdx]
+        exafs[selected] = ddict["EXAFSNormalized"][:, exafsIdx]
+        ftIntensity[selected] = ddict["FT"]["FTIntensity"]
+        ftImaginary[selected] = ddict["FT"]["FTImaginary"]
+
+
+# XASClass instance of a worker process
+_workerAnalyzer = None
+
+
+def _initXASWorker(configuration):
+    """Initializer of the worker processes of XASStackBatch
+
+    :param dict configuration: XASClass configuration
+    """
+    global _workerAnalyzer
+    _workerAnalyzer = XASClass.XASClass()
+    _workerAnalyzer.setConfiguration(configuration)
+
+
+def _processRowInWorker(x, spectra, selection, normalizedIdx, exafsIdx,
+                        shapes, jStep):
+    """Process one row of a stack in a worker process
+
+    :returns list: the output arrays of the row (see _processRow)
+    """
+    outputs = [numpy.zeros(shape, numpy.float32) for shape in shapes]
+    _processRow(_workerAnalyzer, x, spectra, selection,
+                normalizedIdx, exafsIdx, outputs, jStep)
+    return outputs
+
 
 class XASStackBatch(object):
     def __init__(self, analyzer=None):
@@ -65,6 +135,16 @@ def setConfigurationFile(self, ffile):
         configuration.read(ffile)
         self.setConfiguration(configuration)
 
+    @staticmethod
+    def _numberOfWorkers(nworkers):
+        """Number of processes used for processing the rows of a stack
+        """
+        if not nworkers or ProcessPoolExecutor is None:
+            return 1
+        if nworkers < 0:
+            nworkers = os.cpu_count() or 1
+        return max(int(nworkers), 1)
+
     def processMultipleSpectra(self, x, y,
                                xmin=None,
                                xmax=None,
@@ -74,13 +154,23 @@ def processMultipleSpectra(self, x, y,
                                mask=None,
                                directory=None,
                                name=None,
-                               entry=None):
+                               entry=None,
+                               chunks=True,
+                               compression=None,
+                               nworkers=None):
         """
         This method performs the actual work.
 
         :param x: 1D array containing the x axis (usually the channels) of the spectra.
         :param y: 3D array containing the spectra as [nrows, ncolumns, nchannels]
         :param weight: 0 Means no weight, 1 Use an average weight, 2 Individual weights (slow)
+        :param chunks: If True (default) the per pixel output datasets are
+                       chunked by whole spectra. If None they are contiguous.
+        :param compression: Optional HDF5 compression filter of the per pixel
+                            output datasets (i.e. "gzip"). It implies chunks.
+        :param nworkers: Number of processes sharing the rows of the stack
+                         (negative: number of cores). The output file is
+                         only written by the calling process.
         :return: A dictionary with the results as keys.
         """
 
@@ -191,6 +281,11 @@ def processMultipleSpectra(self, x, y,
         ftYPath = posixpath.join(entry, "FT", "Intensity")
         ftImaginaryPath = posixpath.join(entry, "FT", "Imaginary")
 
+        if chunks or compression:
+            getChunks = _getPixelChunks
+        else:
+            getChunks = lambda shape: None
+
         iXMin = 0
         iXMax = data.shape[-1] - 1
         e0 = out.require_dataset(e0Path,
@@ -212,8 +307,8 @@ def processMultipleSpectra(self, x, y,
         spectrumY = out.require_dataset(spectrumYPath,
                                    shape=shape,
                                    dtype=numpy.float32,
-                                   chunks=None,
-                                   compression=None)
+                                   chunks=getChunks(shape),
+                                   compression=compression)
         shape = list(data.shape[:-1]) + [normalizedSpectrumX.size]
         normalizedX = out.require_dataset(normalizedXPath,
                                    shape=[normalizedSpectrumX.size],
@@ -223,8 +318,8 @@ def processMultipleSpectra(self, x, y,
         normalizedY = out.require_dataset(normalizedYPath,
                                    shape=shape,
                                    dtype=numpy.float32,
-                                   chunks=None,
-                                   compression=None)
+                                   chunks=getChunks(shape),
+                                   compression=compression)
         shape = list(data.shape[:-1]) + [exafsSpectrumX.size]
         exafsX = out.require_dataset(exafsXPath,
                                      shape=[exafsSpectrumX.size],
@@ -234,8 +329,8 @@ def processMultipleSpectra(self, x, y,
         exafsY = out.require_dataset(exafsYPath,
                                      shape=shape,
                                      dtype=numpy.float32,
-                                     chunks=None,
-                                     compression=None)
+                                     chunks=getChunks(shape),
+                                     compression=compression)
         shape = list(data.shape[:-1]) + [xFT.size]
         ftX = out.require_dataset(ftXPath,
                                      shape=[xFT.size],
@@ -245,13 +340,13 @@ def processMultipleSpectra(self, x, y,
         ftY = out.require_dataset(ftYPath,
                                      shape=shape,
                                      dtype=numpy.float32,
-                                     chunks=None,
-                                     compression=None)
+                                     chunks=getChunks(shape),
+                                     compression=compression)
         ftImaginary = out.require_dataset(ftImaginaryPath,
                                      shape=shape,
                                      dtype=numpy.float32,
-                                     chunks=None,
-                                     compression=None)
+                                     chunks=getChunks(shape),
+                                     compression=compression)
         spectrumX[:] = ddict["Energy"]
         normalizedX[:] = ddict["NormalizedEnergy"][normalizedIdx]
         exafsX[:] = ddict["EXAFSKValues"][exafsIdx]
@@ -259,7 +354,7 @@ def processMultipleSpectra(self, x, y,
 
         t0 = time.time()
         totalSpectra = data.shape[0] * data.shape[1]
-        jStep = min(100, data.shape[1])
+        jStep = min(1000, data.shape[1])
         if weightPolicy == 2:
             SVD = False
             sigma_b = None
@@ -271,44 +366,66 @@ def processMultipleSpectra(self, x, y,
             SVD = True
             sigma_b = None
         last_svd = None
-        #for i in range(10):
-        for i in range(0, data.shape[0]):
-            #print(i)
-            #chunks of nColumns spectra
-            if i == 0:
-                chunk = numpy.zeros((jStep,
-                                     iXMax-iXMin+1),
-                                     numpy.float64)
-            jStart = 0
-            j = 0
-            while jStart < data.shape[1]:
-                jEnd = min(jStart + jStep, data.shape[1])
-                #chunk[:,:(jEnd - jStart)] = data[i, jStart:jEnd, iXMin:iXMax+1].T
-                spectra  = data[i, jStart:jEnd, iXMin:iXMax+1]
-                nSpectra = spectra.shape[0]
-                for spectrumNumber in range(nSpectra):
-                    if mask is not None:
-                        if mask[i, j] == 0:
-                            continue
-                    self._analyzer.setSpectrum(x, spectra[spectrumNumber])
-                    ddict = self._analyzer.processSpectrum()
-                    spectrumY[i, j] = ddict["Mu"]
-                    e0[i, j] = ddict["Edge"]
-                    jump[i, j] = ddict["Jump"]
-                    #normalizedX[i, j] = ddict["NormalizedEnergy"][normalizedIdx]
-                    normalizedY[i, j] = ddict["NormalizedMu"][normalizedIdx]
-                    #exafsX[i, j] = ddict["EXAFSKValues"][exafsIdx]
-                    exafsY[i, j] = ddict["EXAFSNormalized"][exafsIdx]
-                    #ftX[i, j] = ddict["FT"]["FTRadius"]
-                    ftY[i, j] = ddict["FT"]["FTIntensity"]
-                    ftImaginary[i, j] = ddict["FT"]["FTImaginary"]
-                    j +=1
-                jStart = jEnd
+        # results of the current row, written at once at the end of the row
+        rowDatasets = [spectrumY, normalizedY, exafsY, ftY, ftImaginary]
+        rowShapes = [e0.shape[1:], jump.shape[1:]] + \
+                    [dataset.shape[1:] for dataset in rowDatasets]
+        e0Data = numpy.zeros(e0.shape, dtype=e0.dtype)
+        jumpData = numpy.zeros(jump.shape, dtype=jump.dtype)
+
+        def saveRow(i, rowOutputs):
+            e0Data[i] = rowOutputs[0]
+            jumpData[i] = rowOutputs[1]
+            for dataset, rowBuffer in zip(rowDatasets, rowOutputs[2:]):
+                dataset[i] = rowBuffer
+
+        def rowItems():
+            for i in range(0, data.shape[0]):
+                spectra = data[i, :, iXMin:iXMax+1]
+                if mask is None:
+                    selection = None
+                else:
+                    selection = numpy.nonzero(mask[i])[0]
+                yield i, spectra, selection
+
+        nworkers = self._numberOfWorkers(nworkers)
+        if nworkers == 1:
+            rowOutputs = [numpy.zeros(shape, numpy.float32) \
+                                                for shape in rowShapes]
+            for i, spectra, selection in rowItems():
+                if mask is not None:
+                    for rowBuffer in rowOutputs:
+                        rowBuffer[:] = 0
+                _processRow(self._analyzer, x, spectra, selection,
+                            normalizedIdx, exafsIdx, rowOutputs, jStep)
+                saveRow(i, rowOutputs)
+        else:
+            # rows are processed by the workers and written by this process
+            _logger.info("Processing with %d processes", nworkers)
+            maxPending = 2 * nworkers
+            pending = collections.deque()
+            with ProcessPoolExecutor(max_workers=nworkers,
+                                     initializer=_initXASWorker,
+                                     initargs=(config,)) as pool:
+                for i, spectra, selection in rowItems():
+                    future = pool.submit(_processRowInWorker, x,
+                                         numpy.array(spectra, copy=True),
+                                         selection, normalizedIdx, exafsIdx,
+                                         rowShapes, jStep)
+                    pending.append((i, future))
+                    if len(pending) >= maxPending:
+                        i, future = pending.popleft()
+                        saveRow(i, future.result())
+                while pending:
+                    i, future = pending.popleft()
+                    saveRow(i, future.result())
+        e0[()] = e0Data
+        jump[()] = jumpData
         outputDict = {}
         outputDict["names"] = ["Jump", "Edge"]
         output = numpy.zeros((2, e0.shape[0], e0.shape[1]), dtype = e0.dtype)
-        output[0, :] = jump.value
-        output[1, :] = e0.value
+        output[0, :] = jumpData
+        output[1, :] = e0Data
         outputDict["images"] = output
         out.flush()
         out.close()
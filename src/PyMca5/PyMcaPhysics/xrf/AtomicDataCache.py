@@ -0,0 +1,331 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2026 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__doc__ = """
+Binary cache of the atomic data tables read when importing Elements.
+
+The tables are distributed as text files (ConfigDict files or XCOM .mat
+files) whose parsing dominates the import time of the module. The first
+time a table is read its parsed content is stored in a binary file in the
+user cache directory. Later reads memory-map that file and unpickle each
+top level entry (typically one element) only when it is accessed.
+
+A cache file is only used when it has been written by the same cache
+version and PyMca version from a source file with the same size and
+modification time (or, failing that, the same SHA1 digest).
+
+The cache directory can be chosen with the PYMCA_DATA_CACHE_DIR
+environment variable. Setting it to an empty string or to "0" disables
+the cache. Any problem reading or writing the cache is silently ignored
+and the source file is parsed as usual.
+
+The specfile tables read by KShell, LShell and MShell are not cached.
+They are parsed by the C specfile module in a few milliseconds in total,
+about the cost of validating and reading their cache files.
+"""
+import os
+import sys
+import mmap
+import struct
+import pickle
+import hashlib
+import logging
+import tempfile
+import threading
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from PyMca5 import version as _pymcaVersion
+
+_logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+_MAGIC = b"PYMCAADC"
+_HEADER = struct.Struct("<8sQ")
+
+_CACHE_DIR = False
+_LOCK = threading.Lock()
+
+
+def _defaultCacheDirectory():
+    if sys.platform == "win32":
+        base = os.getenv("LOCALAPPDATA")
+        if not base:
+            return None
+        return os.path.join(base, "PyMca", "cache")
+    base = os.getenv("XDG_CACHE_HOME")
+    if not base:
+        home = os.path.expanduser("~")
+        if home == "~":
+            return None
+        base = os.path.join(home, ".cache")
+    return os.path.join(base, "pymca")
+
+
+def getCacheDirectory():
+    """
+    Return the directory holding the cache files or None if the cache
+    is disabled.
+    """
+    if _CACHE_DIR is not False:
+        return _CACHE_DIR
+    directory = os.getenv("PYMCA_DATA_CACHE_DIR")
+    if directory is None:
+        return _defaultCacheDirectory()
+    if directory in ["", "0"]:
+        return None
+    return directory
+
+
+def setCacheDirectory(directory=False):
+    """
+    Set the cache directory. None disables the cache and False restores
+    the default behavior.
+    """
+    global _CACHE_DIR
+    _CACHE_DIR = directory
+
+
+def getCacheFileName(filename):
+    """
+    Return the name of the cache file associated to the given source file
+    or None if the cache is disabled.
+    """
+    directory = getCacheDirectory()
+    if directory is None:
+        return None
+    filename = os.path.abspath(filename)
+    key = hashlib.sha1(filename.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(directory,
+                        "%s-%s.v%d.cache" % (os.path.basename(filename),
+                                             key,
+                                             CACHE_VERSION))
+
+
+def _sha1(filename):
+    hasher = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _sourceInfo(filename):
+    info = os.stat(filename)
+    return {"size": info.st_size,
+            "mtime": info.st_mtime_ns}
+
+
+class CachedSections(Mapping):
+    """
+    Read-only mapping giving access to the entries of a cache file.
+
+    Each entry is unpickled from the memory-mapped file the first time it
+    is accessed and then kept. The same object is returned by successive
+    accesses, so the entries behave as those of the original dictionary.
+    """
+    def __init__(self, cachefile, buffer, index, loaded=None):
+        self._cachefile = cachefile
+        self._buffer = buffer
+        self._index = index
+        self._loaded = {} if loaded is None else loaded
+        self._lock = threading.Lock()
+
+    @classmethod
+    def fromDict(cls, cachefile, data):
+        """
+        Mapping with all the entries already loaded
+        """
+        return cls(cachefile, None, dict.fromkeys(data), loaded=dict(data))
+
+    def __getitem__(self, key):
+        try:
+            return self._loaded[key]
+        except KeyError:
+            pass
+        offset, length = self._index[key]
+        with self._lock:
+            if key not in self._loaded:
+                self._loaded[key] = pickle.loads(
+                                        self._buffer[offset:offset + length])
+                if len(self._loaded) == len(self._index):
+                    # everything has been read
+                    self._buffer.close()
+                    self._buffer = None
+        return self._loaded[key]
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self._cachefile)
+
+
+def _readHeader(f):
+    magic, length = _HEADER.unpack(f.read(_HEADER.size))
+    if magic != _MAGIC:
+        raise IOError("Not a PyMca atomic data cache file")
+    return pickle.loads(f.read(length))
+
+
+def _isValid(header, filename):
+    if header.get("version") != CACHE_VERSION:
+        return False
+    if header.get("pymca") != _pymcaVersion():
+        return False
+    source = header["source"]
+    info = _sourceInfo(filename)
+    if info["size"] != source["size"]:
+        return False
+    if info["mtime"] == source["mtime"]:
+        return True
+    # the file may have been touched or reinstalled without changes
+    return _sha1(filename) == source["sha1"]
+
+
+def _readCache(cachefile, filename, lazy):
+    with open(cachefile, "rb") as f:
+        header = _readHeader(f)
+        if not _isValid(header, filename):
+            _logger.debug("Outdated cache file %s", cachefile)
+            return None
+        if lazy:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return CachedSections(cachefile, buffer, header["sections"])
+        data = f.read()
+    start = _HEADER.size + header["length"]
+    result = {}
+    for key, (offset, length) in header["sections"].items():
+        offset -= start
+        result[key] = pickle.loads(data[offset:offset + length])
+    return result
+
+
+def _writeCache(cachefile, filename, data):
+    sources = _sourceInfo(filename)
+    sources["sha1"] = _sha1(filename)
+    payloads = [(key, pickle.dumps(data[key], protocol=pickle.HIGHEST_PROTOCOL))
+                for key in data]
+    # offsets depend on the header length, iterate until it is stable
+    length = 0
+    while True:
+        offset = _HEADER.size + length
+        sections = {}
+        for key, payload in payloads:
+            sections[key] = (offset, len(payload))
+            offset += len(payload)
+        header = {"version": CACHE_VERSION,
+                  "pymca": _pymcaVersion(),
+                  "source": sources,
+                  "length": length,
+                  "sections": sections}
+        pickledHeader = pickle.dumps(header, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(pickledHeader) == length:
+            break
+        length = len(pickledHeader)
+    directory = os.path.dirname(cachefile)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmpname = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, length))
+            f.write(pickledHeader)
+            for key, payload in payloads:
+                f.write(payload)
+        os.replace(tmpname, cachefile)
+    except Exception:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+
+def load(filename, reader, lazy=True):
+    """
+    Return the dictionary obtained by reader(filename) using the binary
+    cache when possible.
+
+    :param filename: Source file
+    :param reader: Callable parsing the source file into a dictionary
+    :param lazy: If True, the result is a read-only CachedSections mapping
+                 loading the entries of a valid cache on demand. Otherwise
+                 it is a plain dictionary. The type does not depend on the
+                 cache being used or not.
+    """
+    cachefile = getCacheFileName(filename)
+    if cachefile is None:
+        return _result(filename, reader(filename), lazy)
+    if os.path.exists(cachefile):
+        try:
+            result = _readCache(cachefile, filename, lazy)
+            if result is not None:
+                return result
+        except Exception:
+            _logger.debug("Cannot read cache file %s", cachefile,
+                          exc_info=True)
+    data = reader(filename)
+    with _LOCK:
+        try:
+            _writeCache(cachefile, filename, data)
+        except Exception:
+            _logger.debug("Cannot write cache file %s", cachefile,
+                          exc_info=True)
+    return _result(cachefile, data, lazy)
+
+
+def _result(name, data, lazy):
+    if lazy:
+        return CachedSections.fromDict(name, data)
+    return dict(data)
+
+
+def _readConfigDict(filename):
+    from PyMca5.PyMcaIO import ConfigDict
+    cDict = ConfigDict.ConfigDict()
+    cDict.read(filename)
+    return cDict
+
+
+def readConfigDict(filename, lazy=True):
+    """
+    Read a ConfigDict file through the cache. The sections are returned
+    as a read-only mapping (lazy) or as a plain dictionary.
+    """
+    return load(filename, _readConfigDict, lazy=lazy)
@@ -56,6 +56,7 @@ def __init__(self, initdict=None, filelist=None, **kw):
         self.xdata0  = None
         self.sigmay0 = None
         self.__lastTime = None
+        self.__niter = 0
         self.strategyInstances = {}
         self.__toBeConfigured = False
         self.useFisxEscape(False)
@@ -170,6 +171,8 @@ def _updateCallback(self):
 
     def __configure(self):
         self.linearMatrix = None
+        # constraints of a previous estimation are not valid anymore
+        self.__estimatedRange = None
         #user attenuators key
         self.config['userattenuators'] = self.config.get('userattenuators',{})
         #multilayer key
@@ -1665,30 +1668,19 @@ def linearMcaTheoryDerivative(self, param0, index, t0):
             #print "f1,f2,delta = ",f1,f2,delta
             return (f1-f2) / (2.0 * delta)
 
-    def analyticalDerivative(self, param0, index, t0):
+    def __peakGroupDerivative(self, i, param, energy):
         """
-        analyticalDerivative(self, parameters, index, x)
-        Internal function to calculate the derivative of the fitting function
-        f(parameters, x) respect to the parameter given by the index at the
-        array of points x.
+        Derivative of the fitting function respect to the area of the
+        peak group i at the given energies.
         """
-        NGLOBAL = self.NGLOBAL
         HYPERMET = self.__HYPERMET
         PARAMETERS = self.PARAMETERS
         ESCAPE = self.ESCAPE
         PEAKS0 = self.PEAKS0
-        if index > NGLOBAL-1:
-         param=numpy.array(param0)
-         x=numpy.array(t0)
-         zero = param[0]
-         gain = param[1] * 1.0
-         energy=zero + gain * x
-         #print energy
-         noise= param[2]*param[2]
-         fano = param[3]*2.3548*2.3548*0.00385
-         i=index-NGLOBAL
-         #for i in range(len(param[index-4]))):
-         if ESCAPE:
+        gain = param[1] * 1.0
+        noise= param[2]*param[2]
+        fano = param[3]*2.3548*2.3548*0.00385
+        if ESCAPE:
             (r,c) = (PEAKS0[i]).shape
             if OLDESCAPE:
                 if HYPERMET:
@@ -1724,7 +1716,7 @@ def analyticalDerivative(self, param0, index, t0):
                 dummy[r:, 2] = numpy.sqrt(noise + (dummy[r:,1]>0) * dummy[r:,1] * fano)
                 #for jj in range(r+n_escape_lines):
                 #    print index, dummy[jj, 1], dummy[jj, 0], dummy[jj, 2]
-         else:
+        else:
             (r,c) = (PEAKS0[i]).shape
             if HYPERMET:
                 dummy      = numpy.ones((r,3+5*(HYPERMET > 0)),numpy.float64)
@@ -1733,28 +1725,85 @@ def analyticalDerivative(self, param0, index, t0):
             dummy[0:r,0] = PEAKS0[i][:,0] * gain
             dummy[0:r,1] = PEAKS0[i][:,1] * 1.0
             dummy[0:r,2] = numpy.sqrt(noise + PEAKS0[i][:,1] * fano)
-         if HYPERMET:
-                dummy[0:r,3] = param[PARAMETERS.index('ST AreaR')]
-                dummy[r:,3]  = 0.0
-                dummy[:,4] = param[PARAMETERS.index('ST SlopeR')]
-                dummy[0:r,5] = param[PARAMETERS.index('LT AreaR')]
-                dummy[r:,5]  = 0.0
-                dummy[:,6] = param[PARAMETERS.index('LT SlopeR')]
-                dummy[0:r,7] = param[PARAMETERS.index('STEP HeightR')]
-                dummy[r:,7]  = 0.0
-         else:
-                dummy[0:,3] = param[PARAMETERS.index('Eta Factor')]
-         if self.FASTER:
+        if HYPERMET:
+            dummy[0:r,3] = param[PARAMETERS.index('ST AreaR')]
+            dummy[r:,3]  = 0.0
+            dummy[:,4] = param[PARAMETERS.index('ST SlopeR')]
+            dummy[0:r,5] = param[PARAMETERS.index('LT AreaR')]
+            dummy[r:,5]  = 0.0
+            dummy[:,6] = param[PARAMETERS.index('LT SlopeR')]
+            dummy[0:r,7] = param[PARAMETERS.index('STEP HeightR')]
+            dummy[r:,7]  = 0.0
+        else:
+            dummy[0:,3] = param[PARAMETERS.index('Eta Factor')]
+        if self.FASTER:
             if HYPERMET:
                 return SpecfitFuns.fastahypermet(dummy,energy,HYPERMET)
             else:
                 return SpecfitFuns.apvoigt(dummy,energy)
-         else:
+        else:
             if HYPERMET:
                 return SpecfitFuns.ahypermet(dummy,energy,HYPERMET)
             else:
                 return SpecfitFuns.apvoigt(dummy,energy)
 
+    def analyticalJacobian(self, param0, indices, t0):
+        """
+        analyticalJacobian(self, parameters, indices, x)
+        Internal function to calculate at once the derivatives of the fitting
+        function f(parameters, x) respect to the parameters given by the
+        indices. It returns an array of shape (len(indices), len(x)).
+        """
+        NGLOBAL = self.NGLOBAL
+        param = numpy.array(param0)
+        x = numpy.array(t0)
+        zero = param[0]
+        gain = param[1] * 1.0
+        energy = zero + gain * x
+        result = numpy.zeros((len(indices), x.size), numpy.float64)
+        for row, index in enumerate(indices):
+            if index > NGLOBAL-1:
+                derivative = self.__peakGroupDerivative(index-NGLOBAL,
+                                                        param, energy)
+            else:
+                derivative = self.analyticalDerivative(param0, index, t0)
+            result[row] = numpy.reshape(derivative, (-1,))
+        return result
+
+    def linearMcaTheoryJacobian(self, param0, indices, t0):
+        """
+        Derivatives of the linear fitting function respect to the parameters
+        given by the indices as an array of shape (len(indices), len(x)).
+        The derivatives respect to the peak areas are taken from the linear
+        matrix at once.
+        """
+        NGLOBAL = self.NGLOBAL
+        indices = numpy.asarray(indices, dtype=numpy.intp)
+        result = numpy.zeros((indices.size, len(t0)), numpy.float64)
+        groups = indices > NGLOBAL - 1
+        result[groups] = self.linearMatrix[:, indices[groups] - NGLOBAL].T
+        for row in numpy.nonzero(~groups)[0]:
+            result[row] = self.linearMcaTheoryDerivative(param0,
+                                                         indices[row], t0)
+        return result
+
+    def analyticalDerivative(self, param0, index, t0):
+        """
+        analyticalDerivative(self, parameters, index, x)
+        Internal function to calculate the derivative of the fitting function
+        f(parameters, x) respect to the parameter given by the index at the
+        array of points x.
+        """
+        NGLOBAL = self.NGLOBAL
+        HYPERMET = self.__HYPERMET
+        PARAMETERS = self.PARAMETERS
+        if index > NGLOBAL-1:
+            param=numpy.array(param0)
+            x=numpy.array(t0)
+            zero = param[0]
+            gain = param[1] * 1.0
+            energy=zero + gain * x
+            return self.__peakGroupDerivative(index-NGLOBAL, param, energy)
         elif HYPERMET and  (PARAMETERS[index] == 'ST AreaR'):
           param=numpy.array(param0)
           x=numpy.array(t0)
@@ -1816,10 +1865,47 @@ def estimate(self):
             _logger.debug("CONFIGURING FROM ESTIMATION")
             self.configure(self.__originalConfiguration)
         self.parameters, self.codes = self.specfitestimate(self.xdata, self.ydata,self.zz)
+        self.__estimatedRange = self.xdata[0, 0], self.xdata[-1, 0]
         #self.estimatelinpoly(self.xdata, self.ydata,self.zz)
         #self.estimateexppoly(self.xdata, self.ydata,self.zz)
         #print self.codes[:,3]
 
+    def setStartingParameters(self, parameters):
+        """
+        Use the given parameters (for instance the fitted parameters of a
+        neighbouring spectrum) as starting point of the next fit instead of
+        calling estimate. The constraints of the last estimation are kept.
+
+        It returns False when the parameters cannot be used. In that case
+        estimate has to be called.
+        """
+        if self.__toBeConfigured or self.__estimatedRange is None:
+            return False
+        if (self.xdata[0, 0], self.xdata[-1, 0]) != self.__estimatedRange:
+            # the peaks inside the fitting region may be different
+            return False
+        parameters = numpy.array(parameters, dtype=numpy.float64)
+        if parameters.shape != self.codes[0].shape:
+            return False
+        parameters = numpy.where(self.codes[0] == Gefit.CFIXED,
+                                 self.parameters, parameters)
+        # keep the quoted parameters away from their limits
+        quoted = self.codes[0] == Gefit.CQUOTED
+        if quoted.any():
+            pmin = numpy.minimum(self.codes[1], self.codes[2])[quoted]
+            pmax = numpy.maximum(self.codes[1], self.codes[2])[quoted]
+            margin = 1.0E-6 * (pmax - pmin)
+            parameters[quoted] = numpy.clip(parameters[quoted],
+                                            pmin + margin, pmax - margin)
+        self.parameters = parameters
+        return True
+
+    def getNumberOfIterations(self):
+        """
+        Number of iterations needed by the last fit
+        """
+        return self.__niter
+
     def specfitestimate(self,x,y,z,xscaling=1.0,yscaling=1.0):
         if self.PARAMETERS is None:
             self.__configure()
@@ -2156,6 +2242,7 @@ def startfit(self,digest=0, linear=None, currentIteration=None):
                                            weightflag=self.config['fit']['fitweight'],
                                            maxiter=self.MAXITER,
                                     model_deriv=self.linearMcaTheoryDerivative,
+                                    model_jacobian=self.linearMcaTheoryJacobian,
                                            deltachi=self.config['fit']['deltachi'],
                                            fulloutput=1, linear=linear)
             if self.__SUM:
@@ -2175,6 +2262,7 @@ def startfit(self,digest=0, linear=None, currentIteration=None):
                                            weightflag=self.config['fit']['fitweight'],
                                            maxiter=self.MAXITER,
                                     model_deriv=self.linearMcaTheoryDerivative,
+                                    model_jacobian=self.linearMcaTheoryJacobian,
                                            deltachi=self.config['fit']['deltachi'],
                                            fulloutput=1, linear=linear)
 
@@ -2186,6 +2274,7 @@ def startfit(self,digest=0, linear=None, currentIteration=None):
                                            weightflag=self.config['fit']['fitweight'],
                                            maxiter=self.MAXITER,
                                            model_deriv=self.analyticalDerivative,
+                                           model_jacobian=self.analyticalJacobian,
                                            deltachi=self.config['fit']['deltachi'],
                                            fulloutput=1, linear=linear)
             if self.__SUM and linear:
@@ -2205,6 +2294,7 @@ def startfit(self,digest=0, linear=None, currentIteration=None):
                                            weightflag=self.config['fit']['fitweight'],
                                            maxiter=self.MAXITER,
                                            model_deriv=self.analyticalDerivative,
+                                           model_jacobian=self.analyticalJacobian,
                                            deltachi=self.config['fit']['deltachi'],
                                            fulloutput=1, linear=linear)
         self.fittedpar=fitresult[0]
@@ -2294,6 +2384,7 @@ def imagingDigestResult(self):
         result = {}
         result['groups'] = []
         result["chisq"] = self.chisq
+        result["niter"] = self.__niter
         n= self.NGLOBAL
         for group in self.PARAMETERS[n:]:
             # fitatea = self.fittedpar[n + i]
@@ -32,8 +32,8 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import os
 import numpy
-from PyMca5.PyMcaIO import ConfigDict
 from PyMca5 import PyMcaDataDir
+from PyMca5.PyMcaPhysics.xrf import AtomicDataCache
 
 dirmod = PyMcaDataDir.PYMCA_DATA_DIR
 ffile = os.path.join(dirmod, "attdata")
@@ -51,8 +51,7 @@
     if not os.path.exists(ffile):
         print("Cannot find file ", ffile)
         raise IOError("Cannot find file %s" % ffile)
-COEFFICIENTS = ConfigDict.ConfigDict()
-COEFFICIENTS.read(ffile)
+COEFFICIENTS = AtomicDataCache.readConfigDict(ffile)
 KEVTOANG = 12.39852000
 R0 = 2.82E-13 #electron radius in cm
 
@@ -37,10 +37,13 @@
 import re
 import weakref
 import types
+import threading
+import collections
 from PyMca5.PyMcaIO import ConfigDict
 from . import CoherentScattering
 from . import IncoherentScattering
 from . import PyMcaEPDL97
+from . import AtomicDataCache
 from PyMca5 import PyMcaDataDir
 
 """
@@ -2125,6 +2128,173 @@ def getMaterialKey(compound):
         return matkeys[index]
     return None
 
+#
+# Attenuation engine
+#
+# The mass attenuation coefficients of a mixture of elements on a given
+# energy grid are obtained by log-log interpolation of the XCOM tables of
+# each element. Parsed formulae, the interpolation tables and the results
+# are kept in memory so that repeated calls with the same composition and
+# energies (as when configuring a fit) are almost free.
+#
+ATTENUATION_CACHE_SIZE = 256
+_attenuationCache = collections.OrderedDict()
+_attenuationLock = threading.Lock()
+_formulaCache = {}
+_xcomTables = {}
+
+def clearAttenuationCache():
+    """
+    Clear the mass attenuation coefficients kept in memory.
+    """
+    with _attenuationLock:
+        _attenuationCache.clear()
+        _formulaCache.clear()
+        _xcomTables.clear()
+
+def _splitFormula(compound):
+    """
+    Return the lists of element symbols and of their number in the formula.
+    It raises a ValueError if the numbers cannot be converted to integers.
+    """
+    result = _formulaCache.get(compound, None)
+    if result is None:
+        elts = [ w for w in re.split('[0-9]', compound) if w != '' ]
+        nbs = [ int(w) for w in re.split('[a-zA-Z]', compound) if w != '' ]
+        result = (elts, nbs)
+        if len(_formulaCache) > 4 * ATTENUATION_CACHE_SIZE:
+            _formulaCache.clear()
+        _formulaCache[compound] = result
+    return list(result[0]), list(result[1])
+
+def _getXcomTable(ele):
+    table = _xcomTables.get(ele, None)
+    if table is None:
+        xcom_data = getelementmassattcoef(ele, None)
+        table = {}
+        for key in ['energy', 'coherent', 'compton', 'photo', 'pair',
+                    'energylog10', 'coherentlog10', 'comptonlog10',
+                    'photolog10']:
+            table[key] = numpy.asarray(xcom_data[key], dtype=numpy.float64)
+        pair = table['pair']
+        table['pairpositive'] = pair > 0.0
+        table['pairlog10'] = numpy.zeros(pair.shape, dtype=numpy.float64)
+        table['pairlog10'][table['pairpositive']] = \
+                        numpy.log10(pair[table['pairpositive']])
+        _xcomTables[ele] = table
+    return table
+
+def _getElementCrossSections(ele, energy):
+    """
+    Vectorized interpolation of the cross sections of an element.
+
+    :param ele: Element symbol
+    :param energy: 1D array of energies in keV
+    :return: Dictionary of arrays with the keys coherent, compton, photo
+             and pair
+    """
+    result = {}
+    for key in ['coherent', 'compton', 'photo', 'pair']:
+        result[key] = numpy.zeros(energy.shape, dtype=numpy.float64)
+    low = energy < 1.0
+    # below 1 keV use EPDL97
+    for i in numpy.nonzero(low)[0]:
+        if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
+            #make sure the binding energies are those used by this module and not EADL ones
+            PyMcaEPDL97.setElementBindingEnergies(ele,
+                                                  Element[ele]['binding'])
+        tmpDict = PyMcaEPDL97.getElementCrossSections(ele, energy[i])
+        result['coherent'][i] = tmpDict['coherent'][0]
+        result['compton'][i] = tmpDict['compton'][0]
+        result['photo'][i] = tmpDict['photo'][0]
+    high = numpy.nonzero(~low)[0]
+    if not len(high):
+        return result
+    table = _getXcomTable(ele)
+    xenergy = table['energy']
+    ene = energy[high]
+    i0 = numpy.searchsorted(xenergy, ene, side='right') - 1
+    i1 = numpy.searchsorted(xenergy, ene, side='left')
+    if (i0 < 0).any() or (i1 >= xenergy.size).any():
+        raise ValueError("Energy outside the tabulated range of %s" % ele)
+    # energies on a table point (or an edge) take the first value
+    exact = i1 <= i0
+    if exact.any():
+        idx = high[exact]
+        for key in ['coherent', 'compton', 'photo', 'pair']:
+            result[key][idx] = table[key][i1[exact]]
+    interpolate = ~exact
+    if interpolate.any():
+        idx = high[interpolate]
+        j0 = i0[interpolate]
+        j1 = i1[interpolate]
+        ene = ene[interpolate]
+        if LOGLOG:
+            A = table['energylog10'][j0]
+            B = table['energylog10'][j1]
+            ene = numpy.log10(ene)
+        else:
+            A = table['energy'][j0]
+            B = table['energy'][j1]
+        c2 = (ene - A) / (B - A)
+        c1 = (B - ene) / (B - A)
+        for key in ['coherent', 'compton', 'photo']:
+            result[key][idx] = numpy.power(10.0,
+                                   c2 * table[key + 'log10'][j1] + \
+                                   c1 * table[key + 'log10'][j0])
+        positive = table['pairpositive'][j0] & table['pairpositive'][j1]
+        result['pair'][idx[positive]] = numpy.power(10.0,
+                            c1[positive] * table['pairlog10'][j0[positive]] + \
+                            c2[positive] * table['pairlog10'][j1[positive]])
+    return result
+
+def _getMixtureCrossSections(composition, energy):
+    """
+    Mass attenuation coefficients of a mixture of elements.
+
+    :param composition: List of (element, mass fraction) tuples
+    :param energy: Energy or sequence of energies in keV
+    :return: Dictionary of read-only arrays with the keys coherent, compton,
+             photo, pair and total
+    """
+    energy = numpy.array(energy, dtype=numpy.float64, ndmin=1).ravel()
+    key = (tuple((ele, float(fraction)) for ele, fraction in composition),
+           energy.tobytes(), LOGLOG)
+    with _attenuationLock:
+        result = _attenuationCache.get(key, None)
+        if result is not None:
+            _attenuationCache.move_to_end(key)
+            return result
+    result = {}
+    for ele, fraction in composition:
+        data = _getElementCrossSections(ele, energy)
+        total = data['coherent'] + data['compton'] + data['photo'] + data['pair']
+        if not len(result):
+            for key0 in ['coherent', 'compton', 'photo', 'pair']:
+                result[key0] = data[key0] * fraction
+            result['total'] = total * fraction
+        else:
+            for key0 in ['coherent', 'compton', 'photo', 'pair']:
+                result[key0] += data[key0] * fraction
+            result['total'] += total * fraction
+    if not len(result):
+        for key0 in ['coherent', 'compton', 'photo', 'pair', 'total']:
+            result[key0] = numpy.zeros(energy.shape, dtype=numpy.float64)
+    for key0 in result:
+        result[key0].flags.writeable = False
+    with _attenuationLock:
+        _attenuationCache[key] = result
+        while len(_attenuationCache) > ATTENUATION_CACHE_SIZE:
+            _attenuationCache.popitem(last=False)
+    return result
+
+def _crossSectionsToDict(energy, result):
+    ddict = {}
+    ddict['energy'] = list(energy)
+    for key in ['coherent', 'compton', 'photo', 'pair', 'total']:
+        ddict[key] = result[key].tolist()
+    return ddict
+
 def getmassattcoef(compound, energy=None):
     """
     Usage: getmassattcoef(element symbol/composite, energy in kev)
@@ -2152,8 +2322,7 @@ def getmassattcoef(compound, energy=None):
     #single element case
     if compound in Element.keys():
         return getelementmassattcoef(compound,energy)
-    elts= [ w for w in re.split('[0-9]', compound) if w != '' ]
-    nbs= [ int(w) for w in re.split('[a-zA-Z]', compound) if w != '' ]
+    elts, nbs = _splitFormula(compound)
     if len(elts)==1 and len(nbs)==0:
         if elts in Element.keys():
             return getelementmassattcoef(compound,energy)
@@ -2166,14 +2335,6 @@ def getmassattcoef(compound, energy=None):
     div      = sum(fraction)
     fraction = [x/div for x in fraction]
     #print "fraction = ",fraction
-    ddict={}
-    ddict['energy']   = []
-    ddict['coherent'] = []
-    ddict['compton']  = []
-    ddict['photo']    = []
-    ddict['pair']     = []
-    ddict['total']    = []
-    eltindex = 0
     if energy is None:
         energy=[]
         for ele in elts:
@@ -2182,75 +2343,10 @@ def getmassattcoef(compound, energy=None):
                 if ene not in energy:
                     energy.append(ene)
         energy.sort()
-
-    for ele in elts:
-        xcom_data = getelementmassattcoef(ele,None)
-        #now I have to interpolate at the different energies
-        if not hasattr(energy, "__len__"):
-            energy =[energy]
-        eneindex = 0
-        for ene in energy:
-            if ene < 1.0:
-                if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
-                    #make sure the binding energies are those used by this module and not EADL ones
-                    PyMcaEPDL97.setElementBindingEnergies(ele,
-                                                          Element[ele]['binding'])
-                tmpDict = PyMcaEPDL97.getElementCrossSections(ele, ene)
-                cohe  = tmpDict['coherent'][0]
-                comp  = tmpDict['compton'][0]
-                photo = tmpDict['photo'][0]
-                pair  = 0.0
-            else:
-                i0=max(numpy.nonzero(xcom_data['energy'] <= ene)[0])
-                i1=min(numpy.nonzero(xcom_data['energy'] >= ene)[0])
-                if (i1 == i0) or (i0>i1):
-                    cohe=xcom_data['coherent'][i1]
-                    comp=xcom_data['compton'][i1]
-                    photo=xcom_data['photo'][i1]
-                    pair=xcom_data['pair'][i1]
-                else:
-                    if LOGLOG:
-                        A=xcom_data['energylog10'][i0]
-                        B=xcom_data['energylog10'][i1]
-                        logene = numpy.log10(ene)
-                        c2=(logene-A)/(B-A)
-                        c1=(B-logene)/(B-A)
-                    else:
-                        A=xcom_data['energy'][i0]
-                        B=xcom_data['energy'][i1]
-                        c2=(ene-A)/(B-A)
-                        c1=(B-ene)/(B-A)
-                    cohe= pow(10.0,c2*xcom_data['coherentlog10'][i1]+\
-                                   c1*xcom_data['coherentlog10'][i0])
-                    comp= pow(10.0,c2*xcom_data['comptonlog10'][i1]+\
-                                   c1*xcom_data['comptonlog10'][i0])
-                    photo=pow(10.0,c2*xcom_data['photolog10'][i1]+\
-                                   c1*xcom_data['photolog10'][i0])
-                    if xcom_data['pair'][i1] > 0.0:
-                        c2 = c2*numpy.log10(xcom_data['pair'][i1])
-                        if xcom_data['pair'][i0] > 0.0:
-                            c1 = c1*numpy.log10(xcom_data['pair'][i0])
-                            pair = pow(10.0,c1+c2)
-                        else:
-                            pair =0.0
-                    else:
-                        pair =0.0
-            if eltindex == 0:
-                ddict['energy'].append(ene)
-                ddict['coherent'].append(cohe *fraction[eltindex])
-                ddict['compton'].append(comp *fraction[eltindex])
-                ddict['photo'].append(photo *fraction[eltindex])
-                ddict['pair'].append(pair*fraction[eltindex])
-                ddict['total'].append((cohe+comp+photo+pair)*fraction[eltindex])
-            else:
-                ddict['coherent'][eneindex] += cohe  *fraction[eltindex]
-                ddict['compton'] [eneindex] += comp  *fraction[eltindex]
-                ddict['photo']   [eneindex] += photo *fraction[eltindex]
-                ddict['pair']    [eneindex] += pair  *fraction[eltindex]
-                ddict['total']   [eneindex] += (cohe+comp+photo+pair) * fraction[eltindex]
-            eneindex += 1
-        eltindex += 1
-    return ddict
+    if not hasattr(energy, "__len__"):
+        energy =[energy]
+    result = _getMixtureCrossSections(list(zip(elts, fraction)), energy)
+    return _crossSectionsToDict(energy, result)
 
 def __materialInCompoundList(lst):
     for item in lst:
@@ -2395,9 +2491,8 @@ def getMaterialMassAttenuationCoefficients(compoundList0, fractionList0, energy0
             elts=[compound]
             nbs =[1]
         else:
-            elts= [ w for w in re.split('[0-9]', compound) if w != '' ]
             try:
-                nbs= [ int(w) for w in re.split('[a-zA-Z]', compound) if w != '' ]
+                elts, nbs = _splitFormula(compound)
             except Exception:
                 raise ValueError("Compound '%s' not understood" % compound)
             if len(elts)==1 and len(nbs)==0:
@@ -2430,85 +2525,10 @@ def getMaterialMassAttenuationCoefficients(compoundList0, fractionList0, energy0
         energy.sort()
 
     #I have the energy grid, the elements and their fractions
-    dict={}
-    dict['energy']   = []
-    dict['coherent'] = []
-    dict['compton']  = []
-    dict['photo']    = []
-    dict['pair']     = []
-    dict['total']    = []
-    eltindex = 0
-    for ele in materialElements.keys():
-        if 'xcom' in Element[ele]:
-            xcom_data = Element[ele]['xcom']
-        else:
-            xcom_data = getelementmassattcoef(ele,None)
-        #now I have to interpolate at the different energies
-        if (type(energy) != type([])):
-            energy =[energy]
-        eneindex = 0
-        for ene in energy:
-            if ene < 1.0:
-                if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
-                    #make sure the binding energies are those used by this module and not EADL ones
-                    PyMcaEPDL97.setElementBindingEnergies(ele,
-                                                          Element[ele]['binding'])
-                tmpDict = PyMcaEPDL97.getElementCrossSections(ele, ene)
-                cohe  = tmpDict['coherent'][0]
-                comp  = tmpDict['compton'][0]
-                photo = tmpDict['photo'][0]
-                pair  = 0.0
-            else:
-                i0=max(numpy.nonzero(xcom_data['energy'] <= ene)[0])
-                i1=min(numpy.nonzero(xcom_data['energy'] >= ene)[0])
-                if (i1 == i0) or (i0>i1):
-                    cohe=xcom_data['coherent'][i1]
-                    comp=xcom_data['compton'][i1]
-                    photo=xcom_data['photo'][i1]
-                    pair=xcom_data['pair'][i1]
-                else:
-                    if LOGLOG:
-                        A=xcom_data['energylog10'][i0]
-                        B=xcom_data['energylog10'][i1]
-                        logene = numpy.log10(ene)
-                        c2=(logene-A)/(B-A)
-                        c1=(B-logene)/(B-A)
-                    else:
-                        A=xcom_data['energy'][i0]
-                        B=xcom_data['energy'][i1]
-                        c2=(ene-A)/(B-A)
-                        c1=(B-ene)/(B-A)
-                    cohe= pow(10.0,c2*xcom_data['coherentlog10'][i1]+\
-                                   c1*xcom_data['coherentlog10'][i0])
-                    comp= pow(10.0,c2*xcom_data['comptonlog10'][i1]+\
-                                   c1*xcom_data['comptonlog10'][i0])
-                    photo=pow(10.0,c2*xcom_data['photolog10'][i1]+\
-                                   c1*xcom_data['photolog10'][i0])
-                    if xcom_data['pair'][i1] > 0.0:
-                        c2 = c2*numpy.log10(xcom_data['pair'][i1])
-                        if xcom_data['pair'][i0] > 0.0:
-                            c1 = c1*numpy.log10(xcom_data['pair'][i0])
-                            pair = pow(10.0,c1+c2)
-                        else:
-                            pair =0.0
-                    else:
-                        pair =0.0
-            if eltindex == 0:
-                dict['energy'].append(ene)
-                dict['coherent'].append(cohe * materialElements[ele])
-                dict['compton'].append(comp * materialElements[ele])
-                dict['photo'].append(photo * materialElements[ele])
-                dict['pair'].append(pair* materialElements[ele])
-                dict['total'].append((cohe+comp+photo+pair)* materialElements[ele])
-            else:
-                dict['coherent'][eneindex] += cohe  * materialElements[ele]
-                dict['compton'] [eneindex] += comp  * materialElements[ele]
-                dict['photo']   [eneindex] += photo * materialElements[ele]
-                dict['pair']    [eneindex] += pair  * materialElements[ele]
-                dict['total']   [eneindex] += (cohe+comp+photo+pair) *  materialElements[ele]
-            eneindex += 1
-        eltindex += 1
-    return dict
+    if (type(energy) != type([])):
+        energy =[energy]
+    result = _getMixtureCrossSections(list(materialElements.items()), energy)
+    return _crossSectionsToDict(energy, result)
 
 
 def getcandidates(energy,threshold=None,targetrays=None):
@@ -2599,6 +2619,92 @@ def getElementComptonDifferentialCrossSection(ele, theta, energy, p1=None):
           raise ValueError("Unknown element %s" % ele)
     return (value * 6.022142E23)/ Element[ele]['mass']
 
+def _readXcomFile(xcomfile):
+    f = open(xcomfile, 'r')
+    line=f.readline()
+    while (line.split('ENERGY')[0] == line):
+        line = f.readline()
+    xcom = {}
+    xcom['energy']   =[]
+    xcom['coherent'] =[]
+    xcom['compton']  =[]
+    xcom['photo']  =[]
+    xcom['pair']     =[]
+    xcom['total']    =[]
+    line = f.readline()
+    while (line.split('COHERENT')[0] == line):
+        line = line.split()
+        for value in line:
+            xcom['energy'].append(float(value)*1000.)
+        line = f.readline()
+    xcom['energy']=numpy.array(xcom['energy'])
+    line = f.readline()
+    while (line.split('INCOHERENT')[0] == line):
+        line = line.split()
+        for value in line:
+            xcom['coherent'].append(float(value))
+        line = f.readline()
+    xcom['coherent']=numpy.array(xcom['coherent'])
+    line = f.readline()
+    while (line.split('PHOTO')[0] == line):
+        line = line.split()
+        for value in line:
+            xcom['compton'].append(float(value))
+        line = f.readline()
+    xcom['compton']=numpy.array(xcom['compton'])
+    line = f.readline()
+    while (line.split('PAIR')[0] == line):
+        line = line.split()
+        for value in line:
+            xcom['photo'].append(float(value))
+        line = f.readline()
+    line = f.readline()
+    while (line.split('PAIR')[0] == line):
+        line = line.split()
+        for value in line:
+            xcom['pair'].append(float(value))
+        line = f.readline()
+    i = 0
+    line = f.readline()
+    while (len(line)):
+        line = line.split()
+        for value in line:
+            xcom['pair'][i] += float(value)
+            i += 1
+        line = f.readline()
+    f.close()
+    if sys.version >= '3.0':
+        # next line gave problems under under windows
+        # just try numpy.argsort([1,1,1,1,1]) under linux and windows to see
+        # what I mean
+        # i1=numpy.argsort(xcom['energy']) did not work
+        # (uses quicksort and gives problems with Pb not passing tests)
+        i1=numpy.argsort(xcom['energy'], kind='mergesort')
+    else:
+        sset = map(None,xcom['energy'],range(len(xcom['energy'])))
+        sset.sort()
+        i1=numpy.array([x[1] for x in sset])
+    xcom['energy']=numpy.take(xcom['energy'],i1)
+    xcom['coherent']=numpy.take(xcom['coherent'],i1)
+    xcom['compton']=numpy.take(xcom['compton'],i1)
+    xcom['photo']=numpy.take(xcom['photo'],i1)
+    xcom['pair']=numpy.take(xcom['pair'],i1)
+    if xcom['coherent'][0] <= 0:
+       xcom['coherent'][0] = xcom['coherent'][1] * 1.0
+    try:
+        xcom['energylog10']=numpy.log10(xcom['energy'])
+        xcom['coherentlog10']=numpy.log10(xcom['coherent'])
+        xcom['comptonlog10']=numpy.log10(xcom['compton'])
+        xcom['photolog10']=numpy.log10(xcom['photo'])
+    except Exception:
+        raise ValueError("Problem calculating logaritm of %s file data" % os.path.basename(xcomfile))
+    for i in range(0,len(xcom['energy'])):
+        xcom['total'].append(xcom['coherent'][i]+\
+                             xcom['compton'] [i]+\
+                             xcom['photo'] [i]+\
+                             xcom['pair'] [i])
+    return xcom
+
 def getelementmassattcoef(ele,energy=None):
     """
     Usage: getelementmassattcoef(element symbol, energy in kev)
@@ -2629,155 +2735,16 @@ def getelementmassattcoef(ele,energy=None):
             if not os.path.exists(xcomfile):
                 print("Cannot find file ",xcomfile)
                 raise IOError("Cannot find %s" % xcomfile)
-        f = open(xcomfile, 'r')
-        line=f.readline()
-        while (line.split('ENERGY')[0] == line):
-            line = f.readline()
-        Element[ele]['xcom'] = {}
-        Element[ele]['xcom']['energy']   =[]
-        Element[ele]['xcom']['coherent'] =[]
-        Element[ele]['xcom']['compton']  =[]
-        Element[ele]['xcom']['photo']  =[]
-        Element[ele]['xcom']['pair']     =[]
-        Element[ele]['xcom']['total']    =[]
-        line = f.readline()
-        while (line.split('COHERENT')[0] == line):
-            line = line.split()
-            for value in line:
-                Element[ele]['xcom']['energy'].append(float(value)*1000.)
-            line = f.readline()
-        Element[ele]['xcom']['energy']=numpy.array(Element[ele]['xcom']['energy'])
-        line = f.readline()
-        while (line.split('INCOHERENT')[0] == line):
-            line = line.split()
-            for value in line:
-                Element[ele]['xcom']['coherent'].append(float(value))
-            line = f.readline()
-        Element[ele]['xcom']['coherent']=numpy.array(Element[ele]['xcom']['coherent'])
-        line = f.readline()
-        while (line.split('PHOTO')[0] == line):
-            line = line.split()
-            for value in line:
-                Element[ele]['xcom']['compton'].append(float(value))
-            line = f.readline()
-        Element[ele]['xcom']['compton']=numpy.array(Element[ele]['xcom']['compton'])
-        line = f.readline()
-        while (line.split('PAIR')[0] == line):
-            line = line.split()
-            for value in line:
-                Element[ele]['xcom']['photo'].append(float(value))
-            line = f.readline()
-        line = f.readline()
-        while (line.split('PAIR')[0] == line):
-            line = line.split()
-            for value in line:
-                Element[ele]['xcom']['pair'].append(float(value))
-            line = f.readline()
-        i = 0
-        line = f.readline()
-        while (len(line)):
-            line = line.split()
-            for value in line:
-                Element[ele]['xcom']['pair'][i] += float(value)
-                i += 1
-            line = f.readline()
-        f.close()
-        if sys.version >= '3.0':
-            # next line gave problems under under windows
-            # just try numpy.argsort([1,1,1,1,1]) under linux and windows to see
-            # what I mean
-            # i1=numpy.argsort(Element[ele]['xcom']['energy']) did not work
-            # (uses quicksort and gives problems with Pb not passing tests)
-            i1=numpy.argsort(Element[ele]['xcom']['energy'], kind='mergesort')
-        else:
-            sset = map(None,Element[ele]['xcom']['energy'],range(len(Element[ele]['xcom']['energy'])))
-            sset.sort()
-            i1=numpy.array([x[1] for x in sset])
-        Element[ele]['xcom']['energy']=numpy.take(Element[ele]['xcom']['energy'],i1)
-        Element[ele]['xcom']['coherent']=numpy.take(Element[ele]['xcom']['coherent'],i1)
-        Element[ele]['xcom']['compton']=numpy.take(Element[ele]['xcom']['compton'],i1)
-        Element[ele]['xcom']['photo']=numpy.take(Element[ele]['xcom']['photo'],i1)
-        Element[ele]['xcom']['pair']=numpy.take(Element[ele]['xcom']['pair'],i1)
-        if Element[ele]['xcom']['coherent'][0] <= 0:
-           Element[ele]['xcom']['coherent'][0] = Element[ele]['xcom']['coherent'][1] * 1.0
-        try:
-            Element[ele]['xcom']['energylog10']=numpy.log10(Element[ele]['xcom']['energy'])
-            Element[ele]['xcom']['coherentlog10']=numpy.log10(Element[ele]['xcom']['coherent'])
-            Element[ele]['xcom']['comptonlog10']=numpy.log10(Element[ele]['xcom']['compton'])
-            Element[ele]['xcom']['photolog10']=numpy.log10(Element[ele]['xcom']['photo'])
-        except Exception:
-            raise ValueError("Problem calculating logaritm of %s.mat file data" % ele)
-        for i in range(0,len(Element[ele]['xcom']['energy'])):
-            Element[ele]['xcom']['total'].append(Element[ele]['xcom']['coherent'][i]+\
-                                                 Element[ele]['xcom']['compton'] [i]+\
-                                                 Element[ele]['xcom']['photo'] [i]+\
-                                                 Element[ele]['xcom']['pair'] [i])
+        Element[ele]['xcom'] = AtomicDataCache.load(xcomfile,
+                                                    _readXcomFile,
+                                                    lazy=False)
 
     if energy is None:
         return  Element[ele]['xcom']
-    ddict={}
-    ddict['energy']   = []
-    ddict['coherent'] = []
-    ddict['compton']  = []
-    ddict['photo']    = []
-    ddict['pair']     = []
-    ddict['total']    = []
     if not hasattr(energy, "__len__"):
         energy =[energy]
-    for ene in energy:
-        if ene < 1.0:
-            if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
-                #make sure the binding energies are those used by this module and not EADL ones
-                PyMcaEPDL97.setElementBindingEnergies(ele,
-                                                      Element[ele]['binding'])
-            tmpDict = PyMcaEPDL97.getElementCrossSections(ele, ene)
-            cohe  = tmpDict['coherent'][0]
-            comp  = tmpDict['compton'][0]
-            photo = tmpDict['photo'][0]
-            pair  = 0.0
-        else:
-            i0=max(numpy.nonzero(Element[ele]['xcom']['energy'] <= ene)[0])
-            i1=min(numpy.nonzero(Element[ele]['xcom']['energy'] >= ene)[0])
-            if i1 <= i0:
-                cohe=Element[ele]['xcom']['coherent'][i1]
-                comp=Element[ele]['xcom']['compton'][i1]
-                photo=Element[ele]['xcom']['photo'][i1]
-                pair=Element[ele]['xcom']['pair'][i1]
-            else:
-                if LOGLOG:
-                    A=Element[ele]['xcom']['energylog10'][i0]
-                    B=Element[ele]['xcom']['energylog10'][i1]
-                    logene = numpy.log10(ene)
-                    c2=(logene-A)/(B-A)
-                    c1=(B-logene)/(B-A)
-                else:
-                    A=Element[ele]['xcom']['energy'][i0]
-                    B=Element[ele]['xcom']['energy'][i1]
-                    c2=(ene-A)/(B-A)
-                    c1=(B-ene)/(B-A)
-
-                cohe= pow(10.0,c2*Element[ele]['xcom']['coherentlog10'][i1]+\
-                               c1*Element[ele]['xcom']['coherentlog10'][i0])
-                comp= pow(10.0,c2*Element[ele]['xcom']['comptonlog10'][i1]+\
-                               c1*Element[ele]['xcom']['comptonlog10'][i0])
-                photo=pow(10.0,c2*Element[ele]['xcom']['photolog10'][i1]+\
-                               c1*Element[ele]['xcom']['photolog10'][i0])
-                if Element[ele]['xcom']['pair'][i1] > 0.0:
-                    c2 = c2*numpy.log10(Element[ele]['xcom']['pair'][i1])
-                    if Element[ele]['xcom']['pair'][i0] > 0.0:
-                        c1 = c1*numpy.log10(Element[ele]['xcom']['pair'][i0])
-                        pair = pow(10.0,c1+c2)
-                    else:
-                        pair =0.0
-                else:
-                    pair =0.0
-        ddict['energy'].append(ene)
-        ddict['coherent'].append(cohe)
-        ddict['compton'].append(comp)
-        ddict['photo'].append(photo)
-        ddict['pair'].append(pair)
-        ddict['total'].append(cohe+comp+photo+pair)
-    return ddict
+    result = _getMixtureCrossSections([(ele, 1.0)], energy)
+    return _crossSectionsToDict(energy, result)
 
 def getElementLShellRates(symbol,energy=None,photoweights = None):
     """
@@ -34,6 +34,7 @@
 Module to perform a fast linear fit on a stack of fluorescence spectra.
 """
 import os
+import sys
 import numpy
 import logging
 import time
@@ -46,18 +47,36 @@
 from PyMca5.PyMcaMath.fitting import SpecfitFuns
 from PyMca5.PyMcaIO import ConfigDict
 from .XRFBatchFitOutput import OutputBuffer
+from . import LinearModelCache
 from PyMca5.PyMcaCore import McaStackView
 
 _logger = logging.getLogger(__name__)
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    _logger.info("Cannot import ThreadPoolExecutor")
+    ThreadPoolExecutor = None
+
 
 class FastXRFLinearFit(object):
-    def __init__(self, mcafit=None):
+    def __init__(self, mcafit=None, modelcache=None):
+        """
+        :param mcafit: McaTheory instance (created when not provided)
+        :param modelcache: LinearModelCache instance to reuse the linear
+                           models of previous fits. None (default) or False
+                           to calculate the model of every fit.
+        """
         self._config = None
         if mcafit is None:
             self._mcaTheory = ClassMcaTheory.McaTheory()
         else:
             self._mcaTheory = mcafit
+        if modelcache is False:
+            modelcache = None
+        self.modelCache = modelcache
+        self._modelEstimated = False
+        self._stream = None
 
     def setFitConfiguration(self, configuration):
         self._mcaTheory.setConfiguration(configuration)
@@ -73,7 +92,9 @@ def setFitConfigurationFile(self, ffile):
     def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
                            configuration=None, concentrations=False,
                            ysum=None, weight=None, refit=True, livetime=None,
-                           outbuffer=None, save=True, **outbufferinitargs):
+                           outbuffer=None, save=True, nworkers=None,
+                           mask=None, uncertaintyNames=None,
+                           **outbufferinitargs):
         """
         This method performs the actual fit. The y keyword is the only mandatory input argument.
 
@@ -90,6 +111,16 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
                          automatic time. The default is None.
         :param outbuffer:
         :param save: set to False to postpone saving the in-memory buffers
+        :param nworkers: number of threads used to fit the spectra in chunks.
+                         None or 1 fits in the calling thread, a negative value
+                         uses all cores. The results do not depend on it.
+        :param mask: pixels to be fitted, either a boolean image (the stack
+                     shape without the MCA axis) or a list of (flat) pixel
+                     indices. Only the selected spectra are read and fitted,
+                     the results of the other pixels are set to NaN.
+        :param uncertaintyNames: names of the free parameters whose
+                     uncertainties are calculated (all by default). The
+                     uncertainties of the other parameters are set to NaN.
         :return OutputBuffer: works like a dict
         """
         # Parse data
@@ -103,7 +134,12 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
             t0 = time.time()
 
             # Configure fit
-            nSpectra = data.size // data.shape[mcaIndex]
+            mask = self._fitParseMask(data=data, mcaIndex=mcaIndex,
+                                      mask=mask)
+            if mask is None:
+                nSpectra = data.size // data.shape[mcaIndex]
+            else:
+                nSpectra = int(mask.sum())
             configorg, config, weight, weightPolicy, \
             autotime, liveTimeFactor = self._fitConfigure(
                                                 configuration=configuration,
@@ -125,205 +161,538 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
                 else:
                     sumover = 'first vector'
                 yref = self._fitReferenceSpectrum(data=data, mcaIndex=mcaIndex,
-                                                  sumover=sumover)
+                                                  sumover=sumover, mask=mask)
             else:
                 yref = ysum
 
-            # Get the basis of the linear models (i.e. derivative to peak areas)
-            if xmin is None:
-                xmin = config['fit']['xmin']
-            if xmax is None:
-                xmax = config['fit']['xmax']
-            dtypeCalculcation = self._fitDtypeCalculation(data)
-            self._mcaTheory.setData(x=x, y=yref, xmin=xmin, xmax=xmax)
-            derivatives, freeNames, nFree, nFreeBkg = self._fitCreateModel(dtype=dtypeCalculcation)
-
-            # Background anchor points (if any)
-            anchorslist = self._fitBkgAnchorList(config=config)
-
-            # MCA trimming: [iXMin:iXMax]
-            iXMin, iXMax = self._fitMcaTrimInfo(x=x)
-            sliceChan = slice(iXMin, iXMax)
-            nObs = iXMax-iXMin
-
-            # Least-squares parameters
-            if weightPolicy == 2:
-                # Individual spectrum weights (assumed Poisson)
-                SVD = False
-                sigma_b = None
-            elif weightPolicy == 1:
-                # Average weight from sum spectrum (assume Poisson)
-                # the +1 is to prevent misbehavior due to weights less than 1.0
-                sigma_b = 1 + numpy.sqrt(yref[sliceChan])/nSpectra
-                sigma_b = sigma_b.reshape(-1, 1)
-                SVD = True
-            else:
-                # No weights
-                SVD = True
-                sigma_b = None
-            lstsq_kwargs = {'svd': SVD, 'sigma_b': sigma_b, 'weight': weight}
-
-            # Allocate output buffers
-            stackShape = data.shape
-            imageShape = list(stackShape)
-            imageShape.pop(mcaIndex)
-            imageShape = tuple(imageShape)
-            paramShape = (nFree,) + imageShape
-            dtypeResult = self._fitDtypeResult(data)
-            dataAttrs = {}  #{'units':'counts'})
-            paramAttrs = {'errors': 'uncertainties',
-                          'default': not concentrations}
-            results = outbuffer.allocateMemory('parameters',
-                                                shape=paramShape,
-                                                dtype=dtypeResult,
-                                                labels=freeNames,
-                                                dataAttrs=dataAttrs,
-                                                groupAttrs=paramAttrs,
-                                                memtype='ram')
-            uncertainties = outbuffer.allocateMemory('uncertainties',
-                                                shape=paramShape,
-                                                dtype=dtypeResult,
-                                                labels=freeNames,
-                                                dataAttrs=dataAttrs,
-                                                groupAttrs=None,
-                                                memtype='ram')
-            fitAttrs = {}
-            if outbuffer.saveDataDiagnostics:
-                # Generic axes
-                dataAxesNames = ['dim{}'.format(i) for i in range(data.ndim)]
-                dataAxes = [(name, numpy.arange(n, dtype=dtypeResult), {})
-                            for name, n in zip(dataAxesNames, stackShape)]
-                # MCA axis: use energy and add channels as extra (unused) axis
-                xdata = self._mcaTheory.xdata0.flatten()
-                zero, gain = self._mcaTheory.parameters[:2]
-                xenergy = zero + gain*xdata
-                dataAxesNames[mcaIndex] = 'energy'
-                dataAxes[mcaIndex] = 'energy', xenergy.astype(dtypeResult), {'units': 'keV'}
-                dataAxes.append(('channels', xdata.astype(numpy.float32), {}))
-                fitAttrs['axes'] = dataAxes
-                fitAttrs['axesused'] = dataAxesNames
-
-            if outbuffer.saveDataDiagnostics:
-                derivAttrs = {}
-                derivAttrs['axes'] = [('energy', xenergy.astype(dtypeResult), {'units': 'keV'}),
-                                      ('channels', xdata.astype(numpy.float32), {})]
-                derivAttrs['axesused'] = ["energy"]
-                _derivatives = outbuffer.allocateMemory('derivatives',
-                                        shape=(nFree, xdata.size),
-                                        dtype=derivatives.dtype,
-                                        fill_value=numpy.nan,
-                                        labels=freeNames,
-                                        dataAttrs=dataAttrs,
-                                        groupAttrs=derivAttrs,
-                                        memtype='ram')
-                _derivatives[:, iXMin:iXMax] = derivatives.T
-
-            dataAttrs = {}
-            if outbuffer.saveFOM:
-                nFreeParameters = outbuffer.allocateMemory('nFreeParameters',
-                                                           group='diagnostics',
-                                                           shape=imageShape,
-                                                           fill_value=nFree,
-                                                           dtype=numpy.int32,
-                                                           dataAttrs=dataAttrs,
-                                                           groupAttrs=None,
-                                                           memtype='ram')
-                nObservations = outbuffer.allocateMemory('nObservations',
-                                                         group='diagnostics',
-                                                         shape=imageShape,
-                                                         fill_value=nObs,
-                                                         dtype=numpy.int32,
-                                                         dataAttrs=dataAttrs,
-                                                         groupAttrs=None,
-                                                         memtype='ram')
-            else:
-                nFreeParameters = None
-            if outbuffer.saveFit:
-                fitmodel = outbuffer.allocateMemory('model',
-                                                    group='fit',
-                                                    shape=stackShape,
-                                                    dtype=dtypeResult,
-                                                    chunks=True,
-                                                    fill_value=0,
-                                                    dataAttrs=dataAttrs,
-                                                    groupAttrs=fitAttrs,
-                                                    memtype='hdf5')
-                idx = [slice(None)]*fitmodel.ndim
-                idx[mcaIndex] = slice(0, iXMin)
-                fitmodel[tuple(idx)] = numpy.nan
-                idx[mcaIndex] = slice(iXMax, None)
-                fitmodel[tuple(idx)] = numpy.nan
-            else:
-                fitmodel = None
+            # Linear model and output buffers
+            state = self._fitPrepare(x=x, yref=yref, xmin=xmin, xmax=xmax,
+                                     config=config, weight=weight,
+                                     weightPolicy=weightPolicy,
+                                     nSpectra=nSpectra,
+                                     concentrations=concentrations,
+                                     stackShape=data.shape, mcaIndex=mcaIndex,
+                                     dtypeCalculation=self._fitDtypeCalculation(data),
+                                     dtypeResult=self._fitDtypeResult(data),
+                                     outbuffer=outbuffer, mask=mask,
+                                     uncertaintyNames=uncertaintyNames)
+            fitmodel = state['fitmodel']
 
             _logger.debug("Configuration elapsed = %f", time.time() - t0)
             t0 = time.time()
 
             # Fit all spectra
-            self._fitLstSqAll(data=data, sliceChan=sliceChan, mcaIndex=mcaIndex,
-                            derivatives=derivatives, fitmodel=fitmodel,
-                            results=results, uncertainties=uncertainties,
-                            config=config, anchorslist=anchorslist,
-                            lstsq_kwargs=lstsq_kwargs)
+            self._fitLstSqAll(data=data, sliceChan=state['sliceChan'],
+                            mcaIndex=mcaIndex,
+                            derivatives=state['derivatives'], fitmodel=fitmodel,
+                            results=state['results'],
+                            uncertainties=state['uncertainties'],
+                            config=config, anchorslist=state['anchorslist'],
+                            lstsq_kwargs=state['lstsq_kwargs'], nworkers=nworkers,
+                            mask=mask)
 
             t = time.time() - t0
             _logger.debug("First fit elapsed = %f", t)
             if t > 0.:
                 _logger.debug("Spectra per second = %f",
-                              numpy.prod(imageShape)/float(t))
+                              nSpectra/float(t))
+
+            # Refit spectra with negative peak areas, save diagnostics
+            # and derive concentrations
+            self._fitFinish(data=data, state=state, config=config,
+                            refit=refit, concentrations=concentrations,
+                            autotime=autotime, liveTimeFactor=liveTimeFactor,
+                            mcaIndex=mcaIndex, outbuffer=outbuffer,
+                            nworkers=nworkers)
+            return outbuffer
+
+    def begin(self, shape, configuration=None, x=None, xmin=None, xmax=None,
+              ysum=None, weight=None, refit=True, concentrations=False,
+              livetime=None, outbuffer=None, save=True, dtype=numpy.float32,
+              uncertaintyNames=None, **outbufferinitargs):
+        """
+        Start fitting a stack of spectra which becomes available in blocks
+        (e.g. while a scan is running):
+
+            fitter.begin(shape, configuration=config)
+            for index, block in scan:
+                fitter.push(block, index)
+            outbuffer = fitter.finalize()
+
+        Every block is fitted as soon as it is pushed and the results are
+        written into the output buffer. Refitting pixels with negative peak
+        areas, the residuals and the concentrations are postponed to
+        `finalize`.
+
+        :param tuple shape: shape of the stack (last axis is the MCA axis)
+        :param ysum: sum spectrum. By default the first pushed spectrum
+                     is used to initialize the fit.
+        :param dtype: type of the spectra and the results
+        :param **kwargs: see `fitMultipleSpectra`
+        """
+        if self._stream is not None:
+            raise RuntimeError("Fitting of a stack already in progress")
+        shape = tuple(shape)
+        if len(shape) < 2:
+            shape = (1,)*(2-len(shape)) + shape
+        nSpectra = int(numpy.prod(shape[:-1]))
+
+        if outbuffer is None:
+            outbuffer = OutputBuffer(**outbufferinitargs)
+        context = outbuffer.Context(save=save)
+        context.__enter__()
+        try:
+            configorg, config, weight, weightPolicy, \
+            autotime, liveTimeFactor = self._fitConfigure(
+                                                configuration=configuration,
+                                                concentrations=concentrations,
+                                                livetime=livetime,
+                                                weight=weight,
+                                                nSpectra=nSpectra)
+            if weightPolicy == 1 and ysum is None:
+                raise ValueError("Average weights require the sum spectrum")
+            outbuffer['configuration'] = configorg
+            self._stream = {'shape': shape,
+                            'nSpectra': nSpectra,
+                            'x': x,
+                            'xmin': xmin,
+                            'xmax': xmax,
+                            'ysum': ysum,
+                            'yref': None,
+                            'config': config,
+                            'weight': weight,
+                            'weightPolicy': weightPolicy,
+                            'autotime': autotime,
+                            'liveTimeFactor': liveTimeFactor,
+                            'refit': refit,
+                            'concentrations': concentrations,
+                            'uncertaintyNames': uncertaintyNames,
+                            'dtype': self._fitDtypeResult(numpy.empty(0, dtype)),
+                            'outbuffer': outbuffer,
+                            'context': context,
+                            'state': None,
+                            'data': None}
+            if ysum is not None:
+                self._streamPrepare(numpy.asarray(ysum))
+        except:
+            self._stream = None
+            context.__exit__(*sys.exc_info())
+            raise
+
+    def push(self, spectra, index=0):
+        """
+        Fit a block of spectra of the stack started with `begin`.
+
+        :param spectra: array of spectra (last axis is the MCA axis)
+        :param int index: index of the first spectrum in the flattened
+                          image (C-order)
+        """
+        stream = self._stream
+        if stream is None:
+            raise RuntimeError("Call begin before pushing spectra")
+        try:
+            spectra = numpy.asarray(spectra)
+            nChan = stream['shape'][-1]
+            if spectra.shape[-1] != nChan:
+                raise ValueError("Spectra must have {} channels".format(nChan))
+            spectra = spectra.reshape((-1, nChan))
+            nMca = spectra.shape[0]
+            if index < 0 or index + nMca > stream['nSpectra']:
+                raise IndexError("Spectra {}-{} outside the stack".format(index, index + nMca))
+            if stream['state'] is None:
+                # first spectrum is used to initialize the fit
+                self._streamPrepare(spectra[0])
+            state = stream['state']
+            config = stream['config']
+            dtype = stream['dtype']
+            lstsq_kwargs = state['lstsq_kwargs']
+            sliceChan = state['sliceChan']
+            fitmodel = state['fitmodel']
+            results = state['results']
+            uncertainties = state['uncertainties']
+
+            fitkwargs = {'derivatives': state['derivatives'],
+                         'config': config,
+                         'anchorslist': state['anchorslist'],
+                         'lstsq_kwargs': lstsq_kwargs}
+            chunk = spectra[:, sliceChan].astype(dtype)
+            if fitmodel is None:
+                chunkModel = None
+                ddict = self._fitLstSqChunk(chunk.T, **fitkwargs)
+            else:
+                chunkModel = numpy.zeros_like(chunk)
+                ddict = self._fitLstSqChunk(chunk.T, fitmodel=chunkModel.T,
+                                            **fitkwargs)
+            lstsq_kwargs['last_svd'] = ddict.get('svd', None)
+
+            # Write into the output buffers (one image row at a time)
+            data = stream['data']
+            parameters = ddict['parameters']
+            sigmas = ddict['uncertainties']
+            imageShape = stream['shape'][:-1]
+            for idx, i0, i1 in self._streamSegments(imageShape, index, nMca):
+                results[(slice(None),) + idx] = parameters[:, i0:i1]
+                uncertainties[(slice(None),) + idx] = sigmas[:, i0:i1]
+                if fitmodel is not None:
+                    fitmodel[idx + (sliceChan,)] = chunkModel[i0:i1]
+                if data is not None:
+                    data[idx] = spectra[i0:i1]
+            if stream['ysum'] is None:
+                stream['yref'] += spectra.sum(axis=0, dtype=stream['yref'].dtype)
+        except:
+            self._streamAbort()
+            raise
+
+    def finalize(self):
+        """
+        Finish fitting the stack started with `begin`.
+
+        :return OutputBuffer: works like a dict
+        """
+        stream = self._stream
+        if stream is None:
+            raise RuntimeError("Call begin before finalizing")
+        try:
+            if stream['state'] is None:
+                raise RuntimeError("No spectra were pushed")
+            config = stream['config']
+            if stream['ysum'] is None and stream['concentrations']:
+                # reference spectrum: sum of all spectra
+                self._mcaTheory.setData(x=stream['x'], y=stream['yref'],
+                                        xmin=stream['xmin'], xmax=stream['xmax'])
+                self._modelEstimated = False
+            self._fitFinish(data=stream['data'], state=stream['state'],
+                            config=config, refit=stream['refit'],
+                            concentrations=stream['concentrations'],
+                            autotime=stream['autotime'],
+                            liveTimeFactor=stream['liveTimeFactor'],
+                            mcaIndex=-1, outbuffer=stream['outbuffer'],
+                            saveData=False)
+        except:
+            self._streamAbort()
+            raise
+        self._stream = None
+        stream['context'].__exit__(None, None, None)
+        return stream['outbuffer']
+
+    def _streamPrepare(self, yref):
+        """Get the linear model and allocate the output buffers of a stream
+        """
+        stream = self._stream
+        outbuffer = stream['outbuffer']
+        dtype = stream['dtype']
+        shape = stream['shape']
+        state = self._fitPrepare(x=stream['x'], yref=yref,
+                                 xmin=stream['xmin'], xmax=stream['xmax'],
+                                 config=stream['config'],
+                                 weight=stream['weight'],
+                                 weightPolicy=stream['weightPolicy'],
+                                 nSpectra=stream['nSpectra'],
+                                 concentrations=stream['concentrations'],
+                                 stackShape=shape, mcaIndex=-1,
+                                 dtypeCalculation=self._fitDtypeCalculation(yref),
+                                 dtypeResult=dtype,
+                                 outbuffer=outbuffer,
+                                 uncertaintyNames=stream['uncertaintyNames'])
+        # The spectra are needed after fitting
+        if outbuffer.saveData:
+            data = outbuffer.allocateMemory('data',
+                                            group='fit',
+                                            shape=shape,
+                                            dtype=dtype,
+                                            chunks=True,
+                                            fill_value=0,
+                                            dataAttrs={},
+                                            groupAttrs=state['fitAttrs'],
+                                            memtype='hdf5')
+        elif stream['refit'] or outbuffer.saveResiduals:
+            data = numpy.zeros(shape, dtype=dtype)
+        else:
+            data = None
+        if stream['ysum'] is None:
+            stream['yref'] = numpy.zeros((shape[-1],), dtype=state['derivatives'].dtype)
+        stream['data'] = data
+        stream['state'] = state
+
+    def _streamAbort(self):
+        """Leave the output buffer context of a stream after an exception
+        """
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            stream['context'].__exit__(*sys.exc_info())
+
+    @staticmethod
+    def _streamSegments(imageShape, index, n):
+        """Split the flat pixel range [index, index+n) in segments along
+        the last image dimension
+
+        :returns generator: image index, start and stop in the range
+        """
+        ncol = imageShape[-1]
+        i = 0
+        while i < n:
+            row, col = divmod(index + i, ncol)
+            m = min(ncol - col, n - i)
+            idx = numpy.unravel_index(row, imageShape[:-1]) if len(imageShape) > 1 else ()
+            idx = tuple(int(j) for j in idx) + (slice(col, col + m),)
+            yield idx, i, i + m
+            i += m
+
+    def _fitPrepare(self, x=None, yref=None, xmin=None, xmax=None,
+                    config=None, weight=None, weightPolicy=None,
+                    nSpectra=None, concentrations=False, stackShape=None,
+                    mcaIndex=None, dtypeCalculation=None, dtypeResult=None,
+                    outbuffer=None, mask=None, uncertaintyNames=None):
+        """Get the linear model and allocate the output buffers
+
+        :param mask: boolean image of the pixels to be fitted (None for all).
+                     The outputs of the other pixels are set to NaN (zero
+                     for integer diagnostics).
+        :param uncertaintyNames: free parameters whose uncertainties are
+                     calculated (None for all).
+
+        :returns dict:
+        """
+        # Get the basis of the linear models (i.e. derivative to peak areas)
+        if xmin is None:
+            xmin = config['fit']['xmin']
+        if xmax is None:
+            xmax = config['fit']['xmax']
+        self._mcaTheory.setData(x=x, y=yref, xmin=xmin, xmax=xmax)
+        model = self._fitGetModel(config=config, dtype=dtypeCalculation)
+        derivatives = model['derivatives']
+        freeNames = model['freeNames']
+        nFree = len(freeNames)
+        nFreeBkg = model['nFreeBkg']
+
+        # Background anchor points (if any)
+        anchorslist = self._fitBkgAnchorList(config=config)
+
+        # MCA trimming: [iXMin:iXMax]
+        iXMin, iXMax = self._fitMcaTrimInfo(x=x)
+        sliceChan = slice(iXMin, iXMax)
+        nObs = iXMax-iXMin
+
+        # Least-squares parameters
+        if weightPolicy == 2:
+            # Individual spectrum weights (assumed Poisson)
+            SVD = False
+            sigma_b = None
+        elif weightPolicy == 1:
+            # Average weight from sum spectrum (assume Poisson)
+            # the +1 is to prevent misbehavior due to weights less than 1.0
+            sigma_b = 1 + numpy.sqrt(yref[sliceChan])/nSpectra
+            sigma_b = sigma_b.reshape(-1, 1)
+            SVD = True
+        else:
+            # No weights
+            SVD = True
+            sigma_b = None
+        lstsq_kwargs = {'svd': SVD, 'sigma_b': sigma_b, 'weight': weight}
+        if not weight:
+            # SVD of the unweighted model (lstsq modifies s in-place)
+            U, s, V = model['svd']
+            lstsq_kwargs['last_svd'] = U, s.copy(), V
+        if uncertaintyNames is not None:
+            # the uncertainties of the other parameters are NaN
+            for name in uncertaintyNames:
+                if name not in freeNames:
+                    _logger.warning("%s is not a free parameter", name)
+            lstsq_kwargs['uncertainties'] = [freeNames.index(name)
+                                             for name in uncertaintyNames
+                                             if name in freeNames]
+
+        # Allocate output buffers
+        imageShape = list(stackShape)
+        imageShape.pop(mcaIndex)
+        imageShape = tuple(imageShape)
+        paramShape = (nFree,) + imageShape
+        dataAttrs = {}  #{'units':'counts'})
+        paramAttrs = {'errors': 'uncertainties',
+                      'default': not concentrations}
+        results = outbuffer.allocateMemory('parameters',
+                                            shape=paramShape,
+                                            dtype=dtypeResult,
+                                            labels=freeNames,
+                                            dataAttrs=dataAttrs,
+                                            groupAttrs=paramAttrs,
+                                            memtype='ram')
+        uncertainties = outbuffer.allocateMemory('uncertainties',
+                                            shape=paramShape,
+                                            dtype=dtypeResult,
+                                            labels=freeNames,
+                                            dataAttrs=dataAttrs,
+                                            groupAttrs=None,
+                                            memtype='ram')
+        fitAttrs = {}
+        if outbuffer.saveDataDiagnostics:
+            # Generic axes
+            dataAxesNames = ['dim{}'.format(i) for i in range(len(stackShape))]
+            dataAxes = [(name, numpy.arange(n, dtype=dtypeResult), {})
+                        for name, n in zip(dataAxesNames, stackShape)]
+            # MCA axis: use energy and add channels as extra (unused) axis
+            xdata = self._mcaTheory.xdata0.flatten()
+            zero, gain = model['calibration']
+            xenergy = zero + gain*xdata
+            dataAxesNames[mcaIndex] = 'energy'
+            dataAxes[mcaIndex] = 'energy', xenergy.astype(dtypeResult), {'units': 'keV'}
+            dataAxes.append(('channels', xdata.astype(numpy.float32), {}))
+            fitAttrs['axes'] = dataAxes
+            fitAttrs['axesused'] = dataAxesNames
+
+        if outbuffer.saveDataDiagnostics:
+            derivAttrs = {}
+            derivAttrs['axes'] = [('energy', xenergy.astype(dtypeResult), {'units': 'keV'}),
+                                  ('channels', xdata.astype(numpy.float32), {})]
+            derivAttrs['axesused'] = ["energy"]
+            _derivatives = outbuffer.allocateMemory('derivatives',
+                                    shape=(nFree, xdata.size),
+                                    dtype=derivatives.dtype,
+                                    fill_value=numpy.nan,
+                                    labels=freeNames,
+                                    dataAttrs=dataAttrs,
+                                    groupAttrs=derivAttrs,
+                                    memtype='ram')
+            _derivatives[:, iXMin:iXMax] = derivatives.T
+
+        dataAttrs = {}
+        if outbuffer.saveFOM:
+            nFreeParameters = outbuffer.allocateMemory('nFreeParameters',
+                                                       group='diagnostics',
+                                                       shape=imageShape,
+                                                       fill_value=nFree,
+                                                       dtype=numpy.int32,
+                                                       dataAttrs=dataAttrs,
+                                                       groupAttrs=None,
+                                                       memtype='ram')
+            nObservations = outbuffer.allocateMemory('nObservations',
+                                                     group='diagnostics',
+                                                     shape=imageShape,
+                                                     fill_value=nObs,
+                                                     dtype=numpy.int32,
+                                                     dataAttrs=dataAttrs,
+                                                     groupAttrs=None,
+                                                     memtype='ram')
+        else:
+            nFreeParameters = None
+        if outbuffer.saveFit:
+            fitmodel = outbuffer.allocateMemory('model',
+                                                group='fit',
+                                                shape=stackShape,
+                                                dtype=dtypeResult,
+                                                chunks=True,
+                                                fill_value=0,
+                                                dataAttrs=dataAttrs,
+                                                groupAttrs=fitAttrs,
+                                                memtype='hdf5')
+            idx = [slice(None)]*fitmodel.ndim
+            idx[mcaIndex] = slice(0, iXMin)
+            fitmodel[tuple(idx)] = numpy.nan
+            idx[mcaIndex] = slice(iXMax, None)
+            fitmodel[tuple(idx)] = numpy.nan
+        else:
+            fitmodel = None
+
+        if mask is not None:
+            notFitted = ~mask
+            results[:, notFitted] = numpy.nan
+            uncertainties[:, notFitted] = numpy.nan
+            if nFreeParameters is not None:
+                nFreeParameters[notFitted] = 0
+                nObservations[notFitted] = 0
+            if fitmodel is not None:
+                modelstack = McaStackView.MaskedView(fitmodel, mask=notFitted,
+                                                     mcaAxis=mcaIndex,
+                                                     nMca=(1, 'MB'),
+                                                     readonly=False)
+                for _, chunk in modelstack.items():
+                    chunk[()] = numpy.nan
+
+        return {'model': model,
+                'derivatives': derivatives,
+                'freeNames': freeNames,
+                'nFreeBkg': nFreeBkg,
+                'anchorslist': anchorslist,
+                'sliceChan': sliceChan,
+                'lstsq_kwargs': lstsq_kwargs,
+                'results': results,
+                'uncertainties': uncertainties,
+                'nFreeParameters': nFreeParameters,
+                'fitmodel': fitmodel,
+                'fitAttrs': fitAttrs,
+                'dtypeResult': dtypeResult}
+
+    def _fitFinish(self, data=None, state=None, config=None, refit=True,
+                   concentrations=False, autotime=None, liveTimeFactor=None,
+                   mcaIndex=None, outbuffer=None, nworkers=None,
+                   saveData=True):
+        """Refit spectra with negative peak areas, add data diagnostics
+        and concentrations to the output buffer
+
+        :param bool saveData: add the data to the output buffer (when enabled)
+        """
+        t0 = time.time()
+        fitmodel = state['fitmodel']
+        results = state['results']
+        dtypeResult = state['dtypeResult']
+        fitAttrs = state['fitAttrs']
+
+        # Refit spectra with negative peak areas
+        if refit:
+            self._fitLstSqNegative(data=data, sliceChan=state['sliceChan'],
+                        mcaIndex=mcaIndex,
+                        derivatives=state['derivatives'], fitmodel=fitmodel,
+                        results=results, uncertainties=state['uncertainties'],
+                        config=config, anchorslist=state['anchorslist'],
+                        lstsq_kwargs=state['lstsq_kwargs'],
+                        freeNames=state['freeNames'],
+                        nFreeBkg=state['nFreeBkg'],
+                        nFreeParameters=state['nFreeParameters'],
+                        nworkers=nworkers)
+            t = time.time() - t0
+            _logger.debug("Fit of negative peaks elapsed = %f", t)
             t0 = time.time()
 
-            # Refit spectra with negative peak areas
-            if refit:
-                self._fitLstSqNegative(data=data, sliceChan=sliceChan, mcaIndex=mcaIndex,
-                            derivatives=derivatives, fitmodel=fitmodel,
-                            results=results, uncertainties=uncertainties,
-                            config=config, anchorslist=anchorslist,
-                            lstsq_kwargs=lstsq_kwargs, freeNames=freeNames,
-                            nFreeBkg=nFreeBkg, nFreeParameters=nFreeParameters)
-                t = time.time() - t0
-                _logger.debug("Fit of negative peaks elapsed = %f", t)
-                t0 = time.time()
-
-            # Return results as a dictionary
-            if outbuffer.saveData:
-                outbuffer.allocateMemory('data',
-                                     group='fit',
-                                     data=data,
-                                     dtype=dtypeResult,
-                                     chunks=True,
+        # Return results as a dictionary
+        dataAttrs = {}
+        if outbuffer.saveData and saveData:
+            outbuffer.allocateMemory('data',
+                                 group='fit',
+                                 data=data,
+                                 dtype=dtypeResult,
+                                 chunks=True,
+                                 dataAttrs=dataAttrs,
+                                 groupAttrs=fitAttrs,
+                                 memtype='hdf5')
+        if outbuffer.saveResiduals:
+            residuals = outbuffer.allocateMemory('residuals',
+                                             group='fit',
+                                             data=data,
+                                             dtype=dtypeResult,
+                                             chunks=True,
+                                             dataAttrs=dataAttrs,
+                                             groupAttrs=fitAttrs,
+                                             memtype='hdf5')
+            residuals[()] -= fitmodel
+
+        if concentrations:
+            t0 = time.time()
+            labels, concentrations = self._fitDeriveMassFractions(config=config,
+                                         freeNames=state['freeNames'],
+                                         nFreeBkg=state['nFreeBkg'],
+                                         results=results,
+                                         autotime=autotime,
+                                         liveTimeFactor=liveTimeFactor)
+            dataAttrs = {}  #{'units':'dimensionless'})
+            massfracAttrs = {'default': True}
+            outbuffer.allocateMemory('massfractions',
+                                     data=concentrations,
+                                     labels=labels,
                                      dataAttrs=dataAttrs,
-                                     groupAttrs=fitAttrs,
-                                     memtype='hdf5')
-            if outbuffer.saveResiduals:
-                residuals = outbuffer.allocateMemory('residuals',
-                                                 group='fit',
-                                                 data=data,
-                                                 dtype=dtypeResult,
-                                                 chunks=True,
-                                                 dataAttrs=dataAttrs,
-                                                 groupAttrs=fitAttrs,
-                                                 memtype='hdf5')
-                residuals[()] -= fitmodel
-
-            if concentrations:
-                t0 = time.time()
-                labels, concentrations = self._fitDeriveMassFractions(config=config,
-                                             nFreeBkg=nFreeBkg,
-                                             results=results,
-                                             autotime=autotime,
-                                             liveTimeFactor=liveTimeFactor)
-                dataAttrs = {}  #{'units':'dimensionless'})
-                massfracAttrs = {'default': True}
-                outbuffer.allocateMemory('massfractions',
-                                         data=concentrations,
-                                         labels=labels,
-                                         dataAttrs=dataAttrs,
-                                         groupAttrs=massfracAttrs,
-                                         memtype='ram')
-                t = time.time() - t0
-                _logger.debug("Calculation of concentrations elapsed = %f", t)
-            return outbuffer
+                                     groupAttrs=massfracAttrs,
+                                     memtype='ram')
+            t = time.time() - t0
+            _logger.debug("Calculation of concentrations elapsed = %f", t)
 
     @staticmethod
     def _fitParseData(x=None, y=None, livetime=None):
@@ -472,10 +841,45 @@ def _fitConfigure(self, configuration=None, concentrations=False,
         return configorg, config, weight, weightPolicy, \
                autotime, liveTimeFactor
 
-    def _fitReferenceSpectrum(self, data=None, mcaIndex=None, sumover='all'):
+    @staticmethod
+    def _fitParseMask(data=None, mcaIndex=None, mask=None):
+        """Boolean image of the pixels to be fitted
+
+        :param mask: boolean image or list of (flat) pixel indices
+        :returns: boolean array with the stack shape without the MCA
+                  axis or None when all pixels are to be fitted
+        """
+        if mask is None:
+            return None
+        imageShape = list(data.shape)
+        imageShape.pop(mcaIndex)
+        imageShape = tuple(imageShape)
+        mask = numpy.asarray(mask)
+        if mask.dtype == bool or (mask.ndim > 1 and mask.shape == imageShape):
+            if mask.shape != imageShape:
+                raise ValueError("Mask shape %s does not match the image "
+                                 "shape %s" % (mask.shape, imageShape))
+            mask = mask.astype(bool)
+        else:
+            indices = mask.astype(numpy.intp).reshape(-1)
+            mask = numpy.zeros(imageShape, dtype=bool)
+            mask.reshape(-1)[indices] = True
+        if mask.all():
+            return None
+        if not mask.any():
+            raise ValueError("No pixel selected")
+        return mask
+
+    def _fitReferenceSpectrum(self, data=None, mcaIndex=None, sumover='all',
+                              mask=None):
         """Get sum spectrum
         """
         dtype = self._fitDtypeCalculation(data)
+        if mask is not None:
+            return self._fitMaskedReferenceSpectrum(data=data,
+                                                    mcaIndex=mcaIndex,
+                                                    sumover=sumover,
+                                                    mask=mask)
         if sumover == 'all':
             nMca = 20, 'MB'
             _logger.debug('Add spectra in chunks of {}'.format(nMca))
@@ -503,11 +907,68 @@ def _fitReferenceSpectrum(self, data=None, mcaIndex=None, sumover='all'):
             yref = data[tuple(idx)].astype(dtype)
         return yref
 
+    def _fitMaskedReferenceSpectrum(self, data=None, mcaIndex=None,
+                                    sumover='all', mask=None):
+        """Get sum spectrum of the selected pixels
+        """
+        dtype = self._fitDtypeCalculation(data)
+        if sumover == 'all':
+            nMca = 20, 'MB'
+            datastack = McaStackView.MaskedView(data, mask=mask,
+                                                mcaAxis=mcaIndex, nMca=nMca)
+            yref = numpy.zeros((data.shape[mcaIndex],), dtype)
+            for key, chunk in datastack.items():
+                yref += chunk.sum(axis=0, dtype=dtype)
+            return yref
+        # First selected pixel
+        pixel = [int(i[0]) for i in mask.nonzero()]
+        if sumover == 'first vector':
+            # All selected pixels of its vector (last image dimension)
+            selected = mask[tuple(pixel[:-1])].nonzero()[0]
+            pixel[-1] = selected
+        else:
+            selected = None
+        ndim = data.ndim
+        while mcaIndex < 0:
+            mcaIndex += ndim
+        idx = list(pixel)
+        idx.insert(mcaIndex, slice(None))
+        yref = numpy.asarray(data[tuple(idx)], dtype=dtype)
+        if selected is not None:
+            yref = yref.sum(axis=int(mcaIndex < ndim - 1), dtype=dtype)
+        return yref
+
+    def _fitGetModel(self, config=None, dtype=None):
+        """Get linear model for fitting from the cache or create it
+        """
+        calibration = config['detector']['zero'], config['detector']['gain']
+        cache = self.modelCache
+        if cache is not None:
+            key = LinearModelCache.modelKey(config, self._mcaTheory.xdata,
+                                            calibration, dtype=dtype)
+            model = cache.get(key)
+            if model is not None:
+                _logger.debug("Use cached linear model %s", key)
+                self._modelEstimated = False
+                return model
+        derivatives, freeNames, nFree, nFreeBkg = self._fitCreateModel(dtype=dtype)
+        if cache is not None:
+            model = cache.set(key, derivatives, freeNames, nFreeBkg,
+                              calibration)
+        else:
+            model = {'derivatives': derivatives,
+                     'svd': numpy.linalg.svd(derivatives, full_matrices=False),
+                     'freeNames': freeNames,
+                     'nFreeBkg': nFreeBkg,
+                     'calibration': calibration}
+        return model
+
     def _fitCreateModel(self, dtype=None):
         """Get linear model for fitting
         """
         # Initialize the derivatives
         self._mcaTheory.estimate()
+        self._modelEstimated = True
 
         # now we can get the derivatives respect to the free parameters
         # These are the "derivatives" respect to the peaks
@@ -607,61 +1068,170 @@ def _dataChunkIter(self, slicecls, data=None, fitmodel=None, **kwargs):
             chunkItems = McaStackView.izipChunkItems(chunkItems, modeliter)
         return chunkItems
 
-    def _fitLstSqAll(self, data=None, sliceChan=None, mcaIndex=None,
-                     derivatives=None, results=None, uncertainties=None,
-                     fitmodel=None, config=None, anchorslist=None,
-                     lstsq_kwargs=None):
+    @staticmethod
+    def _fitNumberOfWorkers(nworkers):
+        """Number of threads used for fitting the chunks of a stack
         """
-        Fit all spectra
+        if not nworkers or ThreadPoolExecutor is None:
+            return 1
+        if nworkers < 0:
+            nworkers = os.cpu_count() or 1
+        return max(int(nworkers), 1)
+
+    def _fitChunks(self, slicecls, saveResult, data=None, fitmodel=None,
+                   derivatives=None, config=None, anchorslist=None,
+                   lstsq_kwargs=None, nworkers=None, **kwargs):
         """
-        nChan, nFree = derivatives.shape
-        bkgsub = bool(config['fit']['stripflag'])
+        Fit all chunks of a stack view. Chunks are distributed over a pool
+        of threads when more than one worker is requested (numpy releases
+        the GIL in the linear algebra routines). The first chunk is always
+        fitted in the calling thread so that the SVD of the model matrix is
+        shared read-only by all workers.
+
+        :param slicecls: McaStackView.FullView or McaStackView.MaskedView
+        :param callable saveResult: saveResult(idx, idxShape, ddict)
+        :param int nworkers: number of threads (negative: number of cores)
+        :param **kwargs: see slicecls
+        """
+        fitkwargs = {'derivatives': derivatives,
+                     'config': config,
+                     'anchorslist': anchorslist,
+                     'lstsq_kwargs': lstsq_kwargs}
+        nworkers = self._fitNumberOfWorkers(nworkers)
+        if nworkers == 1:
+            chunkItems = self._dataChunkIter(slicecls, data=data,
+                                             fitmodel=fitmodel, **kwargs)
+            for chunk in chunkItems:
+                if fitmodel is None:
+                    (idx, idxShape), chunk = chunk
+                    chunkModel = None
+                else:
+                    ((idx, idxShape), chunk), (_, chunkModel) = chunk
+                    chunkModel = chunkModel.T
+                ddict = self._fitLstSqChunk(chunk.T, fitmodel=chunkModel,
+                                            **fitkwargs)
+                lstsq_kwargs['last_svd'] = ddict.get('svd', None)
+                saveResult(idx, idxShape, ddict)
+            return
 
-        nMca = 1, 'MB'
-        _logger.debug('Fit spectra in chunks of {}'.format(nMca))
-        chunkItems = self._dataChunkIter(McaStackView.FullView,
-                                         data=data,
-                                         fitmodel=fitmodel,
-                                         mcaSlice=sliceChan,
-                                         mcaAxis=mcaIndex,
-                                         nMca=nMca)
-        for chunk in chunkItems:
-            if fitmodel is None:
-                (idx, idxShape), chunk = chunk
+        _logger.debug('Fit chunks with {} threads'.format(nworkers))
+        chunkItems = self._dataChunkIter(slicecls, data=data, **kwargs)
+        if fitmodel is None:
+            modelItems = None
+        else:
+            dtype = self._fitDtypeResult(data)
+            modelstack = slicecls(fitmodel, dtype=dtype,
+                                  readonly=False, **kwargs)
+            modelItems = modelstack.items()
+
+        def fitChunk(idx, idxShape, chunk):
+            # chunk: private copy of the view buffer (nMca x nChan)
+            if modelItems is None:
                 chunkModel = None
+                ddict = self._fitLstSqChunk(chunk.T, **fitkwargs)
             else:
-                ((idx, idxShape), chunk), (_, chunkModel) = chunk
-                chunkModel = chunkModel.T
-            chunk = chunk.T
+                chunkModel = numpy.zeros_like(chunk)
+                ddict = self._fitLstSqChunk(chunk.T, fitmodel=chunkModel.T,
+                                            **fitkwargs)
+            saveResult(idx, idxShape, ddict)
+            return ddict, chunkModel
+
+        def collect(result):
+            # Results are collected in submission order so that the model
+            # chunks correspond with the chunks of the model view
+            ddict, chunkModel = result
+            if modelItems is not None:
+                _, bufferModel = next(modelItems)
+                bufferModel[()] = chunkModel
+            return ddict
+
+        maxPending = 2 * nworkers
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=nworkers) as pool:
+            for (idx, idxShape), chunk in chunkItems:
+                # the view buffer is reused for the next chunk
+                chunk = chunk.copy()
+                if lstsq_kwargs.get('last_svd', None) is None and not pending:
+                    # SVD to be shared by all workers
+                    ddict = collect(fitChunk(idx, idxShape, chunk))
+                    lstsq_kwargs['last_svd'] = ddict.get('svd', None)
+                    continue
+                pending.append(pool.submit(fitChunk, idx, idxShape, chunk))
+                if len(pending) >= maxPending:
+                    collect(pending.popleft().result())
+            while pending:
+                collect(pending.popleft().result())
+        if modelItems is not None:
+            # write the last model chunk
+            next(modelItems, None)
+
+    def _fitLstSqChunk(self, chunk, fitmodel=None, derivatives=None,
+                       config=None, anchorslist=None, lstsq_kwargs=None):
+        """
+        Fit one chunk of spectra (nChan x nMca). The background is subtracted
+        from the chunk in-place.
+        """
+        bkgsub = bool(config['fit']['stripflag'])
+
+        # Subtract background
+        if bkgsub:
+            self._fitBkgSubtract(chunk, config=config,
+                                 anchorslist=anchorslist,
+                                 fitmodel=fitmodel)
 
-            # Subtract background
+        # Solve linear system of equations
+        ddict = lstsq(derivatives, chunk, digested_output=True,
+                      **lstsq_kwargs)
+
+        if fitmodel is not None:
             if bkgsub:
-                self._fitBkgSubtract(chunk, config=config,
-                                     anchorslist=anchorslist,
-                                     fitmodel=chunkModel)
+                fitmodel += numpy.dot(derivatives, ddict['parameters'])
+            else:
+                fitmodel[()] = numpy.dot(derivatives, ddict['parameters'])
+        return ddict
 
-            # Solve linear system of equations
-            ddict = lstsq(derivatives, chunk, digested_output=True,
-                          **lstsq_kwargs)
-            lstsq_kwargs['last_svd'] = ddict.get('svd', None)
+    def _fitLstSqAll(self, data=None, sliceChan=None, mcaIndex=None,
+                     derivatives=None, results=None, uncertainties=None,
+                     fitmodel=None, config=None, anchorslist=None,
+                     lstsq_kwargs=None, nworkers=None, mask=None):
+        """
+        Fit all spectra (only the selected ones when a mask is given)
+        """
+        nChan, nFree = derivatives.shape
 
-            # Save results
+        def saveResult(idx, idxShape, ddict):
             idx = (slice(None),) + idx
             idxShape = (nFree,) + idxShape
             results[idx] = ddict['parameters'].reshape(idxShape)
             uncertainties[idx] = ddict['uncertainties'].reshape(idxShape)
-            if chunkModel is not None:
-                if bkgsub:
-                    chunkModel += numpy.dot(derivatives, ddict['parameters'])
-                else:
-                    chunkModel[()] = numpy.dot(derivatives, ddict['parameters'])
+
+        nMca = 1, 'MB'
+        _logger.debug('Fit spectra in chunks of {}'.format(nMca))
+        if mask is None:
+            slicecls = McaStackView.FullView
+            viewkwargs = {}
+        else:
+            slicecls = McaStackView.MaskedView
+            viewkwargs = {'mask': mask}
+        self._fitChunks(slicecls, saveResult,
+                        data=data,
+                        fitmodel=fitmodel,
+                        derivatives=derivatives,
+                        config=config,
+                        anchorslist=anchorslist,
+                        lstsq_kwargs=lstsq_kwargs,
+                        nworkers=nworkers,
+                        mcaSlice=sliceChan,
+                        mcaAxis=mcaIndex,
+                        nMca=nMca,
+                        **viewkwargs)
 
     def _fitLstSqReduced(self, data=None, sliceChan=None, mcaIndex=None,
                          derivatives=None, results=None, uncertainties=None,
                          fitmodel=None, config=None, anchorslist=None,
                          lstsq_kwargs=None, mask=None,
                          skipNames=None, skipParams=None,
-                         nFreeParameters=None, nmin=None):
+                         nFreeParameters=None, nmin=None, nworkers=None):
         """
         Fit reduced number of spectra (mask) with a reduced model (skipped parameters will be set to zero)
         """
@@ -683,37 +1253,14 @@ def _fitLstSqReduced(self, data=None, sliceChan=None, mcaIndex=None,
             nFree = len(idxFree)
             A = derivatives[:, idxFree]
             lstsq_kwargs['last_svd'] = None
-
-            # Fit all selected spectra in one chunk
-            bkgsub = bool(config['fit']['stripflag'])
-            chunkItems = self._dataChunkIter(McaStackView.MaskedView,
-                                             data=data,
-                                             fitmodel=fitmodel,
-                                             mask=mask,
-                                             mcaSlice=sliceChan,
-                                             mcaAxis=mcaIndex,
-                                             nMca=nMca)
-            for chunk in chunkItems:
-                if fitmodel is None:
-                    (idx, idxShape), chunk = chunk
-                    chunkModel = None
-                else:
-                    ((idx, idxShape), chunk), (_, chunkModel) = chunk
-                    chunkModel = chunkModel.T
-                chunk = chunk.T
-
-                # Subtract background
-                if bkgsub:
-                    self._fitBkgSubtract(chunk, config=config,
-                                         anchorslist=anchorslist,
-                                         fitmodel=chunkModel)
-
-                # Solve linear system of equations
-                ddict = lstsq(A, chunk, digested_output=True,
-                              **lstsq_kwargs)
-                lstsq_kwargs['last_svd'] = ddict.get('svd', None)
-
-                # Save results
+            if numpy.ndim(lstsq_kwargs.get('uncertainties', True)):
+                # requested uncertainties in terms of the reduced model
+                lstsq_kwargs = dict(lstsq_kwargs)
+                lstsq_kwargs['uncertainties'] = \
+                            [idxFree.index(i) for i in lstsq_kwargs['uncertainties']
+                             if i in idxFree]
+
+            def saveResult(idx, idxShape, ddict):
                 iParam = 0
                 for iFree in range(nFreeOrg):
                     if iFree in skipParams:
@@ -725,14 +1272,23 @@ def _fitLstSqReduced(self, data=None, sliceChan=None, mcaIndex=None,
                         uncertainties[iFree][idx] = ddict['uncertainties'][iParam]\
                                                 .reshape(idxShape)
                         iParam += 1
-                if chunkModel is not None:
-                    if bkgsub:
-                        chunkModel += numpy.dot(A, ddict['parameters'])
-                    else:
-                        chunkModel[()] = numpy.dot(A, ddict['parameters'])
                 if nFreeParameters is not None:
                     nFreeParameters[idx] = nFree
 
+            # Fit all selected spectra in chunks
+            self._fitChunks(McaStackView.MaskedView, saveResult,
+                            data=data,
+                            fitmodel=fitmodel,
+                            derivatives=A,
+                            config=config,
+                            anchorslist=anchorslist,
+                            lstsq_kwargs=lstsq_kwargs,
+                            nworkers=nworkers,
+                            mask=mask,
+                            mcaSlice=sliceChan,
+                            mcaAxis=mcaIndex,
+                            nMca=nMca)
+
     @staticmethod
     def _fitDtypeResult(data):
         if data.dtype not in [numpy.float32, numpy.float64]:
@@ -755,26 +1311,15 @@ def _fitDtypeCalculation(data):
     def _fitBkgSubtract(spectra, config=None, anchorslist=None, fitmodel=None):
         """Subtract brackground from data and add it to fit model
         """
-        for k in range(spectra.shape[1]):
-            # obtain the smoothed spectrum
-            background = SpecfitFuns.SavitskyGolay(spectra[:, k],
-                                    config['fit']['stripfilterwidth'])
-            lastAnchor = 0
-            for anchor in anchorslist:
-                if (anchor > lastAnchor) and (anchor < background.size):
-                    background[lastAnchor:anchor] =\
-                            SpecfitFuns.snip1d(background[lastAnchor:anchor],
-                                               config['fit']['snipwidth'],
-                                               0)
-                    lastAnchor = anchor
-            if lastAnchor < background.size:
-                background[lastAnchor:] =\
-                        SpecfitFuns.snip1d(background[lastAnchor:],
-                                           config['fit']['snipwidth'],
-                                           0)
-            spectra[:, k] -= background
-            if fitmodel is not None:
-                fitmodel[:, k] = background
+        # all spectra (columns) are processed in one call without the GIL
+        background = SpecfitFuns.stripbackground(spectra,
+                                                 config['fit']['snipwidth'],
+                                                 0,
+                                                 config['fit']['stripfilterwidth'],
+                                                 anchorslist)
+        spectra -= background
+        if fitmodel is not None:
+            fitmodel[()] = background
 
     def _fitLstSqNegative(self, data=None, freeNames=None, nFreeBkg=None,
                           results=None, **kwargs):
@@ -838,8 +1383,8 @@ def _fitLstSqNegative(self, data=None, freeNames=None, nFreeBkg=None,
                                   nmin=nmin, **kwargs)
             iIter += 1
 
-    def _fitDeriveMassFractions(self, config=None, results=None, nFreeBkg=None,
-                                autotime=None, liveTimeFactor=None):
+    def _fitDeriveMassFractions(self, config=None, results=None, freeNames=None,
+                                nFreeBkg=None, autotime=None, liveTimeFactor=None):
         """Calculate concentrations from peak areas
         """
         # check if an internal reference is used and if it is set to auto
@@ -859,6 +1404,10 @@ def _fitDeriveMassFractions(self, config=None, results=None, nFreeBkg=None,
 
         fitresult = {}
         if fitreference:
+            if not self._modelEstimated:
+                # the linear model was taken from the cache
+                self._mcaTheory.estimate()
+                self._modelEstimated = True
             # we have to fit the "reference" spectrum just to get the reference element
             mcafitresult = self._mcaTheory.startfit(digest=0, linear=True)
             # if one of the elements has zero area this cannot be made directly
@@ -879,21 +1428,14 @@ def _fitDeriveMassFractions(self, config=None, results=None, nFreeBkg=None,
             fitresult['result'] = {}
             fitresult['result']['config'] = config
             fitresult['result']['groups'] = []
-            idx = 0
-            for iParam, param in enumerate(self._mcaTheory.PARAMETERS):
-                if self._mcaTheory.codes[0][iParam] == Gefit.CFIXED:
-                    continue
-                if iParam < self._mcaTheory.NGLOBAL:
-                    # background
-                    pass
-                else:
-                    fitresult['result']['groups'].append(param)
-                    fitresult['result'][param] = {}
-                    # we are just interested on the factor to be applied to the area to get the
-                    # concentrations
-                    fitresult['result'][param]['fitarea'] = 1.0
-                    fitresult['result'][param]['sigmaarea'] = 1.0
-                idx += 1
+            # free parameters after the background parameters are peak areas
+            for param in freeNames[nFreeBkg:]:
+                fitresult['result']['groups'].append(param)
+                fitresult['result'][param] = {}
+                # we are just interested on the factor to be applied to the area to get the
+                # concentrations
+                fitresult['result'][param]['fitarea'] = 1.0
+                fitresult['result'][param]['sigmaarea'] = 1.0
         concentrationsResult, addInfo = cTool.processFitResult(config=cToolConf,
                                                 fitresult=fitresult,
                                                 elementsfrommatrix=False,
@@ -1052,7 +1594,8 @@ def main():
                    'tif=', 'edf=', 'csv=', 'h5=', 'dat=',
                    'filepattern=', 'begin=', 'end=', 'increment=',
                    'outroot=', 'outentry=', 'outprocess=',
-                   'diagnostics=', 'debug=', 'overwrite=', 'multipage=']
+                   'diagnostics=', 'debug=', 'overwrite=', 'multipage=',
+                   'nworkers=', 'modelcache=']
     try:
         opts, args = getopt.getopt(
                      sys.argv[1:],
@@ -1082,6 +1625,8 @@ def main():
     debug = 0
     overwrite = 1
     multipage = 0
+    nworkers = None
+    modelcache = None
     for opt, arg in opts:
         if opt == '--cfg':
             configurationFile = arg
@@ -1135,6 +1680,10 @@ def main():
             overwrite = int(arg)
         elif opt == '--multipage':
             multipage = int(arg)
+        elif opt == '--nworkers':
+            nworkers = int(arg)
+        elif opt == '--modelcache':
+            modelcache = LinearModelCache.LinearModelCache(filename=arg)
 
     logging.basicConfig()
     if debug:
@@ -1161,7 +1710,7 @@ def main():
         print("RESULTS WILL NOT BE SAVED: No output directory specified")
 
     t0 = time.time()
-    fastFit = FastXRFLinearFit()
+    fastFit = FastXRFLinearFit(modelcache=modelcache)
     fastFit.setFitConfigurationFile(configurationFile)
     print("Main configuring Elapsed = % s " % (time.time() - t0))
 
@@ -1182,7 +1731,8 @@ def main():
                                                 weight=weight,
                                                 refit=refit,
                                                 concentrations=concentrations,
-                                                outbuffer=outbuffer)
+                                                outbuffer=outbuffer,
+                                                nworkers=nworkers)
         print("Total Elapsed = % s " % (time.time() - t0))
 
 
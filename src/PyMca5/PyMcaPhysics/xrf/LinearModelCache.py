@@ -0,0 +1,249 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2026 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__doc__ = """
+Cache of the linear XRF models used by the fast linear fit.
+
+A model is the matrix of derivatives with respect to the free parameters
+together with its singular value decomposition. It only depends on the
+fit configuration, the fitted channels and the energy calibration, so it
+can be reused when fitting many maps with the same configuration.
+"""
+import hashlib
+import logging
+import threading
+import collections
+import numpy
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+_logger = logging.getLogger(__name__)
+
+
+def _updateHash(hasher, obj):
+    """Feed a canonical representation of obj to the hasher
+    """
+    if isinstance(obj, dict):
+        hasher.update(b"{")
+        for key in sorted(obj.keys(), key=str):
+            _updateHash(hasher, str(key))
+            hasher.update(b":")
+            _updateHash(hasher, obj[key])
+        hasher.update(b"}")
+    elif isinstance(obj, (list, tuple)):
+        hasher.update(b"[")
+        for item in obj:
+            _updateHash(hasher, item)
+            hasher.update(b",")
+        hasher.update(b"]")
+    elif isinstance(obj, numpy.ndarray):
+        hasher.update(str(obj.dtype).encode())
+        hasher.update(str(obj.shape).encode())
+        hasher.update(numpy.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, bytes):
+        hasher.update(obj)
+    else:
+        hasher.update(repr(obj).encode())
+
+
+def modelKey(config, xdata, calibration, dtype=None):
+    """
+    Hash identifying a linear model
+
+    :param dict config: fit configuration
+    :param array xdata: fitted channels
+    :param tuple calibration: zero and gain
+    :param dtype: dtype of the derivatives
+    :returns str:
+    """
+    hasher = hashlib.sha1()
+    _updateHash(hasher, config)
+    _updateHash(hasher, numpy.asarray(xdata, dtype=numpy.float64).ravel())
+    _updateHash(hasher, [float(x) for x in calibration])
+    _updateHash(hasher, str(numpy.dtype(dtype)))
+    return hasher.hexdigest()
+
+
+class LinearModelCache(object):
+    """
+    Least-recently-used cache of linear models with an optional HDF5 store.
+
+    A model is a dictionary with the keys 'derivatives' (nChannels x nFree),
+    'svd' (U, s, V), 'freeNames', 'nFreeBkg' and 'calibration'. The arrays
+    are shared by all the users of the model and therefore read-only.
+
+    The key of a model only covers the fit configuration, the channels and
+    the calibration, so the cache has to be cleared when anything else
+    used to build the models changes (e.g. user defined materials or the
+    cross-section database).
+    """
+
+    def __init__(self, maxsize=8, filename=None):
+        """
+        :param int maxsize: maximal number of models kept in memory
+        :param str filename: HDF5 file to store the models (optional)
+        """
+        self.maxsize = maxsize
+        self.filename = filename
+        self._models = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._models)
+
+    def __contains__(self, key):
+        return key in self._models or self._h5contains(key)
+
+    def clear(self):
+        """Clear the in-memory cache (the HDF5 store is not modified)
+        """
+        with self._lock:
+            self._models.clear()
+
+    def get(self, key):
+        """
+        :param str key: see modelKey
+        :returns dict or None:
+        """
+        with self._lock:
+            model = self._models.get(key, None)
+            if model is not None:
+                self._models.move_to_end(key)
+                _logger.debug("Linear model %s found in memory", key)
+                return self._copy(model)
+        model = self._h5get(key)
+        if model is not None:
+            _logger.debug("Linear model %s loaded from %s", key, self.filename)
+            model = self._add(key, model)
+        return model
+
+    def set(self, key, derivatives, freeNames, nFreeBkg, calibration,
+            svd=None):
+        """
+        Add a model to the cache (and to the HDF5 store when defined)
+
+        :param str key: see modelKey
+        :param array derivatives: nChannels x nFree
+        :param list freeNames:
+        :param int nFreeBkg: number of free background parameters
+        :param tuple calibration: zero and gain
+        :param tuple svd: U, s, V of the derivatives (calculated when None)
+        :returns dict: model
+        """
+        if svd is None:
+            svd = numpy.linalg.svd(numpy.asarray(derivatives,
+                                                 dtype=numpy.float64),
+                                   full_matrices=False)
+        model = {"derivatives": derivatives,
+                 "svd": tuple(svd),
+                 "freeNames": list(freeNames),
+                 "nFreeBkg": int(nFreeBkg),
+                 "calibration": tuple(float(x) for x in calibration)}
+        self._h5set(key, model)
+        return self._add(key, model)
+
+    def _add(self, key, model):
+        model["derivatives"] = self._readOnly(model["derivatives"])
+        model["svd"] = tuple(self._readOnly(x) for x in model["svd"])
+        with self._lock:
+            self._models[key] = model
+            self._models.move_to_end(key)
+            while len(self._models) > max(self.maxsize, 0):
+                self._models.popitem(last=False)
+        return self._copy(model)
+
+    @staticmethod
+    def _readOnly(array):
+        array = numpy.array(array, copy=True)
+        array.setflags(write=False)
+        return array
+
+    @staticmethod
+    def _copy(model):
+        """The arrays are read-only, the containers are copied
+        """
+        model = dict(model)
+        model["freeNames"] = list(model["freeNames"])
+        return model
+
+    def _h5contains(self, key):
+        if not self.filename or h5py is None:
+            return False
+        try:
+            with h5py.File(self.filename, "r") as f:
+                return key in f
+        except (IOError, OSError):
+            return False
+
+    def _h5get(self, key):
+        if not self.filename or h5py is None:
+            return None
+        try:
+            with h5py.File(self.filename, "r") as f:
+                if key not in f:
+                    return None
+                group = f[key]
+                freeNames = [x.decode() if hasattr(x, "decode") else x
+                             for x in group["freeNames"][()]]
+                return {"derivatives": group["derivatives"][()],
+                        "svd": (group["U"][()], group["s"][()],
+                                group["V"][()]),
+                        "freeNames": freeNames,
+                        "nFreeBkg": int(group.attrs["nFreeBkg"]),
+                        "calibration": tuple(group.attrs["calibration"])}
+        except (IOError, OSError):
+            _logger.warning("Cannot read linear model from %s",
+                            self.filename)
+            return None
+
+    def _h5set(self, key, model):
+        if not self.filename or h5py is None:
+            return
+        try:
+            with h5py.File(self.filename, "a") as f:
+                if key in f:
+                    del f[key]
+                group = f.create_group(key)
+                group["derivatives"] = model["derivatives"]
+                U, s, V = model["svd"]
+                group["U"] = U
+                group["s"] = s
+                group["V"] = V
+                group["freeNames"] = numpy.array([x.encode()
+                                                  for x in model["freeNames"]])
+                group.attrs["nFreeBkg"] = model["nFreeBkg"]
+                group.attrs["calibration"] = model["calibration"]
+        except (IOError, OSError):
+            _logger.warning("Cannot save linear model to %s", self.filename)
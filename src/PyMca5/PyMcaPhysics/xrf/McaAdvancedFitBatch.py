@@ -34,6 +34,7 @@
 import os
 import time
 import logging
+import collections
 import numpy
 from . import ClassMcaTheory
 from PyMca5.PyMcaCore import SpecFileLayer
@@ -57,6 +58,12 @@
 
 _logger = logging.getLogger(__name__)
 
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    _logger.info("Cannot import ProcessPoolExecutor")
+    ProcessPoolExecutor = None
+
 
 def getRootName(filelist=None):
     if filelist is None:
@@ -117,8 +124,8 @@ def __init__(self, initdict, filelist=None, outputdir=None,
                  filebeginoffset=0, fileendoffset=0,
                  mcaoffset=0, chunk=None,
                  selection=None, lock=None, nosave=None,
-                 quiet=False, outbuffer=None,
-                 **outbufferkwargs):
+                 quiet=False, outbuffer=None, nproc=None,
+                 warmstart=False, **outbufferkwargs):
         """
         Range of filelist indices to be processed:
 
@@ -132,6 +139,16 @@ def __init__(self, initdict, filelist=None, outputdir=None,
 
             range(mcaoffset, nColumns, mcastep)
 
+        The spectra of a stack (e.g. one HDF5 file) are fitted by `nproc`
+        worker processes when `nproc > 1`. The results are gathered in
+        the output buffer of this instance. Fitting of ROIs, FIT files and
+        multiple configurations require a single process.
+
+        With `warmstart` the fit of a spectrum starts from the fitted
+        parameters of its left neighbour (or of the first spectrum of the
+        previous row for the first spectrum of a row) instead of estimating
+        them. Compare with the number of iterations of each fit, which is
+        part of the diagnostics.
         """
         #for the time being the concentrations are bound to the .fit files
         #that is not necessary, but it will be correctly implemented in
@@ -157,6 +174,10 @@ def __init__(self, initdict, filelist=None, outputdir=None,
         self.mcaStep = mcastep
         self.mcaOffset = mcaoffset
         self.chunk = chunk
+        self.nproc = nproc
+        self.warmStart = warmstart
+        self._warmParameters = None
+        self._warmRowParameters = None
 
         if isinstance(initdict, list):
             self.mcafit = ClassMcaTheory.McaTheory(initdict[mcaoffset])
@@ -451,11 +472,16 @@ def __processStack(self):
         for i in range(nrows):
             keylist[i] = "1.%04d" % i
 
+        if self._useProcessPool():
+            self.__processStackInPool(keylist, mcaIndices, xStack)
+            return
+
         for i in range(nrows):
             if self.pleaseBreak:
                 break
             self.onImage(keylist[i], keylist)
             self.__row = i
+            self._warmStartNextRow()
             try:
                 cache_data = data[i, :, :]
             except Exception:
@@ -491,6 +517,115 @@ def __processStack(self):
                 self.onMca(imca, nmcaToFit, filename=filename,
                            key=key, info=infoDict)
 
+    def _useProcessPool(self):
+        """Fit the spectra of a stack with a pool of processes
+        """
+        if not self.nproc or self.nproc < 2:
+            return False
+        if ProcessPoolExecutor is None:
+            reason = "no process pool available"
+        elif self.roiFit:
+            reason = "ROI fitting"
+        elif self.fitFiles:
+            reason = "FIT files requested"
+        elif len(self.__configList) > 1:
+            reason = "multiple configurations"
+        else:
+            return True
+        _logger.warning("Fitting in a single process (%s)", reason)
+        return False
+
+    def __processStackInPool(self, keylist, mcaIndices, xStack):
+        """
+        Fit spectra from one file, which corresponds to the spectra
+        from the entire image, with a pool of processes. One task
+        is one row of the image.
+        """
+        stack = self.filehandle
+        info = stack.info
+        data = stack.data
+        nmcaToFit = len(mcaIndices)
+        filename = os.path.basename(info['SourceName'][0])
+        if xStack is None:
+            if 'MCA start ch' in info:
+                xmin = float(info['MCA start ch'])
+            else:
+                xmin = 0.0
+            x = numpy.arange(data.shape[-1])*1.0 + xmin
+        else:
+            x = xStack
+
+        # Workers compute the same results as this instance
+        # but do not save anything
+        config = self.__configList[self.__currentConfig]
+        if self.outbuffer is None:
+            bufferkwargs = None
+        else:
+            bufferkwargs = {'saveFit': self.outbuffer.saveFit,
+                            'saveData': self.outbuffer.saveData,
+                            'saveResiduals': self.outbuffer.saveResiduals}
+        batchkwargs = {'concentrations': self._concentrations,
+                       'outputdir': self.outputdir,
+                       'warmstart': self.warmStart}
+
+        def collect(item):
+            i, keys, infos, spectra, future = item
+            self.__row = i
+            for imca, (mcaIndex, key, infoDict, y0, (result, concentrations)) in \
+                    enumerate(zip(mcaIndices, keys, infos, spectra, future.result())):
+                self.__col = mcaIndex
+                if self.fitConcFile:
+                    self._updateConcFile(concentrations, filename, key)
+                self.__storeOneMcaFitResult(y0, result, concentrations)
+                self.counter += 1
+                self.onMca(imca, nmcaToFit, filename=filename,
+                           key=key, info=infoDict)
+
+        _logger.info("Fitting with %d processes", self.nproc)
+        maxPending = 2 * self.nproc
+        pending = collections.deque()
+        with ProcessPoolExecutor(max_workers=self.nproc,
+                                 initializer=_initPixelFitWorker,
+                                 initargs=(config, batchkwargs, bufferkwargs)) as pool:
+            for i in range(self.__nrows):
+                if self.pleaseBreak:
+                    break
+                self.onImage(keylist[i], keylist)
+                try:
+                    cache_data = data[i, :, :]
+                except Exception:
+                    _logger.error("Error reading dataset row %d" % i)
+                    _logger.error(str(sys.exc_info()))
+                    _logger.error("Batch resumed")
+                    continue
+                spectra = numpy.array(cache_data[mcaIndices, :])
+                keys = ["%s.%04d" % (keylist[i], mcaIndex)
+                        for mcaIndex in mcaIndices]
+                infos = []
+                for mcaIndex, key in zip(mcaIndices, keys):
+                    infoDict = {}
+                    infoDict['SourceName'] = info['SourceName']
+                    infoDict['Key'] = key
+                    if "McaLiveTime" in info:
+                        infoDict["McaLiveTime"] = \
+                                info["McaLiveTime"][i * self.__ncols + mcaIndex]
+                    infos.append(infoDict)
+                if self.outbuffer is not None and \
+                   not self.outbuffer.hasAllocatedMemory():
+                    # the output buffers need the fit limits
+                    self._attemptMcaLoad(x, spectra[0], filename, info=infos[0])
+                future = pool.submit(_fitPixelBlock, x, spectra, filename,
+                                     keys, infos)
+                pending.append((i, keys, infos, spectra, future))
+                if len(pending) >= maxPending:
+                    collect(pending.popleft())
+            if self.pleaseBreak:
+                for item in pending:
+                    item[-1].cancel()
+                pending.clear()
+            while pending:
+                collect(pending.popleft())
+
     def __processOneFile(self):
         """
         Fit spectra from one file, which corresponds to the spectra
@@ -500,6 +635,7 @@ def __processOneFile(self):
         fileinfo = ffile.GetSourceInfo()
         if self.counter == 0:
             self.__nMcaPerScan = None
+        self._warmStartNextRow()
 
         # In case of multiple scans:
         # assume they have the same number of spectra
@@ -667,23 +803,28 @@ def __processOneMca(self,x,y,filename,key,info=None):
                     self._allocateMemoryRoiFit(result)
                 self._storeRoiFitResult(result)
         else:
-            result, concentrations = self.__fitOneMca(x,y,filename,key,info=info)
-            if bOutput and result is not None:
-                result['ydata0'] = y
-                if not self.outbuffer.hasAllocatedMemory():
-                    if self._concentrations and (concentrations is None):
-                        # if concentrations were requested but unsuccessful on the first MCA
-                        # the memory allocation crashes the program
-                        _logger.error("Cannot allocate memory due to error on concentrations")
-                    else:
-                        self._allocateMemoryFit(result, concentrations)
-                        self._storeFitResult(result, concentrations)
-                        _logger.info("Memory allocated")
+            result, concentrations = self._fitOneMca(x,y,filename,key,info=info)
+            self.__storeOneMcaFitResult(y, result, concentrations)
+        self.counter += 1
+
+    def __storeOneMcaFitResult(self, y, result, concentrations):
+        bOutput = self.outbuffer is not None and \
+                  self.__ncols and self.__nrows
+        if bOutput and result is not None:
+            result['ydata0'] = y
+            if not self.outbuffer.hasAllocatedMemory():
+                if self._concentrations and (concentrations is None):
+                    # if concentrations were requested but unsuccessful on the first MCA
+                    # the memory allocation crashes the program
+                    _logger.error("Cannot allocate memory due to error on concentrations")
                 else:
+                    self._allocateMemoryFit(result, concentrations)
                     self._storeFitResult(result, concentrations)
-        self.counter += 1
+                    _logger.info("Memory allocated")
+            else:
+                self._storeFitResult(result, concentrations)
 
-    def __fitOneMca(self,x,y,filename,key,info=None):
+    def _fitOneMca(self,x,y,filename,key,info=None):
         fitresult = None
         result = None
         concentrations = None
@@ -770,7 +911,8 @@ def _fitMca(self, filename):
         concentrations = None
         fitresult = None
         try:
-            self.mcafit.estimate()
+            if not self._warmStartFit():
+                self.mcafit.estimate()
             # Avoid digest=1 when possible (slow but more detailed information)
             digest = self.fitFiles or\
                      (self._concentrations and (self.mcafit._fluoRates is None))
@@ -809,8 +951,37 @@ def _fitMca(self, filename):
                 fitresult = self.mcafit.startfit(digest=0)
         except Exception:
             self._restoreFitConfig(filename, 'fitting data')
+        if self.warmStart:
+            self._warmStartUpdate(fitresult)
         return fitresult, result, concentrations
 
+    def _warmStartFit(self):
+        """Seed the next fit with the parameters of a neighbouring spectrum
+
+        :returns bool: False when the parameters have to be estimated
+        """
+        if not self.warmStart or self._warmParameters is None:
+            return False
+        if self.mcafit.config['fit'].get("strategyflag", False):
+            # the configuration may change from one spectrum to the next
+            return False
+        return self.mcafit.setStartingParameters(self._warmParameters)
+
+    def _warmStartUpdate(self, fitresult):
+        if fitresult:
+            self._warmParameters = self.mcafit.fittedpar
+            if self._warmRowParameters is None:
+                self._warmRowParameters = self._warmParameters
+        else:
+            self._warmParameters = None
+
+    def _warmStartNextRow(self):
+        """The first spectrum of a row starts from the first spectrum
+        of the previous row
+        """
+        self._warmParameters = self._warmRowParameters
+        self._warmRowParameters = None
+
     def _concentrationsFromResult(self, fitresult, result):
         if fitresult:
             fitresult0 = {}
@@ -984,6 +1155,14 @@ def _allocateMemoryFit(self, result, concentrations):
                                          dataAttrs=None,
                                          groupAttrs=None,
                                          memtype='ram')
+                outbuffer.allocateMemory('niter',
+                                         group='diagnostics',
+                                         shape=imageShape,
+                                         fill_value=0,
+                                         dtype=numpy.int32,
+                                         dataAttrs=None,
+                                         groupAttrs=None,
+                                         memtype='ram')
             dataAttrs = {} #{'units':'counts'}
             fitAttrs = {}
             if outbuffer.saveDataDiagnostics:
@@ -1066,6 +1245,7 @@ def _storeFitResult(self, result, concentrations):
         if outbuffer.diagnostics:
             if outbuffer.saveFOM:
                 outbuffer['chisq'][self.__row, self.__col] = result['chisq']
+                outbuffer['niter'][self.__row, self.__col] = result.get('niter', 0)
             idx = self.__row, self.__col, self._mcaIdx
             idxall = self.__row, self.__col, slice(None)
             if outbuffer.saveFit:
@@ -1106,6 +1286,45 @@ def _storeRoiFitResult(self, result):
             output[i, self.__row, self.__col] = result[group][roi+' ROI']
 
 
+# McaAdvancedFitBatch instance of a worker process
+_workerBatch = None
+
+
+def _initPixelFitWorker(config, batchkwargs, bufferkwargs):
+    """Initializer of the worker processes of McaAdvancedFitBatch
+
+    :param str config: fit configuration file
+    """
+    global _workerBatch
+    if bufferkwargs is None:
+        outbuffer = None
+    else:
+        outbuffer = OutputBuffer(nosave=True, **bufferkwargs)
+    _workerBatch = McaAdvancedFitBatch(config, fitfiles=0, fitconcfile=0,
+                                       fitimages=0, quiet=True, nosave=True,
+                                       outbuffer=outbuffer, **batchkwargs)
+    _workerBatch.mcafit.enableOptimizedLinearFit()
+
+
+def _fitPixelBlock(x, spectra, filename, keys, infos):
+    """Fit a block of spectra in a worker process
+
+    :returns list: (result, concentrations) for each spectrum
+    """
+    # a block is a row: do not depend on the rows done by this worker before
+    _workerBatch._warmParameters = None
+    _workerBatch._warmRowParameters = None
+    results = []
+    for y, key, info in zip(spectra, keys, infos):
+        result, concentrations = _workerBatch._fitOneMca(x, y, filename,
+                                                         key, info=info)
+        if result is not None:
+            # the configuration is known by the parent process
+            result.pop('config', None)
+        results.append((result, concentrations))
+    return results
+
+
 def main():
     import getopt
     options = 'f'
@@ -1113,7 +1332,8 @@ def main():
                    'roiwidth=', 'concentrations=', 'overwrite=',
                    'outroot=', 'outentry=', 'outprocess=',
                    'edf=', 'h5=', 'csv=', 'tif=', 'dat=',
-                   'diagnostics=', 'debug=', 'multipage=']
+                   'diagnostics=', 'debug=', 'multipage=', 'nproc=',
+                   'warmstart=']
     filelist = None
     cfg = None
     roifit = 0
@@ -1132,6 +1352,8 @@ def main():
     outputRoot = ""
     fileEntry = ""
     fileProcess = ""
+    nproc = None
+    warmstart = 0
     opts, args = getopt.getopt(
                     sys.argv[1:],
                     options,
@@ -1179,6 +1401,10 @@ def main():
             dat = int(arg)
         elif opt == '--multipage':
             multipage = int(arg)
+        elif opt == '--nproc':
+            nproc = int(arg)
+        elif opt == '--warmstart':
+            warmstart = int(arg)
 
     logging.basicConfig()
     if debug:
@@ -1211,7 +1437,9 @@ def main():
                                 roiwidth=roiwidth,
                                 concentrations=concentrations,
                                 outbuffer=outbuffer,
-                                overwrite=overwrite)
+                                overwrite=overwrite,
+                                nproc=nproc,
+                                warmstart=warmstart)
         b.processList()
         print("Total Elapsed = % s " % (time.time() - t0))
 
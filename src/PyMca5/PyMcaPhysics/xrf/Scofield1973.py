@@ -32,9 +32,8 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import sys
 import os
-from PyMca5.PyMcaIO import ConfigDict
 from PyMca5 import getDataFile
+from PyMca5.PyMcaPhysics.xrf import AtomicDataCache
 
-dict = ConfigDict.ConfigDict()
 dictfile = getDataFile("Scofield1973.dict")
-dict.read(dictfile)
+dict = AtomicDataCache.readConfigDict(dictfile)
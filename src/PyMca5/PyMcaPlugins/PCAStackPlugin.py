@@ -31,7 +31,9 @@
 
 The user can configure following parameters:
 
-  - PCA method (*Covariance, Expectation Max, Covariance Multiple Arrays*)
+  - PCA method (*Covariance, Expectation Max, Covariance Multiple Arrays,
+    Randomized SVD*)
+  - Oversampling and power iterations of the randomized SVD
   - Number of Principal Components
   - Spectral Binning
   - Spectral Regions
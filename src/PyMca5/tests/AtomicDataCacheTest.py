@@ -0,0 +1,182 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2026 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+
+
+class testAtomicDataCache(unittest.TestCase):
+    def setUp(self):
+        from PyMca5.PyMcaPhysics.xrf import AtomicDataCache
+        self.tmpDir = tempfile.mkdtemp(prefix="pymca")
+        self.cacheDir = os.path.join(self.tmpDir, "cache")
+        AtomicDataCache.setCacheDirectory(self.cacheDir)
+        self.source = os.path.join(self.tmpDir, "data.dict")
+        self._writeSource(1.0)
+
+    def tearDown(self):
+        from PyMca5.PyMcaPhysics.xrf import AtomicDataCache
+        AtomicDataCache.setCacheDirectory()
+        shutil.rmtree(self.tmpDir)
+
+    def _writeSource(self, scale):
+        from PyMca5.PyMcaIO import ConfigDict
+        cDict = ConfigDict.ConfigDict()
+        for ele in ["Fe", "Cu", "Pb"]:
+            cDict[ele] = {}
+            cDict[ele]["energy"] = numpy.arange(10.) * scale
+            cDict[ele]["binding"] = {"K": 7.112 * scale, "L1": 0.85}
+            cDict[ele]["name"] = ele
+        cDict.write(self.source)
+
+    def _fromCache(self, data):
+        from PyMca5.PyMcaPhysics.xrf import AtomicDataCache
+        return isinstance(data, AtomicDataCache.CachedSections) and \
+               data._buffer is not None
+
+    def testConfigDictCache(self):
+        from PyMca5.PyMcaIO import ConfigDict
+        from PyMca5.PyMcaPhysics.xrf import AtomicDataCache
+        expected = ConfigDict.ConfigDict()
+        expected.read(self.source)
+
+        first = AtomicDataCache.readConfigDict(self.source)
+        cachefile = AtomicDataCache.getCacheFileName(self.source)
+        self.assertTrue(os.path.exists(cachefile))
+        second = AtomicDataCache.readConfigDict(self.source)
+        self.assertFalse(self._fromCache(first))
+        self.assertTrue(self._fromCache(second))
+        # same read-only type with or without a valid cache
+        for data in [first, second]:
+            self.assertTrue(isinstance(data, AtomicDataCache.CachedSections))
+            self.assertFalse(hasattr(data, "__setitem__"))
+        self.assertEqual(list(second.keys()), list(expected.keys()))
+        for data in [first, second]:
+            for ele in expected:
+                self.assertEqual(list(data[ele].keys()),
+                                 list(expected[ele].keys()))
+                numpy.testing.assert_array_equal(data[ele]["energy"],
+                                                 expected[ele]["energy"])
+                self.assertEqual(data[ele]["binding"],
+                                 expected[ele]["binding"])
+                self.assertEqual(data[ele]["name"], expected[ele]["name"])
+        # the entries are only unpickled once
+        self.assertTrue(second["Fe"] is second["Fe"])
+        self.assertFalse("Zn" in second)
+        self.assertRaises(KeyError, second.__getitem__, "Zn")
+
+        # a plain dictionary is obtained when not lazy
+        third = AtomicDataCache.readConfigDict(self.source, lazy=False)
+        self.assertTrue(isinstance(third, dict))
+        self.assertEqual(third["Pb"]["binding"], expected["Pb"]["binding"])
+
+    def testInvalidation(self):
+        from PyMca5.PyMcaPhysics.xrf import AtomicDataCache
+        AtomicDataCache.readConfigDict(self.source)
+        data = AtomicDataCache.readConfigDict(self.source)
+        self.assertAlmostEqual(data["Cu"]["binding"]["K"], 7.112)
+
+        # a modified source file must be parsed again
+        self._writeSource(2.0)
+        data = AtomicDataCache.readConfigDict(self.source)
+        self.assertAlmostEqual(data["Cu"]["binding"]["K"], 2 * 7.112)
+        data = AtomicDataCache.readConfigDict(self.source)
+        self.assertTrue(self._fromCache(data))
+        self.assertAlmostEqual(data["Cu"]["binding"]["K"], 2 * 7.112)
+
+        # a touched but otherwise identical file keeps its cache
+        info = os.stat(self.source)
+        os.utime(self.source, ns=(info.st_atime_ns,
+                                  info.st_mtime_ns + 10**9))
+        data = AtomicDataCache.readConfigDict(self.source)
+        self.assertTrue(self._fromCache(data))
+
+        # a corrupted cache file is ignored and rewritten
+        cachefile = AtomicDataCache.getCacheFileName(self.source)
+        with open(cachefile, "wb") as f:
+            f.write(b"garbage")
+        data = AtomicDataCache.readConfigDict(self.source)
+        self.assertAlmostEqual(data["Cu"]["binding"]["K"], 2 * 7.112)
+        data = AtomicDataCache.readConfigDict(self.source)
+        self.assertTrue(self._fromCache(data))
+
+    def testDisabledCache(self):
+        from PyMca5.PyMcaPhysics.xrf import AtomicDataCache
+        AtomicDataCache.setCacheDirectory(None)
+        self.assertTrue(AtomicDataCache.getCacheFileName(self.source) is None)
+        data = AtomicDataCache.readConfigDict(self.source)
+        self.assertTrue(isinstance(data, AtomicDataCache.CachedSections))
+        self.assertFalse(self._fromCache(data))
+        self.assertEqual(data["Fe"]["name"], "Fe")
+        data = AtomicDataCache.readConfigDict(self.source, lazy=False)
+        self.assertTrue(isinstance(data, dict))
+        self.assertFalse(os.path.exists(self.cacheDir))
+
+    def testXcomCache(self):
+        from PyMca5.PyMcaPhysics.xrf import AtomicDataCache
+        from PyMca5.PyMcaPhysics.xrf import Elements
+        from PyMca5 import PyMcaDataDir
+        xcomfile = os.path.join(PyMcaDataDir.PYMCA_DATA_DIR,
+                                "attdata", "Fe.mat")
+        expected = Elements._readXcomFile(xcomfile)
+        for i in range(2):
+            data = AtomicDataCache.load(xcomfile,
+                                        Elements._readXcomFile,
+                                        lazy=False)
+            self.assertEqual(sorted(data.keys()), sorted(expected.keys()))
+            for key in expected:
+                numpy.testing.assert_array_equal(data[key], expected[key])
+        self.assertTrue(os.path.exists(
+                        AtomicDataCache.getCacheFileName(xcomfile)))
+
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testAtomicDataCache))
+    else:
+        # use a predefined order
+        testSuite.addTest(testAtomicDataCache("testConfigDictCache"))
+        testSuite.addTest(testAtomicDataCache("testInvalidation"))
+        testSuite.addTest(testAtomicDataCache("testDisabledCache"))
+        testSuite.addTest(testAtomicDataCache("testXcomCache"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -116,6 +116,137 @@ def testEdfFileReadWrite(self):
         edf =None
         gc.collect()
 
+    def testEdfFileMemMap(self):
+        self.assertTrue(self.fileClass is not None)
+        data = numpy.arange(60000).astype(numpy.int32)
+        data.shape = 200, 300
+        volume = numpy.arange(60.).reshape(3, 4, 5)
+        edf = self.fileClass(self.fname, 'wb+')
+        edf.WriteImage({}, data)
+        edf.WriteImage({}, data, ByteOrder="HighByteFirst", Append=1)
+        edf.WriteImage({}, volume, Append=1)
+        edf = None
+
+        edf = self.fileClass(self.fname, 'rb')
+        self.assertTrue(edf.IsMemMappable(0))
+        # a non native byte order cannot be mapped
+        self.assertFalse(edf.IsMemMappable(1))
+        self.assertTrue(edf.IsMemMappable(2))
+        for index in [0, 1]:
+            for memmap in [False, True]:
+                readData = edf.GetData(index, MemMap=memmap)
+                self.assertEqual(isinstance(readData, numpy.memmap),
+                                 memmap and (index == 0))
+                self.assertTrue(numpy.array_equal(readData, data))
+                # regions read as full rows, as blocks and row by row
+                for pos, size in [((0, 5), (300, 10)),
+                                  ((20, 3), (100, 7)),
+                                  ((250, 10), (10, 0)),
+                                  ((5, 5), (0, 0))]:
+                    x, y = pos
+                    w = size[0] or (300 - x)
+                    h = size[1] or (200 - y)
+                    readData = edf.GetData(index, Pos=pos, Size=size,
+                                           MemMap=memmap)
+                    self.assertTrue(numpy.array_equal(readData,
+                                                      data[y:y + h, x:x + w]))
+                readData = edf.GetData(index, DataType="DoubleValue",
+                                       MemMap=memmap)
+                self.assertEqual(readData.dtype, numpy.float64)
+                self.assertTrue(numpy.array_equal(readData, data))
+        for memmap in [False, True]:
+            readData = edf.GetData(2, MemMap=memmap)
+            self.assertTrue(numpy.array_equal(readData, volume))
+            readData = edf.GetData(2, Pos=(1, 2, 1), Size=(3, 2, 2),
+                                   MemMap=memmap)
+            self.assertTrue(numpy.array_equal(readData, volume[1:3, 2:4, 1:4]))
+        edf = None
+        readData = None
+        gc.collect()
+
+    def testEDFStackVirtual(self):
+        from PyMca5.PyMcaIO import EDFStack
+        tmpDir = tempfile.mkdtemp()
+        try:
+            fileList = []
+            reference = numpy.arange(20 * 30 * 40).astype(numpy.float32)
+            reference.shape = 20, 30, 40
+            for i in range(reference.shape[0]):
+                fname = os.path.join(tmpDir, "image_%04d.edf" % i)
+                edf = self.fileClass(fname, 'wb+')
+                edf.WriteImage({}, reference[i])
+                edf = None
+                fileList.append(fname)
+            for fileindex in [0, 1, 2]:
+                stack = EDFStack.EDFStack(virtual=False)
+                stack.loadFileList(fileList, fileindex=fileindex)
+                virtual = EDFStack.EDFStack(virtual=True)
+                virtual.loadFileList(fileList, fileindex=fileindex)
+                self.assertTrue(isinstance(virtual.data,
+                                           EDFStack.VirtualStack))
+                self.assertEqual(virtual.data.shape, stack.data.shape)
+                self.assertEqual(virtual.data.dtype, stack.data.dtype)
+                for key in ["FileIndex", "McaIndex", "NumberOfFiles", "Size"]:
+                    self.assertEqual(virtual.info.get(key),
+                                     stack.info.get(key))
+                self.assertTrue(numpy.array_equal(numpy.asarray(virtual.data),
+                                                  stack.data))
+                for key in [(3,), (slice(2, 12, 3), 7), (Ellipsis, 5),
+                            (slice(None), 4, slice(1, 9)), ([1, 4], 2),
+                            (-1, slice(None, None, -1))]:
+                    self.assertTrue(numpy.array_equal(virtual.data[key],
+                                                      stack.data[key]),
+                                    "Different data for key %s" % (key,))
+            virtual = None
+            gc.collect()
+        finally:
+            for fname in os.listdir(tmpDir):
+                os.remove(os.path.join(tmpDir, fname))
+            os.rmdir(tmpDir)
+
+    def testEDFStackPrefetch(self):
+        from PyMca5.PyMcaIO import EDFStack
+        from PyMca5.PyMcaIO import PrefetchLoader
+        tmpDir = tempfile.mkdtemp()
+        try:
+            fileList = []
+            reference = numpy.arange(25 * 6 * 7).astype(numpy.float32)
+            reference.shape = 25, 6, 7
+            for i in range(reference.shape[0]):
+                fname = os.path.join(tmpDir, "image_%04d.edf" % i)
+                edf = self.fileClass(fname, 'wb+')
+                edf.WriteImage({}, reference[i])
+                edf = None
+                fileList.append(fname)
+            for fileindex in [0, 1, 2]:
+                sequential = EDFStack.EDFStack(virtual=False, nworkers=1)
+                sequential.loadFileList(fileList, fileindex=fileindex)
+                progress = []
+                stack = EDFStack.EDFStack(virtual=False, nworkers=4)
+                stack.onProgress = progress.append
+                stack.loadFileList(fileList, fileindex=fileindex)
+                self.assertEqual(progress, list(range(1, len(fileList) + 1)))
+                self.assertTrue(numpy.array_equal(stack.data,
+                                                  sequential.data))
+                self.assertEqual(stack.info["NumberOfFiles"], len(fileList))
+
+            # cancel from the progress callback
+            calls = []
+            stack = EDFStack.EDFStack(virtual=False, nworkers=4)
+            def onProgress(n):
+                if n == 5:
+                    stack.cancel()
+            stack.onProgress = onProgress
+            stack.onEnd = lambda: calls.append("end")
+            self.assertRaises(PrefetchLoader.LoadCancelled,
+                              stack.loadFileList, fileList)
+            self.assertEqual(calls, ["end"])
+            self.assertEqual(stack.incrProgressBar, 5)
+        finally:
+            for fname in os.listdir(tmpDir):
+                os.remove(os.path.join(tmpDir, fname))
+            os.rmdir(tmpDir)
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -125,6 +256,9 @@ def getSuite(auto=True):
         # use a predefined order
         testSuite.addTest(testEdfFile("testEdfFileImport"))
         testSuite.addTest(testEdfFile("testEdfFileReadWrite"))
+        testSuite.addTest(testEdfFile("testEdfFileMemMap"))
+        testSuite.addTest(testEdfFile("testEDFStackVirtual"))
+        testSuite.addTest(testEdfFile("testEDFStackPrefetch"))
     return testSuite
 
 def test(auto=False):
@@ -311,6 +311,47 @@ def testMaterialCompositionCalculation(self):
             self.assertTrue(abs(c1[key] - c2[key]) < 1.0e-7,
                             "Inconsistent calculation for element %s" % key)
 
+    def testMaterialCrossSectionsCache(self):
+        if DEBUG:
+            print()
+            print("Testing Material Cross Sections Cache")
+        # the lists are modified when expanding materials, give copies
+        compounds = ("Fe2O3", "Water", "Pb")
+        fractions = (0.2, 0.5, 0.3)
+        energies = numpy.concatenate(([0.5, 1.0, 7.112, 88.0045],
+                                      numpy.linspace(1.0, 80.0, 500)))
+        self._elements.clearAttenuationCache()
+        vector = self._elements.getMaterialMassAttenuationCoefficients( \
+                                list(compounds), list(fractions), energies)
+        self.assertEqual(len(vector["total"]), len(energies))
+        # vectorized and single energy calculations must agree
+        for i in range(0, len(energies), 25):
+            single = self._elements.getMaterialMassAttenuationCoefficients( \
+                                list(compounds), list(fractions), energies[i])
+            for key in ["coherent", "compton", "photo", "pair", "total"]:
+                self.assertAlmostEqual(single[key][0], vector[key][i],
+                        delta=1.0e-10 * abs(single[key][0]),
+                        msg="Inconsistent %s at %f keV" % (key, energies[i]))
+
+        # the output can be modified without corrupting the cache
+        vector["total"][0] = -1.0
+        again = self._elements.getMaterialMassAttenuationCoefficients( \
+                                list(compounds), list(fractions), energies)
+        self.assertTrue(again["total"][0] > 0.0)
+        self.assertEqual(again["total"][1:], vector["total"][1:])
+
+        # the number of cached results is bounded
+        size = self._elements.ATTENUATION_CACHE_SIZE
+        try:
+            self._elements.ATTENUATION_CACHE_SIZE = 4
+            for fraction in numpy.linspace(0.1, 0.9, 10):
+                self._elements.getMaterialMassAttenuationCoefficients( \
+                            ["Fe", "Pb"], [fraction, 1.0 - fraction], 10.0)
+            self.assertEqual(len(self._elements._attenuationCache), 4)
+        finally:
+            self._elements.ATTENUATION_CACHE_SIZE = size
+            self._elements.clearAttenuationCache()
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -323,6 +364,7 @@ def getSuite(auto=True):
         testSuite.addTest(testElements("testElementCrossSectionsCalculation"))
         testSuite.addTest(testElements("testMaterialCrossSectionsCalculation"))
         testSuite.addTest(testElements("testMaterialCompositionCalculation"))
+        testSuite.addTest(testElements("testMaterialCrossSectionsCache"))
     return testSuite
 
 def test(auto=False):
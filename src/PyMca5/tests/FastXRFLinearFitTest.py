@@ -57,6 +57,23 @@ def setUp(self):
     def tearDown(self):
         shutil.rmtree(self.path)
 
+    def _getStripConfiguredFit(self, nRows, nColumns):
+        """
+        Spectra of different pixels with Poisson noise and a fit
+        configured with the strip background
+        """
+        data, livetime = XrfData.generateXRFData(nRows=nRows,
+                                                 nColumns=nColumns,
+                                                 same=False)
+        data = data[0] + numpy.random.RandomState(0).poisson(1, data.shape[1:])
+        configuration = XrfData.generateXRFConfig()
+        configuration["fit"]["stripalgorithm"] = 1
+        configuration["fit"]["stripflag"] = 1
+
+        fastFit = FastXRFLinearFit.FastXRFLinearFit()
+        fastFit.setFitConfiguration(configuration)
+        return data, fastFit
+
     @unittest.skipUnless(HAS_H5PY, "h5py not installed")
     def testCommand(self):
         from PyMca5.PyMcaIO import HDF5Stack1D
@@ -149,6 +166,138 @@ def testCommand(self):
         h5.close()
         h5 = None
 
+    def testParallel(self):
+        data, fastFit = self._getStripConfiguredFit(20, 30)
+
+        results = []
+        for nworkers in (None, 4):
+            outbuffer = OutputBuffer(diagnostics=True, nosave=True)
+            fastFit.fitMultipleSpectra(y=data,
+                                       refit=True,
+                                       outbuffer=outbuffer,
+                                       nworkers=nworkers)
+            results.append(outbuffer)
+        serial, parallel = results
+        for key in ("parameters", "uncertainties", "model"):
+            numpy.testing.assert_array_equal(serial[key], parallel[key])
+
+    def testMask(self):
+        data, fastFit = self._getStripConfiguredFit(8, 10)
+        mask = numpy.zeros(data.shape[:-1], dtype=bool)
+        mask[2:5, 3:8] = True
+        mask[7, 0] = True
+
+        results = []
+        for pixels in (None, mask, numpy.flatnonzero(mask)):
+            outbuffer = OutputBuffer(diagnostics=True, nosave=True)
+            fastFit.fitMultipleSpectra(y=data,
+                                       refit=False,
+                                       outbuffer=outbuffer,
+                                       mask=pixels)
+            results.append(outbuffer)
+        full, masked, indexed = results
+        for key in ("parameters", "uncertainties", "model"):
+            numpy.testing.assert_array_equal(masked[key], indexed[key])
+        for key in ("parameters", "uncertainties"):
+            numpy.testing.assert_allclose(masked[key][:, mask],
+                                          full[key][:, mask], rtol=1e-5)
+            self.assertTrue(numpy.isnan(masked[key][:, ~mask]).all())
+        numpy.testing.assert_allclose(masked["model"][mask],
+                                      full["model"][mask], rtol=1e-5,
+                                      atol=1e-5)
+        self.assertTrue(numpy.isnan(masked["model"][~mask]).all())
+        self.assertFalse(masked["nObservations"][~mask].any())
+
+    def testRequestedUncertainties(self):
+        data, fastFit = self._getStripConfiguredFit(6, 8)
+        results = []
+        for uncertaintyNames in (None, ["Fe Ka", "Cu K"], []):
+            outbuffer = OutputBuffer(nosave=True)
+            fastFit.fitMultipleSpectra(y=data, weight=2, refit=True,
+                                       outbuffer=outbuffer,
+                                       uncertaintyNames=uncertaintyNames)
+            results.append(outbuffer)
+        full, requested, none = results
+        labels = full.labels("uncertainties")
+        for i, label in enumerate(labels):
+            numpy.testing.assert_allclose(requested["parameters"][i],
+                                          full["parameters"][i],
+                                          rtol=1e-6, atol=1e-6)
+            if label in ("Fe Ka", "Cu K"):
+                self.assertTrue(numpy.isfinite(
+                                requested["uncertainties"][i]).any())
+                numpy.testing.assert_allclose(requested["uncertainties"][i],
+                                              full["uncertainties"][i],
+                                              rtol=1e-6, atol=1e-6)
+            else:
+                # parameters removed by the refit have zero uncertainty
+                refitted = full["uncertainties"][i] == 0
+                self.assertTrue(
+                    numpy.isnan(requested["uncertainties"][i][~refitted]).all())
+        self.assertFalse(numpy.isfinite(none["uncertainties"][
+                                        none["uncertainties"] != 0]).any())
+
+    def testModelCache(self):
+        from PyMca5.PyMcaPhysics.xrf import LinearModelCache
+
+        data, livetime = XrfData.generateXRFData(nRows=4, nColumns=5,
+                                                 same=False)
+        configuration = XrfData.generateXRFConfig()
+        configuration["fit"]["stripalgorithm"] = 1
+        fname = os.path.join(self.path, "models.h5")
+
+        # no caching by default
+        self.assertIsNone(FastXRFLinearFit.FastXRFLinearFit().modelCache)
+
+        results = []
+        for modelcache in (None,
+                           LinearModelCache.LinearModelCache(filename=fname),
+                           LinearModelCache.LinearModelCache(filename=fname)):
+            fastFit = FastXRFLinearFit.FastXRFLinearFit(modelcache=modelcache)
+            fastFit.setFitConfiguration(configuration)
+            outbuffer = OutputBuffer(diagnostics=True, nosave=True)
+            fastFit.fitMultipleSpectra(y=data[0],
+                                       refit=True,
+                                       concentrations=True,
+                                       outbuffer=outbuffer)
+            results.append(outbuffer)
+            if modelcache:
+                self.assertEqual(len(modelcache), 1)
+        # the last fit uses the model stored by the previous one
+        self.assertFalse(fastFit._modelEstimated)
+        # the cached arrays are shared and cannot be modified
+        key = list(modelcache._models.keys())[0]
+        model = modelcache.get(key)
+        self.assertFalse(model["derivatives"].flags.writeable)
+        for array in model["svd"]:
+            self.assertFalse(array.flags.writeable)
+        model["freeNames"].append("dummy")
+        self.assertNotIn("dummy", modelcache.get(key)["freeNames"])
+        for outbuffer in results[1:]:
+            for key in ("parameters", "uncertainties", "massfractions", "model"):
+                numpy.testing.assert_array_equal(results[0][key],
+                                                 outbuffer[key])
+
+    def testStream(self):
+        data, fastFit = self._getStripConfiguredFit(10, 12)
+        batch = OutputBuffer(diagnostics=True, nosave=True)
+        fastFit.fitMultipleSpectra(y=data, refit=True, outbuffer=batch)
+
+        # blocks of spectra do not coincide with the image rows
+        stream = OutputBuffer(diagnostics=True, nosave=True)
+        fastFit.begin(data.shape, refit=True, outbuffer=stream,
+                      dtype=data.dtype)
+        spectra = data.reshape(-1, data.shape[-1])
+        for index in range(0, spectra.shape[0], 7):
+            fastFit.push(spectra[index:index+7], index)
+        self.assertIs(fastFit.finalize(), stream)
+
+        self.assertRaises(RuntimeError, fastFit.push, spectra[:1], 0)
+        for key in ("parameters", "uncertainties", "model", "residuals"):
+            numpy.testing.assert_allclose(batch[key], stream[key],
+                                          rtol=1e-5, atol=1e-5)
+        numpy.testing.assert_array_equal(stream["data"], data)
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -157,7 +306,12 @@ def getSuite(auto=True):
         )
     else:
         # use a predefined order
-        testSuite.addTest(testPyMcaBatch("testCommand"))
+        testSuite.addTest(testFastXRFLinearFit("testCommand"))
+        testSuite.addTest(testFastXRFLinearFit("testParallel"))
+        testSuite.addTest(testFastXRFLinearFit("testMask"))
+        testSuite.addTest(testFastXRFLinearFit("testRequestedUncertainties"))
+        testSuite.addTest(testFastXRFLinearFit("testModelCache"))
+        testSuite.addTest(testFastXRFLinearFit("testStream"))
     return testSuite
 
 
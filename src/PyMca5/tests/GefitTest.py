@@ -70,6 +70,122 @@ def testGefitLeastSquares(self):
         for i in range(len(originalParameters)):
             self.assertTrue(abs(fittedpar[i] - originalParameters[i]) < 0.01)
 
+    def gaussianPlusLinearBackgroundJacobian(self, param, indices, t):
+        dummy = 2.3548200450309493 * (t - param[3])/ param[4]
+        gaussian = numpy.exp(-0.5 * dummy * dummy)
+        jacobian = numpy.array([numpy.ones(t.shape),
+                                t,
+                                gaussian,
+                                param[2] * gaussian * dummy * \
+                                    2.3548200450309493 / param[4],
+                                param[2] * gaussian * dummy * dummy / param[4]])
+        return jacobian[indices]
+
+    def testGefitJacobian(self):
+        self.testGefitImport()
+        x = numpy.arange(500.)
+        originalParameters = numpy.array([10.5, 2, 1000.0, 200., 100],
+                                         numpy.float64)
+        fitFunction = self.gaussianPlusLinearBackground
+        y = fitFunction(originalParameters, x)
+        startingParameters = [0.0 ,1.0,900.0, 150., 90]
+        CFREE = self.gefit.CFREE
+        CPOSITIVE = self.gefit.CPOSITIVE
+        CQUOTED = self.gefit.CQUOTED
+        for constrains in [None,
+                           [[CFREE, CFREE, CPOSITIVE, CQUOTED, CPOSITIVE],
+                            [0, 0, 0, 100., 0],
+                            [0, 0, 0, 300., 0]]]:
+            results = []
+            for jacobian in [None, self.gaussianPlusLinearBackgroundJacobian]:
+                results.append(self.gefit.LeastSquaresFit(fitFunction,
+                                        startingParameters,
+                                        xdata=x,
+                                        ydata=y,
+                                        constrains=constrains,
+                                        model_jacobian=jacobian))
+            for fittedpar, chisq, sigmapar in results:
+                for i in range(len(originalParameters)):
+                    self.assertTrue(\
+                        abs(fittedpar[i] - originalParameters[i]) < 0.01)
+
+    def testGefitConstraintsArrays(self):
+        self.testGefitImport()
+        Gefit = self.gefit
+        parameters = numpy.array([-1.5, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0])
+        codes = [Gefit.CPOSITIVE, Gefit.CFREE, Gefit.CFACTOR, Gefit.CDELTA,
+                 Gefit.CSUM, Gefit.CIGNORED, Gefit.CFIXED]
+        cons1 = [0, 0, 0, 1, 0, 0, 0]
+        cons2 = [0, 0, 2.0, 0.5, 10.0, 0, 0]
+        for reference in [0, 2]:
+            # a parameter related to a related parameter is handled too
+            cons1[3] = reference
+            constrains = [codes, cons1, cons2]
+            expected = Gefit.getparameters(parameters.tolist(), constrains)
+            obtained = Gefit.getparametersarray(parameters, constrains)
+            self.assertTrue(numpy.allclose(obtained, expected))
+
+    def testStackGefit(self):
+        self.testGefitImport()
+        from PyMca5.PyMcaMath.fitting import StackGefit
+        x = numpy.arange(500.)
+        random = numpy.random.RandomState(0)
+        nSpectra = 20
+        originalParameters = numpy.zeros((nSpectra, 5), numpy.float64)
+        originalParameters[:, 0] = 10.5 + random.rand(nSpectra)
+        originalParameters[:, 1] = 2.0
+        originalParameters[:, 2] = 1000.0 + 100 * random.rand(nSpectra)
+        originalParameters[:, 3] = 200.0 + 10 * random.rand(nSpectra)
+        originalParameters[:, 4] = 100.0 + 10 * random.rand(nSpectra)
+        fitFunction = self.gaussianPlusLinearBackground
+        y = numpy.array([fitFunction(p, x) for p in originalParameters])
+        y += random.normal(0.0, 1.0, y.shape)
+        startingParameters = numpy.zeros(originalParameters.shape) + \
+                             [0.0, 2.0, 900.0, 205., 90]
+
+        def stackFunction(parameters, t):
+            return numpy.array([fitFunction(p, t) for p in parameters])
+
+        def stackJacobian(parameters, t):
+            return numpy.array([\
+                self.gaussianPlusLinearBackgroundJacobian(p, slice(None), t)
+                for p in parameters])
+
+        CFREE = self.gefit.CFREE
+        for constrains in [None,
+                           [[CFREE, "FIXED", "POSITIVE", "QUOTED", CFREE],
+                            [0, 0, 0, 150., 0],
+                            [0, 0, 0, 250., 0]]]:
+            for jacobian in [None, stackJacobian]:
+                fittedpar, chisq, sigmapar, niter, lastdeltachi = \
+                    StackGefit.LeastSquaresFit(stackFunction,
+                                               startingParameters,
+                                               xdata=x,
+                                               ydata=y,
+                                               constrains=constrains,
+                                               model_jacobian=jacobian,
+                                               fulloutput=True)
+                self.assertEqual(fittedpar.shape, startingParameters.shape)
+                for i in range(nSpectra):
+                    # the same as fitting the spectra one by one
+                    expected = self.gefit.LeastSquaresFit(fitFunction,
+                                            startingParameters[i],
+                                            xdata=x,
+                                            ydata=y[i],
+                                            constrains=constrains,
+                                            fulloutput=True)
+                    self.assertTrue(numpy.allclose(fittedpar[i], expected[0],
+                                                   rtol=1.0e-5))
+                    # Gefit does not propagate the uncertainty of the
+                    # quoted parameter through its transformation
+                    index = [0, 1, 2, 4]
+                    self.assertTrue(numpy.allclose(sigmapar[i][index],
+                                                   numpy.array(expected[2])[index],
+                                                   rtol=1.0e-3))
+                    self.assertEqual(niter[i], expected[3])
+                    self.assertTrue(abs(fittedpar[i, 3] - \
+                                        originalParameters[i, 3]) < 0.5)
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -79,6 +195,9 @@ def getSuite(auto=True):
         # use a predefined order
         testSuite.addTest(testGefit("testGefitImport"))
         testSuite.addTest(testGefit("testGefitLeastSquares"))
+        testSuite.addTest(testGefit("testGefitJacobian"))
+        testSuite.addTest(testGefit("testGefitConstraintsArrays"))
+        testSuite.addTest(testGefit("testStackGefit"))
     return testSuite
 
 def test(auto=False):
@@ -0,0 +1,177 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2026 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import numpy
+
+
+class testLinalg(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.a = random.uniform(0.1, 1, size=(200, 6))
+        parameters = random.uniform(10, 100, size=(6, 50))
+        self.b = random.poisson(numpy.dot(self.a, parameters)).astype(numpy.float64)
+
+    def _reference(self, a, b):
+        # column by column weighted least squares
+        parameters = numpy.zeros((a.shape[1], b.shape[1]))
+        covariances = numpy.zeros((b.shape[1], a.shape[1], a.shape[1]))
+        for k in range(b.shape[1]):
+            w = numpy.sqrt(numpy.abs(b[:, k]))
+            w += numpy.equal(w, 0)
+            A = a / w[:, numpy.newaxis]
+            covariances[k] = numpy.linalg.inv(numpy.dot(A.T, A))
+            parameters[:, k] = numpy.dot(covariances[k],
+                                         numpy.dot(A.T, b[:, k] / w))
+        uncertainties = numpy.sqrt(numpy.diagonal(covariances, axis1=1, axis2=2)).T
+        return parameters, uncertainties, covariances
+
+    def testIndividualWeights(self):
+        from PyMca5.PyMcaMath import linalg
+        expected = self._reference(self.a, self.b)
+        batchMemory = linalg.BATCH_MEMORY
+        try:
+            for memory in (batchMemory, 32000, 1):
+                # one block, products of the model columns by groups of
+                # pairs and one column per block
+                linalg.BATCH_MEMORY = memory
+                result = linalg.lstsq(self.a, self.b, weight=1, svd=False,
+                                      covariances=True)
+                for r, e in zip(result, expected):
+                    numpy.testing.assert_allclose(r, e, rtol=1e-10)
+        finally:
+            linalg.BATCH_MEMORY = batchMemory
+
+        # one spectrum
+        parameters, uncertainties = linalg.lstsq(self.a, self.b[:, 0],
+                                                 weight=1, svd=False)
+        self.assertEqual(parameters.shape, (self.a.shape[1],))
+        numpy.testing.assert_allclose(parameters, expected[0][:, 0], rtol=1e-10)
+        numpy.testing.assert_allclose(uncertainties, expected[1][:, 0], rtol=1e-10)
+
+    def testIndividualWeightsSingular(self):
+        from PyMca5.PyMcaMath import linalg
+        b = self.b.copy()
+        # infinite uncertainties: no data to fit the first spectrum
+        b[:, 0] = numpy.inf
+        parameters, uncertainties = linalg.lstsq(self.a, b, weight=1,
+                                                 svd=False)
+        self.assertTrue((parameters[:, 0] == 0).all())
+        self.assertTrue((uncertainties[:, 0] == 0).all())
+        expected = self._reference(self.a, self.b[:, 1:])
+        numpy.testing.assert_allclose(parameters[:, 1:], expected[0], rtol=1e-10)
+        numpy.testing.assert_allclose(uncertainties[:, 1:], expected[1], rtol=1e-10)
+
+
+    def testPropagatedUncertainties(self):
+        from PyMca5.PyMcaMath import linalg
+        random = numpy.random.RandomState(1)
+        sigma_b = random.uniform(1, 2, size=self.b.shape)
+        d = numpy.linalg.pinv(self.a)
+        expectedParameters = numpy.dot(d, self.b)
+        expectedCovariances = numpy.array([numpy.dot(d * sigma_b[:, k]**2, d.T)
+                                           for k in range(self.b.shape[1])])
+        expectedUncertainties = numpy.sqrt(numpy.dot(d * d, sigma_b**2))
+        batchMemory = linalg.BATCH_MEMORY
+        try:
+            for memory in (batchMemory, 1):
+                linalg.BATCH_MEMORY = memory
+                parameters, uncertainties = linalg.lstsq(self.a, self.b,
+                                                         sigma_b=sigma_b,
+                                                         weight=0)
+                numpy.testing.assert_allclose(parameters, expectedParameters,
+                                              rtol=1e-10)
+                numpy.testing.assert_allclose(uncertainties,
+                                              expectedUncertainties, rtol=1e-10)
+                result = linalg.lstsq(self.a, self.b, sigma_b=sigma_b,
+                                      weight=0, covariances=True)
+                numpy.testing.assert_allclose(result[1], expectedUncertainties,
+                                              rtol=1e-10)
+                numpy.testing.assert_allclose(result[2], expectedCovariances,
+                                              rtol=1e-10, atol=1e-14)
+        finally:
+            linalg.BATCH_MEMORY = batchMemory
+
+        # same uncertainties for all columns
+        parameters, uncertainties = linalg.lstsq(self.a, self.b,
+                                                 sigma_b=sigma_b[:, 0],
+                                                 weight=0)
+        expected = numpy.sqrt(numpy.dot(d * d, sigma_b[:, 0]**2))
+        for k in range(self.b.shape[1]):
+            numpy.testing.assert_allclose(uncertainties[:, k], expected,
+                                          rtol=1e-10)
+
+    def testRequestedUncertainties(self):
+        from PyMca5.PyMcaMath import linalg
+        random = numpy.random.RandomState(1)
+        sigma_b = random.uniform(1, 2, size=self.b.shape)
+        for kwargs in ({'weight': 0},
+                       {'weight': 0, 'sigma_b': sigma_b},
+                       {'weight': 1, 'svd': True},
+                       {'weight': 1, 'svd': False},
+                       {'weight': 1, 'svd': True, 'sigma_b': sigma_b},
+                       {'weight': 1, 'svd': False, 'sigma_b': sigma_b}):
+            expected = linalg.lstsq(self.a, self.b, **kwargs)
+            parameters, uncertainties = linalg.lstsq(self.a, self.b,
+                                                     uncertainties=[1, 3],
+                                                     **kwargs)
+            numpy.testing.assert_allclose(parameters, expected[0],
+                                          rtol=1e-10)
+            numpy.testing.assert_allclose(uncertainties[[1, 3]],
+                                          expected[1][[1, 3]], rtol=1e-10)
+            self.assertTrue(numpy.isnan(uncertainties[[0, 2, 4, 5]]).all())
+            # none requested
+            parameters, uncertainties = linalg.lstsq(self.a, self.b,
+                                                     uncertainties=[],
+                                                     **kwargs)
+            numpy.testing.assert_allclose(parameters, expected[0],
+                                          rtol=1e-10)
+            self.assertEqual(uncertainties.shape, expected[1].shape)
+            self.assertTrue(numpy.isnan(uncertainties).all())
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(unittest.TestLoader().loadTestsFromTestCase(testLinalg))
+    else:
+        # use a predefined order
+        testSuite.addTest(testLinalg("testIndividualWeights"))
+        testSuite.addTest(testLinalg("testIndividualWeightsSingular"))
+        testSuite.addTest(testLinalg("testPropagatedUncertainties"))
+        testSuite.addTest(testLinalg("testRequestedUncertainties"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -39,6 +39,11 @@
 except Exception:
     # MDP can give very weird errors
     MDP = False
+try:
+    import h5py
+    HAS_H5PY = True
+except ImportError:
+    HAS_H5PY = False
 
 class testPCATools(unittest.TestCase):
     def testPCAToolsImport(self):
@@ -149,6 +154,171 @@ def testPCAToolsPCA(self):
                     self.assertTrue(numpy.allclose(-eigenvectors[i],
                                                    numpyEigenvectors[i]))
 
+    def testPCAToolsChunkedCovariance(self):
+        from PyMca5.PyMcaMath.mva.PCATools import getChunkedCovarianceMatrix
+        x = numpy.random.RandomState(0).rand(6, 5, 8) * 100.
+        spectra = x.reshape(-1, 8)
+        mask = numpy.ones((6, 5), dtype=numpy.uint8)
+        mask[2:4, 1:3] = 0
+        for center in [True, False]:
+            for spatial_mask in [None, mask]:
+                if spatial_mask is None:
+                    used = spectra
+                else:
+                    used = spectra[spatial_mask.reshape(-1) > 0]
+                if center:
+                    numpyCov = numpy.cov(used.T)
+                else:
+                    numpyCov = numpy.dot(used.T, used) / (used.shape[0] - 1)
+                # chunks of 7 spectra and in one go
+                for nMca in [7, 100]:
+                    pymcaCov, pymcaAvg, nData = \
+                        getChunkedCovarianceMatrix(x,
+                                                   center=center,
+                                                   spatial_mask=spatial_mask,
+                                                   nMca=nMca)
+                    self.assertTrue(numpy.allclose(numpyCov, pymcaCov))
+                    self.assertTrue(numpy.allclose(used.mean(axis=0),
+                                                   pymcaAvg))
+                    self.assertEqual(nData, used.shape[0])
+
+        # the images as first dimension
+        images = numpy.ascontiguousarray(numpy.moveaxis(x, -1, 0))
+        pymcaCov, pymcaAvg, nData = getChunkedCovarianceMatrix(images,
+                                                               index=0,
+                                                               nMca=4)
+        self.assertTrue(numpy.allclose(numpy.cov(spectra.T), pymcaCov))
+
+    def testPCAToolsChunkedPCA(self):
+        from PyMca5.PyMcaMath.mva.PCATools import chunkedPCA
+        random = numpy.random.RandomState(0)
+        channels = numpy.linspace(0, 1, 40)
+        components = numpy.array([numpy.exp(-(channels - c) ** 2 / 0.005)
+                                  for c in (0.2, 0.5, 0.8)])
+        x = numpy.dot(random.rand(9, 7, 3) * [1, 2, 3], components) + \
+            random.rand(9, 7, 40) * 0.01 + 10.
+        spectra = x.reshape(-1, 40)
+        numpyEigenvalues, numpyEigenvectors = \
+                            numpy.linalg.eigh(numpy.cov(spectra.T))
+        numpyEigenvalues = numpyEigenvalues[::-1][:3]
+        numpyEigenvectors = numpyEigenvectors[:, ::-1][:, :3].T
+        ncomp = 3
+        result = chunkedPCA(x, ncomponents=ncomp, center=True, scale=False,
+                            legacy=False, nMca=10)
+        self.assertEqual(result["scores"].shape, (ncomp, 9, 7))
+        self.assertTrue(numpy.allclose(result["eigenvalues"],
+                                       numpyEigenvalues, rtol=1.0e-5))
+        self.assertTrue(numpy.allclose(result["average"],
+                                       spectra.mean(axis=0)))
+        for i in range(ncomp):
+            eigenvector = result["eigenvectors"][i]
+            if numpy.dot(eigenvector, numpyEigenvectors[i]) < 0:
+                eigenvector = -eigenvector
+            self.assertTrue(numpy.allclose(eigenvector, numpyEigenvectors[i],
+                                           atol=1.0e-5))
+            scores = numpy.dot(spectra, result["eigenvectors"][i])
+            self.assertTrue(numpy.allclose(result["scores"][i].reshape(-1),
+                                           scores, rtol=1.0e-5))
+
+        if not HAS_H5PY:
+            return
+        # read from and write to HDF5
+        with h5py.File("pca.h5", "w", driver="core",
+                       backing_store=False) as h5:
+            h5["data"] = x
+            output = h5.create_group("pca")
+            h5Result = chunkedPCA(h5["data"], ncomponents=ncomp,
+                                  center=True, scale=False, legacy=False,
+                                  output=output, nMca=(1, "kB"))
+            self.assertEqual(h5Result["scores"].name, "/pca/scores")
+            self.assertTrue(numpy.allclose(output["scores"][()],
+                                           result["scores"]))
+            self.assertTrue(numpy.allclose(output["eigenvectors"][()],
+                                           result["eigenvectors"]))
+
+    def testPCAToolsRandomizedPCA(self):
+        from PyMca5.PyMcaMath.mva.PCATools import chunkedPCA
+        from PyMca5.PyMcaMath.mva.PCATools import randomizedPCA
+        random = numpy.random.RandomState(0)
+        channels = numpy.linspace(0, 1, 60)
+        components = numpy.array([numpy.exp(-(channels - c) ** 2 / 0.005)
+                                  for c in (0.2, 0.5, 0.8)])
+        x = numpy.dot(random.rand(12, 10, 3) * [1, 2, 3], components) + \
+            random.rand(12, 10, 60) * 0.01 + 10.
+        ncomp = 3
+        for offset, factor, scale in [(0.0, 1.0, False),
+                                      (0.0, 1.0, True),
+                                      (1.0e6, 1.0, True),
+                                      (1.0e6, 1.0e-2, False)]:
+            data = x * factor + offset
+            spectra = data.reshape(-1, 60)
+            if scale:
+                matrix = numpy.corrcoef(spectra.T)
+            else:
+                matrix = numpy.cov(spectra.T)
+            numpyEigenvalues = numpy.linalg.eigvalsh(matrix)[::-1][:ncomp]
+            reference = chunkedPCA(data, ncomponents=ncomp, scale=scale,
+                                   legacy=False)
+            result = randomizedPCA(data, ncomponents=ncomp, scale=scale,
+                                   legacy=False, oversampling=5,
+                                   iterations=2, seed=0, nMca=25)
+            self.assertEqual(result["scores"].shape, (ncomp, 12, 10))
+            self.assertTrue(numpy.allclose(result["eigenvalues"],
+                                           numpyEigenvalues, rtol=1.0e-4,
+                                           atol=0))
+            self.assertTrue(numpy.allclose(result["variance"],
+                                           numpy.trace(matrix), atol=0))
+            self.assertTrue(numpy.allclose(result["average"],
+                                           reference["average"]))
+            for i in range(ncomp):
+                self.assertTrue(numpy.allclose(result["eigenvectors"][i],
+                                               reference["eigenvectors"][i],
+                                               atol=1.0e-4))
+                self.assertTrue(numpy.allclose(result["scores"][i],
+                                               reference["scores"][i],
+                                               rtol=1.0e-4))
+
+        # spectral and spatial masks
+        spectral_mask = numpy.ones((60,), numpy.float64)
+        spectral_mask[40:50] = 0
+        spectral_mask[10:20] = 0.5
+        mask = numpy.ones((12, 10), numpy.uint8)
+        mask[3:5, 2:7] = 0
+        data = x + 1.0e3
+        for scale in [False, True]:
+            reference = chunkedPCA(data, ncomponents=ncomp, scale=scale,
+                                   mask=mask, spectral_mask=spectral_mask,
+                                   legacy=False)
+            result = randomizedPCA(data, ncomponents=ncomp, scale=scale,
+                                   mask=mask, spectral_mask=spectral_mask,
+                                   legacy=False, seed=0, nMca=25)
+            self.assertEqual(result["pixels"], reference["pixels"])
+            self.assertTrue(numpy.allclose(result["average"],
+                                           reference["average"]))
+            self.assertTrue(numpy.allclose(result["eigenvalues"],
+                                           reference["eigenvalues"],
+                                           rtol=1.0e-4))
+            for i in range(ncomp):
+                self.assertTrue(numpy.allclose(result["eigenvectors"][i],
+                                               reference["eigenvectors"][i],
+                                               atol=1.0e-4))
+
+        if not HAS_H5PY:
+            return
+        # read from and write to HDF5
+        with h5py.File("rpca.h5", "w", driver="core",
+                       backing_store=False) as h5:
+            h5["data"] = x
+            output = h5.create_group("pca")
+            h5Result = randomizedPCA(h5["data"], ncomponents=ncomp,
+                                     scale=True, legacy=False, seed=0,
+                                     output=output, nMca=(1, "kB"))
+            result = randomizedPCA(x, ncomponents=ncomp, scale=True,
+                                   legacy=False, seed=0)
+            self.assertEqual(h5Result["scores"].name, "/pca/scores")
+            self.assertTrue(numpy.allclose(output["scores"][()],
+                                           result["scores"], rtol=1.0e-4))
+
     if MDP:
         def testPCAToolsMDP(self):
             from PyMca5.PyMcaMath.mva.PCATools import getCovarianceMatrix, numpyPCA
@@ -195,6 +365,9 @@ def getSuite(auto=True):
         testSuite.addTest(testPCATools("testPCAToolsImport"))
         testSuite.addTest(testPCATools("testPCAToolsCovariance"))
         testSuite.addTest(testPCATools("testPCAToolsPCA"))
+        testSuite.addTest(testPCATools("testPCAToolsChunkedCovariance"))
+        testSuite.addTest(testPCATools("testPCAToolsChunkedPCA"))
+        testSuite.addTest(testPCATools("testPCAToolsRandomizedPCA"))
         if MDP:
             testSuite.addTest(testPCATools("testPCAToolsMDP"))
     return testSuite
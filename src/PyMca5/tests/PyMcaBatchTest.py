@@ -188,6 +188,22 @@ def testSlowRoiFitHdf5Map(self):
     def testSlowMultiFitHdf5Map(self):
         self._assertSlowMultiFitMap('hdf5')
 
+    @unittest.skipIf(not HAS_H5PY, "skipped h5py missing")
+    def testSlowPoolFitHdf5Map(self):
+        info = self._generateData(typ='hdf5')
+        # Compare single process vs. process pool
+        result1 = self._fitMap(info, outputdir='fitresults1')
+        result2 = self._fitMap(info, outputdir='fitresults2', nproc=2)
+        self._assertEqualFitResults(result1, result2, rtol=0)
+
+    @unittest.skipIf(not HAS_H5PY, "skipped h5py missing")
+    def testSlowWarmStartFitHdf5Map(self):
+        info = self._generateData(typ='hdf5')
+        # Compare estimated vs. neighbouring starting parameters
+        result1 = self._fitMap(info, outputdir='fitresults1')
+        result2 = self._fitMap(info, outputdir='fitresults2', warmstart=True)
+        self._assertEqualFitResults(result1, result2, rtol=1e-6)
+
     def _assertFastFitMap(self, typ, outputdir='fitresults'):
         info = self._generateData(fast=True, typ=typ)
         # Compare with legacy FastXRFLinearFit
@@ -290,9 +306,10 @@ def _fastFitMap(self, info, outputdir, legacy=False):
             FastXRFLinearFit.save(outbuffer, outputdir, csv=False)
         return self._fitResultFileName(None, outputdir, fast=True, legacy=legacy)
 
-    def _slowFitMap(self, info, outputdir, legacy=False, roiwidth=0):
+    def _slowFitMap(self, info, outputdir, legacy=False, roiwidth=0,
+                    nproc=None, warmstart=False):
         """
-        Single process slow fitting
+        Single process slow fitting (pool of processes when nproc > 1)
         """
         if legacy:
             from PyMca5.PyMcaPhysics.xrf import LegacyMcaAdvancedFitBatch as McaAdvancedFitBatch
@@ -311,6 +328,8 @@ def _slowFitMap(self, info, outputdir, legacy=False, roiwidth=0):
             kwargs['edf'] = False
             kwargs['h5'] = False
             kwargs['diagnostics'] = True
+            kwargs['nproc'] = nproc
+            kwargs['warmstart'] = warmstart
         batch = McaAdvancedFitBatch.McaAdvancedFitBatch(info['cfgname'], **kwargs)
         batch.processList()
         return self._fitResultFileName(info['input'], outputdir,
@@ -674,6 +693,8 @@ def getSuite(auto=True):
         testSuite.addTest(testPyMcaBatch("testSlowFitHdf5Map"))
         testSuite.addTest(testPyMcaBatch("testSlowRoiFitHdf5Map"))
         testSuite.addTest(testPyMcaBatch("testSlowMultiFitHdf5Map"))
+        testSuite.addTest(testPyMcaBatch("testSlowPoolFitHdf5Map"))
+        testSuite.addTest(testPyMcaBatch("testSlowWarmStartFitHdf5Map"))
         testSuite.addTest(testPyMcaBatch("testFastFitSpecMap"))
         testSuite.addTest(testPyMcaBatch("testSlowFitSpecMap"))
         testSuite.addTest(testPyMcaBatch("testSlowRoiFitSpecMap"))
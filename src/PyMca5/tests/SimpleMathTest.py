@@ -58,6 +58,18 @@ def testDerivativeSinglePoint(self):
     def testDerivativeSavitzkyGolay(self):
         self._testDerivativeHelper(option="SG smoothed 3 point")
 
+    def testSavitzkyGolayCoefficients(self):
+        from PyMca5.PyMcaMath import SGModule
+        # the coefficients of the last call are kept and must not be
+        # returned for different parameters
+        derivative = SGModule.calc_coeff(2, 2, 1)
+        numpy.testing.assert_allclose(derivative,
+                                      [0.2, 0.1, 0.0, -0.1, -0.2], atol=1e-12)
+        smooth = SGModule.calc_coeff(1, 1, 0)
+        numpy.testing.assert_allclose(smooth, [1/3., 1/3., 1/3.])
+        numpy.testing.assert_allclose(SGModule.calc_coeff(2, 2, 1),
+                                      derivative)
+
 
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
@@ -67,6 +79,7 @@ def getSuite(auto=True):
         # use a predefined order
         testSuite.addTest(testSimpleMath("testDerivativeSinglePoint"))
         testSuite.addTest(testSimpleMath("testDerivativeSavitzkyGolay"))
+        testSuite.addTest(testSimpleMath("testSavitzkyGolayCoefficients"))
     return testSuite
 
 def test(auto=False):
@@ -0,0 +1,96 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2026 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import numpy
+from PyMca5.PyMcaMath.fitting import SpecfitFuns
+
+
+class testSpecfitFuns(unittest.TestCase):
+    def setUp(self):
+        state = numpy.random.RandomState(0)
+        self.spectra = state.poisson(50, (1000, 17)).astype(numpy.float32)
+
+    def _stripBackgroundLoop(self, spectra, snipWidth, filterWidth, anchors):
+        result = numpy.empty(spectra.shape, numpy.float64)
+        for k in range(spectra.shape[1]):
+            background = SpecfitFuns.SavitskyGolay(spectra[:, k], filterWidth)
+            lastAnchor = 0
+            for anchor in anchors:
+                if (anchor > lastAnchor) and (anchor < background.size):
+                    background[lastAnchor:anchor] = \
+                        SpecfitFuns.snip1d(background[lastAnchor:anchor],
+                                           snipWidth, 0)
+                    lastAnchor = anchor
+            if lastAnchor < background.size:
+                background[lastAnchor:] = \
+                    SpecfitFuns.snip1d(background[lastAnchor:], snipWidth, 0)
+            result[:, k] = background
+        return result
+
+    def testStripBackground(self):
+        for filterWidth in [0, 4, 7]:
+            for anchors in [[], [0, 999], [0, 250, 600, 999]]:
+                expected = self._stripBackgroundLoop(self.spectra, 30,
+                                                     filterWidth, anchors)
+                background = SpecfitFuns.stripbackground(self.spectra, 30, 0,
+                                                         filterWidth, anchors)
+                self.assertTrue(numpy.array_equal(expected, background))
+                background = SpecfitFuns.stripbackground(
+                                        numpy.asfortranarray(self.spectra),
+                                        30, 0, filterWidth, anchors)
+                self.assertTrue(numpy.array_equal(expected, background))
+
+    def testStripBackgroundSmoothing(self):
+        spectra = self.spectra.T.astype(numpy.float64)
+        expected = SpecfitFuns.snip1d(spectra, 20, 2)
+        background = SpecfitFuns.stripbackground(spectra.T, 20, 2)
+        self.assertTrue(numpy.array_equal(expected.T, background))
+        background = SpecfitFuns.stripbackground(spectra[0], 20, 2)
+        self.assertTrue(numpy.array_equal(expected[0], background))
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testSpecfitFuns))
+    else:
+        # use a predefined order
+        testSuite.addTest(testSpecfitFuns("testStripBackground"))
+        testSuite.addTest(testSpecfitFuns("testStripBackgroundSmoothing"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -200,6 +200,118 @@ def testStackBaseStack2DDataHandling(self):
         dummyArray = None
         referenceData = None
 
+    def testStackBaseROIIndex(self):
+        from PyMca5.PyMcaCore import StackBase
+        import os
+        import shutil
+        import tempfile
+        nrows = 20
+        ncolumns = 30
+        nchannels = 100
+        referenceData = numpy.random.RandomState(0).poisson(
+                                    10, (nrows, ncolumns, nchannels))
+        i0 = 10
+        imiddle = 40
+        i1 = 80
+        tmpDir = tempfile.mkdtemp()
+        try:
+            for mcaindex, axes in [(2, (0, 1, 2)), (1, (0, 2, 1)),
+                                   (0, (2, 0, 1))]:
+                data = DummyArray(numpy.transpose(referenceData, axes).copy())
+                for filename in [None, os.path.join(tmpDir, "index.npy")]:
+                    stackBase = StackBase.StackBase()
+                    stackBase.setROIIndexEnabled(True, filename=filename)
+                    stackBase.setStack(data, mcaindex=mcaindex)
+                    self.assertEqual(stackBase.getROIIndexSize(),
+                                     (nchannels + 1) * nrows * ncolumns * 8)
+                    imageDict = stackBase.calculateROIImages(i0, i1,
+                                                             imiddle=imiddle)
+                    self.assertTrue(numpy.allclose(imageDict['ROI'],
+                                    referenceData[:, :, i0:i1].sum(axis=-1)))
+                    self.assertTrue(numpy.allclose(imageDict['Left'],
+                                    referenceData[:, :, i0]))
+                    self.assertTrue(numpy.allclose(imageDict['Middle'],
+                                    referenceData[:, :, imiddle]))
+                    self.assertTrue(numpy.allclose(imageDict['Right'],
+                                    referenceData[:, :, i1 - 1]))
+                    background = 0.5 * (i1 - i0) * (referenceData[:, :, i0] +
+                                                    referenceData[:, :, i1 - 1])
+                    self.assertTrue(numpy.allclose(imageDict['Background'],
+                                                   background))
+                    images, names = stackBase.getStackROIImagesAndNames()
+                    self.assertEqual(len(images), len(names))
+                    self.assertTrue(numpy.allclose(images[0],
+                                    referenceData.sum(axis=-1)))
+
+                    # back to the calculation from the data
+                    stackBase.setROIIndexEnabled(False)
+                    imageDict = stackBase.calculateROIImages(i0, i1,
+                                                             imiddle=imiddle)
+                    self.assertTrue(imageDict['Maximum'] is not None)
+                    stackBase = None
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def testStackBaseDynamicSums(self):
+        from PyMca5.PyMcaCore import StackBase
+        referenceData = numpy.random.RandomState(0).poisson(
+                                    10, (25, 30, 40)).astype(numpy.float32)
+        for mcaindex in [0, 2]:
+            reference = StackBase.StackBase()
+            reference.setStack(referenceData, mcaindex=mcaindex)
+            for nworkers in [1, 4]:
+                stackBase = StackBase.StackBase()
+                # small blocks to have more blocks than threads
+                stackBase._dynamicBlockSize = 3 * 30 * 40 * 4
+                stackBase._dynamicWorkers = nworkers
+                stackBase.setStack(DummyArray(referenceData), mcaindex=mcaindex)
+                self.assertTrue(numpy.allclose(stackBase.getStackOriginalImage(),
+                                               reference.getStackOriginalImage()))
+                self.assertTrue(numpy.allclose(stackBase.getActiveCurve()[1],
+                                               reference.getActiveCurve()[1]))
+                self.assertTrue(numpy.allclose(stackBase._mcaMax,
+                                               reference._mcaMax))
+
+    def testStackBaseMaskedMca(self):
+        from PyMca5.PyMcaCore import StackBase
+        random = numpy.random.RandomState(0)
+        referenceData = random.poisson(10, (20, 30, 40)).astype(numpy.float64)
+        for mcaindex, axes in [(2, (0, 1, 2)), (1, (0, 2, 1)),
+                               (0, (2, 0, 1))]:
+            data = numpy.transpose(referenceData, axes).copy()
+            for fileindex in [i for i in range(3) if i != mcaindex]:
+                for dynamic in [False, True]:
+                    stackBase = StackBase.StackBase()
+                    stackBase._dynamicBlockSize = 2 * 30 * 40 * 8
+                    if dynamic:
+                        stackBase.setStack(DummyArray(data), mcaindex=mcaindex,
+                                           fileindex=fileindex)
+                    else:
+                        stackBase.setStack(data, mcaindex=mcaindex,
+                                           fileindex=fileindex)
+                    self.assertEqual(stackBase.fileIndex, fileindex)
+                    self.assertEqual(stackBase.mcaIndex, mcaindex)
+                    # few and most of the pixels selected
+                    for fraction in [0.1, 0.9]:
+                        mask = (random.uniform(size=(20, 30)) < fraction)
+                        mask = mask.astype(numpy.uint8)
+                        stackBase.setSelectionMask(mask)
+                        mcaDataObject = stackBase.calculateMcaDataObject()
+                        self.assertTrue(numpy.allclose(mcaDataObject.y[0],
+                                        referenceData[mask > 0].sum(axis=0)))
+                        mcaDataObject = stackBase.calculateMcaDataObject(
+                                                                mcamax=True)
+                        self.assertTrue(numpy.allclose(mcaDataObject.y[0],
+                                        referenceData[mask > 0].max(axis=0)))
+
+                    # inconsistent file and MCA indices
+                    stackBase.fileIndex = mcaindex
+                    self.assertRaises(IndexError,
+                                      stackBase.calculateMcaDataObject)
+                    stackBase.fileIndex = 3
+                    self.assertRaises(IndexError,
+                                      stackBase.calculateMcaDataObject)
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -210,6 +322,9 @@ def getSuite(auto=True):
         testSuite.addTest(testStackBase("testStackBaseImport"))
         testSuite.addTest(testStackBase("testStackBaseStack1DDataHandling"))
         testSuite.addTest(testStackBase("testStackBaseStack2DDataHandling"))
+        testSuite.addTest(testStackBase("testStackBaseROIIndex"))
+        testSuite.addTest(testStackBase("testStackBaseDynamicSums"))
+        testSuite.addTest(testStackBase("testStackBaseMaskedMca"))
     return testSuite
 
 def test(auto=False):
@@ -548,6 +548,72 @@ def _verifyBatchFitResult(self, imageFile, nRows, nColumns, live_time, nTimes, l
                                     "Incorrect value for point %d" % point)
 
 
+    @unittest.skipIf(not HAS_H5PY, "skipped h5py missing")
+    def testHdf5StackPrefetch(self):
+        import tempfile
+        import threading
+        from PyMca5.PyMcaIO import HDF5Stack1D
+        from PyMca5.PyMcaIO import PrefetchLoader
+        self._outputDir = tempfile.mkdtemp()
+        random = numpy.random.RandomState(0)
+        nFiles, nScans, nSpectra, nChannels = 3, 4, 5, 16
+        monitor = numpy.arange(1., nSpectra + 1)
+        fileList = []
+        reference = []
+        for i in range(nFiles):
+            fname = os.path.join(self._outputDir, "stack_%d.h5" % i)
+            with h5py.File(fname, "w") as h5:
+                for j in range(nScans):
+                    data = random.poisson(10, (nSpectra, nChannels))
+                    data = data.astype(numpy.float64)
+                    h5["/scan%d/measurement/mca" % (j + 1)] = data
+                    h5["/scan%d/measurement/i0" % (j + 1)] = monitor
+                    reference.append(data)
+            fileList.append(fname)
+        reference = numpy.array(reference).reshape(nFiles, -1, nChannels)
+
+        # the files and scans are read ahead in the loading order
+        for selection, expected in [({"y": "/measurement/mca"}, reference),
+                                    ({"y": "/measurement/mca",
+                                      "m": "/measurement/i0"},
+                                     reference / numpy.tile(monitor, nScans)\
+                                                 [:, None])]:
+            sequential = HDF5Stack1D.HDF5Stack1D(fileList, selection,
+                                                 nworkers=1)
+            stack = HDF5Stack1D.HDF5Stack1D(fileList, selection, nworkers=4)
+            self.assertEqual(stack.info["McaIndex"], 2)
+            self.assertTrue(numpy.allclose(sequential.data, expected))
+            self.assertTrue(numpy.array_equal(stack.data, sequential.data))
+
+        def readingThreads():
+            return [thread for thread in threading.enumerate()
+                    if thread.name.startswith("ThreadPoolExecutor")]
+
+        # cancel from the progress callback
+        calls = []
+        stack = HDF5Stack1D.HDF5Stack1D(None, None, nworkers=4)
+        stack.onProgress = lambda n: stack.cancel()
+        stack.onEnd = lambda: calls.append("end")
+        self.assertRaises(PrefetchLoader.LoadCancelled,
+                          stack.loadFileList, fileList,
+                          {"y": "/measurement/mca"})
+        self.assertEqual(calls, ["end"])
+        self.assertEqual(readingThreads(), [])
+
+        # an error while filling the stack stops the reading threads,
+        # even while the traceback keeps the loading frame alive
+        def onProgress(n):
+            raise RuntimeError("Progress error")
+        stack = HDF5Stack1D.HDF5Stack1D(None, None, nworkers=4)
+        stack.onProgress = onProgress
+        try:
+            stack.loadFileList(fileList, {"y": "/measurement/mca"})
+        except RuntimeError:
+            self.assertEqual(readingThreads(), [])
+        else:
+            self.fail("RuntimeError not raised")
+
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -559,6 +625,7 @@ def getSuite(auto=True):
         testSuite.addTest(testStackInfo("testDataFilePresence"))
         testSuite.addTest(testStackInfo("testStackFastFit"))
         testSuite.addTest(testStackInfo("testFitHdf5Stack"))
+        testSuite.addTest(testStackInfo("testHdf5StackPrefetch"))
     return testSuite
 
 def test(auto=False):
@@ -0,0 +1,307 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2023 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+import numpy
+
+
+class testStackSimpleFit(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix="pymca")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _getStack(self, nRows, nColumns, function):
+        x = numpy.arange(300.)
+        random = numpy.random.RandomState(0)
+        stack = numpy.zeros((nRows, nColumns, x.size), numpy.float64)
+        for row in range(nRows):
+            for column in range(nColumns):
+                parameters = [1000. + 500 * random.rand(),
+                              140. + 20 * random.rand(),
+                              20. + 5 * random.rand(),
+                              0.5]
+                stack[row, column] = 10.0 + 0.05 * x + \
+                        function(parameters[:4 if "voigt" in \
+                                 function.__name__ else 3], x)
+        return x, random.poisson(stack).astype(numpy.float64)
+
+    def _processStack(self, x, stack, theory, blockSize, mask=None,
+                      fixedLenghtOutput=True):
+        from PyMca5.PyMcaMath.fitting import SimpleFitModule
+        from PyMca5.PyMcaMath.fitting import SpecfitFunctions
+        from PyMca5.PyMcaMath.fitting import StackSimpleFit
+        fit = SimpleFitModule.SimpleFit()
+        fit.importFunctions(SpecfitFunctions)
+        fit.setFitFunction(theory)
+        fit.setBackgroundFunction("Linear")
+        fit.setConfiguration({"fit": {"strip_flag": 0,
+                     "function_estimation_policy": "Estimate once",
+                     "background_estimation_policy": "Estimate once"}})
+        stackFit = StackSimpleFit.StackSimpleFit(fit)
+        stackFit.blockSize = blockSize
+        stackFit.fixedLenghtOutput = fixedLenghtOutput
+        stackFit.setOutputDirectory(self.path)
+        stackFit.setOutputFileBaseName("fit_%s" % blockSize)
+        stackFit.setData(x, stack)
+        stackFit.processStack(mask=mask)
+        return stackFit
+
+    def testStackFit(self):
+        from PyMca5.PyMcaMath.fitting import SpecfitFunctions
+        fitfuns = SpecfitFunctions.fitfuns
+        for theory, function in [("Lorentz", fitfuns.lorentz),
+                                 ("Pseudo-Voigt Line", fitfuns.pvoigt)]:
+            x, stack = self._getStack(4, 6, function)
+            mask = numpy.ones(stack.shape[:2], dtype=numpy.uint8)
+            mask[1, 2:4] = 0
+            single = self._processStack(x, stack, theory, None, mask=mask)
+            block = self._processStack(x, stack, theory, 5, mask=mask)
+            self.assertTrue(block._isStackFitPossible())
+            self.assertFalse(single._isStackFitPossible())
+            self.assertEqual(single._parameters, block._parameters)
+            for key in single._images:
+                numpy.testing.assert_allclose(block._images[key],
+                                              single._images[key],
+                                              rtol=1.0e-4)
+            for key in single._sigmas:
+                numpy.testing.assert_allclose(block._sigmas[key],
+                                              single._sigmas[key],
+                                              rtol=1.0e-3)
+            self.assertFalse(block._images["chisq"][mask > 0].min() == 0)
+            self.assertFalse(block._images["chisq"][mask == 0].any())
+            self.assertTrue(os.path.exists(block.getOutputFileNames()["edf"]))
+
+    def testStripCache(self):
+        from PyMca5.PyMcaMath.fitting import SimpleFitModule
+        from PyMca5.PyMcaMath.fitting import SpecfitFunctions
+        from PyMca5.PyMcaMath.fitting import SpecfitFuns
+        x, stack = self._getStack(1, 2, SpecfitFunctions.fitfuns.gauss)
+        fit = SimpleFitModule.SimpleFit()
+        fit.importFunctions(SpecfitFunctions)
+        fit.setFitFunction("Gaussians")
+        fit.setBackgroundFunction("Linear")
+        for y in stack[0]:
+            fit.setData(x, y)
+            z = fit._z
+            fit.estimate()
+            # the estimation does not calculate the background again
+            self.assertTrue(fit._z is z)
+            numpy.testing.assert_array_equal(z, fit._getStripBackground())
+        # a new strip configuration is taken into account
+        fit.setConfiguration({"fit": {"stripwidth": 2,
+                                      "stripiterations": 100}})
+        self.assertFalse(fit._z is z)
+        numpy.testing.assert_array_equal(fit._z, fit._getStripBackground())
+
+        # the estimation functions share the strip of the same spectrum
+        fitfuns = SpecfitFunctions.SpecfitFunctions()
+        y = stack[0, 0]
+        zz = fitfuns.estimateStrip(y)
+        numpy.testing.assert_array_equal(zz, SpecfitFuns.subac(y, 1.0, 10000))
+        zz[:] = 0
+        numpy.testing.assert_array_equal(fitfuns.estimateStrip(y.copy()),
+                                         SpecfitFuns.subac(y, 1.0, 10000))
+        y = stack[0, 1]
+        numpy.testing.assert_array_equal(fitfuns.estimateStrip(y),
+                                         SpecfitFuns.subac(y, 1.0, 10000))
+
+    def testVariableLengthOutput(self):
+        import h5py
+        from PyMca5.PyMcaMath.fitting import SpecfitFunctions
+        x, stack = self._getStack(4, 6, SpecfitFunctions.fitfuns.lorentz)
+        mask = numpy.ones(stack.shape[:2], dtype=numpy.uint8)
+        mask[1, 2:4] = 0
+        images = self._processStack(x, stack, "Lorentz", None, mask=mask)
+        results = []
+        for blockSize in [None, 4]:
+            stackFit = self._processStack(x, stack, "Lorentz", blockSize,
+                                          mask=mask, fixedLenghtOutput=False)
+            fileName = stackFit.getOutputFileNames()["h5"]
+            with h5py.File(fileName, "r") as h5:
+                process = h5["entry/fit_process"]
+                names = [name.decode() for name in \
+                         process["parameter_names"][()]]
+                self.assertEqual(names, images._parameters)
+                self.assertTrue("configuration" in process)
+                group = process["results"]
+                results.append(dict([(key, group[key][()]) for key in group]))
+        single, block = results
+        numpy.testing.assert_array_equal(single["status"][mask > 0], 0)
+        numpy.testing.assert_array_equal(single["status"][mask == 0], -1)
+        numpy.testing.assert_array_equal(block["status"], single["status"])
+        numpy.testing.assert_array_equal(block["niter"], single["niter"])
+        for key in single:
+            numpy.testing.assert_allclose(block[key], single[key],
+                                          rtol=1.0e-3)
+        for name in images._parameters:
+            numpy.testing.assert_allclose(single[name][mask > 0],
+                                          images._images[name][mask > 0],
+                                          rtol=1.0e-5)
+            self.assertTrue(numpy.isnan(single[name][mask == 0]).all())
+
+    def testFitResultBuffer(self):
+        import h5py
+        from PyMca5.PyMcaMath.fitting import FitResultBuffer
+        fileName = os.path.join(self.path, "buffer.h5")
+        with FitResultBuffer.FitResultBuffer(fileName, (3, 4),
+                                             blockSize=5) as output:
+            output.add(numpy.arange(7, 1, -1), numpy.arange(7, 1, -1),
+                       names=["A", "B"],
+                       values=numpy.arange(12.).reshape(6, 2),
+                       niter=3)
+            output.add(0, 10., names=["B", "C"], values=[20., 30.],
+                       sigmas=[2., 3.])
+            output.add([9, 11], numpy.nan,
+                       status=FitResultBuffer.STATUS_FAILED)
+            self.assertEqual(len(output), 9)
+            self.assertEqual(output.parameterNames, ["A", "B", "C"])
+        with h5py.File(fileName, "r") as h5:
+            results = h5["entry/fit_process/results"]
+            chisq = numpy.ravel(results["chisq"][()])
+            status = numpy.ravel(results["status"][()])
+            niter = numpy.ravel(results["niter"][()])
+            a = numpy.ravel(results["A"][()])
+            b = numpy.ravel(results["B"][()])
+            c = numpy.ravel(results["C"][()])
+            cErrors = numpy.ravel(results["C_errors"][()])
+        numpy.testing.assert_array_equal(chisq[2:8], numpy.arange(2, 8))
+        numpy.testing.assert_array_equal(a[2:8], numpy.arange(10., -1, -2))
+        numpy.testing.assert_array_equal(b[2:8], numpy.arange(11., 0, -2))
+        numpy.testing.assert_array_equal(niter[2:8], 3)
+        self.assertEqual(chisq[0], 10.)
+        self.assertTrue(numpy.isnan(a[0]))
+        self.assertEqual(b[0], 20.)
+        self.assertEqual(c[0], 30.)
+        self.assertEqual(cErrors[0], 3.)
+        self.assertTrue(numpy.isnan(c[1:]).all())
+        numpy.testing.assert_array_equal(status,
+                                         [0, -1, 0, 0, 0, 0, 0, 0,
+                                          -1, 1, -1, 1])
+
+    def testSimpleFitAll(self):
+        import h5py
+        from PyMca5.PyMcaMath.fitting import SimpleFitModule
+        from PyMca5.PyMcaMath.fitting import SpecfitFunctions
+        from PyMca5.PyMcaMath.fitting import SimpleFitAll
+        lorentz = SpecfitFunctions.fitfuns.lorentz
+        x = numpy.arange(300.)
+        random = numpy.random.RandomState(0)
+        curves = []
+        for i in range(4):
+            y = 10.0 + 0.05 * x + lorentz([1000. + 100 * i, 100., 15.], x)
+            if i == 2:
+                # a curve with more parameters than the others
+                y += lorentz([800., 220., 15.], x)
+            curves.append(random.poisson(y).astype(numpy.float64))
+        fit = SimpleFitModule.SimpleFit()
+        fit.importFunctions(SpecfitFunctions)
+        fit.setFitFunction("Lorentz")
+        fit.setBackgroundFunction("Linear")
+        fit.setConfiguration({"fit": {"strip_flag": 0,
+                     "function_estimation_policy": "Estimate always",
+                     "background_estimation_policy": "Estimate always"}})
+        results = []
+        for curveEntries in [True, False]:
+            fitAll = SimpleFitAll.SimpleFitAll(fit)
+            fitAll.curveEntries = curveEntries
+            fitAll.setOutputDirectory(self.path)
+            fitAll.setOutputFileName("fitall_%d.h5" % curveEntries)
+            fitAll.setData(x, curves)
+            fitAll.processAll()
+            with h5py.File(fitAll.getOutputFileName(), "r") as h5:
+                self.assertEqual(h5["fit_summary"].attrs["default"],
+                                 "result")
+                self.assertEqual(h5["fit_summary/title"][()].decode(),
+                                 "Summary of fit_0 to fit_3")
+                group = h5["fit_summary/result"]
+                self.assertEqual(group["chisq"].dtype, numpy.float32)
+                summary = dict([(key, group[key][()]) for key in group])
+                curveResults = []
+                for i in range(len(curves)):
+                    entry = "fit_%d" % i
+                    self.assertEqual(entry in h5, curveEntries)
+                    if curveEntries:
+                        result = h5[entry + "/fit_process/results"]
+                        names = [name.decode() for name in \
+                                 result["parameter_names"][()]]
+                        values = result["parameter_values"][()]
+                        curveResults.append((result["chisq"][()],
+                                             dict(zip(names, values))))
+            results.append(summary)
+            numpy.testing.assert_array_equal(summary["index"],
+                                             numpy.arange(len(curves)))
+            numpy.testing.assert_array_equal(summary["status"], 0)
+            for i, (chisq, values) in enumerate(curveResults):
+                self.assertAlmostEqual(summary["chisq"][i], chisq, places=3)
+                for name in values:
+                    self.assertAlmostEqual(summary[name][i], values[name],
+                                           delta=1.0e-5 * abs(values[name]))
+        withEntries, withoutEntries = results
+        self.assertEqual(sorted(withEntries.keys()),
+                         sorted(withoutEntries.keys()))
+        # the parameters of the additional peak only exist for one curve
+        self.assertTrue("Height_2" in withEntries)
+        self.assertTrue(numpy.isnan(withEntries["Height"][2]))
+        for key in withEntries:
+            numpy.testing.assert_array_equal(withEntries[key],
+                                             withoutEntries[key])
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testStackSimpleFit))
+    else:
+        # use a predefined order
+        testSuite.addTest(testStackSimpleFit("testStackFit"))
+        testSuite.addTest(testStackSimpleFit("testStripCache"))
+        testSuite.addTest(testStackSimpleFit("testVariableLengthOutput"))
+        testSuite.addTest(testStackSimpleFit("testFitResultBuffer"))
+        testSuite.addTest(testStackSimpleFit("testSimpleFitAll"))
+    return testSuite
+
+def test(auto=False):
+    return unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        auto = False
+    else:
+        auto = True
+    result = test(auto)
+    sys.exit(not result.wasSuccessful())
@@ -0,0 +1,130 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2026 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import numpy
+
+
+def getSpectrum(energy, edge=8980., jump=1.0):
+    mu = jump / (1.0 + numpy.exp(-(energy - edge) / 3.))
+    mu *= 1.0 + 0.05 * numpy.sin((energy - edge) / 20.) * \
+                numpy.exp(-(energy - edge) / 400.) * (energy > edge)
+    mu += 1.0e-4 * (energy - energy[0]) / 100. + 0.3
+    return mu
+
+
+class testXASClass(unittest.TestCase):
+    def setUp(self):
+        # strictly equidistant energies are not interpolated prior to the
+        # edge determination, non equidistant energies are
+        self.energy = 8800. + 2.0 * numpy.arange(500.)
+        self.energyNonEquidistant = numpy.concatenate(
+                        [numpy.linspace(8800., 8950., 80, endpoint=False),
+                         numpy.linspace(8950., 9800., 500)])
+        numpy.random.seed(100)
+        self.mu = self._getSpectra(self.energy)
+        self.muNonEquidistant = self._getSpectra(self.energyNonEquidistant)
+
+    def _getSpectra(self, energy, nSpectra=12):
+        mu = numpy.zeros((nSpectra, energy.size))
+        for i in range(nSpectra):
+            mu[i] = getSpectrum(energy,
+                                edge=8975. + 6 * numpy.random.random(),
+                                jump=1.0 + 0.2 * numpy.random.random())
+            mu[i] += 0.002 * numpy.random.standard_normal(energy.size)
+        return mu
+
+    def testProcessSpectra(self):
+        from PyMca5.PyMcaPhysics.xas import XASClass
+        configurations = [{},
+            {"Normalization": {"JumpNormalizationMethod": "Constant",
+                               "PreEdge": {"Polynomial": "Victoreen"},
+                               "PostEdge": {"Polynomial": "Cubic"}}},
+            {"EXAFS": {"KWeight": 2, "KMax": 12,
+                       "Knots": {"Number": 3, "Values": [4, 7, 10],
+                                 "Orders": [3, 3, 3, 3]}},
+             "FT": {"Window": "Hanning", "WindowRange": [3, 11]}},
+            {"Normalization": {"E0Method": "Manual", "E0Value": 8977.},
+             "FT": {"Window": "Tukey"}},
+            {"Normalization": {"E0Method": "Auto - 9pt SG"},
+             "EXAFS": {"Knots": {"Number": 0, "Orders": [2, 3]}},
+             "FT": {"Window": "Box"}}]
+        keys = ["Edge", "Jump", "Mu", "NormalizedMu", "NormalizedBackground",
+                "NormalizedSignal", "NormalizedPlotMin", "NormalizedPlotMax",
+                "EXAFSNormalized", "KMax", "KnotsX", "KnotsY"]
+        # the derivative of the interpolated spectra presents plateaus,
+        # the automatic edge determination is only meaningful to compare
+        # when no interpolation is involved
+        cases = [(self.energy, self.mu, configuration) \
+                                    for configuration in configurations]
+        cases += [(self.energyNonEquidistant, self.muNonEquidistant,
+                   configuration) for configuration in configurations \
+                   if configuration.get("Normalization", {}).get("E0Method") \
+                                                            == "Manual"]
+        for energy, mu, configuration in cases:
+            analyzer = XASClass.XASClass()
+            analyzer.setConfiguration(configuration)
+            result = analyzer.processSpectra(energy, mu)
+            for i in range(mu.shape[0]):
+                analyzer.setSpectrum(energy, mu[i])
+                ddict = analyzer.processSpectrum()
+                for key in keys:
+                    reference = numpy.asarray(ddict[key], dtype=numpy.float64)
+                    scale = numpy.abs(reference).max()
+                    delta = numpy.abs(reference - result[key][i]).max()
+                    self.assertTrue(delta <= 1.0e-5 * scale,
+                        "%s spectrum %d differs for configuration %s" % \
+                        (key, i, configuration))
+                for key in ["FTIntensity", "FTReal", "FTImaginary"]:
+                    reference = ddict["FT"][key]
+                    scale = numpy.abs(reference).max()
+                    delta = numpy.abs(reference - result["FT"][key][i]).max()
+                    self.assertTrue(delta <= 1.0e-5 * scale,
+                        "FT %s spectrum %d differs for configuration %s" % \
+                        (key, i, configuration))
+
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testXASClass))
+    else:
+        # use a predefined order
+        testSuite.addTest(testXASClass("testProcessSpectra"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
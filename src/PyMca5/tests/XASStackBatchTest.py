@@ -0,0 +1,177 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2026 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+try:
+    import h5py
+    HAS_H5PY = True
+except ImportError:
+    HAS_H5PY = False
+
+
+def getSpectrum(energy, edge=8980., jump=1.0):
+    mu = jump / (1.0 + numpy.exp(-(energy - edge) / 3.))
+    mu *= 1.0 + 0.05 * numpy.sin((energy - edge) / 20.)
+    mu += 1.0e-6 * energy
+    return mu
+
+
+class testXASStackBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix="pymca")
+        self.energy = numpy.linspace(8800., 9800., 600)
+        self.data = self._getData(self.energy)
+
+    def _getData(self, energy):
+        nRows, nColumns = 3, 7
+        data = numpy.zeros((nRows, nColumns, energy.size))
+        for i in range(nRows):
+            for j in range(nColumns):
+                data[i, j] = getSpectrum(energy,
+                                         edge=8975. + i + 0.5 * j,
+                                         jump=1.0 + 0.1 * j)
+        return data
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    @unittest.skipIf(not HAS_H5PY, "skipped h5py missing")
+    def testProcessMultipleSpectra(self):
+        from PyMca5.PyMcaPhysics.xas import XASClass
+        from PyMca5.PyMcaPhysics.xas import XASStackBatch
+        analyzer = XASClass.XASClass()
+        batch = XASStackBatch.XASStackBatch(analyzer=XASClass.XASClass())
+        # the linspace grid is not strictly equidistant and the spectra
+        # are interpolated prior to the automatic edge determination
+        grids = [("", self.energy, self.data)]
+        equidistant = 8800. + 2.0 * numpy.arange(500.)
+        grids.append(("equidistant_", equidistant,
+                      self._getData(equidistant)))
+        mask = numpy.ones(self.data.shape[:2], dtype=numpy.uint8)
+        mask[1, 2] = 0
+        for prefix, energy, data in grids:
+            self._checkProcessMultipleSpectra(batch, analyzer, prefix,
+                                              energy, data, mask)
+
+    def _checkProcessMultipleSpectra(self, batch, analyzer, prefix,
+                                     energy, data, mask):
+        for name, compression in [("contiguous", None), ("gzip", "gzip")]:
+            chunks = compression is not None
+            result = batch.processMultipleSpectra(energy, data,
+                                                  mask=mask,
+                                                  directory=self.tmpDir,
+                                                  name=prefix + name,
+                                                  chunks=chunks,
+                                                  compression=compression)
+            self.assertEqual(result["names"], ["Jump", "Edge"])
+            fname = os.path.join(self.tmpDir, prefix + name + ".h5")
+            with h5py.File(fname, "r") as h5:
+                group = h5["xas_analysis"]
+                mu = group["spectrum"]["mu"]
+                intensity = group["FT"]["Intensity"]
+                self.assertEqual(mu.compression, compression)
+                if chunks:
+                    self.assertEqual(mu.chunks,
+                                     (1, data.shape[1], mu.shape[2]))
+                else:
+                    self.assertEqual(mu.chunks, None)
+                for i in range(data.shape[0]):
+                    for j in range(data.shape[1]):
+                        if not mask[i, j]:
+                            self.assertEqual(group["edge"][i, j], 0)
+                            self.assertFalse(numpy.any(mu[i, j]))
+                            continue
+                        analyzer.setSpectrum(energy, data[i, j])
+                        ddict = analyzer.processSpectrum()
+                        self.assertAlmostEqual(group["edge"][i, j],
+                                               ddict["Edge"], 2)
+                        self.assertAlmostEqual(result["images"][0, i, j],
+                                               ddict["Jump"], 4)
+                        self.assertTrue(numpy.allclose(mu[i, j],
+                                                       ddict["Mu"],
+                                                       rtol=1.0e-5))
+                        self.assertTrue(numpy.allclose(intensity[i, j],
+                                            ddict["FT"]["FTIntensity"],
+                                            rtol=1.0e-4, atol=1.0e-6))
+
+    @unittest.skipIf(not HAS_H5PY, "skipped h5py missing")
+    def testProcessMultipleSpectraWorkers(self):
+        from PyMca5.PyMcaPhysics.xas import XASClass
+        from PyMca5.PyMcaPhysics.xas import XASStackBatch
+        batch = XASStackBatch.XASStackBatch(analyzer=XASClass.XASClass())
+        mask = numpy.ones(self.data.shape[:2], dtype=numpy.uint8)
+        mask[0, 1] = 0
+        mask[2, 5] = 0
+        results = {}
+        for nworkers in [1, 2]:
+            name = "workers%d" % nworkers
+            batch.processMultipleSpectra(self.energy, self.data,
+                                         mask=mask,
+                                         directory=self.tmpDir,
+                                         name=name,
+                                         nworkers=nworkers)
+            fname = os.path.join(self.tmpDir, name + ".h5")
+            results[nworkers] = {}
+            with h5py.File(fname, "r") as h5:
+                def visit(path, item):
+                    if isinstance(item, h5py.Dataset):
+                        results[nworkers][path] = item[()]
+                h5.visititems(visit)
+        self.assertEqual(sorted(results[1].keys()),
+                         sorted(results[2].keys()))
+        for path in results[1]:
+            self.assertTrue(numpy.array_equal(results[1][path],
+                                              results[2][path]),
+                            "Different results for %s" % path)
+
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testXASStackBatch))
+    else:
+        # use a predefined order
+        testSuite.addTest(testXASStackBatch("testProcessMultipleSpectra"))
+        testSuite.addTest(\
+            testXASStackBatch("testProcessMultipleSpectraWorkers"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
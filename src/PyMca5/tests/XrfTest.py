@@ -349,6 +349,57 @@ def testTrainingDataFit(self):
             self.assertTrue( delta < 1.0e-5,
                 "Error for <%s> concentration %g != %g" % (key, internal, fp))
 
+    def testWarmStartFit(self):
+        from PyMca5.PyMcaIO import specfilewrapper as specfile
+        from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+        from PyMca5.PyMcaIO import ConfigDict
+        trainingDataFile = os.path.join(self.dataDir, "XRFSpectrum.mca")
+        sf = specfile.Specfile(trainingDataFile)
+        y = sf[1].mca(1)
+        sf = None
+
+        configuration = ConfigDict.ConfigDict()
+        configuration.readfp(StringIO(cfg))
+        configuration["fit"]["linearfitflag"] = 0
+        configuration["fit"]["maxiter"] = 50
+        mcaFit = ClassMcaTheory.ClassMcaTheory()
+        configuration = mcaFit.configure(configuration)
+        x = numpy.arange(y.size).astype(numpy.float64)
+        xmin = configuration["fit"]["xmin"]
+        xmax = configuration["fit"]["xmax"]
+
+        # nothing estimated yet
+        mcaFit.setData(x, y, xmin=xmin, xmax=xmax)
+        self.assertFalse(mcaFit.setStartingParameters([1.0]))
+        mcaFit.estimate()
+        mcaFit.startFit()
+        neighbour = numpy.array(mcaFit.fittedpar)
+        self.assertFalse(mcaFit.setStartingParameters(neighbour[:-1]))
+
+        # spectrum of a "neighbouring pixel"
+        y2 = numpy.random.RandomState(0).poisson(y * 1.05).astype(numpy.float64)
+        mcaFit.setData(x, y2, xmin=xmin, xmax=xmax)
+        mcaFit.estimate()
+        mcaFit.startFit()
+        coldIterations = mcaFit.getNumberOfIterations()
+        coldChisq = mcaFit.chisq
+        coldParameters = numpy.array(mcaFit.fittedpar)
+
+        mcaFit.setData(x, y2, xmin=xmin, xmax=xmax)
+        self.assertTrue(mcaFit.setStartingParameters(neighbour))
+        mcaFit.startFit()
+        warmIterations = mcaFit.getNumberOfIterations()
+        self.assertTrue(warmIterations <= coldIterations,
+                        "Warm start needs %d iterations instead of %d" %
+                        (warmIterations, coldIterations))
+        self.assertTrue(mcaFit.chisq < 1.01 * coldChisq)
+        sigma = numpy.array(mcaFit.sigmapar)
+        delta = numpy.abs(numpy.array(mcaFit.fittedpar) - coldParameters)
+        self.assertTrue(numpy.all(delta <= sigma),
+                        "Warm and cold start results differ")
+        self.assertEqual(mcaFit.imagingDigestResult()["niter"],
+                         warmIterations)
+
     def testStainlessSteelDataFit(self):
         from PyMca5.PyMcaIO import specfilewrapper as specfile
         from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
@@ -555,6 +606,7 @@ def getSuite(auto=True):
         testSuite.addTest(testXrf("testTrainingDataDirectoryPresence"))
         testSuite.addTest(testXrf("testTrainingDataFilePresence"))
         testSuite.addTest(testXrf("testTrainingDataFit"))
+        testSuite.addTest(testXrf("testWarmStartFit"))
         testSuite.addTest(testXrf("testStainlessSteelDataFit"))
     return testSuite
 
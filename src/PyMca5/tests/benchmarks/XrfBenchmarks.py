@@ -0,0 +1,396 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2026 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__doc__ = """
+Benchmarks of the XRF fitting hot paths on synthetic stacks.
+
+The stacks are generated with :mod:`PyMca5.tests.XrfData` so the same
+parameters always give the same data. Usage::
+
+    python -m PyMca5.tests.benchmarks --shape=20x50 --output=results.json
+
+The JSON output contains the software versions, the benchmark parameters
+and the elapsed times of each repetition.
+"""
+import os
+import sys
+import time
+import json
+import getopt
+import logging
+import platform
+import tempfile
+import shutil
+import numpy
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+_logger = logging.getLogger(__name__)
+
+BENCHMARKS = ["FastXRFLinearFit",
+              "McaAdvancedFitBatch",
+              "StackROIBatch",
+              "StackBase",
+              "PCA"]
+
+
+def _modifyConfiguration(configuration):
+    configuration["concentrations"]["usematrix"] = 0
+    configuration["concentrations"]["useautotime"] = 1
+    configuration["fit"]["stripalgorithm"] = 1
+
+
+def generateStack(nRows=20, nColumns=50):
+    """
+    :param int nRows:
+    :param int nColumns:
+    :returns tuple: data(nRows, nColumns, nChannels), liveTime(nRows, nColumns),
+                    configuration
+    """
+    from PyMca5.tests import XrfData
+    info = XrfData.generate(modfunc=_modifyConfiguration,
+                            nRows=nRows, nColumns=nColumns, same=False)
+    return info["data"][0], info["liveTime"][0], info["configuration"]
+
+
+def timeit(func, repeat=3):
+    """
+    :param callable func: function to be timed (no arguments)
+    :param int repeat: number of calls
+    :returns list: elapsed time of each call in seconds
+    """
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def _result(name, parameters, nSpectra, times):
+    best = min(times)
+    result = {"name": name,
+              "parameters": parameters,
+              "spectra": nSpectra,
+              "times": times,
+              "best": best}
+    if best > 0:
+        result["spectra_per_second"] = nSpectra / best
+    _logger.info("%s %s: %.3f s", name, parameters, best)
+    return result
+
+
+def benchmarkFastXRFLinearFit(data, liveTime, configuration, repeat=3):
+    from PyMca5.PyMcaPhysics.xrf import FastXRFLinearFit
+    from PyMca5.PyMcaPhysics.xrf.XRFBatchFitOutput import OutputBuffer
+    nSpectra = data.shape[0] * data.shape[1]
+    results = []
+    for refit in (False, True):
+        for weight in (0, 1, 2):
+            for concentrations in (False, True):
+                fastFit = FastXRFLinearFit.FastXRFLinearFit()
+                fastFit.setFitConfiguration(configuration)
+
+                def run():
+                    outbuffer = OutputBuffer(nosave=True)
+                    fastFit.fitMultipleSpectra(y=data,
+                                               weight=weight,
+                                               refit=refit,
+                                               concentrations=concentrations,
+                                               livetime=liveTime,
+                                               outbuffer=outbuffer)
+                parameters = {"refit": refit,
+                              "weight": weight,
+                              "concentrations": concentrations}
+                results.append(_result("FastXRFLinearFit", parameters,
+                                       nSpectra, timeit(run, repeat=repeat)))
+    return results
+
+
+def benchmarkMcaAdvancedFitBatch(nRows=4, nColumns=5, repeat=1):
+    from PyMca5.tests import XrfData
+    from PyMca5.PyMcaPhysics.xrf import McaAdvancedFitBatch
+    from PyMca5.PyMcaPhysics.xrf.XRFBatchFitOutput import OutputBuffer
+    nSpectra = nRows * nColumns
+    results = []
+    path = tempfile.mkdtemp(prefix="pymcabench")
+    try:
+        for linear, warmstart in [(True, False), (False, False), (False, True)]:
+            def modfunc(configuration):
+                _modifyConfiguration(configuration)
+                configuration["fit"]["linearfitflag"] = int(linear)
+            filename = os.path.join(path, "Map.h5")
+            info = XrfData.generateHdf5Map(filename, nRows=nRows,
+                                           nColumns=nColumns, same=False,
+                                           modfunc=modfunc)
+            cfgname = os.path.join(path, "Map.cfg")
+            selection = {'x': [], 'm': [], 'y': ['/xrf/mca00/data']}
+
+            def run():
+                outbuffer = OutputBuffer(nosave=True, diagnostics=True)
+                batch = McaAdvancedFitBatch.McaAdvancedFitBatch(
+                                    cfgname, filelist=info["filelist"],
+                                    outputdir=path, selection=selection,
+                                    quiet=True, outbuffer=outbuffer,
+                                    warmstart=warmstart)
+                batch.processList()
+            parameters = {"linear": linear, "warmstart": warmstart}
+            results.append(_result("McaAdvancedFitBatch", parameters,
+                                   nSpectra, timeit(run, repeat=repeat)))
+    finally:
+        shutil.rmtree(path)
+    return results
+
+
+def _roiConfiguration(nChannels, nRois=10):
+    config = {"ROI": {"roilist": [], "roidict": {}}}
+    width = nChannels // (2 * nRois)
+    for i in range(nRois):
+        name = "roi%d" % i
+        start = (2 * i + 0.5) * width
+        config["ROI"]["roilist"].append(name)
+        config["ROI"]["roidict"][name] = {"from": start,
+                                          "to": start + width,
+                                          "type": "Channel"}
+    return config
+
+
+def benchmarkStackROIBatch(data, repeat=3):
+    from PyMca5.PyMcaCore import StackROIBatch
+    nSpectra = data.shape[0] * data.shape[1]
+    x = numpy.arange(data.shape[-1], dtype=numpy.float64)
+    configuration = _roiConfiguration(data.shape[-1])
+    results = []
+    for net in (False, True):
+        for xAtMinMax in (False, True):
+            instance = StackROIBatch.StackROIBatch()
+
+            def run():
+                instance.batchROIMultipleSpectra(x=x, y=data,
+                                                 configuration=configuration,
+                                                 net=net, xAtMinMax=xAtMinMax,
+                                                 save=False)
+            parameters = {"net": net, "xAtMinMax": xAtMinMax}
+            results.append(_result("StackROIBatch", parameters,
+                                   nSpectra, timeit(run, repeat=repeat)))
+    return results
+
+
+def benchmarkStackBase(data, repeat=3):
+    from PyMca5.PyMcaCore import StackBase
+    nSpectra = data.shape[0] * data.shape[1]
+    results = []
+    stackBase = StackBase.StackBase()
+    stackBase.setStack(data, mcaindex=2)
+    parameters = {"dynamic": False}
+    results.append(_result("StackBase.stackUpdated", parameters, nSpectra,
+                           timeit(stackBase.stackUpdated, repeat=repeat)))
+    if h5py is None:
+        _logger.warning("h5py missing: dynamic stack not benchmarked")
+        return results
+    path = tempfile.mkdtemp(prefix="pymcabench")
+    try:
+        filename = os.path.join(path, "stack.h5")
+        with h5py.File(filename, "w") as h5:
+            h5.create_dataset("data", data=data, chunks=True)
+        with h5py.File(filename, "r") as h5:
+            stackBase = StackBase.StackBase()
+            stackBase.setStack(h5["data"], mcaindex=2)
+            parameters = {"dynamic": True}
+            results.append(_result("StackBase.stackUpdated", parameters,
+                                   nSpectra,
+                                   timeit(stackBase.stackUpdated,
+                                          repeat=repeat)))
+            stackBase = None
+    finally:
+        shutil.rmtree(path)
+    return results
+
+
+def generatePCAStack(nRows=50, nColumns=100, nChannels=1024, nComponents=5):
+    """
+    :param int nRows:
+    :param int nColumns:
+    :param int nChannels:
+    :param int nComponents: rank of the noiseless data
+    :returns ndarray: float32 data(nRows, nColumns, nChannels)
+    """
+    random = numpy.random.RandomState(0)
+    components = random.rand(nComponents, nChannels)
+    data = numpy.dot(random.rand(nRows, nColumns, nComponents), components) + \
+           0.1 * random.rand(nRows, nColumns, nChannels)
+    return data.astype(numpy.float32)
+
+
+def benchmarkPCA(nRows=50, nColumns=100, channels=(256, 1024, 2048),
+                 ncomponents=10, repeat=3):
+    """
+    Compare chunkedPCA and randomizedPCA. The covariance matrix of
+    chunkedPCA grows with the square of the number of channels, therefore
+    randomizedPCA is expected to be faster for the largest ones. A warning
+    is logged when it is not.
+    """
+    from PyMca5.PyMcaMath.mva import PCATools
+    nSpectra = nRows * nColumns
+    results = []
+    for nChannels in channels:
+        data = generatePCAStack(nRows=nRows, nColumns=nColumns,
+                                nChannels=nChannels)
+        best = {}
+        for method in ["chunkedPCA", "randomizedPCA"]:
+            function = getattr(PCATools, method)
+
+            def run():
+                function(data, ncomponents=ncomponents)
+            parameters = {"method": method,
+                          "channels": nChannels,
+                          "ncomponents": ncomponents}
+            result = _result("PCA", parameters, nSpectra,
+                             timeit(run, repeat=repeat))
+            best[method] = result["best"]
+            results.append(result)
+        if best["randomizedPCA"] > 0:
+            speedup = best["chunkedPCA"] / best["randomizedPCA"]
+        else:
+            speedup = None
+        results[-1]["speedup"] = speedup
+        _logger.info("randomizedPCA speedup with %d channels: %s",
+                     nChannels, speedup)
+    if (speedup is not None) and (speedup <= 1):
+        _logger.warning("randomizedPCA not faster than chunkedPCA "
+                        "with %d channels", channels[-1])
+    return results
+
+
+def environment():
+    """
+    :returns dict: versions of the software and machine description
+    """
+    from PyMca5 import version
+    env = {"pymca": version(),
+           "python": platform.python_version(),
+           "numpy": numpy.__version__,
+           "platform": platform.platform(),
+           "processor": platform.processor(),
+           "cpu_count": os.cpu_count()}
+    if h5py is not None:
+        env["h5py"] = h5py.version.version
+    return env
+
+
+def run(benchmarks=None, shape=(20, 50), mcaShape=(4, 5), repeat=3):
+    """
+    :param list benchmarks: names from `BENCHMARKS` (all by default)
+    :param tuple shape: rows and columns of the stacks
+    :param tuple mcaShape: rows and columns of the McaAdvancedFitBatch map
+    :param int repeat: number of repetitions of each timing
+    :returns dict: JSON serializable results
+    """
+    if benchmarks is None:
+        benchmarks = BENCHMARKS
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            raise ValueError("Unknown benchmark %s" % name)
+    data, liveTime, configuration = generateStack(*shape)
+    results = []
+    if "FastXRFLinearFit" in benchmarks:
+        results += benchmarkFastXRFLinearFit(data, liveTime, configuration,
+                                             repeat=repeat)
+    if "McaAdvancedFitBatch" in benchmarks:
+        if h5py is None:
+            _logger.warning("h5py missing: McaAdvancedFitBatch not benchmarked")
+        else:
+            results += benchmarkMcaAdvancedFitBatch(*mcaShape, repeat=repeat)
+    if "StackROIBatch" in benchmarks:
+        results += benchmarkStackROIBatch(data, repeat=repeat)
+    if "StackBase" in benchmarks:
+        results += benchmarkStackBase(data, repeat=repeat)
+    if "PCA" in benchmarks:
+        results += benchmarkPCA(repeat=repeat)
+    return {"environment": environment(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "shape": list(data.shape),
+            "mcashape": list(mcaShape),
+            "repeat": repeat,
+            "benchmarks": results}
+
+
+def _parseShape(arg):
+    return tuple(int(n) for n in arg.lower().split("x"))
+
+
+def main():
+    options = ''
+    longoptions = ['shape=', 'mcashape=', 'repeat=', 'benchmarks=',
+                   'output=', 'debug=']
+    shape = 20, 50
+    mcaShape = 4, 5
+    repeat = 3
+    benchmarks = None
+    output = None
+    debug = 0
+    opts, args = getopt.getopt(sys.argv[1:], options, longoptions)
+    for opt, arg in opts:
+        if opt == '--shape':
+            shape = _parseShape(arg)
+        elif opt == '--mcashape':
+            mcaShape = _parseShape(arg)
+        elif opt == '--repeat':
+            repeat = int(arg)
+        elif opt == '--benchmarks':
+            benchmarks = arg.split(",")
+        elif opt == '--output':
+            output = arg
+        elif opt == '--debug':
+            debug = int(arg)
+
+    logging.basicConfig()
+    if debug:
+        _logger.setLevel(logging.DEBUG)
+    else:
+        _logger.setLevel(logging.INFO)
+
+    results = run(benchmarks=benchmarks, shape=shape, mcaShape=mcaShape,
+                  repeat=repeat)
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()